@@ -0,0 +1,198 @@
+# benchmarks/fake_llm_server.py
+"""
+供性能测试使用的本地 LLM 替身服务器，兼容 Ollama (/api/chat) 与 DashScope
+(/api/v1/services/aigc/text-generation/generation) 的非流式接口。
+
+延迟 = 首 token 延迟 (按配置的分布抽样) + 输出 token 数 / token 速率；可按比例注入错误响应。
+评估调用 (任一消息中要求输出 evaluation_summary) 返回符合 EVALUATION_REPORT_SCHEMA 的 JSON 报告，其余调用返回一段提示词文本。
+"""
+import json
+import math
+import random
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+OLLAMA_PATH = "/api/chat"
+DASHSCOPE_PATH = "/api/v1/services/aigc/text-generation/generation"
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "lognormal")
+
+_WORDS = [
+    "角色", "目标", "背景", "约束", "步骤", "示例", "输出格式", "语气", "受众", "评价标准",
+    "细节", "边界条件", "术语", "结构", "清晰", "具体", "完整", "简洁", "上下文", "检查",
+]
+
+
+@dataclass
+class FakeLLMConfig:
+    """
+    Args:
+        latency_ms (float): 首 token 延迟的中位数 (毫秒)。
+        latency_distribution (str): "fixed"、"uniform" (0 到 2 倍中位数之间均匀分布) 或 "lognormal" (长尾)。
+        latency_sigma (float): lognormal 分布的对数标准差，越大尾部越长。
+        tokens_per_second (float): 输出 token 的生成速率，0 表示一次性返回。
+        output_tokens (int): 每次响应的输出 token 数 (评估报告的长度固定，不受此项影响)。
+        error_rate (float): 以该概率返回 error_status 错误响应。
+        error_status (int): 注入的错误状态码，例如 500 (可重试) 或 400 (不可重试)。
+        seed (int | None): 随机数种子，便于复现。
+    """
+    latency_ms: float = 200.0
+    latency_distribution: str = "lognormal"
+    latency_sigma: float = 0.5
+    tokens_per_second: float = 0.0
+    output_tokens: int = 120
+    error_rate: float = 0.0
+    error_status: int = 500
+    seed: int | None = None
+
+
+class FakeLLMServer:
+    """
+    在后台线程中运行的替身服务器 (每个请求一个线程，模拟上游可同时处理任意多个请求)。
+    可作为上下文管理器使用；stats() 返回收到的请求数与注入的错误数。
+    """
+
+    def __init__(self, config: FakeLLMConfig | None = None, host: str = "127.0.0.1", port: int = 0):
+        self.config = config or FakeLLMConfig()
+        if self.config.latency_distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"不支持的延迟分布: {self.config.latency_distribution}")
+        self._random = random.Random(self.config.seed)
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "errors_injected": 0, "evaluations": 0}
+        self._httpd = ThreadingHTTPServer((host, port), _make_handler(self))
+        self._httpd.daemon_threads = True
+        self._thread: threading.Thread | None = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeLLMServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="fake-llm-server", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def __enter__(self) -> "FakeLLMServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self._stats = {key: 0 for key in self._stats}
+
+    # --- 响应生成 ---
+    def _sample(self, is_evaluation: bool) -> tuple[float, bool, int, list[str]]:
+        # 随机数生成器不是线程安全的，统一在锁内抽样
+        config = self.config
+        with self._lock:
+            self._stats["requests"] += 1
+            if config.latency_distribution == "fixed":
+                first_token_ms = config.latency_ms
+            elif config.latency_distribution == "uniform":
+                first_token_ms = self._random.uniform(0, 2 * config.latency_ms)
+            else:
+                first_token_ms = self._random.lognormvariate(math.log(max(config.latency_ms, 1e-3)), config.latency_sigma)
+            failed = self._random.random() < config.error_rate
+            if failed:
+                self._stats["errors_injected"] += 1
+            elif is_evaluation:
+                self._stats["evaluations"] += 1
+            score = self._random.randint(2, 4)
+            words = [self._random.choice(_WORDS) for _ in range(config.output_tokens)]
+        return first_token_ms / 1000, failed, score, words
+
+    def respond(self, messages: list[dict]) -> tuple[int, str | None, int, int]:
+        """返回 (状态码, 内容, 输入 token 数, 输出 token 数)，并按配置的延迟阻塞当前线程。"""
+        # 模板的固定前缀作为单独的 system 消息发送，评估要求可能不在最后一条消息中
+        is_evaluation = any("evaluation_summary" in str(message.get("content", "")) for message in messages)
+        delay, failed, score, words = self._sample(is_evaluation)
+        input_tokens = sum(len(str(message.get("content", ""))) for message in messages) // 2 + 1
+        if failed:
+            time.sleep(delay)
+            return self.config.error_status, None, input_tokens, 0
+        content = _evaluation_report(score) if is_evaluation else "优化后的提示词：" + "，".join(words) + "。"
+        output_tokens = self.config.output_tokens if not is_evaluation else len(content) // 2
+        if self.config.tokens_per_second > 0:
+            delay += output_tokens / self.config.tokens_per_second
+        time.sleep(delay)
+        return 200, content, input_tokens, output_tokens
+
+
+def _evaluation_report(score: int) -> str:
+    dimension = {"score": score, "justification": "基准测试生成的评估。"}
+    return json.dumps({
+        "evaluation_summary": {"overall_score": score, "main_strengths": "结构清晰", "main_weaknesses": "缺少示例"},
+        "dimension_scores": {
+            name: dimension for name in ("clarity", "completeness", "specificity_actionability", "faithfulness_consistency")
+        },
+        "potential_risks": {"level": "Low", "description": "无"},
+        "suggestions_for_improvement": ["补充输出示例"],
+    }, ensure_ascii=False)
+
+
+def _make_handler(server: FakeLLMServer):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1" # 保持连接，与真实服务一样让客户端复用连接池
+        disable_nagle_algorithm = True # 响应头与响应体分两次写出，否则与客户端的延迟确认叠加出约 40ms 的额外延迟
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            try:
+                payload = json.loads(self.rfile.read(length) or b"{}")
+            except json.JSONDecodeError:
+                self._send_json(400, {"error": "invalid json"})
+                return
+            if self.path == OLLAMA_PATH:
+                self._ollama(payload)
+            elif self.path.rstrip("/") == DASHSCOPE_PATH:
+                self._dashscope(payload)
+            else:
+                self._send_json(404, {"error": f"unknown path {self.path}"})
+
+        def _ollama(self, payload: dict):
+            status, content, input_tokens, output_tokens = server.respond(payload.get("messages") or [])
+            if content is None:
+                self._send_json(status, {"error": "injected error"})
+                return
+            self._send_json(200, {
+                "model": payload.get("model"), "message": {"role": "assistant", "content": content}, "done": True,
+                "prompt_eval_count": input_tokens, "eval_count": output_tokens,
+            })
+
+        def _dashscope(self, payload: dict):
+            status, content, input_tokens, output_tokens = server.respond((payload.get("input") or {}).get("messages") or [])
+            if content is None:
+                self._send_json(status, {"request_id": "fake", "code": "InternalError", "message": "injected error"})
+                return
+            self._send_json(200, {
+                "request_id": "fake",
+                "output": {"choices": [{"finish_reason": "stop", "message": {"role": "assistant", "content": content}}]},
+                "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens},
+            })
+
+        def _send_json(self, status: int, data: dict):
+            body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args): # 不把每个请求打印到 stderr
+            pass
+
+    return Handler
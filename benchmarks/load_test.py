@@ -0,0 +1,334 @@
+# benchmarks/load_test.py
+"""
+端到端负载与延迟基准：启动本地 LLM 替身服务器 (benchmarks/fake_llm_server.py)，按递增的并发度驱动
+generate_and_refine_prompt (target=pipeline) 或运行在本进程中的 FastAPI 应用 (target=api)，
+输出每个并发度的吞吐量、p50/p95/p99 延迟与资源使用 (JSON)。
+
+    python -m benchmarks.load_test --target api --concurrency 1,4,16 --requests-per-level 40 -o load.json
+
+所有请求都跳过响应缓存，且每个请求的文本不同，因此每次LLM调用都会到达替身服务器。
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+
+import httpx
+
+from benchmarks.fake_llm_server import LATENCY_DISTRIBUTIONS, FakeLLMConfig, FakeLLMServer
+from meta_prompt_agent.config import settings
+
+TARGETS = ("pipeline", "api")
+PROVIDERS = ("ollama", "qwen")
+
+
+@dataclass
+class WorkloadOptions:
+    task_type: str = "通用/问答"
+    enable_self_correction: bool = True
+    max_recursion_depth: int = 1
+    self_correction_mode: str | None = None
+
+
+# --- 统计 ---
+def percentile(values: list[float], q: float) -> float | None:
+    """线性插值的百分位数 (q 取 0-100)；values 为空时返回 None。"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * q / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize_latencies(latencies_ms: list[float]) -> dict:
+    def rounded(value):
+        return round(value, 1) if value is not None else None
+    return {
+        "p50": rounded(percentile(latencies_ms, 50)),
+        "p95": rounded(percentile(latencies_ms, 95)),
+        "p99": rounded(percentile(latencies_ms, 99)),
+        "mean": rounded(sum(latencies_ms) / len(latencies_ms)) if latencies_ms else None,
+        "max": rounded(max(latencies_ms)) if latencies_ms else None,
+    }
+
+
+def _current_rss_bytes() -> int | None:
+    try:
+        with open("/proc/self/statm") as f: # 仅 Linux；其他平台只报告 ru_maxrss
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class ResourceSampler:
+    """在一个并发度运行期间定期采样本进程的内存与线程数，并统计 CPU 时间。"""
+
+    def __init__(self, interval_seconds: float = 0.05):
+        self.interval_seconds = interval_seconds
+        self.peak_rss_bytes: int | None = None
+        self.peak_threads = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="resource-sampler", daemon=True)
+
+    def _sample(self) -> None:
+        rss = _current_rss_bytes()
+        if rss is not None:
+            self.peak_rss_bytes = max(self.peak_rss_bytes or 0, rss)
+        self.peak_threads = max(self.peak_threads, threading.active_count())
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval_seconds):
+            self._sample()
+
+    def __enter__(self) -> "ResourceSampler":
+        self._cpu_started = time.process_time()
+        self._wall_started = time.perf_counter()
+        self._sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stopped.set()
+        self._thread.join()
+        self._sample()
+        self.cpu_seconds = time.process_time() - self._cpu_started
+        self.wall_seconds = time.perf_counter() - self._wall_started
+
+    def to_dict(self) -> dict:
+        return {
+            "cpu_seconds": round(self.cpu_seconds, 3),
+            "cpu_utilization": round(self.cpu_seconds / self.wall_seconds, 3) if self.wall_seconds else None,
+            "peak_rss_mb": round(self.peak_rss_bytes / 2**20, 1) if self.peak_rss_bytes else None,
+            "peak_threads": self.peak_threads,
+        }
+
+
+# --- 把提供者指向替身服务器 ---
+@contextlib.contextmanager
+def use_fake_provider(provider: str, base_url: str):
+    """在该上下文中让 provider 的请求发往替身服务器，并关闭跨请求的复用 (缓存、多提供者路由)，退出时恢复设置。"""
+    overrides = {
+        "ACTIVE_LLM_PROVIDER": provider, "LLM_ROUTER_PROVIDERS": [], "LLM_CACHE_ENABLED": False,
+        "OLLAMA_API_URL": f"{base_url}/api/chat",
+        "QWEN_API_BASE_URL": f"{base_url}/api/v1",
+        "QWEN_API_KEY_FROM_ENV": settings.QWEN_API_KEY_FROM_ENV or "benchmark-key",
+    }
+    saved = {name: getattr(settings, name) for name in overrides}
+    import dashscope # 同步版本通过 DashScope SDK 调用，其地址是模块级设置
+    saved_dashscope_url = dashscope.base_http_api_url
+    for name, value in overrides.items():
+        setattr(settings, name, value)
+    dashscope.base_http_api_url = f"{base_url}/api/v1"
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(settings, name, value)
+        dashscope.base_http_api_url = saved_dashscope_url
+
+
+def _request_text(level: int, index: int) -> str:
+    return f"基准测试请求 {level}-{index}：为一场新产品发布会写一段面向开发者的开场白。"
+
+
+# --- 负载驱动 ---
+def run_pipeline_level(concurrency: int, num_requests: int, workload: WorkloadOptions) -> list[tuple[float, bool]]:
+    """以 concurrency 个线程直接调用 generate_and_refine_prompt，返回每个请求的 (延迟毫秒, 是否成功)。"""
+    from meta_prompt_agent.core.agent import generate_and_refine_prompt
+
+    def one(index: int) -> tuple[float, bool]:
+        started = time.perf_counter()
+        results = generate_and_refine_prompt(
+            _request_text(concurrency, index), workload.task_type, workload.enable_self_correction,
+            workload.max_recursion_depth, use_cache=False, self_correction_mode=workload.self_correction_mode,
+        )
+        return (time.perf_counter() - started) * 1000, not results.get("error_message")
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(one, range(num_requests)))
+
+
+def _api_request(level: int, index: int, workload: WorkloadOptions) -> tuple[str, dict]:
+    # 不做自我校正时走 /generate-simple-p1，否则以单条目的 /generate-batch 运行完整流程
+    if not workload.enable_self_correction:
+        return "/generate-simple-p1", {"raw_request": _request_text(level, index), "task_type": workload.task_type, "use_cache": False}
+    item = {
+        "raw_request": _request_text(level, index), "task_type": workload.task_type, "use_cache": False,
+        "enable_self_correction": True, "max_recursion_depth": workload.max_recursion_depth,
+        "self_correction_mode": workload.self_correction_mode,
+    }
+    return "/generate-batch", {"items": [item]}
+
+
+def _api_succeeded(response: httpx.Response) -> bool:
+    if response.status_code != 200:
+        return False
+    data = response.json()
+    return all(item["status"] == "ok" for item in data["results"]) if "results" in data else True
+
+
+async def _run_api_level_async(base_url: str, concurrency: int, num_requests: int, workload: WorkloadOptions):
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=600) as client:
+        async def one(index: int) -> tuple[float, bool]:
+            path, body = _api_request(concurrency, index, workload)
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    response = await client.post(path, json=body)
+                    ok = _api_succeeded(response)
+                except httpx.HTTPError:
+                    ok = False
+                return (time.perf_counter() - started) * 1000, ok
+        return list(await asyncio.gather(*(one(index) for index in range(num_requests))))
+
+
+def run_api_level(base_url: str, concurrency: int, num_requests: int, workload: WorkloadOptions) -> list[tuple[float, bool]]:
+    """以 concurrency 个并发的 HTTP 客户端请求 API，返回每个请求的 (延迟毫秒, 是否成功)。"""
+    return asyncio.run(_run_api_level_async(base_url, concurrency, num_requests, workload))
+
+
+@contextlib.contextmanager
+def serve_api(host: str = "127.0.0.1", port: int = 0):
+    """在后台线程中用 uvicorn 运行 FastAPI 应用 (与基准同一进程，因此共享替身服务器的设置)，产出其地址。"""
+    import socket
+    import uvicorn
+    from meta_prompt_agent.api.main import app
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    server = uvicorn.Server(uvicorn.Config(app, log_level="warning", access_log=False))
+    thread = threading.Thread(target=server.run, kwargs={"sockets": [sock]}, name="benchmark-api", daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 30
+    while not server.started:
+        if not thread.is_alive() or time.monotonic() > deadline:
+            raise RuntimeError("API 服务器未能启动。")
+        time.sleep(0.01)
+    try:
+        yield f"http://{host}:{sock.getsockname()[1]}"
+    finally:
+        server.should_exit = True
+        thread.join(timeout=30)
+        sock.close()
+
+
+def _level_report(concurrency: int, outcomes: list[tuple[float, bool]], resources: ResourceSampler, upstream: dict) -> dict:
+    latencies = [latency for latency, ok in outcomes if ok]
+    failed = sum(1 for _, ok in outcomes if not ok)
+    return {
+        "concurrency": concurrency,
+        "requests": len(outcomes),
+        "succeeded": len(outcomes) - failed,
+        "failed": failed,
+        "duration_s": round(resources.wall_seconds, 3),
+        "throughput_rps": round(len(latencies) / resources.wall_seconds, 3) if resources.wall_seconds else None,
+        "latency_ms": summarize_latencies(latencies),
+        "resources": resources.to_dict(),
+        "upstream": upstream,
+    }
+
+
+def run_benchmark(
+    target: str = "pipeline", provider: str = "ollama", levels: list[int] = (1, 2, 4, 8),
+    requests_per_level: int = 20, server_config: FakeLLMConfig | None = None,
+    workload: WorkloadOptions | None = None, warmup_requests: int = 2,
+) -> dict:
+    """
+    依次以 levels 中的每个并发度发送 requests_per_level 个请求 (成功请求才计入延迟分布与吞吐量)，返回报告。
+    每个并发度开始前先发送 warmup_requests 个不计入统计的请求，以建立连接池和共享客户端。
+    """
+    if target not in TARGETS:
+        raise ValueError(f"不支持的 target: {target}")
+    if provider not in PROVIDERS:
+        raise ValueError(f"不支持的 provider: {provider}")
+    server_config = server_config or FakeLLMConfig()
+    workload = workload or WorkloadOptions()
+    report = {
+        "benchmark": "load",
+        "target": target,
+        "provider": provider,
+        "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpu_count": os.cpu_count()},
+        "fake_server": asdict(server_config),
+        "workload": asdict(workload),
+        "levels": [],
+    }
+    with FakeLLMServer(server_config) as fake, use_fake_provider(provider, fake.base_url), \
+            (serve_api() if target == "api" else contextlib.nullcontext()) as api_url:
+        def drive(concurrency: int, num_requests: int):
+            if target == "api":
+                return run_api_level(api_url, concurrency, num_requests, workload)
+            return run_pipeline_level(concurrency, num_requests, workload)
+
+        for concurrency in levels:
+            if warmup_requests:
+                drive(min(concurrency, warmup_requests), warmup_requests)
+            fake.reset_stats()
+            with ResourceSampler() as resources:
+                outcomes = drive(concurrency, requests_per_level)
+            report["levels"].append(_level_report(concurrency, outcomes, resources, fake.stats()))
+    return report
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.load_test", description="使用本地 LLM 替身服务器的端到端负载基准。")
+    parser.add_argument("--target", choices=TARGETS, default="pipeline", help="直接驱动流水线，或通过 HTTP 请求 FastAPI 应用。")
+    parser.add_argument("--provider", choices=PROVIDERS, default="ollama", help="替身服务器模拟的提供者接口。")
+    parser.add_argument("--concurrency", default="1,2,4,8", help="逗号分隔的并发度，依次运行。")
+    parser.add_argument("--requests-per-level", type=int, default=20, help="每个并发度发送的请求数。")
+    parser.add_argument("--warmup", type=int, default=2, help="每个并发度开始前不计入统计的请求数。")
+    parser.add_argument("--latency-ms", type=float, default=200.0, help="上游首 token 延迟的中位数。")
+    parser.add_argument("--latency-distribution", choices=LATENCY_DISTRIBUTIONS, default="lognormal")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="lognormal 分布的对数标准差。")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0, help="上游输出 token 的速率 (0 表示一次性返回)。")
+    parser.add_argument("--output-tokens", type=int, default=120, help="每次响应的输出 token 数。")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="注入错误响应的比例。")
+    parser.add_argument("--error-status", type=int, default=500, help="注入错误响应的状态码。")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--no-self-correction", action="store_true", help="只生成 P1。")
+    parser.add_argument("--rounds", type=int, default=1, help="自我校正的最大轮数。")
+    parser.add_argument("--self-correction-mode", choices=("sequential", "best_of_n"), default=None)
+    parser.add_argument("-o", "--output", help="把 JSON 报告写入文件 (默认输出到标准输出)。")
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    report = run_benchmark(
+        target=args.target, provider=args.provider,
+        levels=[int(level) for level in args.concurrency.split(",") if level.strip()],
+        requests_per_level=args.requests_per_level, warmup_requests=args.warmup,
+        server_config=FakeLLMConfig(
+            latency_ms=args.latency_ms, latency_distribution=args.latency_distribution, latency_sigma=args.latency_sigma,
+            tokens_per_second=args.tokens_per_second, output_tokens=args.output_tokens,
+            error_rate=args.error_rate, error_status=args.error_status, seed=args.seed,
+        ),
+        workload=WorkloadOptions(
+            enable_self_correction=not args.no_self_correction, max_recursion_depth=args.rounds,
+            self_correction_mode=args.self_correction_mode,
+        ),
+    )
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0 if all(level["failed"] == 0 for level in report["levels"]) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,264 @@
+# benchmarks/microbench.py
+"""
+热路径辅助函数的微基准与回归门禁：每个请求都会执行的 clean_llm_output、load_and_format_structured_prompt、
+评估报告的 JSON 解析与修复、近似重复索引的查找与插入，以及大模板 (CORE_META_PROMPT_TEMPLATE / EVALUATION_META_PROMPT_TEMPLATE) 的格式化。
+
+    python -m benchmarks.microbench                       # 与存储的基准比较，有回归时退出码为 1，找不到基准文件时为 2
+    python -m benchmarks.microbench --update-baseline     # 重新记录基准 (只运行部分用例时合并进已有基准)
+
+每个用例的耗时除以紧挨着它测得的校准循环耗时后再与基准比较，以抵消不同机器之间的整体速度差异。
+运行期间关闭 WARNING 及以下级别的日志，只测量函数本身。
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import sys
+import timeit
+from datetime import datetime, timezone
+from typing import Callable
+
+from meta_prompt_agent.core import agent
+from meta_prompt_agent.core.near_duplicate import NearDuplicateIndex
+from meta_prompt_agent.prompts.templates import CORE_META_PROMPT_TEMPLATE, EVALUATION_META_PROMPT_TEMPLATE
+
+DEFAULT_BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baselines", "microbench.json")
+DEFAULT_THRESHOLD = 0.3 # 归一化耗时比基准慢 30% 以上视为回归
+
+
+# --- 真实规模的输入 ---
+def _paragraphs(count: int, sentence: str) -> str:
+    return "\n\n".join(f"{index + 1}. {sentence * 3}" for index in range(count))
+
+
+def _nested_think_output() -> str:
+    # 约 8KB 的模型输出：多段思考过程 (含嵌套的 <<think>> 块) 之后才是最终提示词
+    thinking = _paragraphs(12, "先分析用户的真实意图，再列出需要补充的约束条件与输出格式。")
+    inner = f"<<think>>\n{thinking}\n<<think>>\n{thinking}\n<</think>>\n{thinking}\n<</think>>\n"
+    final = _paragraphs(15, "你是一名资深技术写作者，请围绕用户的主题给出结构清晰、可执行的说明。")
+    return inner * 2 + final
+
+
+def _unclosed_think_output() -> str:
+    return "<<think>>\n" + _paragraphs(40, "模型的输出在思考阶段被截断，没有闭合标记。")
+
+
+def _evaluation_report(score: int = 3) -> dict:
+    dimension = {"score": score, "justification": "提示词结构清晰，但缺少输出格式的具体示例。" * 3}
+    return {
+        "evaluation_summary": {"overall_score": score, "main_strengths": "结构清晰、角色明确", "main_weaknesses": "缺少示例"},
+        "dimension_scores": {
+            name: dimension for name in ("clarity", "completeness", "specificity_actionability", "faithfulness_consistency")
+        },
+        "potential_risks": {"level": "Low", "description": "可能遗漏边界条件。"},
+        "suggestions_for_improvement": [f"建议 {index}: 补充一个完整的输入输出示例。" for index in range(8)],
+    }
+
+
+def _damaged_evaluation_output() -> str:
+    # 代码块标记、前后说明文字、末尾逗号，并在最后一个数组中被截断
+    text = json.dumps(_evaluation_report(), ensure_ascii=False, indent=2).replace("\n  }", ",\n  }")
+    return "以下是评估报告：\n```json\n" + text[: int(len(text) * 0.9)]
+
+
+def _near_duplicate_index(requests: list[str]) -> NearDuplicateIndex:
+    index = NearDuplicateIndex(threshold=0.85)
+    for request in requests:
+        index.add(("通用/问答", "", "{}"), request, "P1")
+    return index
+
+
+def build_cases() -> dict[str, Callable[[], object]]:
+    """返回 {用例名: 无参函数}。输入在这里一次性构造，不计入测得的耗时。"""
+    nested_output = _nested_think_output()
+    unclosed_output = _unclosed_think_output()
+    plain_output = _paragraphs(30, "请根据以下要求撰写一份面向初学者的教程。")
+    user_request = _paragraphs(10, "帮我写一个函数，读取 CSV 文件并按列统计缺失值，结果输出为 Markdown 表格。")
+    p1_prompt = agent.clean_llm_output(nested_output)
+    clean_report = json.dumps(_evaluation_report(), ensure_ascii=False)
+    damaged_report = _damaged_evaluation_output()
+    code_vars = {
+        "programming_language": "Python", "function_name": "summarize_missing", "input_params": "path: str",
+        "return_value": "str", "algorithms_steps": "读取、统计、格式化", "error_handling": "文件不存在时抛出异常",
+        "documentation_level": "详细", "dependencies": "pandas", "code_style": "PEP 8", "include_tests": "是",
+    }
+    # 约 130 字的请求；查找只访问 bands 个桶，索引规模不影响耗时，因此只预先插入少量条目
+    rng = random.Random(0)
+    alphabet = "帮我写一个函数读取文件并按列统计缺失值结果输出为表格请总结论文的主要贡献"
+    known_requests = ["".join(rng.choice(alphabet) for _ in range(130)) for _ in range(2000)]
+    near_duplicate_index = _near_duplicate_index(known_requests)
+    new_request = "".join(rng.choice(alphabet) for _ in range(130))
+    return {
+        "clean_llm_output.nested_think": lambda: agent.clean_llm_output(nested_output),
+        "clean_llm_output.unclosed_think": lambda: agent.clean_llm_output(unclosed_output),
+        "clean_llm_output.plain": lambda: agent.clean_llm_output(plain_output),
+        "load_and_format_structured_prompt": lambda: agent.load_and_format_structured_prompt(
+            "DetailedCodeFunction", user_request, code_vars,
+        ),
+        "parse_evaluation_report.valid": lambda: agent._parse_evaluation_report(clean_report, 1),
+        "parse_evaluation_report.repair": lambda: agent._parse_evaluation_report(damaged_report, 1),
+        "near_duplicate.query": lambda: near_duplicate_index.query(("通用/问答", "", "{}"), known_requests[7]),
+        "near_duplicate.signature": lambda: near_duplicate_index.signature(new_request),
+        "format.core_meta_prompt": lambda: CORE_META_PROMPT_TEMPLATE.format(user_raw_request=user_request),
+        "format.evaluation_meta_prompt": lambda: EVALUATION_META_PROMPT_TEMPLATE.format(
+            user_raw_request=user_request, prompt_to_evaluate=p1_prompt,
+        ),
+    }
+
+
+def _calibration() -> int:
+    # 与被测函数相近的纯 Python 字符串与字典操作，用于归一化
+    total = 0
+    for index in range(200):
+        text = f"校准 {index} " * 4
+        total += len(text.strip().split(" ")) + len({"key": text}.get("key", ""))
+    return total
+
+
+def measure(func: Callable[[], object], repeats: int = 5, min_time: float = 0.2) -> dict:
+    """
+    先用 autorange 选出总耗时不少于 min_time 秒的循环次数，再重复 repeats 次，
+    返回单次调用耗时 (微秒) 的最小值与中位数。比较时使用最小值，它受调度与其他进程干扰最小。
+    """
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    if elapsed < min_time:
+        number = max(1, int(number * min_time / max(elapsed, 1e-9)))
+    samples = [seconds / number * 1e6 for seconds in timer.repeat(repeat=repeats, number=number)]
+    return {"min_us": round(min(samples), 3), "median_us": round(statistics.median(samples), 3), "loops": number}
+
+
+def run_suite(selected: list[str] | None = None, repeats: int = 5, min_time: float = 0.2) -> dict:
+    cases = build_cases()
+    unknown = set(selected or []) - set(cases)
+    if unknown:
+        raise ValueError(f"未知的用例: {sorted(unknown)}")
+    previous_disable = logging.root.manager.disable
+    logging.disable(logging.WARNING)
+    try:
+        results = {}
+        calibrations = []
+        for name, func in cases.items():
+            if selected and name not in selected:
+                continue
+            # 紧挨着每个用例重新校准，机器速度在运行过程中的波动 (频率调整、其他负载) 会同时作用于两者
+            calibration = measure(_calibration, repeats, min_time)
+            result = measure(func, repeats, min_time)
+            result["normalized"] = round(result["min_us"] / calibration["min_us"], 4)
+            results[name] = result
+            calibrations.append(calibration["min_us"])
+    finally:
+        logging.disable(previous_disable)
+    return {
+        "benchmark": "microbench",
+        "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "environment": {"python": platform.python_version(), "platform": platform.platform()},
+        "calibration_us": round(statistics.median(calibrations), 3) if calibrations else None,
+        "cases": results,
+    }
+
+
+def compare_to_baseline(report: dict, baseline: dict, threshold: float = DEFAULT_THRESHOLD) -> list[dict]:
+    """
+    比较每个用例的归一化耗时，返回比基准慢超过 threshold 的用例列表。
+    基准中没有的用例不参与比较 (新增用例需要先更新基准)。
+    """
+    regressions = []
+    for name, result in report["cases"].items():
+        reference = baseline.get("cases", {}).get(name)
+        if not reference:
+            continue
+        ratio = result["normalized"] / reference["normalized"]
+        result["vs_baseline"] = round(ratio, 3)
+        if ratio > 1 + threshold:
+            regressions.append({"case": name, "ratio": round(ratio, 3), "baseline": reference["normalized"], "current": result["normalized"]})
+    return regressions
+
+
+def check_regressions(
+    report: dict, baseline: dict, threshold: float = DEFAULT_THRESHOLD, repeats: int = 5, min_time: float = 0.2,
+) -> list[dict]:
+    """与基准比较；超出阈值的用例重新测量一次，两次都超出才算回归，避免偶发的干扰使门禁失败。"""
+    suspects = compare_to_baseline(report, baseline, threshold)
+    if not suspects:
+        return []
+    rerun = run_suite([suspect["case"] for suspect in suspects], repeats=repeats, min_time=min_time)
+    confirmed = {regression["case"] for regression in compare_to_baseline(rerun, baseline, threshold)}
+    return [suspect for suspect in suspects if suspect["case"] in confirmed]
+
+
+def load_baseline(path: str) -> dict | None:
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_baseline(reports: list[dict], path: str) -> None:
+    """
+    把多次运行中每个用例归一化耗时的中位数写为基准，单次运行偶然偏快或偏慢都不会进入基准。
+    已有基准中本次没有运行的用例原样保留。
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    cases = dict((load_baseline(path) or {}).get("cases", {}))
+    for name in reports[0]["cases"]:
+        runs = [report["cases"][name] for report in reports]
+        cases[name] = {
+            "min_us": round(statistics.median(run["min_us"] for run in runs), 3),
+            "normalized": round(statistics.median(run["normalized"] for run in runs), 4),
+        }
+    baseline = {
+        "recorded_at": reports[0]["started_at"], "environment": reports[0]["environment"], "runs": len(reports),
+        "calibration_us": round(statistics.median(report["calibration_us"] for report in reports), 3),
+        "cases": cases,
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(baseline, f, ensure_ascii=False, indent=2)
+        f.write("\n")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.microbench", description="热路径辅助函数的微基准与回归门禁。")
+    parser.add_argument("cases", nargs="*", help="只运行指定的用例 (默认全部)。")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_PATH, help="基准文件路径。")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="允许的变慢比例，例如 0.3 表示 30%%。")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2, help="每次重复的最短总耗时 (秒)。")
+    parser.add_argument("--update-baseline", action="store_true", help="重新记录基准，不做比较。")
+    parser.add_argument("--baseline-runs", type=int, default=3, help="记录基准时运行的次数 (取中位数)。")
+    parser.add_argument("-o", "--output", help="把 JSON 报告写入文件 (默认输出到标准输出)。")
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    report = run_suite(args.cases or None, repeats=args.repeats, min_time=args.min_time)
+    exit_code = 0
+    if args.update_baseline:
+        extra_runs = [run_suite(args.cases or None, repeats=args.repeats, min_time=args.min_time) for _ in range(args.baseline_runs - 1)]
+        save_baseline([report, *extra_runs], args.baseline)
+    else:
+        baseline = load_baseline(args.baseline)
+        if baseline is None: # 路径写错时不能让门禁静默通过
+            print(f"未找到基准文件 {args.baseline}，请先使用 --update-baseline 记录。", file=sys.stderr)
+            exit_code = 2
+        else:
+            report["threshold"] = args.threshold
+            report["regressions"] = check_regressions(report, baseline, args.threshold, args.repeats, args.min_time)
+            exit_code = 1 if report["regressions"] else 0
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    for regression in report.get("regressions", []):
+        print(f"回归: {regression['case']} 比基准慢 {regression['ratio']:.2f} 倍", file=sys.stderr)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -80,10 +80,12 @@ function App() {
     const signal = abortControllerRef.current.signal;
 
     try {
-      const response = await fetch('/api/generate-simple-p1', {
+      // 使用SSE流式端点：LLM生成的内容会逐块显示，而不是等待整个提示生成完毕
+      const response = await fetch('/api/generate-simple-p1/stream', {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
+          'Accept': 'text/event-stream',
         },
         body: JSON.stringify({
           raw_request: rawRequest,
@@ -98,16 +100,52 @@ function App() {
         return;
       }
 
-      if (!response.ok) {
+      if (!response.ok || !response.body) {
         const errorData = await response.json().catch(() => ({ detail: `HTTP错误: ${response.status}` }));
         throw new Error(errorData.detail || `请求失败，状态码: ${response.status}`);
       }
 
-      const data = await response.json();
-      if (data.p1_prompt) {
-        setP1Prompt(data.p1_prompt);
-      } else {
-        throw new Error('从API返回的数据格式不正确，缺少p1_prompt字段。');
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      let streamedText = '';
+      let finished = false;
+
+      while (!finished) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // SSE 事件之间以空行分隔
+        let separatorIndex;
+        while ((separatorIndex = buffer.indexOf('\n\n')) !== -1) {
+          const rawEvent = buffer.slice(0, separatorIndex);
+          buffer = buffer.slice(separatorIndex + 2);
+
+          let eventName = 'message';
+          let dataText = '';
+          for (const line of rawEvent.split('\n')) {
+            if (line.startsWith('event:')) eventName = line.slice(6).trim();
+            else if (line.startsWith('data:')) dataText += line.slice(5).trim();
+          }
+          if (!dataText) continue;
+          const data = JSON.parse(dataText);
+
+          if (eventName === 'token') {
+            streamedText += data.text;
+            setP1Prompt(streamedText);
+          } else if (eventName === 'done') {
+            // 完成事件携带已去除思考标记的最终提示
+            setP1Prompt(data.p1_prompt);
+            finished = true;
+          } else if (eventName === 'error') {
+            throw new Error(data.detail || '生成提示时发生错误');
+          }
+        }
+      }
+
+      if (!finished) {
+        throw new Error('连接在提示生成完成前中断。');
       }
 
     } catch (err) {
@@ -0,0 +1,49 @@
+# src/meta_prompt_agent/__main__.py
+"""
+命令行批处理入口：python -m meta_prompt_agent INPUT.jsonl -o OUTPUT.jsonl
+
+输入每行一个请求 (字段与 API 的 /generate-batch 条目相同)，结果按完成顺序写入输出 JSONL。
+中断后使用相同的命令重新运行即可从检查点继续。
+"""
+import argparse
+import json
+import sys
+
+from meta_prompt_agent.config import settings
+from meta_prompt_agent.config.logging_config import setup_logging
+from meta_prompt_agent.core import batch_runner, tracing
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m meta_prompt_agent", description="批量生成并精炼提示 (JSONL 输入/输出)。")
+    parser.add_argument("input", help="输入 JSONL 文件，每行一个请求，raw_request 为必填字段。")
+    parser.add_argument("-o", "--output", required=True, help="输出 JSONL 文件，同时作为断点续跑的检查点。")
+    parser.add_argument("--p1-workers", type=int, default=settings.BATCH_P1_WORKERS, help="P1 生成阶段的线程数。")
+    parser.add_argument("--eval-workers", type=int, default=settings.BATCH_EVALUATION_WORKERS, help="评估阶段的线程数。")
+    parser.add_argument("--refine-workers", type=int, default=settings.BATCH_REFINEMENT_WORKERS, help="精炼阶段的线程数。")
+    parser.add_argument("--max-in-flight", type=int, default=None, help="同时处理的请求数上限 (默认为总线程数的两倍)。")
+    parser.add_argument("--checkpoint-every", type=int, default=settings.BATCH_CHECKPOINT_EVERY, help="每写入多少条结果落盘一次。")
+    parser.add_argument("--no-cache", action="store_true", help="跳过响应缓存与近似重复复用。")
+    parser.add_argument("--restart", action="store_true", help="忽略已有输出，从头开始 (会覆盖输出文件)。")
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    setup_logging(filters=[tracing.TraceContextFilter()])
+    summary = batch_runner.run_jsonl_batch(
+        args.input, args.output,
+        workers={
+            batch_runner.STAGE_P1: args.p1_workers,
+            batch_runner.STAGE_EVALUATION: args.eval_workers,
+            batch_runner.STAGE_REFINEMENT: args.refine_workers,
+        },
+        max_in_flight=args.max_in_flight, use_cache=not args.no_cache,
+        resume=not args.restart, checkpoint_every=args.checkpoint_every,
+    )
+    print(json.dumps(summary, ensure_ascii=False))
+    return 0 if summary["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,27 @@
 # src/meta_prompt_agent/api/main.py
+import asyncio
 import logging
-from fastapi import FastAPI, HTTPException
+import time
+from contextlib import asynccontextmanager
+from typing import Literal
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware 
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel, Field 
 import uvicorn 
 import json 
 
+from meta_prompt_agent.config import settings # 配置模块不依赖核心逻辑，请求模型的校验上限需要它
+
 try:
     from meta_prompt_agent.core.agent import generate_and_refine_prompt, explain_term_in_prompt # 1. 导入 explain_term_in_prompt
+    # 端点使用异步版本，避免慢速LLM调用阻塞事件循环
+    from meta_prompt_agent.core.agent import generate_and_refine_prompt_async, explain_term_in_prompt_async
+    from meta_prompt_agent.core.agent import stream_p1_prompt_async
+    from meta_prompt_agent.core import transport, client_registry, single_flight, response_cache, provider_router, resilience, rate_limit
+    from meta_prompt_agent.core import service_metrics, tracing, template_registry
     from meta_prompt_agent.config.logging_config import setup_logging 
     # setup_logging() # 考虑在应用启动时配置
 except ImportError as e:
@@ -16,15 +30,52 @@ except ImportError as e:
         return {"error_message": "核心逻辑(g&r)未正确导入", "p1_initial_optimized_prompt": ""}
     def explain_term_in_prompt(*args, **kwargs): # type: ignore
         return "错误：核心逻辑(explain)未正确导入", {"type": "ImportError", "details": str(e)}
+    async def generate_and_refine_prompt_async(*args, **kwargs): # type: ignore
+        return generate_and_refine_prompt(*args, **kwargs)
+    async def explain_term_in_prompt_async(*args, **kwargs): # type: ignore
+        return explain_term_in_prompt(*args, **kwargs)
+    async def stream_p1_prompt_async(*args, **kwargs): # type: ignore
+        yield "error", ("核心逻辑(stream)未正确导入", {"type": "ImportError", "details": str(e)})
+    transport = None # type: ignore
+    client_registry = None # type: ignore
+    single_flight = None # type: ignore
+    response_cache = None # type: ignore
+    provider_router = None # type: ignore
+    resilience = None # type: ignore
+    rate_limit = None # type: ignore
+    service_metrics = None # type: ignore
+    tracing = None # type: ignore
+    template_registry = None # type: ignore
     pass
 
 
 logger = logging.getLogger(__name__) 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 启动时编译全部结构化模板，模板不合法时直接启动失败，而不是在请求中才报错
+    if template_registry is not None:
+        template_registry.get_registry()
+    # 启动时预热客户端，使第一个用户请求不必承担构建开销
+    if client_registry is not None and settings.LLM_WARMUP_ON_STARTUP:
+        await asyncio.to_thread(client_registry.warm_up)
+    # 多 worker 部署时定期写出本进程的指标快照，供任一 worker 的 /metrics 合并
+    if service_metrics is not None:
+        service_metrics.start_flusher()
+    yield
+    if service_metrics is not None:
+        service_metrics.stop_flusher()
+    if tracing is not None:
+        await asyncio.to_thread(tracing.shutdown) # 导出剩余的 span
+    # 关闭时释放异步HTTP客户端持有的 keep-alive 连接
+    if transport is not None:
+        await transport.aclose_async_clients()
+
 app = FastAPI(
     title="Meta-Prompt Agent API",
     description="提供元提示生成与优化服务的API。",
     version="0.1.0",
+    lifespan=lifespan,
 )
 
 # --- CORS 配置 ---
@@ -42,15 +93,89 @@ app.add_middleware(
     allow_headers=["*"],    
 )
 
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    if service_metrics is None or not settings.METRICS_ENABLED or request.url.path == "/metrics":
+        return await call_next(request)
+    started = time.perf_counter()
+    status = 500
+    with service_metrics.HTTP_IN_FLIGHT.track_in_progress():
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return response
+        finally:
+            # 按路由模板而不是实际路径计数，避免标签基数随请求增长
+            route = request.scope.get("route")
+            endpoint = getattr(route, "path", "unmatched")
+            service_metrics.observe_http_request(request.method, endpoint, status, time.perf_counter() - started)
+
+@app.middleware("http")
+async def trace_request(request: Request, call_next):
+    # 后注册的中间件在外层，因此 span 覆盖指标记录；请求头中的 traceparent 会延续调用方的 trace
+    if tracing is None or request.url.path == "/metrics":
+        return await call_next(request)
+    attributes = {"http.method": request.method, "http.target": request.url.path}
+    span = tracing.begin_span(
+        f"{request.method} {request.url.path}", tracing.KIND_SERVER, attributes,
+        traceparent=request.headers.get("traceparent"),
+    )
+    if span is None:
+        return await call_next(request)
+    with tracing.use_span(span):
+        try:
+            response = await call_next(request)
+        except Exception as e:
+            logger.exception(f"处理 {request.method} {request.url.path} 时发生未处理的异常: {e}")
+            response = JSONResponse({"detail": "服务器内部错误。", "trace_id": span.trace_id}, status_code=500)
+    route = getattr(request.scope.get("route"), "path", "unmatched")
+    span.name = f"{request.method} {route}"
+    span.set_attributes({"http.route": route, "http.status_code": response.status_code})
+    span.set_status(tracing.STATUS_ERROR if response.status_code >= 500 else tracing.STATUS_OK)
+    response.headers["X-Trace-Id"] = span.trace_id
+    response.headers["traceparent"] = tracing.format_traceparent(span)
+    if not hasattr(response, "body_iterator"):
+        tracing.end_span(span)
+        return response
+    # call_next 在发送响应头时就返回，流式响应 (SSE / NDJSON) 的响应体随后才生成：span 在响应体发送完毕后结束
+    response.body_iterator = _end_span_after_body(response.body_iterator, span)
+    return response
+
+async def _end_span_after_body(body_iterator, span):
+    try:
+        async for chunk in body_iterator:
+            yield chunk
+    except BaseException as e:
+        span.set_status(tracing.STATUS_ERROR, f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        tracing.end_span(span)
+
+def _error_content(detail) -> dict:
+    # 错误响应带上 trace_id，便于在日志与导出的 trace 中找到对应的请求
+    trace_id = tracing.current_trace_id() if tracing is not None else None
+    return {"detail": detail, "trace_id": trace_id} if trace_id else {"detail": detail}
+
+@app.exception_handler(HTTPException)
+async def http_exception_handler(request: Request, exc: HTTPException):
+    return JSONResponse(_error_content(exc.detail), status_code=exc.status_code, headers=exc.headers)
+
+@app.exception_handler(RequestValidationError)
+async def validation_exception_handler(request: Request, exc: RequestValidationError):
+    return JSONResponse(_error_content(jsonable_encoder(exc.errors())), status_code=422)
+
 # --- Pydantic 模型定义 ---
 class UserRequest(BaseModel):
     raw_request: str = Field(..., min_length=1, description="用户的原始文本请求")
     task_type: str = Field(default="通用/问答", description="任务类型")
+    use_cache: bool = Field(default=True, description="是否允许复用缓存的LLM响应；为 false 时强制获取新的输出")
+    include_metrics: bool = Field(default=False, description="是否在响应中返回各阶段的耗时、token 用量与估算费用")
 
 class P1Response(BaseModel):
     p1_prompt: str
     original_request: str
     message: str | None = None
+    metrics: dict | None = None # 仅在 include_metrics=true 时返回
 
 # 2. 为 /explain-term 端点定义新的请求和响应模型
 class ExplainTermRequest(BaseModel):
@@ -65,6 +190,41 @@ class ExplanationResponse(BaseModel):
 
 class ErrorResponse(BaseModel):
     detail: str
+    trace_id: str | None = None
+
+# --- 批量生成模型 ---
+class BatchItem(UserRequest):
+    id: str | None = Field(default=None, description="调用方自定义的条目标识，原样返回")
+    enable_self_correction: bool = Field(default=False, description="是否对该条目执行自我校正循环")
+    max_recursion_depth: int = Field(default=1, ge=0, le=5, description="自我校正的最大轮数")
+    structured_template_name: str | None = Field(default=None, description="使用的结构化模板名称")
+    structured_template_vars: dict | None = Field(default=None, description="结构化模板的变量")
+    self_correction_mode: Literal["sequential", "best_of_n"] | None = Field(default=None, description="自我校正模式，默认使用服务端配置")
+
+class BatchRequest(BaseModel):
+    items: list[BatchItem] = Field(..., min_length=1, max_length=settings.BATCH_MAX_ITEMS)
+    max_concurrency: int | None = Field(default=None, ge=1, description="同时处理的条目数，不超过服务端上限")
+    stream: bool = Field(default=False, description="为 true 时以 NDJSON 逐行返回每个完成的条目")
+
+class BatchItemResult(BaseModel):
+    index: int
+    id: str | None = None
+    status: str # "ok" 或 "error"
+    final_prompt: str | None = None
+    p1_prompt: str | None = None
+    evaluation_reports: list = []
+    refined_prompts: list[str] = []
+    stop_reason: str | None = None # 自我校正循环的停止原因，未启用自我校正时为空
+    template: dict | None = None # 使用的结构化模板 {"name", "version"}，未使用模板时为空
+    error: str | None = None
+    error_details: dict | None = None
+    trace_id: str | None = None # 仅在出错时返回
+    metrics: dict | None = None # 仅在该条目 include_metrics=true 时返回
+
+class BatchResponse(BaseModel):
+    results: list[BatchItemResult]
+    succeeded: int
+    failed: int
 
 # --- API 端点定义 ---
 
@@ -73,6 +233,43 @@ async def read_root():
     logger.info("访问了根端点 /")
     return {"message": "欢迎使用 Meta-Prompt Agent API!"}
 
+@app.get("/stats", tags=["General"], summary="运行时统计 (提供者路由、熔断器、限流、请求合并、连接池、响应缓存、模板版本)")
+async def stats_endpoint():
+    if single_flight is None or transport is None:
+        raise HTTPException(status_code=503, detail="核心模块未正确导入，统计不可用。")
+    cache = response_cache.get_response_cache()
+    return {
+        "routing": provider_router.get_routing_snapshot(),
+        "circuit_breakers": resilience.get_breaker_states(),
+        "rate_limits": rate_limit.get_rate_limit_stats(),
+        "single_flight": single_flight.get_coalescing_stats(),
+        "connection_pool": transport.get_pool_stats(),
+        "response_cache": cache.stats() if cache is not None else None,
+        "templates": template_registry.get_template_store().stats(),
+    }
+
+@app.get("/metrics", tags=["General"], summary="Prometheus 格式的服务指标", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    """
+    请求数与耗时 (按端点)、LLM调用耗时 (按提供者与模型)、token 速率、在途调用数、按错误类型的失败数，
+    以及响应缓存、客户端限流与请求合并的统计。配置 METRICS_MULTIPROC_DIR 时合并所有 worker 的数据。
+    """
+    if service_metrics is None or not settings.METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="服务指标未启用。")
+    content = await asyncio.to_thread(service_metrics.render_latest) # 多进程模式下需要读取快照文件
+    return PlainTextResponse(content, media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/templates", tags=["General"], summary="结构化模板及任务类型索引 (支持 ETag 条件请求)")
+async def templates_endpoint(request: Request, task_type: str | None = None):
+    """返回模板的名称、描述、变量与适用的任务类型；If-None-Match 与当前 ETag 一致时返回 304。"""
+    if template_registry is None:
+        raise HTTPException(status_code=503, detail="核心模块未正确导入，模板列表不可用。")
+    body, etag = template_registry.get_registry().snapshot(task_type)
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={settings.TEMPLATES_CACHE_MAX_AGE_SECONDS}"}
+    if template_registry.etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
 @app.post(
     "/generate-simple-p1", 
     response_model=P1Response,
@@ -86,17 +283,18 @@ async def read_root():
 async def generate_simple_p1_endpoint(request_data: UserRequest):
     logger.info(f"收到生成P1的请求: {request_data.raw_request[:50]}..., 任务类型: {request_data.task_type}")
     try:
-        if 'generate_and_refine_prompt' not in globals() or not callable(generate_and_refine_prompt):
-             logger.error("核心函数 generate_and_refine_prompt 未成功导入或不可调用。")
+        if 'generate_and_refine_prompt_async' not in globals() or not callable(generate_and_refine_prompt_async):
+             logger.error("核心函数 generate_and_refine_prompt_async 未成功导入或不可调用。")
              raise HTTPException(status_code=500, detail="服务器内部配置错误: 核心逻辑不可用。")
 
-        results = generate_and_refine_prompt(
+        results = await generate_and_refine_prompt_async(
             user_raw_request=request_data.raw_request,
             task_type=request_data.task_type,
             enable_self_correction=False, 
             max_recursion_depth=0,        
             use_structured_template_name=None, 
-            structured_template_vars=None
+            structured_template_vars=None,
+            use_cache=request_data.use_cache,
         )
 
         if results.get("error_message"):
@@ -116,7 +314,8 @@ async def generate_simple_p1_endpoint(request_data: UserRequest):
         return P1Response(
             p1_prompt=p1_prompt,
             original_request=request_data.raw_request,
-            message="P1提示已成功生成。"
+            message="P1提示已成功生成。",
+            metrics=results.get("metrics") if request_data.include_metrics else None,
         )
     except HTTPException: 
         raise
@@ -124,6 +323,140 @@ async def generate_simple_p1_endpoint(request_data: UserRequest):
         logger.exception(f"处理 /generate-simple-p1 请求时发生未预料的错误: {e}")
         raise HTTPException(status_code=500, detail=f"服务器处理请求时发生意外错误: {str(e)}")
 
+def _sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.post(
+    "/generate-simple-p1/stream",
+    tags=["Prompt Generation"],
+    summary="以SSE流式生成初步优化提示 (P1)",
+    response_class=StreamingResponse,
+    responses={
+        200: {"content": {"text/event-stream": {}}, "description": "token / done / error 事件流"},
+        422: {"model": ErrorResponse, "description": "请求体验证失败"},
+    }
+)
+async def generate_simple_p1_stream_endpoint(request_data: UserRequest):
+    """
+    与 /generate-simple-p1 相同，但在LLM生成过程中通过 Server-Sent Events 逐块推送内容：
+    `token` 事件携带新生成的文本片段，`done` 事件携带清理后的完整P1，`error` 事件携带错误信息。
+    """
+    logger.info(f"收到流式生成P1的请求: {request_data.raw_request[:50]}..., 任务类型: {request_data.task_type}")
+
+    async def event_stream():
+        try:
+            async for event, payload in stream_p1_prompt_async(
+                user_raw_request=request_data.raw_request,
+                task_type=request_data.task_type,
+            ):
+                if event == "token":
+                    yield _sse_event("token", {"text": payload})
+                elif event == "done":
+                    logger.info(f"成功为请求 '{request_data.raw_request[:50]}...' 流式生成P1提示。")
+                    yield _sse_event("done", {
+                        "p1_prompt": payload,
+                        "original_request": request_data.raw_request,
+                        "message": "P1提示已成功生成。",
+                    })
+                else:
+                    error_message, error_details = payload
+                    logger.error(f"流式生成P1时发生错误: {error_message}, 详情: {error_details}")
+                    yield _sse_event("error", _error_content(error_message))
+        except Exception as e:
+            logger.exception(f"处理 /generate-simple-p1/stream 请求时发生未预料的错误: {e}")
+            yield _sse_event("error", _error_content(f"服务器处理请求时发生意外错误: {str(e)}"))
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}, # 禁止代理缓冲，保证逐块送达
+    )
+
+async def _run_batch_item(index: int, item: BatchItem, semaphore: asyncio.Semaphore) -> BatchItemResult:
+    async with semaphore:
+        try:
+            results = await generate_and_refine_prompt_async(
+                user_raw_request=item.raw_request,
+                task_type=item.task_type,
+                enable_self_correction=item.enable_self_correction,
+                max_recursion_depth=item.max_recursion_depth,
+                use_structured_template_name=item.structured_template_name,
+                structured_template_vars=item.structured_template_vars,
+                use_cache=item.use_cache,
+                self_correction_mode=item.self_correction_mode,
+            )
+        except Exception as e:
+            logger.exception(f"批量条目 {index} 处理时发生未预料的错误: {e}")
+            return BatchItemResult(
+                index=index, id=item.id, status="error", error=f"服务器处理请求时发生意外错误: {str(e)}",
+                trace_id=tracing.current_trace_id() if tracing is not None else None,
+            )
+    metrics = results.get("metrics") if item.include_metrics else None
+    if results.get("error_message"):
+        return BatchItemResult(
+            index=index, id=item.id, status="error",
+            error=results["error_message"], error_details=results.get("error_details"),
+            trace_id=results.get("trace_id"), metrics=metrics,
+        )
+    return BatchItemResult(
+        index=index, id=item.id, status="ok",
+        final_prompt=results.get("final_prompt"),
+        p1_prompt=results.get("p1_initial_optimized_prompt"),
+        evaluation_reports=results.get("evaluation_reports", []),
+        refined_prompts=results.get("refined_prompts", []),
+        stop_reason=results.get("stop_reason"),
+        template=results.get("template"),
+        metrics=metrics,
+    )
+
+@app.post(
+    "/generate-batch",
+    response_model=BatchResponse,
+    tags=["Prompt Generation"],
+    summary="批量生成优化提示",
+    responses={
+        200: {"content": {"application/x-ndjson": {}}, "description": "stream=true 时逐行返回完成的条目"},
+        422: {"model": ErrorResponse, "description": "请求体验证失败"},
+    }
+)
+async def generate_batch_endpoint(request_data: BatchRequest):
+    """
+    以有限的并发处理一批请求，每个条目可以单独指定模板与自我校正设置。
+    单个条目失败不影响其他条目，失败信息在该条目的 `error` / `error_details` 中返回。
+
+    `stream=true` 时按完成顺序逐行返回 NDJSON，每行是一个条目结果，最后一行为 `{"done": true, ...}` 汇总。
+    """
+    concurrency = min(request_data.max_concurrency or settings.BATCH_MAX_CONCURRENCY, settings.BATCH_MAX_CONCURRENCY)
+    logger.info(f"收到批量生成请求: {len(request_data.items)} 个条目，并发 {concurrency}，流式: {request_data.stream}")
+    semaphore = asyncio.Semaphore(concurrency)
+
+    if not request_data.stream:
+        item_results = await asyncio.gather(
+            *(_run_batch_item(i, item, semaphore) for i, item in enumerate(request_data.items))
+        )
+        succeeded = sum(1 for r in item_results if r.status == "ok")
+        logger.info(f"批量生成完成: 成功 {succeeded}，失败 {len(item_results) - succeeded}。")
+        return BatchResponse(results=item_results, succeeded=succeeded, failed=len(item_results) - succeeded)
+
+    async def ndjson_stream():
+        tasks = [
+            asyncio.create_task(_run_batch_item(i, item, semaphore))
+            for i, item in enumerate(request_data.items)
+        ]
+        succeeded = 0
+        try:
+            for finished in asyncio.as_completed(tasks):
+                item_result = await finished
+                succeeded += item_result.status == "ok"
+                yield json.dumps(item_result.model_dump(), ensure_ascii=False) + "\n"
+            yield json.dumps({"done": True, "succeeded": succeeded, "failed": len(tasks) - succeeded}) + "\n"
+        finally:
+            # 客户端中途断开时取消尚未完成的条目
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(ndjson_stream(), media_type="application/x-ndjson")
+
 # 3. 新增 /explain-term API 端点
 @app.post(
     "/explain-term",
@@ -141,11 +474,11 @@ async def explain_term_endpoint(request_data: ExplainTermRequest):
     """
     logger.info(f"收到解释术语的请求: '{request_data.term_to_explain}', 上下文长度: {len(request_data.context_prompt)}")
     try:
-        if 'explain_term_in_prompt' not in globals() or not callable(explain_term_in_prompt):
-            logger.error("核心函数 explain_term_in_prompt 未成功导入或不可调用。")
+        if 'explain_term_in_prompt_async' not in globals() or not callable(explain_term_in_prompt_async):
+            logger.error("核心函数 explain_term_in_prompt_async 未成功导入或不可调用。")
             raise HTTPException(status_code=500, detail="服务器内部配置错误: 解释逻辑不可用。")
 
-        explanation_text, error_details = explain_term_in_prompt(
+        explanation_text, error_details = await explain_term_in_prompt_async(
             term_to_explain=request_data.term_to_explain,
             context_prompt=request_data.context_prompt
         )
@@ -176,7 +509,7 @@ async def explain_term_endpoint(request_data: ExplainTermRequest):
 
 if __name__ == "__main__":
     if 'setup_logging' in globals() and callable(setup_logging):
-       setup_logging()
+       setup_logging(filters=[tracing.TraceContextFilter()] if tracing is not None else ())
     else:
        logging.basicConfig(level=logging.INFO) 
        logger.info("使用基础日志配置运行 (直接运行 main.py)。")
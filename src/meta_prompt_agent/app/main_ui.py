@@ -4,7 +4,7 @@ import json
 
 try:
     import meta_prompt_agent.core.agent as agent_logic
-    from meta_prompt_agent.prompts.templates import STRUCTURED_PROMPT_TEMPLATES
+    from meta_prompt_agent.core import template_registry, tracing
     from meta_prompt_agent.config.settings import OLLAMA_MODEL, OLLAMA_API_URL 
 except ImportError as e:
     st.error(f"启动错误: {e}. 请确保 agent_logic.py 和 prompt_templates.py 文件在同一目录下。")
@@ -12,13 +12,15 @@ except ImportError as e:
 
 from meta_prompt_agent.config.settings import (
     OLLAMA_MODEL,
-    OLLAMA_API_URL
+    OLLAMA_API_URL,
+    LLM_CACHE_ENABLED,
+    SELF_CORRECTION_MODE
 )
 
 from meta_prompt_agent.config.logging_config import setup_logging
 import logging # 仍然需要导入logging来获取logger实例
 
-setup_logging() # 你可以传递不同的级别，如 setup_logging(logging.DEBUG)
+setup_logging(filters=[tracing.TraceContextFilter()]) # 你可以传递不同的级别，如 setup_logging(logging.DEBUG)
 
 # 获取logger实例 (现在它会使用我们刚刚设置的全局配置)
 logger = logging.getLogger(__name__)
@@ -69,15 +71,25 @@ def main():
             max_recursion_depth = 0
             if enable_self_correction:
                 max_recursion_depth = st.number_input("最大递归深度", min_value=0, max_value=3, value=max_recursion_depth_default, step=1, key="num_recursion_depth")
+            self_correction_mode = None
+            if enable_self_correction:
+                mode_labels = {"sequential": "逐轮精炼", "best_of_n": "并发候选择优 (best-of-N)"}
+                self_correction_mode = st.radio(
+                    "自我校正模式", list(mode_labels), format_func=mode_labels.get, horizontal=True, key="radio_correction_mode",
+                    index=list(mode_labels).index(SELF_CORRECTION_MODE) if SELF_CORRECTION_MODE in mode_labels else 0,
+                    help="best-of-N 并发生成并评估多个候选P1，以更多 token 换取更低的总耗时",
+                )
+
+            use_cache = True
+            if LLM_CACHE_ENABLED:
+                use_cache = st.checkbox("复用缓存的LLM响应", value=True, key="cb_use_cache", help="取消勾选可强制重新生成")
+            show_metrics = st.checkbox("显示各阶段耗时与 token 用量", value=False, key="cb_show_metrics")
 
             st.subheader("结构化模板 (可选)")
-            filtered_templates = {"无": {}} 
-            for name, template_info in STRUCTURED_PROMPT_TEMPLATES.items():
-                template_task_categories = template_info.get("task_type", [])
-                if current_task_type_for_logic in template_task_categories or \
-                ("通用" in template_task_categories and current_task_type_for_logic == "通用") or \
-                ("问答" in template_task_categories and current_task_type_for_logic == "问答"): # More specific matching
-                    filtered_templates[name] = template_info
+            # 注册表在首次使用时编译全部模板并建立任务类型索引，之后每次重跑脚本只做一次字典查找
+            filtered_templates = {"无": None}
+            for template in template_registry.get_registry().for_task_type(current_task_type_for_logic):
+                filtered_templates[template.name] = template
     
             selected_template_name = st.selectbox(
                 "选择一个模板 (基于任务类型筛选):", 
@@ -87,8 +99,8 @@ def main():
     
             structured_vars_input = {}
             if selected_template_name != "无" and selected_template_name in filtered_templates:
-                st.caption(filtered_templates[selected_template_name].get("description", "没有描述"))
-                template_vars_needed = filtered_templates[selected_template_name].get("variables", [])
+                st.caption(filtered_templates[selected_template_name].description or "没有描述")
+                template_vars_needed = filtered_templates[selected_template_name].variables
                 if template_vars_needed:
                     st.markdown("**模板变量:**")
                     for var_name in template_vars_needed:
@@ -120,7 +132,8 @@ def main():
                 # Validation logic
                 proceed_with_generation = False
                 if selected_template_name != "无": # If a structured template is selected
-                    template_vars_needed = filtered_templates.get(selected_template_name, {}).get("variables", [])
+                    selected_template = filtered_templates.get(selected_template_name)
+                    template_vars_needed = selected_template.variables if selected_template is not None else ()
                     all_vars_filled = True
                     if template_vars_needed: # Only check if template actually has variables defined
                         for var_name in template_vars_needed:
@@ -147,7 +160,9 @@ def main():
                             enable_self_correction=enable_self_correction,
                             max_recursion_depth=max_recursion_depth,
                             use_structured_template_name=use_template_for_logic,
-                            structured_template_vars=structured_vars_input if use_template_for_logic else None
+                            structured_template_vars=structured_vars_input if use_template_for_logic else None,
+                            use_cache=use_cache,
+                            self_correction_mode=self_correction_mode
                         )
                         st.session_state.processing_results = results
                         st.session_state.user_raw_request_for_feedback = user_raw_request # Store the raw request for feedback context
@@ -194,6 +209,25 @@ def main():
                         for i, prompt_text in enumerate(results["refined_prompts"]):
                             st.markdown(f"#### 第 {i+1} 轮精炼后的提示词 (P{i+2}):")
                             st.text_area(f"P{i+2}内容:", value=prompt_text, height=200, disabled=True, key=f"disp_p_refined{i+1}")
+
+                    if results.get("stop_reason"):
+                        scores = ", ".join("-" if score is None else f"{score:g}" for score in results.get("evaluation_scores", []))
+                        st.caption(f"自我校正停止原因: {results['stop_reason']}；各轮评估分数: {scores or '无'}")
+
+                    if show_metrics and results.get("metrics"):
+                        st.markdown("#### 各阶段计量:")
+                        stage_labels = {"p1": "P1", "evaluation": "评估", "refinement": "精炼"}
+                        st.table([
+                            {"阶段": stage_labels.get(stage, stage), "调用数": m["calls"], "耗时 (ms)": m["wall_ms"],
+                             "排队 (ms)": m["queue_ms"], "首 token (ms)": m["ttft_ms"], "输入 tokens": m["input_tokens"],
+                             "输出 tokens": m["output_tokens"], "估算费用": m["cost"]}
+                            for stage, m in results["metrics"]["stages"].items() if m["calls"]
+                        ])
+                        total = results["metrics"]["total"]
+                        st.caption(
+                            f"总耗时 {total['wall_ms']:.0f} ms，共 {total['input_tokens']} 输入 / {total['output_tokens']} 输出 tokens"
+                            + ("（部分为本地估算）" if total["tokens_estimated"] else "")
+                        )
         
                 st.subheader("🎯 最终优化后的目标提示词:")
                 final_prompt_text = results.get("final_prompt", "未能生成最终提示词。")
@@ -2,12 +2,14 @@
 import logging
 import sys # 为了能够将日志输出到标准输出
 
-def setup_logging(level=logging.INFO):
+def setup_logging(level=logging.INFO, filters=()):
     """
     配置全局日志记录。
 
     Args:
         level (int, optional): 要设置的最低日志级别。默认为 logging.INFO。
+        filters (iterable, optional): 添加到处理器上的日志过滤器，例如入口传入的 tracing.TraceContextFilter()
+            (为日志记录加上当前的 trace_id；未提供时 trace_id 显示为 "-")。
     """
     # 创建一个logger，通常是根logger或者一个特定的应用logger
     # 如果我们获取根logger，那么所有子logger都会继承这个配置
@@ -24,11 +26,14 @@ def setup_logging(level=logging.INFO):
     # StreamHandler默认输出到sys.stderr，但我们可以指定sys.stdout
     console_handler = logging.StreamHandler(sys.stdout)
     console_handler.setLevel(level)
+    for log_filter in filters:
+        console_handler.addFilter(log_filter)
 
     # 创建一个格式化器并将其添加到处理器
     formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
+        '%(asctime)s - %(name)s - %(levelname)s - [trace=%(trace_id)s] %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+        defaults={"trace_id": "-"},
     )
     console_handler.setFormatter(formatter)
 
@@ -51,7 +56,7 @@ def setup_logging(level=logging.INFO):
     # 这种方式更接近 basicConfig 的行为，但更可控。
     logging.basicConfig(
         level=level,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        format='%(asctime)s - %(name)s - %(levelname)s - [trace=%(trace_id)s] %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S',
         handlers=[console_handler] # 使用我们创建的处理器
         # 如果也想输出到文件，可以加上 file_handler:
@@ -1,5 +1,6 @@
 # src/meta_prompt_agent/config/settings.py
 import os
+import json
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -11,16 +12,182 @@ OLLAMA_API_URL: str = os.getenv("OLLAMA_API_URL", "http://localhost:11434/api/ch
 # --- Gemini API 配置 ---
 GEMINI_API_KEY: str | None = os.getenv("GEMINI_API_KEY")
 GEMINI_MODEL_NAME: str = os.getenv("GEMINI_MODEL_NAME", "gemini-1.5-flash-latest") 
+# 异步流程直接调用 Gemini REST 接口
+GEMINI_API_BASE_URL: str = os.getenv("GEMINI_API_BASE_URL", "https://generativelanguage.googleapis.com/v1beta")
 
 # --- 通义千问 (Qwen) API 配置 ---
 # DashScope SDK 优先查找 DASHSCOPE_API_KEY
 # 我们也允许通过 QWEN_API_KEY 设置，但在 .env 中推荐使用 DASHSCOPE_API_KEY
 QWEN_API_KEY_FROM_ENV: str | None = os.getenv("DASHSCOPE_API_KEY") or os.getenv("QWEN_API_KEY")
 QWEN_MODEL_NAME: str = os.getenv("QWEN_MODEL_NAME", "qwen-plus-2025-04-28") # 您指定的模型
+# 异步流程直接调用 DashScope HTTP 接口
+QWEN_API_BASE_URL: str = os.getenv("QWEN_API_BASE_URL", "https://dashscope.aliyuncs.com/api/v1")
 
 # --- 当前激活的LLM服务提供者 ---
 ACTIVE_LLM_PROVIDER: str = os.getenv("ACTIVE_LLM_PROVIDER", "qwen").lower()
 
+# --- HTTP 连接池配置 (core/transport.py) ---
+# 每个提供者一个 keep-alive 会话；POOL_CONNECTIONS 为缓存的主机连接池数量，
+# POOL_MAXSIZE 为单个主机上保持的最大连接数 (即每主机上限)。
+HTTP_POOL_CONNECTIONS: int = int(os.getenv("HTTP_POOL_CONNECTIONS", "10"))
+HTTP_POOL_MAXSIZE: int = int(os.getenv("HTTP_POOL_MAXSIZE", "20"))
+# 为 True 时，单主机连接数达到上限后新请求会等待空闲连接，而不是临时新建连接
+HTTP_POOL_BLOCK: bool = os.getenv("HTTP_POOL_BLOCK", "false").lower() == "true"
+HTTP_POOL_MAXSIZE_BY_PROVIDER: dict[str, int] = {
+    "ollama": int(os.getenv("OLLAMA_HTTP_POOL_MAXSIZE", str(HTTP_POOL_MAXSIZE))),
+    "qwen": int(os.getenv("QWEN_HTTP_POOL_MAXSIZE", str(HTTP_POOL_MAXSIZE))),
+    "gemini": int(os.getenv("GEMINI_HTTP_POOL_MAXSIZE", str(HTTP_POOL_MAXSIZE))),
+}
+# 异步客户端 (httpx.AsyncClient) 每个提供者允许同时打开的最大连接数；
+# keep-alive 连接数沿用上面的 HTTP_POOL_MAXSIZE_BY_PROVIDER。
+ASYNC_HTTP_MAX_CONNECTIONS: int = int(os.getenv("ASYNC_HTTP_MAX_CONNECTIONS", "200"))
+LLM_REQUEST_TIMEOUT: float = float(os.getenv("LLM_REQUEST_TIMEOUT", "180"))
+
+# --- 客户端预热 (core/client_registry.py) ---
+# API 启动时预先构建当前提供者的 SDK 客户端与连接池
+LLM_WARMUP_ON_STARTUP: bool = os.getenv("LLM_WARMUP_ON_STARTUP", "true").lower() == "true"
+# 最多缓存的 SDK 客户端数；Gemini 按 system 指令各构建一个模型，超出时淘汰最久未使用的
+LLM_CLIENT_CACHE_MAX_ENTRIES: int = int(os.getenv("LLM_CLIENT_CACHE_MAX_ENTRIES", "32"))
+
+# --- LLM 响应缓存 (core/response_cache.py) ---
+# 默认关闭；开启后相同 (提供者, 模型, 消息, 生成参数) 的请求直接返回缓存结果
+LLM_CACHE_ENABLED: bool = os.getenv("LLM_CACHE_ENABLED", "false").lower() == "true"
+LLM_CACHE_MAX_ENTRIES: int = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1024"))
+LLM_CACHE_TTL_SECONDS: float = float(os.getenv("LLM_CACHE_TTL_SECONDS", "3600"))
+# 设置后启用磁盘缓存层 (多个进程/重启之间共享)
+LLM_CACHE_DIR: str | None = os.getenv("LLM_CACHE_DIR") or None
+LLM_CACHE_DISK_MAX_ENTRIES: int = int(os.getenv("LLM_CACHE_DISK_MAX_ENTRIES", "10000"))
+
+# --- 多提供者路由与故障转移 (core/provider_router.py) ---
+# 逗号分隔的提供者列表 (例如 "qwen,gemini,ollama")；为空时只使用 ACTIVE_LLM_PROVIDER
+LLM_ROUTER_PROVIDERS: list[str] = [p.strip().lower() for p in os.getenv("LLM_ROUTER_PROVIDERS", "").split(",") if p.strip()]
+LLM_ROUTER_WINDOW_SIZE: int = int(os.getenv("LLM_ROUTER_WINDOW_SIZE", "200"))
+LLM_ROUTER_WINDOW_SECONDS: float = float(os.getenv("LLM_ROUTER_WINDOW_SECONDS", "300"))
+LLM_ROUTER_MIN_SAMPLES: int = int(os.getenv("LLM_ROUTER_MIN_SAMPLES", "5"))
+# 滚动窗口内错误率超过该值的提供者被视为降级，排到最后
+LLM_ROUTER_MAX_ERROR_RATE: float = float(os.getenv("LLM_ROUTER_MAX_ERROR_RATE", "0.5"))
+
+# --- 熔断与重试 (core/resilience.py) ---
+# 连续失败达到阈值后熔断该提供者 LLM_BREAKER_RECOVERY_SECONDS 秒；配置/鉴权错误立即熔断更长时间
+LLM_BREAKER_FAILURE_THRESHOLD: int = int(os.getenv("LLM_BREAKER_FAILURE_THRESHOLD", "5"))
+LLM_BREAKER_RECOVERY_SECONDS: float = float(os.getenv("LLM_BREAKER_RECOVERY_SECONDS", "30"))
+LLM_BREAKER_FATAL_RECOVERY_SECONDS: float = float(os.getenv("LLM_BREAKER_FATAL_RECOVERY_SECONDS", "300"))
+# 单次LLM调用的最大尝试次数 (含首次)，以及一次用户请求内所有调用共享的重试总次数
+LLM_RETRY_MAX_ATTEMPTS: int = int(os.getenv("LLM_RETRY_MAX_ATTEMPTS", "3"))
+LLM_RETRY_BUDGET_PER_REQUEST: int = int(os.getenv("LLM_RETRY_BUDGET_PER_REQUEST", "4"))
+# 指数退避的基数与上限 (秒)，实际等待时间在 [0, min(上限, 基数 * 2^n)] 内随机抖动
+LLM_RETRY_BASE_DELAY: float = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+LLM_RETRY_MAX_DELAY: float = float(os.getenv("LLM_RETRY_MAX_DELAY", "8"))
+
+# --- 客户端限流 (core/rate_limit.py) ---
+# 每个提供者的每分钟请求数 (RPM)、每分钟 token 数 (TPM) 与最大并发数；0 表示不限制。
+# 限流器按 (提供者, 模型) 分别计数。
+LLM_RATE_LIMITS_BY_PROVIDER: dict[str, dict[str, int]] = {
+    provider: {
+        "rpm": int(os.getenv(f"{provider.upper()}_RPM", "0")),
+        "tpm": int(os.getenv(f"{provider.upper()}_TPM", "0")),
+        "max_concurrency": int(os.getenv(f"{provider.upper()}_MAX_CONCURRENCY", "0")),
+    }
+    for provider in ("ollama", "qwen", "gemini")
+}
+# 按模型覆盖，JSON 格式，例如 {"qwen/qwen-max": {"rpm": 60, "tpm": 100000, "max_concurrency": 8}}
+LLM_RATE_LIMITS_BY_MODEL: dict[str, dict[str, int]] = json.loads(os.getenv("LLM_RATE_LIMITS_BY_MODEL", "{}"))
+# 额度不足时最多排队等待的秒数，超过则直接返回 RateLimitQueueTimeout 错误
+LLM_RATE_LIMIT_MAX_QUEUE_SECONDS: float = float(os.getenv("LLM_RATE_LIMIT_MAX_QUEUE_SECONDS", "10"))
+# TPM 预留时对输出 token 数的估计，调用结束后按实际输出修正
+LLM_RATE_LIMIT_OUTPUT_TOKENS_ESTIMATE: int = int(os.getenv("LLM_RATE_LIMIT_OUTPUT_TOKENS_ESTIMATE", "1024"))
+
+# --- 在途请求合并 (core/single_flight.py) ---
+# 相同 (提供者, 模型, 消息) 的并发LLM调用只发起一次上游请求，所有调用方共享结果
+LLM_SINGLE_FLIGHT_ENABLED: bool = os.getenv("LLM_SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+
+# --- 近似重复请求检测 (core/near_duplicate.py) ---
+# "off": 关闭；"reuse": 直接复用相似请求的P1；"seed": 以相似请求的P1为基础让LLM做最小修改
+NEAR_DUPLICATE_MODE: str = os.getenv("NEAR_DUPLICATE_MODE", "off").lower()
+# 估计的 Jaccard 相似度 (字符3-gram) 达到该值才视为近似重复
+NEAR_DUPLICATE_THRESHOLD: float = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", "0.85"))
+NEAR_DUPLICATE_NUM_PERM: int = int(os.getenv("NEAR_DUPLICATE_NUM_PERM", "32"))
+NEAR_DUPLICATE_MAX_ENTRIES: int = int(os.getenv("NEAR_DUPLICATE_MAX_ENTRIES", "200000"))
+
+# --- 精炼上下文 (core/refinement_context.py) ---
+# 每次精炼调用的估计输入 token 上限 (0 表示不限制)；超出时依次省略评估理由、核心元提示并截断评估要点
+REFINEMENT_CONTEXT_TOKEN_BUDGET: int = int(os.getenv("REFINEMENT_CONTEXT_TOKEN_BUDGET", "4000"))
+# 精炼的输出形式："full" 让模型重写完整提示词；"edits" 让模型只返回编辑列表并在本地应用 (无法应用时回退为 full)
+REFINEMENT_OUTPUT_MODE: str = os.getenv("REFINEMENT_OUTPUT_MODE", "full").lower()
+
+# --- 自我校正的提前停止 (core/early_stopping.py)，各项设为 0 时关闭 ---
+# 默认全部关闭，自我校正执行 max_recursion_depth 指定的全部轮数并返回最后一次精炼的结果；
+# 启用后可能提前结束，且分数下降时 final_prompt 会回退为得分最高的较早版本。建议值见各项说明
+# 评估分数 (overall_score，缺失时取各维度平均分，1-5) 达到该值即停止精炼 (例如 4.5)
+EARLY_STOP_SCORE_THRESHOLD: float = float(os.getenv("EARLY_STOP_SCORE_THRESHOLD", "0"))
+# 相邻两轮的评估分数提升低于该值即停止 (例如 0.25)
+EARLY_STOP_MIN_IMPROVEMENT: float = float(os.getenv("EARLY_STOP_MIN_IMPROVEMENT", "0"))
+# 精炼前后提示词的文本相似度达到该值即视为收敛 (例如 0.95)
+EARLY_STOP_SIMILARITY: float = float(os.getenv("EARLY_STOP_SIMILARITY", "0"))
+
+# --- 自我校正模式 ---
+# "sequential": P1 -> E1 -> P2 -> E2 ... 依次执行；
+# "best_of_n": 并发生成 BEST_OF_N_CANDIDATES 个候选P1并并发评估，选出得分最高者 (BEST_OF_N_REFINE_WINNER 为 true 时再只精炼该候选)
+SELF_CORRECTION_MODE: str = os.getenv("SELF_CORRECTION_MODE", "sequential").lower()
+BEST_OF_N_CANDIDATES: int = int(os.getenv("BEST_OF_N_CANDIDATES", "3"))
+BEST_OF_N_REFINE_WINNER: bool = os.getenv("BEST_OF_N_REFINE_WINNER", "true").lower() == "true"
+
+# --- 结构化输出 (core/structured_output.py) ---
+# 评估调用使用各提供者的 JSON / Schema 输出模式 (Ollama format、Gemini responseSchema、DashScope json_object)
+LLM_STRUCTURED_OUTPUT_ENABLED: bool = os.getenv("LLM_STRUCTURED_OUTPUT_ENABLED", "true").lower() == "true"
+
+# --- 流水线计量 (core/pipeline_metrics.py) ---
+# 每百万 token 的价格，用于估算结果 metrics 中的费用。键为 "提供者/模型" 或 "提供者"，例如
+# {"qwen/qwen-plus": {"input": 0.8, "output": 2.0, "cached_input": 0.32}}；命中提供者前缀缓存的输入 token 按 cached_input
+# 计价 (未配置时按 input)；未配置价格的调用费用为 null
+LLM_PRICING_PER_MILLION_TOKENS: dict[str, dict[str, float]] = json.loads(os.getenv("LLM_PRICING_PER_MILLION_TOKENS", "{}"))
+
+# --- 服务指标 (core/service_metrics.py, API /metrics 端点) ---
+METRICS_ENABLED: bool = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+# 以多个 uvicorn worker 运行时设置为各 worker 共享的目录 (部署前清空)：每个 worker 定期写入自己的快照，/metrics 合并全部 worker
+METRICS_MULTIPROC_DIR: str | None = os.getenv("METRICS_MULTIPROC_DIR") or None
+METRICS_FLUSH_INTERVAL_SECONDS: float = float(os.getenv("METRICS_FLUSH_INTERVAL_SECONDS", "1.0"))
+
+# --- 链路追踪 (core/tracing.py) ---
+# 启用时为端点、流水线阶段和每次提供者调用记录 span，trace_id 写入日志与错误响应
+TRACING_ENABLED: bool = os.getenv("TRACING_ENABLED", "true").lower() == "true"
+TRACING_EXPORTER: str = os.getenv("TRACING_EXPORTER", "none") # "none"、"file" (JSON Lines) 或 "otlp" (OTLP/HTTP JSON)
+TRACING_FILE_PATH: str = os.getenv("TRACING_FILE_PATH", "traces.jsonl")
+TRACING_OTLP_ENDPOINT: str = os.getenv("TRACING_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+TRACING_SERVICE_NAME: str = os.getenv("TRACING_SERVICE_NAME", "meta-prompt-agent")
+TRACING_EXPORT_INTERVAL_SECONDS: float = float(os.getenv("TRACING_EXPORT_INTERVAL_SECONDS", "2.0"))
+
+# --- 结构化模板注册表 (core/template_registry.py, API /templates 端点) ---
+# /templates 响应的 Cache-Control max-age (秒)；为 0 时客户端每次都用 ETag 重新验证，内容未变则得到 304
+TEMPLATES_CACHE_MAX_AGE_SECONDS: int = int(os.getenv("TEMPLATES_CACHE_MAX_AGE_SECONDS", "0"))
+# 外部模板目录：其中每个 .json / .toml / .yaml 文件是 {模板名: 模板定义} 的映射，与内置模板合并 (同名时覆盖内置模板)，
+# 修改后无需重启即可生效；为空时只使用内置模板
+TEMPLATES_DIR: str | None = os.getenv("TEMPLATES_DIR") or None
+# 检查模板文件变化的最短间隔 (秒)；<= 0 时每次获取模板都检查
+TEMPLATES_RELOAD_INTERVAL_SECONDS: float = float(os.getenv("TEMPLATES_RELOAD_INTERVAL_SECONDS", "2.0"))
+
+# --- 提示前缀缓存 (core/prompt_layout.py) ---
+# 把模板中第一个占位符之前的固定说明作为单独的 system 消息放在最前面，使其在各请求之间逐字节相同，
+# 便于 Ollama 复用 KV 缓存、通义千问 / Gemini 命中隐式上下文缓存。会改变发送给模型的消息结构，因此默认关闭
+LLM_PROMPT_PREFIX_SPLIT_ENABLED: bool = os.getenv("LLM_PROMPT_PREFIX_SPLIT_ENABLED", "false").lower() == "true"
+LLM_PROMPT_PREFIX_MIN_CHARS: int = int(os.getenv("LLM_PROMPT_PREFIX_MIN_CHARS", "100")) # 固定前缀短于该长度时不拆分
+# 为通义千问的 system 前缀加上显式缓存标记 (cache_control)。仅部分模型支持，前缀需达到服务端的最小 token 数，
+# 且创建缓存按更高的单价计费，因此默认关闭，只依赖隐式缓存
+QWEN_EXPLICIT_PREFIX_CACHE: bool = os.getenv("QWEN_EXPLICIT_PREFIX_CACHE", "false").lower() == "true"
+
+# --- 批量生成 (API /generate-batch 端点) ---
+BATCH_MAX_ITEMS: int = int(os.getenv("BATCH_MAX_ITEMS", "1000"))
+# 单个批量请求内同时处理的条目数上限 (请求可以指定更小的值)
+BATCH_MAX_CONCURRENCY: int = int(os.getenv("BATCH_MAX_CONCURRENCY", "16"))
+
+# --- 命令行批处理 (python -m meta_prompt_agent, core/batch_runner.py) ---
+# 每个流水线阶段 (P1 / 评估 / 精炼) 各自独立的线程池大小
+BATCH_P1_WORKERS: int = int(os.getenv("BATCH_P1_WORKERS", "4"))
+BATCH_EVALUATION_WORKERS: int = int(os.getenv("BATCH_EVALUATION_WORKERS", "4"))
+BATCH_REFINEMENT_WORKERS: int = int(os.getenv("BATCH_REFINEMENT_WORKERS", "4"))
+# 每写入多少条结果强制落盘一次 (输出文件同时作为断点续跑的检查点)
+BATCH_CHECKPOINT_EVERY: int = int(os.getenv("BATCH_CHECKPOINT_EVERY", "50"))
+
 # --- 其他应用配置 ---
 FEEDBACK_FILE: str = "user_feedback.json"
 
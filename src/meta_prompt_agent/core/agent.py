@@ -1,28 +1,52 @@
 # src/meta_prompt_agent/core/agent.py
 import logging
 import requests
+import httpx
 import json
 import os
-import google.generativeai as genai 
-import dashscope 
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from dashscope.api_entities.dashscope_response import Role 
 from http import HTTPStatus 
 
 from meta_prompt_agent.config import settings # 导入配置
+from meta_prompt_agent.core import transport # 共享的 keep-alive 连接池
+from meta_prompt_agent.core import client_registry # 共享的 SDK 客户端
+from meta_prompt_agent.core import response_cache
+from meta_prompt_agent.core import near_duplicate
+from meta_prompt_agent.core import single_flight
+from meta_prompt_agent.core import provider_router
+from meta_prompt_agent.core import resilience
+from meta_prompt_agent.core import rate_limit
+from meta_prompt_agent.core import refinement_context
+from meta_prompt_agent.core import early_stopping
+from meta_prompt_agent.core import prompt_edits
+from meta_prompt_agent.core import structured_output
+from meta_prompt_agent.core import pipeline_metrics
+from meta_prompt_agent.core import service_metrics
+from meta_prompt_agent.core import tracing
+from meta_prompt_agent.core import template_registry
+from meta_prompt_agent.core import prompt_layout
 from meta_prompt_agent.prompts.templates import (
     CORE_META_PROMPT_TEMPLATE,
     EVALUATION_META_PROMPT_TEMPLATE,
+    EVALUATION_REPORT_SCHEMA,
     REFINEMENT_META_PROMPT_TEMPLATE,
+    REFINEMENT_FEEDBACK_TEMPLATE,
+    REFINEMENT_EDITS_TEMPLATE,
     STRUCTURED_PROMPT_TEMPLATES,
-    EXPLAIN_TERM_TEMPLATE
+    EXPLAIN_TERM_TEMPLATE,
+    NEAR_DUPLICATE_SEED_TEMPLATE,
+    BEST_OF_N_VARIANT_TEMPLATE
 )
 
 logger = logging.getLogger(__name__)
 
 # --- 通义千问 (Qwen) API 调用函数 (修正版) ---
-def call_qwen_api(prompt_content: str, messages_history: list = None) -> tuple[str, dict | None]:
+def call_qwen_api(prompt_content: str, messages_history: list = None, response_schema: dict = None) -> tuple[str, dict | None]:
     """
-    调用通义千问 (Qwen) API。
+    调用通义千问 (Qwen) API。指定 response_schema 时使用 DashScope 的 JSON 输出模式 (json_object)。
     """
     # 使用 settings.py 中定义的 QWEN_API_KEY_FROM_ENV
     loaded_api_key = settings.QWEN_API_KEY_FROM_ENV 
@@ -32,42 +56,39 @@ def call_qwen_api(prompt_content: str, messages_history: list = None) -> tuple[s
         logger.error(error_msg)
         return error_msg, {"type": "ConfigurationError", "details": "API key for Qwen is not set."}
 
-    # 如果 .env 中设置的是 QWEN_API_KEY 而不是 DASHSCOPE_API_KEY, 
-    # 并且 SDK 不会自动识别 QWEN_API_KEY, 我们可能需要显式设置。
-    # 但如果 .env 中直接用了 DASHSCOPE_API_KEY, SDK 会自动处理。
-    # 为了保险，如果 DASHSCOPE_API_KEY 环境变量不存在，我们尝试用 loaded_api_key 设置。
-    if os.getenv('DASHSCOPE_API_KEY') is None and loaded_api_key:
-        logger.info("DASHSCOPE_API_KEY 环境变量未设置，尝试使用 settings.QWEN_API_KEY_FROM_ENV 设置 dashscope.api_key。")
-        dashscope.api_key = loaded_api_key
-    # 注意：如果用户在.env中只设置了QWEN_API_KEY，而没有设置DASHSCOPE_API_KEY，
-    # 并且dashscope.api_key = loaded_api_key 这一行由于某种原因没有正确生效或被SDK覆盖，
-    # 那么SDK可能仍然找不到密钥。最稳妥的是在.env中使用DASHSCOPE_API_KEY。
+    # 密钥通过客户端注册表中的 DashScopeClient 在每次调用时显式传入，
+    # 不再修改全局的 dashscope.api_key (并发请求下不安全)。
 
     try:
         qwen_messages = []
-        if messages_history:
-            for msg in messages_history:
-                role = msg.get("role")
-                qwen_role = Role.USER 
-                if role == "user": qwen_role = Role.USER
-                elif role == "assistant": qwen_role = Role.ASSISTANT 
-                elif role == "system": qwen_role = Role.SYSTEM
-                else: logger.warning(f"未知的消息角色 '{role}'，默认为 'user'。")
-                qwen_messages.append({'role': qwen_role, 'content': msg.get("content", "")})
-        
-        qwen_messages.append({'role': Role.USER, 'content': prompt_content})
+        # 模板的固定前缀作为开头的 system 消息，便于命中 DashScope 的上下文缓存
+        for msg in prompt_layout.layout_messages(prompt_content, messages_history):
+            role = msg.get("role")
+            qwen_role = Role.USER 
+            if role == "user": qwen_role = Role.USER
+            elif role == "assistant": qwen_role = Role.ASSISTANT 
+            elif role == "system": qwen_role = Role.SYSTEM
+            else: logger.warning(f"未知的消息角色 '{role}'，默认为 'user'。")
+            qwen_messages.append({'role': qwen_role, 'content': msg.get("content", "")})
+        qwen_messages = prompt_layout.qwen_cache_marked(qwen_messages)
 
         logger.debug(f"向通义千问 API ({settings.QWEN_MODEL_NAME}) 发送请求。最后提示: {prompt_content[:100]}...")
         
-        response = dashscope.Generation.call(
-            model=settings.QWEN_MODEL_NAME,
+        extra_options = {"response_format": {"type": "json_object"}} if response_schema else {}
+        response = client_registry.get_qwen_client().call(
             messages=qwen_messages,
             result_format='message', 
+            **extra_options,
         )
 
         if response.status_code == HTTPStatus.OK:
             if response.output and response.output.choices and response.output.choices[0].message and response.output.choices[0].message.content:
                 generated_text = response.output.choices[0].message.content
+                usage = getattr(response, "usage", None)
+                pipeline_metrics.record_usage(
+                    getattr(usage, "input_tokens", None), getattr(usage, "output_tokens", None),
+                    _qwen_cached_tokens(getattr(usage, "prompt_tokens_details", None)),
+                )
                 logger.info(f"成功从通义千问 API ({settings.QWEN_MODEL_NAME}) 获取响应。")
                 cleaned_content = clean_llm_output(generated_text)
                 return cleaned_content, None
@@ -98,27 +119,39 @@ def call_qwen_api(prompt_content: str, messages_history: list = None) -> tuple[s
         return f"错误：{error_msg}", {"type": "QwenSDKError", "exception_type": type(e).__name__, "details": str(e)}
 
 # --- Gemini API 调用函数 (保持不变) ---
-def call_gemini_api(prompt_content: str, messages_history: list = None) -> tuple[str, dict | None]:
-    # ... (您现有的 call_gemini_api 代码) ...
+def call_gemini_api(prompt_content: str, messages_history: list = None, response_schema: dict = None) -> tuple[str, dict | None]:
+    # 指定 response_schema 时使用 Gemini 的 JSON 输出模式与 responseSchema
     if not settings.GEMINI_API_KEY:
         error_msg = "错误：Gemini API 密钥未配置。"
         logger.error(error_msg)
         return error_msg, {"type": "ConfigurationError", "details": "GEMINI_API_KEY is not set."}
     try:
-        genai.configure(api_key=settings.GEMINI_API_KEY)
-        model = genai.GenerativeModel(settings.GEMINI_MODEL_NAME)
+        # 模板的固定前缀作为 system_instruction，位于请求的最前面，便于命中 Gemini 的隐式缓存
+        system_instruction, messages = prompt_layout.split_system_messages(
+            prompt_layout.layout_messages(prompt_content, messages_history)
+        )
+        model = client_registry.get_gemini_model(system_instruction) # 按 (模型, 密钥, system 指令) 复用，数量有上限
         contents_for_gemini = []
-        if messages_history:
-            for msg in messages_history:
-                gemini_role = "user" if msg.get("role") == "user" else "model"
-                contents_for_gemini.append({"role": gemini_role, "parts": [msg.get("content", "")]})
-        contents_for_gemini.append({"role": "user", "parts": [prompt_content]})
+        for msg in messages:
+            gemini_role = "user" if msg.get("role") == "user" else "model"
+            contents_for_gemini.append({"role": gemini_role, "parts": [msg.get("content", "")]})
         
         logger.debug(f"向 Gemini API ({settings.GEMINI_MODEL_NAME}) 发送请求。最后提示: {prompt_content[:100]}...")
-        response = model.generate_content(contents_for_gemini)
+        if response_schema:
+            response = model.generate_content(contents_for_gemini, generation_config={
+                "response_mime_type": "application/json",
+                "response_schema": structured_output.to_gemini_schema(response_schema),
+            })
+        else:
+            response = model.generate_content(contents_for_gemini)
 
         if response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
             generated_text = "".join(part.text for part in response.candidates[0].content.parts if hasattr(part, 'text'))
+            usage = getattr(response, "usage_metadata", None)
+            pipeline_metrics.record_usage(
+                getattr(usage, "prompt_token_count", None), getattr(usage, "candidates_token_count", None),
+                getattr(usage, "cached_content_token_count", None),
+            )
             logger.info(f"成功从 Gemini API ({settings.GEMINI_MODEL_NAME}) 获取响应。")
             return generated_text.strip(), None
         else:
@@ -133,26 +166,26 @@ def call_gemini_api(prompt_content: str, messages_history: list = None) -> tuple
         return f"错误：{error_msg}", {"type": "GeminiAPIError", "exception_type": type(e).__name__, "details": str(e)}
 
 # --- Ollama API 调用函数 (保持不变) ---
-def call_ollama_api(prompt_content: str, messages_history: list = None) -> tuple[str, dict | None]:
-    # ... (您现有的 call_ollama_api 代码) ...
-    current_messages = []
-    if messages_history:
-        current_messages.extend(messages_history)
-    current_messages.append({"role": "user", "content": prompt_content})
+def call_ollama_api(prompt_content: str, messages_history: list = None, response_schema: dict = None) -> tuple[str, dict | None]:
+    # 指定 response_schema 时通过 Ollama 的 format 参数约束输出；模板的固定前缀作为开头的 system 消息，便于复用 KV 缓存
+    current_messages = prompt_layout.layout_messages(prompt_content, messages_history)
     payload = {
         "model": settings.OLLAMA_MODEL, "messages": current_messages, "stream": False
     }
+    if response_schema:
+        payload["format"] = response_schema
     headers = {"Content-Type": "application/json"}
     error_msg_prefix = "错误："
     try:
         logger.debug(f"向 Ollama API ({settings.OLLAMA_API_URL}) 发送请求。模型: {settings.OLLAMA_MODEL}")
-        response = requests.post(
-            settings.OLLAMA_API_URL, headers=headers, data=json.dumps(payload), timeout=180
+        response = transport.post(
+            settings.OLLAMA_API_URL, provider="ollama", headers=headers, data=json.dumps(payload), timeout=180
         )
         response.raise_for_status()
         response_data = response.json()
         if "message" in response_data and "content" in response_data["message"]:
             logger.info("成功从 Ollama API 获取响应。")
+            pipeline_metrics.record_usage(response_data.get("prompt_eval_count"), response_data.get("eval_count"))
             raw_content = response_data["message"]["content"]
             cleaned_content = clean_llm_output(raw_content) 
             return cleaned_content, None
@@ -196,24 +229,586 @@ def call_ollama_api(prompt_content: str, messages_history: list = None) -> tuple
 
 
 # --- 通用 LLM 调用接口 (更新) ---
-def invoke_llm(prompt_content: str, messages_history: list = None) -> tuple[str, dict | None]:
+def get_model_name(provider: str) -> str | None:
+    """返回提供者当前配置的模型名称；未知提供者返回 None。"""
+    return {
+        "qwen": settings.QWEN_MODEL_NAME,
+        "gemini": settings.GEMINI_MODEL_NAME,
+        "ollama": settings.OLLAMA_MODEL,
+    }.get(provider)
+
+def _response_cache_key(provider: str, prompt_content: str, messages_history: list | None) -> str:
+    messages = [{"role": m.get("role"), "content": m.get("content", "")} for m in (messages_history or [])]
+    messages.append({"role": "user", "content": prompt_content})
+    schema = structured_output.current_response_schema()
+    options = {"response_schema": schema} if schema else None # JSON 模式的输出与普通输出分开缓存
+    return response_cache.make_cache_key(provider, get_model_name(provider), messages, options)
+
+def _lookup_cached_response(provider: str, prompt_content: str, messages_history: list | None, use_cache: bool):
+    """
+    在响应缓存中查找。返回 (cache, key, cached_text)；未启用缓存时 cache 为 None。
+    use_cache=False 时不读取缓存 (cached_text 为 None)，但仍返回 cache 以便写入新结果。
     """
-    根据 ACTIVE_LLM_PROVIDER 配置调用相应的LLM API。
+    cache = response_cache.get_response_cache()
+    if cache is None or get_model_name(provider) is None:
+        return None, None, None
+    key = _response_cache_key(provider, prompt_content, messages_history)
+    if not use_cache:
+        return cache, key, None
+    cached_text = cache.get(key)
+    if cached_text is not None:
+        logger.info(f"命中LLM响应缓存 (提供者: {provider}, 键: {key[:12]})。")
+    return cache, key, cached_text
+
+def _single_flight_key(
+    provider: str, prompt_content: str, messages_history: list | None, use_cache: bool, cache_key: str | None
+) -> str | None:
+    """
+    返回用于合并并发调用的 key；未启用合并、请求要求新输出 (use_cache=False) 或提供者未知时返回 None。
     """
-    provider = settings.ACTIVE_LLM_PROVIDER
-    logger.info(f"使用 LLM 服务提供者: {provider} (模型: {settings.QWEN_MODEL_NAME if provider == 'qwen' else (settings.GEMINI_MODEL_NAME if provider == 'gemini' else settings.OLLAMA_MODEL)})")
+    if not settings.LLM_SINGLE_FLIGHT_ENABLED or not use_cache or get_model_name(provider) is None:
+        return None
+    return cache_key or _response_cache_key(provider, prompt_content, messages_history)
+
+def _response_format_options() -> dict:
+    # 只有要求结构化输出时才传入 response_schema，普通调用的参数保持不变
+    schema = structured_output.current_response_schema() if settings.LLM_STRUCTURED_OUTPUT_ENABLED else None
+    return {"response_schema": schema} if schema else {}
 
+def _dispatch_llm_call(provider: str, prompt_content: str, messages_history: list | None) -> tuple[str, dict | None]:
+    options = _response_format_options()
     if provider == "gemini":
-        return call_gemini_api(prompt_content, messages_history)
+        return call_gemini_api(prompt_content, messages_history, **options)
     elif provider == "ollama":
-        return call_ollama_api(prompt_content, messages_history)
+        return call_ollama_api(prompt_content, messages_history, **options)
     elif provider == "qwen": # 2. 添加对 qwen 的处理
-        return call_qwen_api(prompt_content, messages_history)
+        return call_qwen_api(prompt_content, messages_history, **options)
+    else:
+        error_msg = f"错误：未知的LLM服务提供者配置 '{provider}'。"
+        logger.error(error_msg)
+        return error_msg, {"type": "ConfigurationError", "details": f"ACTIVE_LLM_PROVIDER '{provider}' 不被支持。"}
+
+def _provider_span_attributes(provider: str) -> dict:
+    return {"llm.provider": provider, "llm.model": get_model_name(provider)}
+
+def _end_provider_span(span: tracing.Span | None, usage: tuple[int, int, bool, int] | None, error: dict | None) -> None:
+    # 每次实际的上游尝试 (包括重试) 各有一个 span，失败的尝试带有 error.type
+    if span is None:
+        return
+    if usage is not None:
+        span.set_attributes({
+            "llm.input_tokens": usage[0], "llm.output_tokens": usage[1], "llm.tokens_estimated": usage[2],
+            "llm.cached_input_tokens": usage[3],
+        })
+    span.record_error(error)
+
+def _invoke_provider(provider: str, prompt_content: str, messages_history: list | None, use_cache: bool) -> tuple[str, dict | None]:
+    """
+    对单个提供者执行一次调用：响应缓存 → 在途请求合并 → 熔断器与有限重试 → 客户端限流排队 → 实际调用
+    (每次尝试的延迟与结果记录到路由器，排队时间不计入延迟)。
+    """
+    logger.info(f"使用 LLM 服务提供者: {provider} (模型: {get_model_name(provider)})")
+    cache, cache_key, cached_text = _lookup_cached_response(provider, prompt_content, messages_history, use_cache)
+    if cached_text is not None:
+        pipeline_metrics.record_cache_hit(provider, get_model_name(provider))
+        return cached_text, None
+    def timed_call(requested_at: float):
+        started = time.perf_counter()
+        pipeline_metrics.record_queue_wait(started - requested_at)
+        with tracing.start_span(f"llm.{provider}", tracing.KIND_CLIENT, _provider_span_attributes(provider)) as span:
+            with service_metrics.llm_call_in_flight(provider):
+                result, error = _dispatch_llm_call(provider, prompt_content, messages_history)
+            elapsed = time.perf_counter() - started
+            provider_router.record_call(provider, elapsed, error is None)
+            usage = pipeline_metrics.record_attempt(provider, get_model_name(provider), prompt_content, messages_history, result, error)
+            service_metrics.observe_llm_call(provider, get_model_name(provider), elapsed, error, usage)
+            _end_provider_span(span, usage, error)
+        return result, error
+    def attempt():
+        prompt_tokens = rate_limit.estimate_message_tokens(prompt_content, messages_history)
+        requested_at = time.perf_counter()
+        return rate_limit.limited_call(provider, get_model_name(provider), prompt_tokens, lambda: timed_call(requested_at))
+    def call_and_store():
+        if get_model_name(provider) is None:
+            return attempt()
+        result, error = resilience.call_with_retries(provider, attempt)
+        if cache is not None and error is None:
+            cache.put(cache_key, result)
+        return result, error
+    flight_key = _single_flight_key(provider, prompt_content, messages_history, use_cache, cache_key)
+    if flight_key is None:
+        return call_and_store()
+    return single_flight.get_sync_group().do(flight_key, call_and_store)
+
+def _log_failover(provider: str, error: dict, next_provider: str) -> None:
+    logger.warning(f"提供者 '{provider}' 调用失败 ({error.get('type')})，故障转移到 '{next_provider}'。")
+
+def invoke_llm(prompt_content: str, messages_history: list = None, use_cache: bool = True) -> tuple[str, dict | None]:
+    """
+    调用LLM API。默认使用 ACTIVE_LLM_PROVIDER；配置了 LLM_ROUTER_PROVIDERS 时，
+    按路由器给出的健康顺序选择提供者，失败时自动故障转移到下一个提供者。
+
+    启用响应缓存 (LLM_CACHE_ENABLED) 时，相同的请求直接返回缓存结果；
+    传入 use_cache=False 可跳过缓存获取新的输出 (新结果仍会写入缓存)。
+    相同请求的并发调用会被合并为一次上游调用 (LLM_SINGLE_FLIGHT_ENABLED)。
+    """
+    providers = provider_router.route_providers()
+    for attempt, provider in enumerate(providers):
+        result, error = _invoke_provider(provider, prompt_content, messages_history, use_cache)
+        if error is None or attempt == len(providers) - 1:
+            return result, error
+        _log_failover(provider, error, providers[attempt + 1])
+
+# --- 异步 LLM 调用 (基于 httpx.AsyncClient，供 FastAPI 端点使用) ---
+# 同步版本依赖各厂商 SDK；异步版本直接调用各服务的 HTTP 接口，
+# 以便在单个事件循环中同时保持大量在途请求。返回值约定与同步版本一致。
+def _to_chat_messages(prompt_content: str, messages_history: list | None) -> list[dict]:
+    messages = []
+    for msg in prompt_layout.layout_messages(prompt_content, messages_history):
+        role = msg.get("role")
+        if role not in ("user", "assistant", "system"):
+            logger.warning(f"未知的消息角色 '{role}'，默认为 'user'。")
+            role = "user"
+        messages.append({"role": role, "content": msg.get("content", "")})
+    return prompt_layout.qwen_cache_marked(messages)
+
+def _to_gemini_rest_payload(prompt_content: str, messages_history: list | None) -> dict:
+    # 模板的固定前缀放在 systemInstruction 中，位于请求的最前面
+    system_instruction, messages = prompt_layout.split_system_messages(
+        prompt_layout.layout_messages(prompt_content, messages_history)
+    )
+    contents = []
+    for msg in messages:
+        gemini_role = "user" if msg.get("role") == "user" else "model"
+        contents.append({"role": gemini_role, "parts": [{"text": msg.get("content", "")}]})
+    payload = {"contents": contents}
+    if system_instruction is not None:
+        payload["systemInstruction"] = {"parts": [{"text": system_instruction}]}
+    return payload
+
+def _qwen_cached_tokens(prompt_tokens_details) -> int | None:
+    # DashScope 在 usage.prompt_tokens_details.cached_tokens 中返回命中上下文缓存的输入 token 数
+    if isinstance(prompt_tokens_details, dict):
+        return prompt_tokens_details.get("cached_tokens")
+    return None
+
+def _json_body_or_empty(response: httpx.Response) -> dict:
+    try:
+        data = response.json()
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+async def call_qwen_api_async(prompt_content: str, messages_history: list = None, response_schema: dict = None) -> tuple[str, dict | None]:
+    """
+    异步调用通义千问 (Qwen)，使用 DashScope 的 HTTP 接口。指定 response_schema 时使用 JSON 输出模式。
+    """
+    if not settings.QWEN_API_KEY_FROM_ENV:
+        error_msg = "错误：通义千问 API 密钥 (DASHSCOPE_API_KEY 或 QWEN_API_KEY) 未在 .env 文件中配置。"
+        logger.error(error_msg)
+        return error_msg, {"type": "ConfigurationError", "details": "API key for Qwen is not set."}
+    url = f"{settings.QWEN_API_BASE_URL}/services/aigc/text-generation/generation"
+    payload = {
+        "model": settings.QWEN_MODEL_NAME,
+        "input": {"messages": _to_chat_messages(prompt_content, messages_history)},
+        "parameters": {"result_format": "message"},
+    }
+    if response_schema:
+        payload["parameters"]["response_format"] = {"type": "json_object"}
+    headers = {"Authorization": f"Bearer {settings.QWEN_API_KEY_FROM_ENV}", "Content-Type": "application/json"}
+    try:
+        logger.debug(f"异步请求通义千问 API ({settings.QWEN_MODEL_NAME})。最后提示: {prompt_content[:100]}...")
+        client = transport.get_async_client("qwen")
+        response = await client.post(url, headers=headers, json=payload)
+        # 网关返回的 5xx 可能是 HTML 或空响应体：响应体解析失败时按空对象处理，保证错误中保留状态码
+        response_data = _json_body_or_empty(response)
+        if response.status_code == HTTPStatus.OK:
+            choices = (response_data.get("output") or {}).get("choices") or []
+            content = choices[0].get("message", {}).get("content") if choices else None
+            if content:
+                usage = response_data.get("usage") or {}
+                pipeline_metrics.record_usage(
+                    usage.get("input_tokens"), usage.get("output_tokens"), _qwen_cached_tokens(usage.get("prompt_tokens_details")),
+                )
+                logger.info(f"成功从通义千问 API ({settings.QWEN_MODEL_NAME}) 获取响应。")
+                return clean_llm_output(content), None
+            error_msg = "通义千问 API响应格式不符合预期（缺少output、choices或content）。"
+            logger.warning(f"{error_msg} 响应: {response.text[:500]}")
+            return f"错误：{error_msg}", {"type": "QwenFormatError", "details": str(response_data or response.text[:500])}
+        error_msg = (
+            f"通义千问 API 调用失败。状态码: {response.status_code}。"
+            f"请求ID: {response_data.get('request_id', 'N/A')}。"
+            f"错误代码: {response_data.get('code', 'N/A')}。"
+            f"错误消息: {response_data.get('message', 'N/A')}"
+        )
+        logger.error(error_msg)
+        return f"错误：{error_msg}", {
+            "type": "QwenAPIError",
+            "status_code": response.status_code,
+            "request_id": response_data.get("request_id"),
+            "error_code": response_data.get("code"),
+            "error_message_from_api": response_data.get("message"),
+            "raw_response": response.text,
+        }
+    except httpx.TimeoutException as e:
+        error_msg = f"请求通义千问 API 超时 ({settings.QWEN_MODEL_NAME})"
+        logger.error(f"{error_msg}. 详细错误: {e}")
+        return f"错误：{error_msg}", {"type": "TimeoutError", "url": url, "details": str(e)}
+    except httpx.TransportError as e:
+        error_msg = f"无法连接到通义千问服务: {url}"
+        logger.error(f"{error_msg}. 详细错误: {e}")
+        return f"错误：{error_msg}", {"type": "ConnectionError", "url": url, "details": str(e)}
+    except Exception as e:
+        error_msg = f"调用通义千问 API ({settings.QWEN_MODEL_NAME}) 时发生SDK或未知错误: {type(e).__name__} - {e}"
+        logger.exception(error_msg)
+        return f"错误：{error_msg}", {"type": "QwenSDKError", "exception_type": type(e).__name__, "details": str(e)}
+
+async def call_gemini_api_async(prompt_content: str, messages_history: list = None, response_schema: dict = None) -> tuple[str, dict | None]:
+    """
+    异步调用 Gemini，使用 generateContent REST 接口。指定 response_schema 时使用 JSON 输出模式与 responseSchema。
+    """
+    if not settings.GEMINI_API_KEY:
+        error_msg = "错误：Gemini API 密钥未配置。"
+        logger.error(error_msg)
+        return error_msg, {"type": "ConfigurationError", "details": "GEMINI_API_KEY is not set."}
+    url = f"{settings.GEMINI_API_BASE_URL}/models/{settings.GEMINI_MODEL_NAME}:generateContent"
+    payload = _to_gemini_rest_payload(prompt_content, messages_history)
+    if response_schema:
+        payload["generationConfig"] = {
+            "responseMimeType": "application/json",
+            "responseSchema": structured_output.to_gemini_schema(response_schema),
+        }
+    headers = {"x-goog-api-key": settings.GEMINI_API_KEY, "Content-Type": "application/json"}
+    try:
+        logger.debug(f"异步请求 Gemini API ({settings.GEMINI_MODEL_NAME})。最后提示: {prompt_content[:100]}...")
+        client = transport.get_async_client("gemini")
+        response = await client.post(url, headers=headers, json=payload)
+        response.raise_for_status()
+        response_data = response.json()
+        candidates = response_data.get("candidates") or []
+        parts = (candidates[0].get("content") or {}).get("parts") if candidates else None
+        if parts:
+            generated_text = "".join(part.get("text", "") for part in parts)
+            usage = response_data.get("usageMetadata") or {}
+            pipeline_metrics.record_usage(
+                usage.get("promptTokenCount"), usage.get("candidatesTokenCount"), usage.get("cachedContentTokenCount"),
+            )
+            logger.info(f"成功从 Gemini API ({settings.GEMINI_MODEL_NAME}) 获取响应。")
+            return generated_text.strip(), None
+        prompt_feedback = response_data.get("promptFeedback") or {}
+        block_reason = prompt_feedback.get("blockReason", "未知")
+        safety_ratings_str = str(prompt_feedback.get("safetyRatings", "无"))
+        error_msg = f"Gemini API 未返回有效内容。可能原因: 内容被安全过滤器阻止 (原因: {block_reason}). 安全评级: {safety_ratings_str}"
+        logger.warning(error_msg)
+        return f"错误：{error_msg}", {"type": "GeminiContentError", "block_reason": str(block_reason), "safety_ratings": safety_ratings_str, "raw_response": str(response_data)}
+    except httpx.TimeoutException as e:
+        error_msg = f"请求 Gemini API 超时 ({settings.GEMINI_MODEL_NAME})"
+        logger.error(f"{error_msg}. 详细错误: {e}")
+        return f"错误：{error_msg}", {"type": "TimeoutError", "url": url, "details": str(e)}
+    except httpx.TransportError as e:
+        error_msg = f"无法连接到 Gemini 服务: {url}"
+        logger.error(f"{error_msg}. 详细错误: {e}")
+        return f"错误：{error_msg}", {"type": "ConnectionError", "url": url, "details": str(e)}
+    except Exception as e:
+        error_msg = f"调用 Gemini API ({settings.GEMINI_MODEL_NAME}) 时发生错误: {type(e).__name__} - {e}"
+        logger.exception(error_msg)
+        details = {"type": "GeminiAPIError", "exception_type": type(e).__name__, "details": str(e)}
+        if isinstance(e, httpx.HTTPStatusError):
+            details["status_code"] = e.response.status_code
+        return f"错误：{error_msg}", details
+
+async def call_ollama_api_async(prompt_content: str, messages_history: list = None, response_schema: dict = None) -> tuple[str, dict | None]:
+    """
+    异步调用 Ollama /api/chat 接口。指定 response_schema 时通过 format 参数约束输出。
+    """
+    current_messages = prompt_layout.layout_messages(prompt_content, messages_history)
+    payload = {
+        "model": settings.OLLAMA_MODEL, "messages": current_messages, "stream": False
+    }
+    if response_schema:
+        payload["format"] = response_schema
+    error_msg_prefix = "错误："
+    response = None
+    try:
+        logger.debug(f"异步请求 Ollama API ({settings.OLLAMA_API_URL})。模型: {settings.OLLAMA_MODEL}")
+        client = transport.get_async_client("ollama")
+        response = await client.post(settings.OLLAMA_API_URL, json=payload)
+        response.raise_for_status()
+        response_data = response.json()
+        if "message" in response_data and "content" in response_data["message"]:
+            logger.info("成功从 Ollama API 获取响应。")
+            pipeline_metrics.record_usage(response_data.get("prompt_eval_count"), response_data.get("eval_count"))
+            return clean_llm_output(response_data["message"]["content"]), None
+        error_msg = "Ollama API响应格式不符合预期"
+        logger.warning(f"{error_msg}。响应数据: {response_data}")
+        return f"{error_msg_prefix}{error_msg}", {"type": "FormatError", "details": response_data}
+    except httpx.TimeoutException as e:
+        error_msg = f"请求Ollama API超时 ({settings.OLLAMA_API_URL})"
+        logger.error(f"{error_msg}. 详细错误: {e}")
+        return f"{error_msg_prefix}{error_msg}", {"type": "TimeoutError", "url": settings.OLLAMA_API_URL, "details": str(e)}
+    except httpx.TransportError as e:
+        error_msg = f"无法连接到Ollama服务: {settings.OLLAMA_API_URL}"
+        logger.error(f"{error_msg}. 详细错误: {e}")
+        return f"{error_msg_prefix}{error_msg}", {"type": "ConnectionError", "url": settings.OLLAMA_API_URL, "details": str(e)}
+    except httpx.HTTPStatusError as e:
+        error_text_for_user = f"Ollama API交互失败 (HTTP {e.response.status_code})"
+        logger.error(f"{error_text_for_user}. 响应内容: {e.response.text}")
+        details = {"type": "HTTPError", "status_code": e.response.status_code, "raw_response": e.response.text}
+        try:
+            error_details_json = e.response.json()
+            if "error" in error_details_json:
+                error_text_for_user += f". Ollama错误: {error_details_json['error']}"
+                details["ollama_error"] = error_details_json["error"]
+        except json.JSONDecodeError:
+            logger.warning("解析HTTPError的响应体为JSON时失败。")
+        return f"{error_msg_prefix}{error_text_for_user}", details
+    except json.JSONDecodeError as e:
+        error_msg = "解析Ollama API响应为JSON时失败"
+        raw_response_text = response.text[:500] if response is not None else "未知"
+        logger.error(f"{error_msg}. 详细错误: {e}. 部分原始响应: {raw_response_text}")
+        return f"{error_msg_prefix}{error_msg}", {"type": "JSONDecodeError", "details": str(e), "raw_response_snippet": raw_response_text}
+    except Exception as e:
+        logger.exception(f"异步调用Ollama API时发生未知错误。原始错误: {e}")
+        return f"{error_msg_prefix}调用Ollama API时发生未知内部错误", {"type": "UnknownError", "exception_type": e.__class__.__name__, "details": "详情请查看应用日志"}
+
+async def _dispatch_llm_call_async(provider: str, prompt_content: str, messages_history: list | None) -> tuple[str, dict | None]:
+    options = _response_format_options()
+    if provider == "gemini":
+        return await call_gemini_api_async(prompt_content, messages_history, **options)
+    elif provider == "ollama":
+        return await call_ollama_api_async(prompt_content, messages_history, **options)
+    elif provider == "qwen":
+        return await call_qwen_api_async(prompt_content, messages_history, **options)
     else:
         error_msg = f"错误：未知的LLM服务提供者配置 '{provider}'。"
         logger.error(error_msg)
         return error_msg, {"type": "ConfigurationError", "details": f"ACTIVE_LLM_PROVIDER '{provider}' 不被支持。"}
 
+async def _run_cache_io(cache: response_cache.ResponseCache | None, func, *args):
+    # 磁盘层的读写是阻塞 IO：启用磁盘层时放到线程池执行，避免阻塞事件循环；纯内存缓存直接调用
+    if cache is not None and cache.disk_dir is not None:
+        return await asyncio.to_thread(func, *args)
+    return func(*args)
+
+async def _invoke_provider_async(provider: str, prompt_content: str, messages_history: list | None, use_cache: bool) -> tuple[str, dict | None]:
+    logger.info(f"(async) 使用 LLM 服务提供者: {provider} (模型: {get_model_name(provider)})")
+    cache, cache_key, cached_text = await _run_cache_io(
+        response_cache.get_response_cache(), _lookup_cached_response, provider, prompt_content, messages_history, use_cache,
+    )
+    if cached_text is not None:
+        pipeline_metrics.record_cache_hit(provider, get_model_name(provider))
+        return cached_text, None
+    async def timed_call(requested_at: float):
+        started = time.perf_counter()
+        pipeline_metrics.record_queue_wait(started - requested_at)
+        with tracing.start_span(f"llm.{provider}", tracing.KIND_CLIENT, _provider_span_attributes(provider)) as span:
+            with service_metrics.llm_call_in_flight(provider):
+                result, error = await _dispatch_llm_call_async(provider, prompt_content, messages_history)
+            elapsed = time.perf_counter() - started
+            provider_router.record_call(provider, elapsed, error is None)
+            usage = pipeline_metrics.record_attempt(provider, get_model_name(provider), prompt_content, messages_history, result, error)
+            service_metrics.observe_llm_call(provider, get_model_name(provider), elapsed, error, usage)
+            _end_provider_span(span, usage, error)
+        return result, error
+    async def attempt():
+        prompt_tokens = rate_limit.estimate_message_tokens(prompt_content, messages_history)
+        requested_at = time.perf_counter()
+        return await rate_limit.limited_call_async(provider, get_model_name(provider), prompt_tokens, lambda: timed_call(requested_at))
+    async def call_and_store():
+        if get_model_name(provider) is None:
+            return await attempt()
+        result, error = await resilience.call_with_retries_async(provider, attempt)
+        if cache is not None and error is None:
+            await _run_cache_io(cache, cache.put, cache_key, result)
+        return result, error
+    flight_key = _single_flight_key(provider, prompt_content, messages_history, use_cache, cache_key)
+    if flight_key is None:
+        return await call_and_store()
+    return await single_flight.get_async_group().do(flight_key, call_and_store)
+
+async def invoke_llm_async(prompt_content: str, messages_history: list = None, use_cache: bool = True) -> tuple[str, dict | None]:
+    """
+    invoke_llm 的异步版本：调用相应的异步适配器，路由、故障转移、缓存与请求合并行为与 invoke_llm 相同。
+    """
+    providers = provider_router.route_providers()
+    for attempt, provider in enumerate(providers):
+        result, error = await _invoke_provider_async(provider, prompt_content, messages_history, use_cache)
+        if error is None or attempt == len(providers) - 1:
+            return result, error
+        _log_failover(provider, error, providers[attempt + 1])
+
+# --- 流式 LLM 调用 (供 SSE 端点使用) ---
+# 以异步生成器的形式逐块产出 (文本片段, None)；出错时产出一个 (错误消息, 错误详情) 后结束。
+# 思考标记 (<<think>>) 在流式过程中无法可靠剔除，调用方应在结束后对完整文本调用 clean_llm_output。
+async def _iter_sse_data(response: httpx.Response):
+    async for line in response.aiter_lines():
+        if line.startswith("data:"):
+            data = line[5:].strip()
+            if data and data != "[DONE]":
+                yield data
+
+def _stream_exception_to_error(provider_label: str, url: str, e: Exception) -> tuple[str, dict]:
+    if isinstance(e, httpx.TimeoutException):
+        logger.error(f"流式请求 {provider_label} 超时: {e}")
+        return f"错误：请求{provider_label} API超时", {"type": "TimeoutError", "url": url, "details": str(e)}
+    if isinstance(e, httpx.TransportError):
+        logger.error(f"流式请求时无法连接到 {provider_label}: {e}")
+        return f"错误：无法连接到{provider_label}服务: {url}", {"type": "ConnectionError", "url": url, "details": str(e)}
+    if isinstance(e, httpx.HTTPStatusError):
+        logger.error(f"流式请求 {provider_label} 失败 (HTTP {e.response.status_code})")
+        return f"错误：{provider_label} API交互失败 (HTTP {e.response.status_code})", {"type": "HTTPError", "status_code": e.response.status_code}
+    logger.exception(f"流式请求 {provider_label} 时发生未知错误: {e}")
+    return f"错误：流式调用{provider_label}时发生未知内部错误", {"type": "UnknownError", "exception_type": e.__class__.__name__, "details": str(e)}
+
+async def stream_ollama_api_async(prompt_content: str, messages_history: list = None):
+    current_messages = prompt_layout.layout_messages(prompt_content, messages_history)
+    payload = {"model": settings.OLLAMA_MODEL, "messages": current_messages, "stream": True}
+    try:
+        client = transport.get_async_client("ollama")
+        async with client.stream("POST", settings.OLLAMA_API_URL, json=payload) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines(): # Ollama 以 NDJSON 逐行返回
+                if not line.strip():
+                    continue
+                chunk = json.loads(line)
+                if chunk.get("error"):
+                    yield f"错误：Ollama错误: {chunk['error']}", {"type": "HTTPError", "ollama_error": chunk["error"]}
+                    return
+                text = (chunk.get("message") or {}).get("content")
+                if text:
+                    yield text, None
+                if chunk.get("done"):
+                    break
+    except Exception as e:
+        yield _stream_exception_to_error("Ollama", settings.OLLAMA_API_URL, e)
+
+async def stream_qwen_api_async(prompt_content: str, messages_history: list = None):
+    if not settings.QWEN_API_KEY_FROM_ENV:
+        yield "错误：通义千问 API 密钥 (DASHSCOPE_API_KEY 或 QWEN_API_KEY) 未在 .env 文件中配置。", {"type": "ConfigurationError", "details": "API key for Qwen is not set."}
+        return
+    url = f"{settings.QWEN_API_BASE_URL}/services/aigc/text-generation/generation"
+    payload = {
+        "model": settings.QWEN_MODEL_NAME,
+        "input": {"messages": _to_chat_messages(prompt_content, messages_history)},
+        "parameters": {"result_format": "message", "incremental_output": True},
+    }
+    headers = {
+        "Authorization": f"Bearer {settings.QWEN_API_KEY_FROM_ENV}",
+        "Content-Type": "application/json",
+        "X-DashScope-SSE": "enable",
+    }
+    try:
+        client = transport.get_async_client("qwen")
+        async with client.stream("POST", url, headers=headers, json=payload) as response:
+            response.raise_for_status()
+            async for data in _iter_sse_data(response):
+                chunk = json.loads(data)
+                if chunk.get("code") and not chunk.get("output"):
+                    yield f"错误：通义千问 API 调用失败。错误代码: {chunk.get('code')}。错误消息: {chunk.get('message')}", {
+                        "type": "QwenAPIError", "error_code": chunk.get("code"),
+                        "error_message_from_api": chunk.get("message"), "request_id": chunk.get("request_id"),
+                    }
+                    return
+                choices = (chunk.get("output") or {}).get("choices") or []
+                text = choices[0].get("message", {}).get("content") if choices else None
+                if text:
+                    yield text, None
+    except Exception as e:
+        yield _stream_exception_to_error("通义千问", url, e)
+
+async def stream_gemini_api_async(prompt_content: str, messages_history: list = None):
+    if not settings.GEMINI_API_KEY:
+        yield "错误：Gemini API 密钥未配置。", {"type": "ConfigurationError", "details": "GEMINI_API_KEY is not set."}
+        return
+    url = f"{settings.GEMINI_API_BASE_URL}/models/{settings.GEMINI_MODEL_NAME}:streamGenerateContent"
+    payload = _to_gemini_rest_payload(prompt_content, messages_history)
+    headers = {"x-goog-api-key": settings.GEMINI_API_KEY, "Content-Type": "application/json"}
+    try:
+        client = transport.get_async_client("gemini")
+        async with client.stream("POST", url, params={"alt": "sse"}, headers=headers, json=payload) as response:
+            response.raise_for_status()
+            async for data in _iter_sse_data(response):
+                chunk = json.loads(data)
+                candidates = chunk.get("candidates") or []
+                parts = (candidates[0].get("content") or {}).get("parts") if candidates else None
+                if parts:
+                    text = "".join(part.get("text", "") for part in parts)
+                    if text:
+                        yield text, None
+                elif (chunk.get("promptFeedback") or {}).get("blockReason"):
+                    block_reason = chunk["promptFeedback"]["blockReason"]
+                    yield f"错误：Gemini API 未返回有效内容。可能原因: 内容被安全过滤器阻止 (原因: {block_reason})", {"type": "GeminiContentError", "block_reason": str(block_reason)}
+                    return
+    except Exception as e:
+        yield _stream_exception_to_error("Gemini", url, e)
+
+def _open_provider_stream(provider: str, prompt_content: str, messages_history: list | None):
+    if provider == "gemini":
+        return stream_gemini_api_async(prompt_content, messages_history)
+    elif provider == "ollama":
+        return stream_ollama_api_async(prompt_content, messages_history)
+    elif provider == "qwen":
+        return stream_qwen_api_async(prompt_content, messages_history)
+    return None
+
+async def stream_llm_async(prompt_content: str, messages_history: list = None):
+    """
+    以流式方式调用LLM，逐块产出 (文本片段, 错误详情)。提供者的选择与 invoke_llm 相同；
+    只有在尚未产出任何文本片段时发生的错误才会故障转移到下一个提供者。
+    """
+    providers = provider_router.route_providers()
+    for attempt, provider in enumerate(providers):
+        is_last = attempt == len(providers) - 1
+        logger.info(f"(stream) 使用 LLM 服务提供者: {provider}")
+        if get_model_name(provider) is None:
+            error_msg = f"错误：未知的LLM服务提供者配置 '{provider}'。"
+            logger.error(error_msg)
+            yield error_msg, {"type": "ConfigurationError", "details": f"ACTIVE_LLM_PROVIDER '{provider}' 不被支持。"}
+            return
+        breaker = resilience.get_breaker(provider)
+        if not breaker.allow():
+            error_text, error = breaker.open_error()
+            if is_last:
+                yield error_text, error
+                return
+            _log_failover(provider, error, providers[attempt + 1])
+            continue
+        stream = _open_provider_stream(provider, prompt_content, messages_history)
+        prompt_tokens = rate_limit.estimate_message_tokens(prompt_content, messages_history)
+        produced, last_error, output_tokens = False, None, 0
+        try:
+            # 流式调用在整个流期间占用一个并发额度
+            async with rate_limit.slot_for_async(provider, get_model_name(provider), prompt_tokens):
+                started = time.perf_counter()
+                with service_metrics.llm_call_in_flight(provider):
+                    async for text, error in stream:
+                        if error and not produced and not is_last:
+                            last_error = error
+                            _log_failover(provider, error, providers[attempt + 1])
+                            break
+                        produced, last_error = produced or not error, error or last_error
+                        if not error:
+                            output_tokens += rate_limit.estimate_tokens(text)
+                        yield text, error
+        except rate_limit.RateLimitQueueTimeout as e:
+            error_text, error = rate_limit.queue_timeout_error(e)
+            breaker.record(resilience.REQUEST)
+            if is_last:
+                yield error_text, error
+                return
+            _log_failover(provider, error, providers[attempt + 1])
+            continue
+        finally:
+            # 故障转移时提前 break 或调用方放弃迭代时，立即关闭底层的 HTTP 流并归还连接，而不是等待垃圾回收
+            await stream.aclose()
+        elapsed = time.perf_counter() - started
+        provider_router.record_call(provider, elapsed, last_error is None)
+        usage = None if last_error else (prompt_tokens, output_tokens, True)
+        service_metrics.observe_llm_call(provider, get_model_name(provider), elapsed, last_error, usage)
+        breaker.record(resilience.classify_error(last_error), last_error.get("type") if last_error else None)
+        if last_error is None or produced or is_last:
+            return
+
 # --- 辅助函数 (如 clean_llm_output, load_and_format_structured_prompt 保持不变) ---
 # ... (clean_llm_output, load_and_format_structured_prompt, generate_and_refine_prompt, explain_term_in_prompt, load_feedback, save_feedback 函数定义) ...
 # 注意：generate_and_refine_prompt 和 explain_term_in_prompt 内部调用 invoke_llm 的逻辑不需要改变。
@@ -237,154 +832,469 @@ def clean_llm_output(text: str) -> str:
             return text.strip()
 
 def load_and_format_structured_prompt(template_name: str, user_request: str, variables: dict | None) -> str | None:
-    if not isinstance(STRUCTURED_PROMPT_TEMPLATES, dict):
-        logger.critical(
-            f"STRUCTURED_PROMPT_TEMPLATES 不是一个字典 (实际类型: {type(STRUCTURED_PROMPT_TEMPLATES)}). "
-        )
-        return None 
     logger.debug(f"尝试加载并格式化结构化模板: '{template_name}'，用户请求: '{user_request[:50]}...', 变量: {variables}")
-    if template_name not in STRUCTURED_PROMPT_TEMPLATES:
-        logger.warning(f"未找到名为 '{template_name}' 的结构化提示模板。可用模板: {list(STRUCTURED_PROMPT_TEMPLATES.keys())}")
+    registry = template_registry.get_registry()
+    template = registry.get(template_name)
+    if template is None:
+        logger.warning(f"未找到名为 '{template_name}' 的结构化提示模板。可用模板: {registry.names()}")
         return None
-    template_data = STRUCTURED_PROMPT_TEMPLATES[template_name]
-    if not isinstance(template_data, dict):
-        logger.error(f"模板 '{template_name}' 的数据格式不正确，期望是一个字典，实际是 {type(template_data)}。")
+    actual_vars = variables if variables is not None else {}
+    missing_vars = template.missing_variables(actual_vars)
+    if missing_vars:
+        logger.warning(
+            f"结构化提示模板 '{template_name}' 需要以下变量的值，但未提供或为空: {', '.join(missing_vars)}。"
+            f"提供的变量键: {list(actual_vars.keys())}"
+        )
         return None
-    required_vars = template_data.get("variables", [])
-    if not isinstance(required_vars, list): 
-        logger.error(f"模板 '{template_name}' 中的 'variables' 属性不是一个列表，实际是 {type(required_vars)}。")
-        required_vars = [] 
-    if required_vars:
-        actual_vars = variables if variables is not None else {}
-        missing_vars = [
-            var for var in required_vars
-            if var not in actual_vars or not str(actual_vars.get(var, "")).strip()
-        ]
-        if missing_vars:
-            logger.warning(
-                f"结构化提示模板 '{template_name}' 需要以下变量的值，但未提供或为空: {', '.join(missing_vars)}。"
-                f"提供的变量键: {list(actual_vars.keys())}"
+    # 编译时已保证占位符都在 variables 中声明 (或为 user_raw_request)，上面的检查通过后不会缺值
+    final_prompt_content = template.render({**actual_vars, template_registry.USER_REQUEST_FIELD: user_request})
+    logger.info(f"成功格式化结构化模板 '{template_name}'。")
+    return final_prompt_content
+
+def _empty_results() -> dict:
+    return {
+        "initial_core_prompt": "", "p1_initial_optimized_prompt": "",
+        "evaluation_reports": [], "refined_prompts": [], "final_prompt": "",
+        "error_message": None, "error_details": None,
+    }
+
+def _unhandled_error_results(e: Exception) -> dict:
+    results = _empty_results()
+    results["error_message"] = "处理请求时发生内部错误，请稍后再试或联系管理员。"
+    results["error_details"] = {"type": "UnhandledException", "exception_type": e.__class__.__name__, "message": str(e)}
+    return results
+
+def _build_initial_core_prompt(
+    user_raw_request: str, task_type: str,
+    use_structured_template_name: str | None, structured_template_vars: dict | None
+) -> tuple[str, template_registry.CompiledTemplate | None]:
+    """
+    返回 (核心提示, 使用的结构化模板)，未使用模板时第二项为 None。
+    构建期间固定使用同一个注册表，模板热更新不会使提示与记录的模板版本不一致。
+    """
+    registry = template_registry.get_registry()
+    if use_structured_template_name and structured_template_vars:
+        with template_registry.pinned(registry):
+            formatted_prompt_from_structure = load_and_format_structured_prompt(
+                use_structured_template_name, user_raw_request, structured_template_vars
             )
-            return None
+        if formatted_prompt_from_structure:
+            return formatted_prompt_from_structure, registry.get(use_structured_template_name)
+        logger.warning(f"结构化模板 '{use_structured_template_name}' 处理失败，回退。")
+        return CORE_META_PROMPT_TEMPLATE.format(user_raw_request=user_raw_request), None
+    image_template = registry.get("BasicImageGen") if task_type == "图像生成" else None
+    if image_template is not None:
+        return image_template.render({template_registry.USER_REQUEST_FIELD: user_raw_request}), image_template
+    return CORE_META_PROMPT_TEMPLATE.format(user_raw_request=user_raw_request), None
+
+def _parse_evaluation_report(evaluation_report_str: str, round_index: int) -> dict | str:
+    """
+    将评估报告解析为 JSON (必要时先做容错修复，例如去掉说明文字、补全被截断的括号)；失败时返回原始字符串。
+    """
+    parsed_evaluation_report, repaired = structured_output.parse_json_object(evaluation_report_str)
+    if parsed_evaluation_report is None:
+        logger.warning(f"无法将评估报告 (E{round_index}) 解析为JSON，使用原始字符串。")
+        return evaluation_report_str
+    if repaired:
+        logger.info(f"评估报告 (E{round_index}) 经过容错修复后解析为JSON。")
+    else:
+        logger.info(f"成功解析评估报告 (E{round_index}) 为JSON。")
+    return parsed_evaluation_report
+
+def _evaluation_request(eval_prompt_content: str):
+    # 评估调用要求提供者以 JSON / Schema 模式输出；评估不携带对话历史
+    if settings.LLM_STRUCTURED_OUTPUT_ENABLED:
+        return structured_output.StructuredRequest(eval_prompt_content, [], EVALUATION_REPORT_SCHEMA)
+    return eval_prompt_content, []
+
+def _near_duplicate_scope(
+    task_type: str, use_structured_template_name: str | None, structured_template_vars: dict | None,
+    template_version: str | None = None
+) -> tuple:
+    # 只有任务类型、模板 (及其版本) 和模板变量都相同的请求才可能共享P1；模板更新后不再复用旧模板生成的P1
+    template_vars = json.dumps(structured_template_vars or {}, ensure_ascii=False, sort_keys=True)
+    return (task_type, use_structured_template_name or "", template_version or "", template_vars)
+
+def _best_of_n_p1_steps(user_raw_request: str, initial_core_prompt: str, num_candidates: int, results: dict):
+    """
+    best_of_n 模式的P1阶段：并发生成 num_candidates 个候选P1，再并发评估全部候选。
+    返回 (得分最高的候选, error, 该候选的 (评估提示, (报告, error)))；所有候选都生成失败时返回第一个失败。
+    """
+    candidate_prompts = [initial_core_prompt] + [
+        BEST_OF_N_VARIANT_TEMPLATE.format(core_prompt=initial_core_prompt, index=k + 1, total=num_candidates)
+        for k in range(1, num_candidates)
+    ]
+    outputs = yield [(prompt, None) for prompt in candidate_prompts]
+    candidates = [text for text, error in outputs if not error]
+    if not candidates:
+        return outputs[0][0], outputs[0][1], None
+    eval_prompts = [
+        EVALUATION_META_PROMPT_TEMPLATE.format(user_raw_request=user_raw_request, prompt_to_evaluate=candidate)
+        for candidate in candidates
+    ]
+    evaluations = yield [_evaluation_request(eval_prompt) for eval_prompt in eval_prompts]
+    best_index, best_score = 0, None
+    results["candidates"] = []
+    for index, (candidate, (report_str, error)) in enumerate(zip(candidates, evaluations)):
+        report = None if error else _parse_evaluation_report(report_str, 1)
+        score = None if error else early_stopping.report_score(report)
+        results["candidates"].append({"prompt": candidate, "score": score, "evaluation_report": report, "error_details": error})
+        if score is not None and (best_score is None or score > best_score):
+            best_index, best_score = index, score
+    logger.info(f"best_of_n: {len(candidates)} 个候选的评估分数为 {[c['score'] for c in results['candidates']]}，选择第 {best_index + 1} 个。")
+    return candidates[best_index], None, (eval_prompts[best_index], evaluations[best_index])
+
+def _edit_refinement_steps(
+    round_index: int, current_prompt: str, edit_request: tuple[str, list], fallback_request
+):
+    """
+    编辑列表模式的一轮精炼：模型只返回对当前提示词的编辑列表，由本地应用并校验；
+    编辑无法解析或应用时，调用 fallback_request() 构建完整重新生成的请求作为回退。
+    返回 (精炼后的提示词, error, 本轮的输出 token 统计)。
+    """
+    edits_text, error = yield edit_request
+    if error:
+        return edits_text, error, None
+    output_tokens = rate_limit.estimate_tokens(edits_text)
     try:
-        format_vars = variables.copy() if variables is not None else {}
-        format_vars['user_raw_request'] = user_request 
-        core_template_str = template_data.get("core_template_override")
-        if not isinstance(core_template_str, str): 
-            logger.error(f"模板 '{template_name}' 中的 'core_template_override' 不是一个字符串或未定义。")
-            return None
-        final_prompt_content = core_template_str.format(**format_vars)
-        logger.info(f"成功格式化结构化模板 '{template_name}'。")
-        return final_prompt_content
-    except KeyError as e:
-        logger.error(
-            f"格式化结构化提示模板 '{template_name}' 时缺少预期的变量占位符: '{e}'. ", exc_info=True
-        )
-        return None
-    except Exception as e:
-        logger.exception(f"格式化结构化提示模板 '{template_name}' 时发生未知错误。")
-        return None
+        edits = prompt_edits.parse_edit_list(edits_text)
+        refined_prompt = prompt_edits.apply_edits(current_prompt, edits)
+        stats = {"round": round_index, "applied": True, "edits": len(edits)}
+    except prompt_edits.PromptEditError as e:
+        logger.warning(f"第 {round_index} 轮精炼：编辑列表无法应用 ({e})，回退为完整重新生成。")
+        refined_prompt, error = yield fallback_request()
+        if error:
+            return refined_prompt, error, None
+        output_tokens += rate_limit.estimate_tokens(refined_prompt)
+        stats = {"round": round_index, "applied": False, "edits": 0, "fallback_reason": str(e)}
+    full_output_tokens = rate_limit.estimate_tokens(refined_prompt) # 完整重写同一结果所需的输出 token
+    stats.update({
+        "output_tokens": output_tokens, "full_output_tokens": full_output_tokens,
+        "output_tokens_saved": full_output_tokens - output_tokens,
+    })
+    logger.info(f"第 {round_index} 轮精炼输出约 {output_tokens} tokens (完整重写约 {full_output_tokens} tokens)。")
+    return refined_prompt, None, stats
 
-def generate_and_refine_prompt(
+def _prompt_pipeline_steps(
     user_raw_request: str, task_type: str, enable_self_correction: bool,
     max_recursion_depth: int, use_structured_template_name: str = None,
-    structured_template_vars: dict = None
-) -> dict:
-    try:
-        results = {
-            "initial_core_prompt": "", "p1_initial_optimized_prompt": "",
-            "evaluation_reports": [], "refined_prompts": [], "final_prompt": "",
-            "error_message": None, "error_details": None,
+    structured_template_vars: dict = None, use_near_duplicates: bool = True,
+    self_correction_mode: str | None = None
+):
+    """
+    提示生成与自我校正流程本身，与LLM的调用方式 (同步/异步) 无关。
+
+    这是一个生成器：每需要一次LLM调用就 yield 一个 (prompt_content, messages_history)，
+    由驱动函数执行调用后把 (text, error) send 回来；需要并发执行的多个调用以列表形式 yield，
+    驱动函数并发执行后按相同顺序 send 回结果列表。流程结束时通过 return 给出 results 字典。
+    启用近似重复检测时，与先前请求足够相似的请求会复用 (或以之为种子生成) 该请求的P1。
+    self_correction_mode 为 None 时使用 settings.SELF_CORRECTION_MODE。
+    """
+    results = _empty_results()
+    logger.info(f"开始处理任务类型 '{task_type}' 的请求: '{user_raw_request[:50]}...' (提供者: {settings.ACTIVE_LLM_PROVIDER})")
+    initial_core_prompt_for_llm, template = _build_initial_core_prompt(
+        user_raw_request, task_type, use_structured_template_name, structured_template_vars
+    )
+    results["initial_core_prompt"] = initial_core_prompt_for_llm
+    if template is not None:
+        results["template"] = {"name": template.name, "version": template.version}
+    near_dup_index = near_duplicate.get_near_duplicate_index() if use_near_duplicates else None
+    near_dup_scope = _near_duplicate_scope(
+        task_type, use_structured_template_name, structured_template_vars, template.version if template is not None else None
+    )
+    match = near_dup_index.query(near_dup_scope, user_raw_request) if near_dup_index is not None else None
+    if match:
+        logger.info(f"检测到近似重复请求 (相似度 {match.similarity:.2f}, 模式: {settings.NEAR_DUPLICATE_MODE}): '{match.request_text[:50]}...'")
+        results["near_duplicate"] = {
+            "mode": settings.NEAR_DUPLICATE_MODE, "similarity": match.similarity, "matched_request": match.request_text,
         }
-        logger.info(f"开始处理任务类型 '{task_type}' 的请求: '{user_raw_request[:50]}...' (提供者: {settings.ACTIVE_LLM_PROVIDER})")
-        initial_core_prompt_for_llm = ""
-        if use_structured_template_name and structured_template_vars:
-            formatted_prompt_from_structure = load_and_format_structured_prompt(
-                use_structured_template_name, user_raw_request, structured_template_vars
-            )
-            if formatted_prompt_from_structure:
-                initial_core_prompt_for_llm = formatted_prompt_from_structure
-            else: 
-                logger.warning(f"结构化模板 '{use_structured_template_name}' 处理失败，回退。")
-                initial_core_prompt_for_llm = CORE_META_PROMPT_TEMPLATE.format(user_raw_request=user_raw_request)
+    mode = (self_correction_mode or settings.SELF_CORRECTION_MODE).lower()
+    best_of_n = enable_self_correction and not match and mode == "best_of_n" and settings.BEST_OF_N_CANDIDATES > 1
+    winner_evaluation = None
+    if match and settings.NEAR_DUPLICATE_MODE == "reuse":
+        p1, error = match.p1_prompt, None
+    elif match:
+        seed_prompt = NEAR_DUPLICATE_SEED_TEMPLATE.format(
+            previous_request=match.request_text, previous_prompt=match.p1_prompt, user_raw_request=user_raw_request
+        )
+        p1, error = yield seed_prompt, None
+    elif best_of_n:
+        p1, error, winner_evaluation = yield from _best_of_n_p1_steps(
+            user_raw_request, initial_core_prompt_for_llm, settings.BEST_OF_N_CANDIDATES, results
+        )
+    else:
+        p1, error = yield initial_core_prompt_for_llm, None
+    if error:
+        error_msg_for_results = f"生成初始优化提示失败: {p1}"
+        logger.error(f"调用LLM生成初始提示失败。API返回: {p1}, 错误详情: {error}")
+        results["error_message"] = error_msg_for_results
+        results["error_details"] = error
+        return results
+    results["p1_initial_optimized_prompt"] = p1
+    if near_dup_index is not None and not (match and settings.NEAR_DUPLICATE_MODE == "reuse"):
+        near_dup_index.add(near_dup_scope, user_raw_request, p1)
+    # 以前的做法把每轮的评估与精炼都累积进对话历史；这里只记录其大小，用于统计精炼上下文节省的 token
+    legacy_history_tokens = rate_limit.estimate_tokens(initial_core_prompt_for_llm) + rate_limit.estimate_tokens(p1)
+    current_best_prompt = p1
+    logger.info(f"初步优化后的提示词 (P1):\n{current_best_prompt}")
+    if not enable_self_correction:
+        results["final_prompt"] = current_best_prompt
+        return results
+    stopper = early_stopping.RefinementStopper(
+        score_threshold=settings.EARLY_STOP_SCORE_THRESHOLD,
+        min_improvement=settings.EARLY_STOP_MIN_IMPROVEMENT,
+        similarity_threshold=settings.EARLY_STOP_SIMILARITY,
+    )
+    stop_reason = early_stopping.MAX_ROUNDS
+    for i in range(max_recursion_depth):
+        logger.info(f"开始第 {i+1} 轮自我校正...")
+        if winner_evaluation is not None: # best_of_n 的胜出候选已经评估过，直接使用其评估结果
+            eval_prompt_content, (evaluation_report_str, error) = winner_evaluation
+            winner_evaluation = None
         else:
-            if task_type == "图像生成" and "BasicImageGen" in STRUCTURED_PROMPT_TEMPLATES:
-                 initial_core_prompt_for_llm = STRUCTURED_PROMPT_TEMPLATES["BasicImageGen"]["core_template_override"].format(user_raw_request=user_raw_request)
-            elif task_type == "代码生成" and "BasicCodeSnippet" in STRUCTURED_PROMPT_TEMPLATES:
-                initial_core_prompt_for_llm = CORE_META_PROMPT_TEMPLATE.format(user_raw_request=user_raw_request)
-            else:
-                initial_core_prompt_for_llm = CORE_META_PROMPT_TEMPLATE.format(user_raw_request=user_raw_request)
-        results["initial_core_prompt"] = initial_core_prompt_for_llm
-        conversation_history = []
-        p1, error = invoke_llm(initial_core_prompt_for_llm, None)
-        if error:
-            error_msg_for_results = f"生成初始优化提示失败: {p1}"
-            logger.error(f"调用LLM生成初始提示失败。API返回: {p1}, 错误详情: {error}")
-            results["error_message"] = error_msg_for_results
-            results["error_details"] = error
-            return results
-        results["p1_initial_optimized_prompt"] = p1
-        conversation_history.append({"role": "user", "content": str(initial_core_prompt_for_llm)})
-        conversation_history.append({"role": "assistant", "content": str(p1)})
-        current_best_prompt = p1
-        logger.info(f"初步优化后的提示词 (P1):\n{current_best_prompt}")
-        if not enable_self_correction:
-            results["final_prompt"] = current_best_prompt
-            return results
-        for i in range(max_recursion_depth):
-            logger.info(f"开始第 {i+1} 轮自我校正...")
             eval_prompt_content = EVALUATION_META_PROMPT_TEMPLATE.format(
                 user_raw_request=user_raw_request, prompt_to_evaluate=current_best_prompt
             )
-            evaluation_report_str, error = invoke_llm(eval_prompt_content, []) 
-            if error:
-                logger.warning(f"第 {i+1} 轮自我校正：生成评估报告失败。API返回: {evaluation_report_str}, 错误详情: {error}")
-                break
-            logger.info(f"原始评估报告字符串 (E{i+1}):\n{evaluation_report_str}")
-            parsed_evaluation_report = None
-            try:
-                cleaned_report_str = evaluation_report_str.strip()
-                if cleaned_report_str.startswith("```json"): cleaned_report_str = cleaned_report_str[7:]
-                if cleaned_report_str.endswith("```"): cleaned_report_str = cleaned_report_str[:-3]
-                cleaned_report_str = cleaned_report_str.strip()
-                parsed_evaluation_report = json.loads(cleaned_report_str)
-                results["evaluation_reports"].append(parsed_evaluation_report)
-                logger.info(f"成功解析评估报告 (E{i+1}) 为JSON。")
-            except json.JSONDecodeError as json_e:
-                logger.warning(f"无法将评估报告 (E{i+1}) 解析为JSON。错误: {json_e}. 使用原始字符串。")
-                results["evaluation_reports"].append(evaluation_report_str)
-            conversation_history.append({"role": "user", "content": str(eval_prompt_content)})
-            conversation_history.append({"role": "assistant", "content": str(evaluation_report_str)})
-            refinement_prompt_content = REFINEMENT_META_PROMPT_TEMPLATE.format(
-                user_raw_request=user_raw_request,
-                previous_prompt=current_best_prompt,
-                evaluation_report=evaluation_report_str 
+            evaluation_report_str, error = yield _evaluation_request(eval_prompt_content)
+        if error:
+            logger.warning(f"第 {i+1} 轮自我校正：生成评估报告失败。API返回: {evaluation_report_str}, 错误详情: {error}")
+            stop_reason = early_stopping.EVALUATION_FAILED
+            break
+        logger.info(f"原始评估报告字符串 (E{i+1}):\n{evaluation_report_str}")
+        parsed_report = _parse_evaluation_report(evaluation_report_str, i + 1)
+        results["evaluation_reports"].append(parsed_report)
+        reason = stopper.after_evaluation(current_best_prompt, parsed_report)
+        if reason:
+            stop_reason = reason
+            if reason == early_stopping.NO_IMPROVEMENT and stopper.best_prompt is not None:
+                current_best_prompt = stopper.best_prompt # 精炼反而使分数下降时，回退到得分最高的版本
+            break
+        if best_of_n and not settings.BEST_OF_N_REFINE_WINNER:
+            stop_reason = early_stopping.CANDIDATE_SELECTED
+            break
+        legacy_history_tokens += rate_limit.estimate_tokens(eval_prompt_content) + rate_limit.estimate_tokens(evaluation_report_str)
+        legacy_refinement_tokens = rate_limit.estimate_tokens(REFINEMENT_META_PROMPT_TEMPLATE.format(
+            user_raw_request=user_raw_request,
+            previous_prompt=current_best_prompt,
+            evaluation_report=evaluation_report_str
+        ))
+        edits_mode = settings.REFINEMENT_OUTPUT_MODE == "edits"
+        refinement_prompt_content, refinement_history, context_stats = refinement_context.build_refinement_request(
+            user_raw_request, initial_core_prompt_for_llm, current_best_prompt, parsed_report,
+            token_budget=settings.REFINEMENT_CONTEXT_TOKEN_BUDGET,
+            template=REFINEMENT_EDITS_TEMPLATE if edits_mode else REFINEMENT_FEEDBACK_TEMPLATE,
+        )
+        legacy_tokens = legacy_history_tokens + legacy_refinement_tokens
+        results.setdefault("refinement_context", []).append({
+            "round": i + 1, "tokens": context_stats["tokens"], "legacy_tokens": legacy_tokens,
+            "tokens_saved": legacy_tokens - context_stats["tokens"], "trimmed": context_stats["trimmed"],
+        })
+        logger.info(f"第 {i+1} 轮精炼上下文约 {context_stats['tokens']} tokens (节省约 {legacy_tokens - context_stats['tokens']} tokens)。")
+        if edits_mode:
+            full_request = lambda: refinement_context.build_refinement_request(
+                user_raw_request, initial_core_prompt_for_llm, current_best_prompt, parsed_report,
+                token_budget=settings.REFINEMENT_CONTEXT_TOKEN_BUDGET,
+            )[:2]
+            refined_prompt, error, edit_stats = yield from _edit_refinement_steps(
+                i + 1, current_best_prompt, (refinement_prompt_content, refinement_history), full_request
             )
-            refined_prompt, error = invoke_llm(refinement_prompt_content, conversation_history)
-            if error:
-                logger.warning(f"第 {i+1} 轮自我校正：生成精炼提示失败。API返回: {refined_prompt}, 错误详情: {error}")
-                break
-            logger.info(f"第 {i+1} 轮精炼后的提示词 (P{i+2}):\n{refined_prompt}")
-            results["refined_prompts"].append(refined_prompt)
-            if refined_prompt.strip() == current_best_prompt.strip():
-                 logger.info("精炼后的提示与上一版相同，停止递归。")
-                 break
-            current_best_prompt = refined_prompt
-            conversation_history.append({"role": "user", "content": str(refinement_prompt_content)})
-            conversation_history.append({"role": "assistant", "content": str(refined_prompt)})
-        results["final_prompt"] = current_best_prompt
-        logger.info(f"成功生成最终提示。请求: '{user_raw_request[:50]}...'")
-        return results
-    except Exception as e: 
-        logger.exception(f"在 generate_and_refine_prompt 处理过程中发生未捕获的严重错误。请求: '{user_raw_request[:50]}...'")
-        return {
-            "initial_core_prompt": "", "p1_initial_optimized_prompt": "",
-            "evaluation_reports": [], "refined_prompts": [], "final_prompt": "",
-            "error_message": "处理请求时发生内部错误，请稍后再试或联系管理员。",
-            "error_details": {"type": "UnhandledException", "exception_type": e.__class__.__name__, "message": str(e)},
-        }
+            if edit_stats is not None:
+                results.setdefault("refinement_edits", []).append(edit_stats)
+        else:
+            refined_prompt, error = yield refinement_prompt_content, refinement_history
+        if error:
+            logger.warning(f"第 {i+1} 轮自我校正：生成精炼提示失败。API返回: {refined_prompt}, 错误详情: {error}")
+            stop_reason = early_stopping.REFINEMENT_FAILED
+            break
+        logger.info(f"第 {i+1} 轮精炼后的提示词 (P{i+2}):\n{refined_prompt}")
+        results["refined_prompts"].append(refined_prompt)
+        reason = stopper.after_refinement(current_best_prompt, refined_prompt)
+        current_best_prompt = refined_prompt
+        if reason:
+            stop_reason = reason
+            break
+        legacy_history_tokens += legacy_refinement_tokens + rate_limit.estimate_tokens(refined_prompt)
+    results["stop_reason"] = stop_reason
+    results["evaluation_scores"] = stopper.scores
+    results["final_prompt"] = current_best_prompt
+    logger.info(f"成功生成最终提示。请求: '{user_raw_request[:50]}...'")
+    return results
 
-def explain_term_in_prompt(term_to_explain: str, context_prompt: str) -> tuple[str, dict | None]:
+def _stage_span_attributes(stage: str, step: int, candidate: int | None) -> dict:
+    return {"pipeline.stage": stage, "pipeline.step": step, "pipeline.candidate": candidate}
+
+def _end_stage_span(span: tracing.Span | None, record: pipeline_metrics.CallRecord, error: dict | None) -> None:
+    if span is None:
+        return
+    span.set_attributes({
+        "llm.provider": record.provider, "llm.model": record.model, "llm.cached": record.cached,
+        "llm.upstream_calls": record.upstream_calls, "llm.input_tokens": record.input_tokens,
+        "llm.output_tokens": record.output_tokens, "pipeline.queue_ms": round(record.queue_ms, 1),
+    })
+    span.record_error(error)
+
+def _end_pipeline_span(span: tracing.Span | None, results: dict) -> None:
+    # trace_id 写入结果，便于把返回的错误与日志、导出的 trace 对应起来
+    if span is None:
+        return
+    results["trace_id"] = span.trace_id
+    span.set_attribute("pipeline.stop_reason", results.get("stop_reason"))
+    template = results.get("template") or {}
+    span.set_attributes({"pipeline.template": template.get("name"), "pipeline.template_version": template.get("version")})
+    span.record_error(results.get("error_details"))
+
+def _pipeline_span_attributes(task_type: str, self_correction_mode: str | None) -> dict:
+    return {"pipeline.task_type": task_type, "pipeline.self_correction_mode": self_correction_mode or settings.SELF_CORRECTION_MODE}
+
+def _call_llm_traced(
+    llm_request, llm_options: dict, metrics: pipeline_metrics.PipelineMetrics, step: int,
+    candidate: int | None = None, queued_seconds: float = 0.0, parent_span: tracing.Span | None = None,
+) -> tuple[str, dict | None]:
+    """
+    执行流水线的一次LLM调用，并包在 pipeline.<阶段> span 中。请求要求的响应格式 (例如评估报告的 JSON Schema)
+    通过上下文变量传递给提供者适配器，每次调用的计量同样如此。
+    """
+    stage = pipeline_metrics.step_stage(llm_request[1])
+    with tracing.start_span(f"pipeline.{stage}", attributes=_stage_span_attributes(stage, step, candidate), parent=parent_span) as span, \
+            structured_output.response_schema(structured_output.request_schema(llm_request)), \
+            metrics.track(llm_request, step, candidate, queued_seconds) as record:
+        result, error = invoke_llm(*llm_request, **llm_options)
+        _end_stage_span(span, record, error)
+    return result, error
+
+async def _call_llm_traced_async(
+    llm_request, llm_options: dict, metrics: pipeline_metrics.PipelineMetrics, step: int, candidate: int | None = None,
+) -> tuple[str, dict | None]:
+    stage = pipeline_metrics.step_stage(llm_request[1])
+    with tracing.start_span(f"pipeline.{stage}", attributes=_stage_span_attributes(stage, step, candidate)) as span, \
+            structured_output.response_schema(structured_output.request_schema(llm_request)), \
+            metrics.track(llm_request, step, candidate) as record:
+        result, error = await invoke_llm_async(*llm_request, **llm_options)
+        _end_stage_span(span, record, error)
+    return result, error
+
+def _invoke_llm_step(llm_request, llm_options: dict, budget: resilience.RetryBudget, metrics: pipeline_metrics.PipelineMetrics):
+    # 流水线 yield 的列表表示一组可并发的调用：在线程池中执行，各线程共享本次请求的重试预算
+    step = metrics.begin_step(llm_request)
+    if not isinstance(llm_request, list):
+        return _call_llm_traced(llm_request, llm_options, metrics, step)
+    parent_span = tracing.current_span() # 线程池中的调用不继承上下文变量，显式传入父 span
+    def call(indexed):
+        candidate, request = indexed
+        with resilience.bind_retry_budget(budget):
+            return _call_llm_traced(request, llm_options, metrics, step, candidate, parent_span=parent_span)
+    with ThreadPoolExecutor(max_workers=len(llm_request)) as pool:
+        return list(pool.map(call, enumerate(llm_request)))
+
+async def _invoke_llm_step_async(llm_request, llm_options: dict, metrics: pipeline_metrics.PipelineMetrics):
+    step = metrics.begin_step(llm_request)
+    if not isinstance(llm_request, list):
+        return await _call_llm_traced_async(llm_request, llm_options, metrics, step)
+    return list(await asyncio.gather(*(
+        _call_llm_traced_async(request, llm_options, metrics, step, candidate) for candidate, request in enumerate(llm_request)
+    )))
+
+def generate_and_refine_prompt(
+    user_raw_request: str, task_type: str, enable_self_correction: bool,
+    max_recursion_depth: int, use_structured_template_name: str = None,
+    structured_template_vars: dict = None, use_cache: bool = True,
+    self_correction_mode: str | None = None
+) -> dict:
+    """
+    生成并 (可选地) 通过自我校正循环精炼提示。
+    use_cache=False 时本次请求的所有LLM调用都跳过响应缓存，也不复用近似重复请求的P1。
+    瞬时错误的重试次数受每请求的重试预算 (LLM_RETRY_BUDGET_PER_REQUEST) 限制。
+    self_correction_mode 可选 "sequential" 或 "best_of_n"，默认使用 settings.SELF_CORRECTION_MODE。
+    结果中的 metrics 包含各阶段 (P1 / 评估 / 精炼) 的耗时、排队时间、首 token 时间、token 用量与估算费用。
+    启用 trace 时整个流程、每次阶段调用和每次上游尝试各记录一个 span，结果中的 trace_id 标识本次运行。
+    使用结构化模板时，结果中的 template 记录模板名称与版本 (模板热更新后版本随内容变化)。
+    """
+    llm_options = {} if use_cache else {"use_cache": False}
+    metrics = pipeline_metrics.PipelineMetrics()
+    with tracing.start_span("generate_and_refine_prompt", attributes=_pipeline_span_attributes(task_type, self_correction_mode)) as span:
+        try:
+            steps = _prompt_pipeline_steps(
+                user_raw_request, task_type, enable_self_correction, max_recursion_depth,
+                use_structured_template_name, structured_template_vars, use_near_duplicates=use_cache,
+                self_correction_mode=self_correction_mode
+            )
+            with resilience.retry_budget() as budget: # 本次请求的所有LLM调用共享同一个重试预算
+                llm_request = next(steps)
+                while True:
+                    llm_request = steps.send(_invoke_llm_step(llm_request, llm_options, budget, metrics))
+        except StopIteration as finished:
+            results = finished.value
+        except Exception as e: 
+            logger.exception(f"在 generate_and_refine_prompt 处理过程中发生未捕获的严重错误。请求: '{user_raw_request[:50]}...'")
+            results = _unhandled_error_results(e)
+        results["metrics"] = metrics.summary()
+        _end_pipeline_span(span, results)
+    return results
+
+async def generate_and_refine_prompt_async(
+    user_raw_request: str, task_type: str, enable_self_correction: bool,
+    max_recursion_depth: int, use_structured_template_name: str = None,
+    structured_template_vars: dict = None, use_cache: bool = True,
+    self_correction_mode: str | None = None
+) -> dict:
+    """
+    generate_and_refine_prompt 的异步版本，流程完全相同，LLM调用通过 invoke_llm_async 完成，
+    因此不会阻塞事件循环。
+    """
+    llm_options = {} if use_cache else {"use_cache": False}
+    metrics = pipeline_metrics.PipelineMetrics()
+    with tracing.start_span("generate_and_refine_prompt", attributes=_pipeline_span_attributes(task_type, self_correction_mode)) as span:
+        try:
+            steps = _prompt_pipeline_steps(
+                user_raw_request, task_type, enable_self_correction, max_recursion_depth,
+                use_structured_template_name, structured_template_vars, use_near_duplicates=use_cache,
+                self_correction_mode=self_correction_mode
+            )
+            with resilience.retry_budget(): # 本次请求的所有LLM调用共享同一个重试预算
+                llm_request = next(steps)
+                while True:
+                    llm_request = steps.send(await _invoke_llm_step_async(llm_request, llm_options, metrics))
+        except StopIteration as finished:
+            results = finished.value
+        except Exception as e:
+            logger.exception(f"在 generate_and_refine_prompt_async 处理过程中发生未捕获的严重错误。请求: '{user_raw_request[:50]}...'")
+            results = _unhandled_error_results(e)
+        results["metrics"] = metrics.summary()
+        _end_pipeline_span(span, results)
+    return results
+
+async def stream_p1_prompt_async(
+    user_raw_request: str, task_type: str,
+    use_structured_template_name: str = None, structured_template_vars: dict = None
+):
+    """
+    流式生成初步优化提示 (P1)。
+
+    逐块产出 ("token", 文本片段)；成功结束时产出 ("done", 清理后的完整P1)，
+    失败时产出 ("error", (错误消息, 错误详情))。
+    """
+    initial_core_prompt_for_llm, _ = _build_initial_core_prompt(
+        user_raw_request, task_type, use_structured_template_name, structured_template_vars
+    )
+    logger.info(f"开始流式生成P1。任务类型 '{task_type}'，请求: '{user_raw_request[:50]}...'")
+    chunks = []
+    async for text, error in stream_llm_async(initial_core_prompt_for_llm, None):
+        if error:
+            logger.error(f"流式生成P1失败。API返回: {text}, 错误详情: {error}")
+            yield "error", (f"生成初始优化提示失败: {text}", error)
+            return
+        chunks.append(text)
+        yield "token", text
+    p1 = clean_llm_output("".join(chunks))
+    if not p1:
+        yield "error", ("生成初始优化提示失败: LLM未返回任何内容", {"type": "EmptyResponseError"})
+        return
+    yield "done", p1
+
+def _build_explanation_request(term_to_explain: str, context_prompt: str) -> tuple[str, dict | None]:
+    """
+    校验输入并格式化解释请求。成功时返回 (请求内容, None)，否则返回 (错误消息, 错误详情)。
+    """
     if not term_to_explain or not term_to_explain.strip():
         logger.warning("explain_term_in_prompt: 'term_to_explain' 参数为空。")
         return "错误：需要提供要解释的术语。", {"type": "InputValidationError", "details": "待解释术语不能为空。"}
@@ -396,16 +1306,38 @@ def explain_term_in_prompt(term_to_explain: str, context_prompt: str) -> tuple[s
             term_to_explain=term_to_explain,
             context_prompt=context_prompt
         )
-        logger.info(f"为术语 '{term_to_explain}' 生成解释请求 (提供者: {settings.ACTIVE_LLM_PROVIDER})...")
-        explanation_text, error_details = invoke_llm(explanation_request_prompt) # 使用 invoke_llm
-        if error_details:
-            logger.error(f"调用LLM解释术语 '{term_to_explain}' 时失败。API返回: {explanation_text}, 错误详情: {error_details}")
-            return explanation_text, error_details
-        logger.info(f"成功获取术语 '{term_to_explain}' 的解释。")
-        return explanation_text.strip(), None
     except KeyError as e:
         logger.exception(f"格式化 EXPLAIN_TERM_TEMPLATE 时发生 KeyError: {e}.")
         return "错误：解释模板格式化失败。", {"type": "TemplateFormatError", "details": str(e)}
+    logger.info(f"为术语 '{term_to_explain}' 生成解释请求 (提供者: {settings.ACTIVE_LLM_PROVIDER})...")
+    return explanation_request_prompt, None
+
+def _finish_explanation(term_to_explain: str, explanation_text: str, error_details: dict | None) -> tuple[str, dict | None]:
+    if error_details:
+        logger.error(f"调用LLM解释术语 '{term_to_explain}' 时失败。API返回: {explanation_text}, 错误详情: {error_details}")
+        return explanation_text, error_details
+    logger.info(f"成功获取术语 '{term_to_explain}' 的解释。")
+    return explanation_text.strip(), None
+
+def explain_term_in_prompt(term_to_explain: str, context_prompt: str) -> tuple[str, dict | None]:
+    explanation_request_prompt, error_details = _build_explanation_request(term_to_explain, context_prompt)
+    if error_details:
+        return explanation_request_prompt, error_details
+    try:
+        explanation_text, error_details = invoke_llm(explanation_request_prompt) # 使用 invoke_llm
+        return _finish_explanation(term_to_explain, explanation_text, error_details)
+    except Exception as e:
+        logger.exception(f"解释术语 '{term_to_explain}' 时发生未知错误。")
+        return "错误：解释过程中发生未知内部错误。", {"type": "UnknownExplanationError", "details": str(e)}
+
+async def explain_term_in_prompt_async(term_to_explain: str, context_prompt: str) -> tuple[str, dict | None]:
+    """explain_term_in_prompt 的异步版本。"""
+    explanation_request_prompt, error_details = _build_explanation_request(term_to_explain, context_prompt)
+    if error_details:
+        return explanation_request_prompt, error_details
+    try:
+        explanation_text, error_details = await invoke_llm_async(explanation_request_prompt)
+        return _finish_explanation(term_to_explain, explanation_text, error_details)
     except Exception as e:
         logger.exception(f"解释术语 '{term_to_explain}' 时发生未知错误。")
         return "错误：解释过程中发生未知内部错误。", {"type": "UnknownExplanationError", "details": str(e)}
@@ -0,0 +1,281 @@
+# src/meta_prompt_agent/core/batch_runner.py
+import json
+import logging
+import os
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Iterable, Iterator
+
+from meta_prompt_agent.config import settings
+from meta_prompt_agent.core import agent, pipeline_metrics, resilience, tracing
+from meta_prompt_agent.core.pipeline_metrics import STAGE_EVALUATION, STAGE_P1, STAGE_REFINEMENT, STAGES, step_stage
+
+logger = logging.getLogger(__name__)
+
+_SELF_CORRECTION_MODES = ("sequential", "best_of_n")
+
+
+def _optional_field(item: dict, name: str, expected: type, type_label: str):
+    value = item.get(name)
+    if value is not None and not isinstance(value, expected):
+        raise ValueError(f"字段 {name} 必须是{type_label}。")
+    return value
+
+
+def parse_request_line(line: str) -> dict:
+    """
+    解析输入 JSONL 的一行。字段与 /generate-batch 的条目相同：raw_request (必填)、id、task_type、
+    enable_self_correction、max_recursion_depth、structured_template_name、structured_template_vars、
+    self_correction_mode。返回填入默认值、类型已校验的条目。
+    格式或字段类型错误时抛出 ValueError (该行记录为 InputValidationError，不影响其余行)。
+    """
+    try:
+        item = json.loads(line)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"不是有效的JSON: {e}") from e
+    if not isinstance(item, dict):
+        raise ValueError("每行必须是一个JSON对象。")
+    if not isinstance(item.get("raw_request"), str) or not item["raw_request"].strip():
+        raise ValueError("缺少必填字段 raw_request。")
+    item["task_type"] = _optional_field(item, "task_type", str, "字符串") or "通用/问答"
+    item["enable_self_correction"] = bool(_optional_field(item, "enable_self_correction", bool, "布尔值"))
+    depth = item.get("max_recursion_depth", 1)
+    if isinstance(depth, str) and depth.strip().isdigit(): # 与原来的 int(...) 一样接受数字字符串
+        depth = int(depth)
+    if isinstance(depth, bool) or not isinstance(depth, int) or depth < 0:
+        raise ValueError("字段 max_recursion_depth 必须是非负整数。")
+    item["max_recursion_depth"] = depth
+    _optional_field(item, "structured_template_name", str, "字符串")
+    _optional_field(item, "structured_template_vars", dict, "JSON对象")
+    if item.get("self_correction_mode") not in (None, *_SELF_CORRECTION_MODES):
+        raise ValueError(f"字段 self_correction_mode 必须是 {' / '.join(_SELF_CORRECTION_MODES)} 之一。")
+    return item
+
+
+def load_completed_indices(output_path: str) -> set[int]:
+    """
+    读取已有输出文件中已完成条目的行号，供断点续跑时跳过。
+    进程崩溃时可能留下写了一半的最后一行，该行会被截断丢弃 (对应条目将重新处理)。
+    """
+    if not os.path.exists(output_path):
+        return set()
+    completed = set()
+    valid_length = 0
+    with open(output_path, "rb") as f:
+        for raw_line in f:
+            if not raw_line.endswith(b"\n"):
+                break
+            try:
+                completed.add(json.loads(raw_line)["index"])
+            except (ValueError, KeyError, TypeError):
+                break
+            valid_length += len(raw_line)
+    if valid_length != os.path.getsize(output_path):
+        logger.warning(f"输出文件 '{output_path}' 末尾存在不完整的记录，已截断至最后一条完整记录。")
+        with open(output_path, "r+b") as f:
+            f.truncate(valid_length)
+    return completed
+
+
+def iter_pending_requests(input_path: str, completed: set[int]) -> Iterator[tuple[int, str]]:
+    """逐行读取输入文件 (不会一次性载入内存)，跳过空行和已完成的行，产出 (行号, 行内容)。行号从 0 开始。"""
+    with open(input_path, "r", encoding="utf-8") as f:
+        for index, line in enumerate(f):
+            if line.strip() and index not in completed:
+                yield index, line
+
+
+@dataclass
+class _Job:
+    index: int
+    item: dict
+    steps: Iterator
+    budget: resilience.RetryBudget = field(default_factory=lambda: resilience.RetryBudget(settings.LLM_RETRY_BUDGET_PER_REQUEST))
+    outputs: list = field(default_factory=list) # 当前这一步各个调用的结果 (并发步骤有多个)
+    remaining: int = 0
+    parallel: bool = False
+    metrics: pipeline_metrics.PipelineMetrics = field(default_factory=pipeline_metrics.PipelineMetrics)
+    span: tracing.Span | None = None # 跨越多个阶段线程池，因此不作为上下文中的当前 span，而是显式传给各次调用
+
+
+class StagedPipelineRunner:
+    """
+    以阶段划分线程池的批量提示生成器。
+
+    每个请求由 agent._prompt_pipeline_steps 驱动；它每产出一次LLM调用，就把调用提交到对应阶段
+    (P1 / 评估 / 精炼) 的线程池。不同请求处于不同阶段，因此三个线程池可以同时保持繁忙，
+    而不是让一个请求占用一个线程直到整个流程结束。同时在处理中的请求数不超过 max_in_flight。
+
+    Args:
+        workers (dict[str, int]): 各阶段的线程数，键为 STAGES 中的阶段名。
+        max_in_flight (int | None): 同时在处理中的请求数上限，默认为总线程数的两倍。
+        use_cache (bool): 为 False 时跳过响应缓存与近似重复复用。
+    """
+
+    def __init__(self, workers: dict[str, int], max_in_flight: int | None = None, use_cache: bool = True):
+        self.workers = {stage: max(1, int(workers.get(stage, 1))) for stage in STAGES}
+        self.max_in_flight = max_in_flight or 2 * sum(self.workers.values())
+        self.use_cache = use_cache
+        self.stage_calls = {stage: 0 for stage in STAGES}
+
+    def _call_llm(
+        self, job: _Job, llm_request: tuple, step: int, candidate: int | None, submitted_at: float,
+    ) -> tuple[str, dict | None]:
+        llm_options = {} if self.use_cache else {"use_cache": False}
+        queued_seconds = time.perf_counter() - submitted_at # 在阶段线程池中等待空闲线程的时间
+        with resilience.bind_retry_budget(job.budget):
+            # 同一请求的所有LLM调用共享重试预算，即使它们在不同线程中执行
+            return agent._call_llm_traced(
+                llm_request, llm_options, job.metrics, step, candidate, queued_seconds, parent_span=job.span,
+            )
+
+    def _start(self, index: int, line: str) -> _Job | dict:
+        try:
+            item = parse_request_line(line)
+        except ValueError as e:
+            logger.warning(f"第 {index} 行输入无效: {e}")
+            results = agent._empty_results()
+            results["error_message"] = f"输入无效: {e}"
+            results["error_details"] = {"type": "InputValidationError", "message": str(e)}
+            return results
+        steps = agent._prompt_pipeline_steps(
+            item["raw_request"], item["task_type"], item["enable_self_correction"], item["max_recursion_depth"],
+            item.get("structured_template_name"), item.get("structured_template_vars"),
+            use_near_duplicates=self.use_cache, self_correction_mode=item.get("self_correction_mode"),
+        )
+        span = tracing.begin_span("batch.item", attributes={
+            "batch.index": index, **agent._pipeline_span_attributes(item["task_type"], item.get("self_correction_mode")),
+        })
+        return _Job(index, item, steps, span=span)
+
+    def run(self, requests: Iterable[tuple[int, str]], on_result: Callable[[int, dict | None, dict], None]) -> dict:
+        """
+        处理 (行号, 行内容) 序列，每完成一个请求就调用 on_result(行号, 输入条目, results) (按完成顺序，在调用线程中执行)。
+        返回本次运行的统计。
+        """
+        pending = iter(requests)
+        completions: queue.Queue = queue.Queue()
+        active: dict[int, _Job] = {}
+        summary = {"succeeded": 0, "failed": 0}
+        pools = {
+            stage: ThreadPoolExecutor(max_workers=count, thread_name_prefix=f"batch-{stage}")
+            for stage, count in self.workers.items()
+        }
+
+        def finish(index: int, item: dict | None, results: dict) -> None:
+            job = active.pop(index, None)
+            if job is not None:
+                results["metrics"] = job.metrics.summary()
+                agent._end_pipeline_span(job.span, results)
+                tracing.end_span(job.span)
+            summary["failed" if results.get("error_message") else "succeeded"] += 1
+            on_result(index, item, results)
+
+        def advance(job: _Job, llm_result=None, first: bool = False) -> None:
+            try:
+                llm_request = next(job.steps) if first else job.steps.send(llm_result)
+            except StopIteration as finished:
+                finish(job.index, job.item, finished.value)
+                return
+            except Exception as e:
+                logger.exception(f"批处理第 {job.index} 行时发生未捕获的错误。")
+                finish(job.index, job.item, agent._unhandled_error_results(e))
+                return
+            # 流水线以列表形式 yield 一组可并发的调用 (例如 best_of_n 的候选)，全部完成后按顺序 send 回结果列表
+            job.parallel = isinstance(llm_request, list)
+            llm_requests = llm_request if job.parallel else [llm_request]
+            job.outputs = [None] * len(llm_requests)
+            job.remaining = len(llm_requests)
+            step = job.metrics.begin_step(llm_request)
+            for slot, request in enumerate(llm_requests):
+                stage = step_stage(request[1])
+                self.stage_calls[stage] += 1
+                candidate = slot if job.parallel else None
+                future = pools[stage].submit(self._call_llm, job, request, step, candidate, time.perf_counter())
+                future.add_done_callback(lambda f, job=job, slot=slot: completions.put((job, slot, f)))
+
+        def admit() -> bool:
+            for index, line in pending:
+                try:
+                    started = self._start(index, line)
+                except Exception as e: # 单行的意外错误只记录为该行的失败，不中止整个批处理 (否则每次续跑都会卡在这一行)
+                    logger.exception(f"批处理第 {index} 行启动时发生未捕获的错误。")
+                    finish(index, None, agent._unhandled_error_results(e))
+                    continue
+                if isinstance(started, dict):
+                    finish(index, None, started)
+                    continue
+                active[index] = started
+                advance(started, first=True)
+                return True
+            return False
+
+        try:
+            while True:
+                while len(active) < self.max_in_flight and admit():
+                    pass
+                if not active:
+                    break
+                job, slot, future = completions.get()
+                if active.get(job.index) is not job: # 该请求已因同一步骤中的其他调用出错而结束
+                    continue
+                try:
+                    job.outputs[slot] = future.result()
+                except Exception as e:
+                    logger.exception(f"批处理第 {job.index} 行的LLM调用发生未捕获的错误。")
+                    job.steps.close()
+                    finish(job.index, job.item, agent._unhandled_error_results(e))
+                    continue
+                job.remaining -= 1
+                if job.remaining == 0:
+                    advance(job, job.outputs if job.parallel else job.outputs[0])
+        finally:
+            for pool in pools.values():
+                pool.shutdown(wait=True, cancel_futures=True)
+        summary["stage_calls"] = dict(self.stage_calls)
+        return summary
+
+
+def run_jsonl_batch(
+    input_path: str, output_path: str, workers: dict[str, int] | None = None,
+    max_in_flight: int | None = None, use_cache: bool = True, resume: bool = True,
+    checkpoint_every: int | None = None,
+) -> dict:
+    """
+    读取输入 JSONL，逐条生成提示，并按完成顺序把结果追加写入输出 JSONL。
+
+    每条输出记录包含输入行号 index、条目的 id 以及与 generate_and_refine_prompt 相同的结果字段。
+    输出文件即检查点：resume=True 时跳过输出中已存在的行号，从中断处继续；resume=False 时覆盖输出文件。
+    每写入 checkpoint_every 条记录执行一次 fsync。
+    """
+    workers = workers or {
+        STAGE_P1: settings.BATCH_P1_WORKERS,
+        STAGE_EVALUATION: settings.BATCH_EVALUATION_WORKERS,
+        STAGE_REFINEMENT: settings.BATCH_REFINEMENT_WORKERS,
+    }
+    checkpoint_every = max(1, checkpoint_every or settings.BATCH_CHECKPOINT_EVERY)
+    completed = load_completed_indices(output_path) if resume else set()
+    if completed:
+        logger.info(f"从检查点恢复：输出文件中已有 {len(completed)} 条完成的记录，将跳过这些行。")
+    runner = StagedPipelineRunner(workers, max_in_flight=max_in_flight, use_cache=use_cache)
+    written = 0
+
+    with open(output_path, "a" if resume else "w", encoding="utf-8") as out:
+        def write_result(index: int, item: dict | None, results: dict) -> None:
+            nonlocal written
+            record = {"index": index, "id": (item or {}).get("id"), **results}
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            written += 1
+            if written % checkpoint_every == 0:
+                os.fsync(out.fileno())
+                logger.info(f"批处理进度：本次已完成 {written} 条。")
+
+        summary = runner.run(iter_pending_requests(input_path, completed), write_result)
+        out.flush()
+        os.fsync(out.fileno())
+    summary["skipped"] = len(completed)
+    logger.info(f"批处理完成: {summary}")
+    return summary
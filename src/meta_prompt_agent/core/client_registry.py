@@ -0,0 +1,124 @@
+# src/meta_prompt_agent/core/client_registry.py
+import logging
+import threading
+from collections import OrderedDict
+
+import dashscope
+import google.generativeai as genai
+
+from meta_prompt_agent.config import settings
+from meta_prompt_agent.core import transport
+
+logger = logging.getLogger(__name__)
+
+# (provider, model, api_key, system 指令) -> 已构建的客户端对象。每个组合只构建一次，
+# 总数受 LLM_CLIENT_CACHE_MAX_ENTRIES 限制 (LRU)。
+_clients: OrderedDict[tuple[str, str, str | None, str | None], object] = OrderedDict()
+_clients_lock = threading.Lock()
+
+
+class DashScopeClient:
+    """
+    绑定了模型和 API 密钥的 DashScope 调用封装。
+    每次调用都显式传入 api_key，不再修改全局的 dashscope.api_key，因此可以安全地被并发使用。
+    """
+
+    def __init__(self, model_name: str, api_key: str):
+        self.model_name = model_name
+        self.api_key = api_key
+
+    def call(self, messages: list, **kwargs):
+        return dashscope.Generation.call(
+            model=self.model_name, messages=messages, api_key=self.api_key, **kwargs
+        )
+
+
+def _build_gemini_model(model_name: str, api_key: str, system_instruction: str | None = None):
+    # genai.configure 修改的是 SDK 的全局配置，只在构建时 (持锁) 调用；模型在调用时使用全局配置的客户端，
+    # 因此同步的 Gemini 路径在一个进程内只支持一个密钥 (settings.GEMINI_API_KEY)。
+    # SDK 的 system 指令只能在构建模型时指定，不能按调用传入，因此每个不同的指令各构建一个模型。
+    genai.configure(api_key=api_key)
+    if system_instruction is None:
+        return genai.GenerativeModel(model_name)
+    return genai.GenerativeModel(model_name, system_instruction=system_instruction)
+
+
+_BUILDERS = {
+    "gemini": _build_gemini_model,
+    "qwen": DashScopeClient,
+}
+
+
+def get_client(provider: str, model_name: str, api_key: str | None, system_instruction: str | None = None):
+    """
+    返回指定 (provider, model, api_key, system_instruction) 的共享客户端，首次请求时构建并缓存 (LRU，有数量上限)。线程安全。
+    system_instruction 只适用于 gemini。
+
+    Raises:
+        ValueError: 提供者没有对应的 SDK 客户端 (例如 ollama 直接使用 HTTP 连接池)。
+    """
+    builder = _BUILDERS.get(provider)
+    if builder is None:
+        raise ValueError(f"提供者 '{provider}' 没有可注册的SDK客户端。")
+    key = (provider, model_name, api_key, system_instruction)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is not None:
+            _clients.move_to_end(key)
+            return client
+        logger.info(f"构建 {provider} 客户端 (模型: {model_name})。")
+        client = builder(model_name, api_key) if system_instruction is None else builder(model_name, api_key, system_instruction)
+        _clients[key] = client
+        while len(_clients) > max(settings.LLM_CLIENT_CACHE_MAX_ENTRIES, 1):
+            _clients.popitem(last=False)
+    return client
+
+
+def get_gemini_model(system_instruction: str | None = None):
+    return get_client("gemini", settings.GEMINI_MODEL_NAME, settings.GEMINI_API_KEY, system_instruction)
+
+
+def get_qwen_client() -> DashScopeClient:
+    return get_client("qwen", settings.QWEN_MODEL_NAME, settings.QWEN_API_KEY_FROM_ENV)
+
+
+def warm_up(providers: list[str] | None = None) -> dict[str, bool]:
+    """
+    预先构建客户端，使第一个用户请求不必承担构建开销：qwen / gemini 构建同步路径使用的SDK客户端
+    (它们自行管理连接，不使用 transport 的会话)，ollama 创建共享的 keep-alive 会话。
+    异步 HTTP 客户端绑定在事件循环上，在首次异步调用时创建。
+
+    Args:
+        providers (list[str], optional): 要预热的提供者，默认为 LLM_ROUTER_PROVIDERS (未配置时为 ACTIVE_LLM_PROVIDER)。
+
+    Returns:
+        dict: 每个提供者是否预热成功。缺少密钥或构建失败时记录警告并返回 False。
+    """
+    providers = providers or settings.LLM_ROUTER_PROVIDERS or [settings.ACTIVE_LLM_PROVIDER]
+    status = {}
+    for provider in providers:
+        try:
+            if provider == "gemini":
+                if not settings.GEMINI_API_KEY:
+                    raise ValueError("GEMINI_API_KEY 未配置")
+                get_gemini_model()
+            elif provider == "qwen":
+                if not settings.QWEN_API_KEY_FROM_ENV:
+                    raise ValueError("DASHSCOPE_API_KEY (或 QWEN_API_KEY) 未配置")
+                get_qwen_client()
+            elif provider == "ollama":
+                transport.get_session(provider)
+            else:
+                raise ValueError(f"未知的提供者 '{provider}'")
+            status[provider] = True
+        except Exception as e:
+            logger.warning(f"预热提供者 '{provider}' 的客户端失败: {type(e).__name__} - {e}")
+            status[provider] = False
+    logger.info(f"客户端预热完成: {status}")
+    return status
+
+
+def clear() -> None:
+    """清空已缓存的客户端 (例如在密钥轮换后或测试中)。"""
+    with _clients_lock:
+        _clients.clear()
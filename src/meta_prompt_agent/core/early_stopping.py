@@ -0,0 +1,87 @@
+# src/meta_prompt_agent/core/early_stopping.py
+import difflib
+import logging
+
+logger = logging.getLogger(__name__)
+
+# --- 自我校正循环的停止原因 ---
+SCORE_THRESHOLD = "score_threshold"       # 评估分数已达到阈值，无需继续精炼
+NO_IMPROVEMENT = "no_improvement"         # 相比上一轮的分数提升不足
+CONVERGED = "converged"                   # 精炼结果与上一版几乎相同
+MAX_ROUNDS = "max_rounds"                 # 已完成 max_recursion_depth 轮
+EVALUATION_FAILED = "evaluation_failed"
+REFINEMENT_FAILED = "refinement_failed"
+CANDIDATE_SELECTED = "candidate_selected" # best_of_n 模式选出得分最高的候选后不再精炼
+
+
+def report_score(report: dict | str) -> float | None:
+    """
+    从评估报告中取出分数：优先使用 evaluation_summary.overall_score，否则取各维度评分的平均值。
+    报告不是JSON或不含任何数值评分时返回 None。
+    """
+    if not isinstance(report, dict):
+        return None
+    summary = report.get("evaluation_summary")
+    if isinstance(summary, dict) and isinstance(summary.get("overall_score"), (int, float)):
+        return float(summary["overall_score"])
+    dimensions = report.get("dimension_scores")
+    if not isinstance(dimensions, dict):
+        return None
+    scores = [
+        float(entry["score"]) for entry in dimensions.values()
+        if isinstance(entry, dict) and isinstance(entry.get("score"), (int, float))
+    ]
+    return sum(scores) / len(scores) if scores else None
+
+
+def prompt_similarity(a: str, b: str) -> float:
+    """两个提示词 (去除首尾空白后) 的文本相似度，取值 0-1。"""
+    return difflib.SequenceMatcher(None, a.strip(), b.strip(), autojunk=False).ratio()
+
+
+class RefinementStopper:
+    """
+    自我校正循环的提前停止规则，各项取值为 0 时关闭。
+
+    Args:
+        score_threshold (float): 当前提示词的评估分数不低于该值时停止，不再精炼。
+        min_improvement (float): 分数相比上一轮的提升低于该值时停止；若分数下降，最终结果回退为得分最高的提示词。
+        similarity_threshold (float): 精炼结果与上一版的文本相似度不低于该值时视为收敛。完全相同总是视为收敛。
+    """
+
+    def __init__(self, score_threshold: float = 0, min_improvement: float = 0, similarity_threshold: float = 0):
+        self.score_threshold = score_threshold
+        self.min_improvement = min_improvement
+        self.similarity_threshold = similarity_threshold
+        self.scores: list[float | None] = []
+        self.best_prompt: str | None = None
+        self._best_score: float | None = None
+
+    def after_evaluation(self, prompt: str, report: dict | str) -> str | None:
+        """记录当前提示词的评估结果；应停止时返回停止原因。"""
+        score = report_score(report)
+        previous = self.scores[-1] if self.scores else None
+        self.scores.append(score)
+        if score is None:
+            return None
+        if self._best_score is None or score >= self._best_score:
+            self._best_score, self.best_prompt = score, prompt
+        if self.score_threshold > 0 and score >= self.score_threshold:
+            logger.info(f"评估分数 {score:.2f} 已达到阈值 {self.score_threshold}，停止自我校正。")
+            return SCORE_THRESHOLD
+        if self.min_improvement > 0 and previous is not None and score - previous < self.min_improvement:
+            logger.info(f"评估分数从 {previous:.2f} 变为 {score:.2f}，提升低于 {self.min_improvement}，停止自我校正。")
+            return NO_IMPROVEMENT
+        return None
+
+    def after_refinement(self, previous_prompt: str, refined_prompt: str) -> str | None:
+        """比较精炼前后的提示词；收敛时返回停止原因。"""
+        if refined_prompt.strip() == previous_prompt.strip():
+            logger.info("精炼后的提示与上一版相同，停止递归。")
+            return CONVERGED
+        if self.similarity_threshold > 0:
+            similarity = prompt_similarity(previous_prompt, refined_prompt)
+            if similarity >= self.similarity_threshold:
+                logger.info(f"精炼后的提示与上一版的相似度为 {similarity:.3f}，视为收敛，停止递归。")
+                return CONVERGED
+        return None
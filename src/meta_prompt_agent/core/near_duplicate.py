@@ -0,0 +1,208 @@
+# src/meta_prompt_agent/core/near_duplicate.py
+import logging
+import re
+import threading
+import unicodedata
+import zlib
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from meta_prompt_agent.config import settings
+
+logger = logging.getLogger(__name__)
+
+_MAX_HASH = (1 << 32) - 1
+_EMPTY_BIN = 1 << 32 # 大于任何 crc32 值，表示没有 shingle 落入该桶
+_DENSIFY_STEP = 0x9E3779B1 # 空桶借用相邻桶的值时按距离加上的偏移，使借来的值与原值不同
+_PUNCTUATION_RE = re.compile(r"[^\w\s]", re.UNICODE)
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_request_text(text: str) -> str:
+    """
+    规范化请求文本：全角/半角统一 (NFKC)、小写、去除标点、合并空白。
+    只在标点或空白上不同的请求规范化后完全相同。
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = _PUNCTUATION_RE.sub(" ", text)
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+
+def _shingle_hashes(normalized_text: str, shingle_size: int, seed: int = 0) -> set[int]:
+    # 使用字符级 n-gram，无需分词即可同时处理中文与英文
+    text = normalized_text.replace(" ", "")
+    if len(text) <= shingle_size:
+        return {zlib.crc32(text.encode("utf-8"), seed)}
+    return {
+        zlib.crc32(text[i:i + shingle_size].encode("utf-8"), seed)
+        for i in range(len(text) - shingle_size + 1)
+    }
+
+
+def _densify(bins: list[int]) -> list[int]:
+    """
+    旋转填充 (rotation densification)：空桶取其右侧 (循环) 最近的非空桶的值并按距离加上偏移，
+    两个相似的集合在同样的空桶上得到同样的值，签名仍可用于估计 Jaccard 相似度和 LSH 分桶。
+    """
+    densified = list(bins)
+    num_bins = len(bins)
+    source, distance = None, 0
+    for i in range(2 * num_bins - 1, -1, -1): # 从右向左绕两圈，第一圈只用于找到最右侧空桶的来源
+        value = bins[i % num_bins]
+        if value != _EMPTY_BIN:
+            source, distance = value, 0
+        elif source is not None:
+            distance += 1
+            if i < num_bins:
+                densified[i] = (source + distance * _DENSIFY_STEP) & _MAX_HASH
+    return densified
+
+
+def _choose_bands(num_perm: int, threshold: float) -> tuple[int, int]:
+    """
+    选择 LSH 的 (bands, rows)，使候选概率曲线的拐点 (1/b)^(1/r) 不高于且最接近阈值，
+    以召回优先；候选随后再用估计的相似度按阈值精确过滤。
+    """
+    best = (num_perm, 1)
+    best_gap = None
+    for bands in range(1, num_perm + 1):
+        if num_perm % bands:
+            continue
+        rows = num_perm // bands
+        inflection = (1 / bands) ** (1 / rows)
+        if inflection <= threshold and (best_gap is None or threshold - inflection < best_gap):
+            best, best_gap = (bands, rows), threshold - inflection
+    return best
+
+
+@dataclass
+class NearDuplicateMatch:
+    request_text: str
+    p1_prompt: str
+    similarity: float
+
+
+class NearDuplicateIndex:
+    """
+    基于 MinHash + LSH 分桶的近似重复请求索引。
+
+    签名使用单置换 MinHash (one permutation hashing)：每个 shingle 只计算一次哈希，按哈希值分入
+    num_perm 个桶并保留每个桶的最小值，空桶用旋转填充补齐。计算签名的开销与请求长度成正比，
+    而不是 shingle 数 × 置换数。
+
+    每个条目按作用域 (任务类型, 模板名) 隔离，只有同一作用域内的请求才会互相匹配。
+    查找只需计算一次签名并访问 bands 个桶，与条目总数无关。
+
+    Args:
+        threshold (float): 估计 Jaccard 相似度达到该值才视为近似重复。
+        num_perm (int): 签名长度 (分桶数)。
+        shingle_size (int): 字符 n-gram 的长度。
+        max_entries (int): 最多保留的条目数，超出时淘汰最早加入的条目。
+        seed (int): shingle 哈希的种子。
+    """
+
+    def __init__(self, threshold: float = 0.8, num_perm: int = 32, shingle_size: int = 3,
+                 max_entries: int = 200000, seed: int = 1):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.max_entries = max_entries
+        self.bands, self.rows = _choose_bands(num_perm, threshold)
+        self.seed = seed
+        self._entries: OrderedDict[int, tuple[tuple, str, str, array]] = OrderedDict()
+        self._buckets: dict[tuple, set[int]] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def signature(self, text: str) -> array:
+        num_bins = self.num_perm
+        bins = [_EMPTY_BIN] * num_bins
+        for h in _shingle_hashes(normalize_request_text(text), self.shingle_size, self.seed):
+            slot = h % num_bins
+            if h < bins[slot]:
+                bins[slot] = h
+        if _EMPTY_BIN in bins: # 短请求的 shingle 数可能少于桶数
+            bins = _densify(bins)
+        return array("I", bins)
+
+    def _band_keys(self, scope: tuple, sig: array):
+        rows = self.rows
+        for band in range(self.bands):
+            yield (scope, band, tuple(sig[band * rows:(band + 1) * rows]))
+
+    def _similarity(self, sig_a: array, sig_b: array) -> float:
+        return sum(1 for x, y in zip(sig_a, sig_b) if x == y) / self.num_perm
+
+    def add(self, scope: tuple, request_text: str, p1_prompt: str) -> None:
+        sig = self.signature(request_text)
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (scope, request_text, p1_prompt, sig)
+            for key in self._band_keys(scope, sig):
+                self._buckets.setdefault(key, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._evict_oldest()
+
+    def _evict_oldest(self) -> None:
+        entry_id, (scope, _, _, sig) = self._entries.popitem(last=False)
+        for key in self._band_keys(scope, sig):
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[key]
+
+    def query(self, scope: tuple, request_text: str) -> NearDuplicateMatch | None:
+        """
+        返回同一作用域内相似度最高且不低于阈值的已知请求；没有时返回 None。
+        """
+        sig = self.signature(request_text)
+        with self._lock:
+            candidates = set()
+            for key in self._band_keys(scope, sig):
+                candidates.update(self._buckets.get(key, ()))
+            best = None
+            for entry_id in candidates:
+                _, known_text, p1_prompt, known_sig = self._entries[entry_id]
+                similarity = self._similarity(sig, known_sig)
+                if similarity >= self.threshold and (best is None or similarity > best.similarity):
+                    best = NearDuplicateMatch(known_text, p1_prompt, similarity)
+        return best
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_default_index: NearDuplicateIndex | None = None
+_default_index_lock = threading.Lock()
+
+
+def get_near_duplicate_index() -> NearDuplicateIndex | None:
+    """
+    返回按 settings 配置的全局近似重复索引；NEAR_DUPLICATE_MODE 为 "off" 时返回 None。
+    """
+    global _default_index
+    if settings.NEAR_DUPLICATE_MODE == "off":
+        return None
+    if _default_index is None:
+        with _default_index_lock:
+            if _default_index is None:
+                _default_index = NearDuplicateIndex(
+                    threshold=settings.NEAR_DUPLICATE_THRESHOLD,
+                    num_perm=settings.NEAR_DUPLICATE_NUM_PERM,
+                    max_entries=settings.NEAR_DUPLICATE_MAX_ENTRIES,
+                )
+                logger.info(
+                    f"已启用近似重复请求检测 (模式: {settings.NEAR_DUPLICATE_MODE}, 阈值: {settings.NEAR_DUPLICATE_THRESHOLD}, "
+                    f"bands={_default_index.bands}, rows={_default_index.rows})。"
+                )
+    return _default_index
+
+
+def reset_near_duplicate_index() -> None:
+    """丢弃全局索引实例 (配置变更后或测试中使用)，下次访问时按当前配置重建。"""
+    global _default_index
+    with _default_index_lock:
+        _default_index = None
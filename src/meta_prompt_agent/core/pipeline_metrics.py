@@ -0,0 +1,210 @@
+# src/meta_prompt_agent/core/pipeline_metrics.py
+import contextlib
+import contextvars
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+
+from meta_prompt_agent.config import settings
+from meta_prompt_agent.core import rate_limit
+
+STAGE_P1, STAGE_EVALUATION, STAGE_REFINEMENT = "p1", "evaluation", "refinement"
+STAGES = (STAGE_P1, STAGE_EVALUATION, STAGE_REFINEMENT)
+
+
+def step_stage(messages_history: list | None) -> str:
+    """
+    根据 _prompt_pipeline_steps 产出的一次LLM调用判断其所属阶段：
+    P1 (包括近似重复种子) 不带历史 (None)，评估使用空历史 ([])，精炼携带完整对话历史。
+    """
+    if messages_history is None:
+        return STAGE_P1
+    return STAGE_REFINEMENT if messages_history else STAGE_EVALUATION
+
+
+@dataclass
+class CallRecord:
+    """
+    流水线中一次LLM调用的计量。时间单位为毫秒，token 只统计实际发给上游的成功调用
+    (命中缓存或与并发请求合并的调用为 0)。提供者未返回用量时使用本地估算，并把 tokens_estimated 置为 True。
+    """
+    stage: str
+    started_ms: float # 相对于流水线开始的时间
+    step: int = 1 # 该阶段的第几步 (精炼阶段即第几次精炼调用，编辑列表回退为完整重写时单独计一步)
+    candidate: int | None = None # 并发步骤 (best_of_n) 中的第几个调用，从 0 开始
+    wall_ms: float = 0.0
+    queue_ms: float = 0.0 # 阶段线程池与客户端限流的排队时间
+    ttft_ms: float | None = None # 非流式调用中首个 token 与完整响应同时到达
+    provider: str | None = None
+    model: str | None = None
+    upstream_calls: int = 0 # 包括失败后重试的次数
+    cached: bool = False
+    input_tokens: int = 0
+    cached_input_tokens: int = 0 # 输入中命中提供者前缀缓存的部分 (只统计提供者返回的数值)
+    output_tokens: int = 0
+    tokens_estimated: bool = False
+    cost: float | None = None
+    _started: float = field(default=0.0, repr=False)
+
+    def to_dict(self) -> dict:
+        data = {key: value for key, value in asdict(self).items() if not key.startswith("_")}
+        for key in ("started_ms", "wall_ms", "queue_ms", "ttft_ms"):
+            if data[key] is not None:
+                data[key] = round(data[key], 1)
+        return data
+
+
+_current_call: contextvars.ContextVar[CallRecord | None] = contextvars.ContextVar("llm_call_record", default=None)
+_attempt_usage: contextvars.ContextVar[tuple[int, int, int] | None] = contextvars.ContextVar("llm_attempt_usage", default=None)
+
+
+def _price_for(provider: str, model: str | None) -> dict | None:
+    pricing = settings.LLM_PRICING_PER_MILLION_TOKENS
+    return pricing.get(f"{provider}/{model}") or pricing.get(provider)
+
+
+def current_call() -> CallRecord | None:
+    return _current_call.get()
+
+
+def record_queue_wait(seconds: float) -> None:
+    record = _current_call.get()
+    if record is not None:
+        record.queue_ms += seconds * 1000
+
+
+def record_usage(input_tokens, output_tokens, cached_input_tokens=None) -> None:
+    """
+    由提供者适配器调用，记录响应中的 token 用量 (字段缺失时不记录，改用估算)。
+    cached_input_tokens 为输入中命中提供者前缀 / 上下文缓存的 token 数，提供者未返回时视为 0。
+    """
+    if isinstance(input_tokens, int) and isinstance(output_tokens, int):
+        cached = cached_input_tokens if isinstance(cached_input_tokens, int) else 0
+        _attempt_usage.set((input_tokens, output_tokens, min(max(cached, 0), input_tokens)))
+
+
+def record_cache_hit(provider: str, model: str | None) -> None:
+    record = _current_call.get()
+    if record is not None:
+        record.provider, record.model, record.cached = provider, model, True
+        record.ttft_ms = (time.perf_counter() - record._started) * 1000
+
+
+def record_attempt(
+    provider: str, model: str | None, prompt_content: str, messages_history: list | None,
+    result: str, error: dict | None,
+) -> tuple[int, int, bool, int] | None:
+    """
+    记录一次实际的上游调用；成功时累计 token 用量与费用 (不在流水线中时只计算用量)。
+    成功时返回 (输入 tokens, 输出 tokens, 是否为本地估算, 命中缓存的输入 tokens)，失败时返回 None。
+    """
+    usage = _attempt_usage.get()
+    _attempt_usage.set(None)
+    record = _current_call.get()
+    if record is not None:
+        record.provider, record.model = provider, model
+        record.upstream_calls += 1
+    if error is not None:
+        return None
+    estimated = usage is None
+    if estimated:
+        usage = (rate_limit.estimate_message_tokens(prompt_content, messages_history), rate_limit.estimate_tokens(result), 0)
+    input_tokens, output_tokens, cached_tokens = usage
+    if record is not None:
+        record.ttft_ms = (time.perf_counter() - record._started) * 1000
+        record.tokens_estimated = record.tokens_estimated or estimated
+        record.input_tokens += input_tokens
+        record.cached_input_tokens += cached_tokens
+        record.output_tokens += output_tokens
+        price = _price_for(provider, model)
+        if price:
+            input_price = price.get("input", 0)
+            cost = (
+                (input_tokens - cached_tokens) * input_price + cached_tokens * price.get("cached_input", input_price)
+                + output_tokens * price.get("output", 0)
+            ) / 1_000_000
+            record.cost = (record.cost or 0.0) + cost
+    return input_tokens, output_tokens, estimated, cached_tokens
+
+
+def _union_ms(intervals: list[tuple[float, float]]) -> float:
+    # 并发的调用 (例如 best_of_n 的候选) 在时间上重叠，阶段耗时按区间的并集计算
+    total, current_start, current_end = 0.0, None, None
+    for start, end in sorted(intervals):
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                total += current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        total += current_end - current_start
+    return total
+
+
+def _aggregate(records: list[CallRecord], wall_ms: float) -> dict:
+    ttfts = [r.ttft_ms for r in records if r.ttft_ms is not None]
+    costs = [r.cost for r in records if r.cost is not None]
+    return {
+        "calls": len(records),
+        "wall_ms": round(wall_ms, 1),
+        "queue_ms": round(sum(r.queue_ms for r in records), 1),
+        "ttft_ms": round(sum(ttfts) / len(ttfts), 1) if ttfts else None,
+        "input_tokens": sum(r.input_tokens for r in records),
+        "cached_input_tokens": sum(r.cached_input_tokens for r in records),
+        "output_tokens": sum(r.output_tokens for r in records),
+        "tokens_estimated": any(r.tokens_estimated for r in records),
+        "cost": round(sum(costs), 6) if costs else None,
+    }
+
+
+class PipelineMetrics:
+    """
+    收集一次流水线运行中各LLM调用的计量，并按阶段 (P1 / 评估 / 精炼) 汇总。
+    驱动函数用 track 包住每次调用；各层通过上下文变量把排队时间、用量等写入当前调用的记录，线程安全。
+    """
+
+    def __init__(self):
+        self._started = time.perf_counter()
+        self._records: list[CallRecord] = []
+        self._steps = {stage: 0 for stage in STAGES}
+        self._lock = threading.Lock()
+
+    def begin_step(self, llm_request) -> int:
+        """驱动函数每执行流水线的一步 (单个调用或一组并发调用) 调用一次，返回该步在其阶段中的序号。"""
+        first_request = llm_request[0] if isinstance(llm_request, list) else llm_request
+        stage = step_stage(first_request[1])
+        with self._lock:
+            self._steps[stage] += 1
+            return self._steps[stage]
+
+    @contextlib.contextmanager
+    def track(self, llm_request, step: int = 1, candidate: int | None = None, queued_seconds: float = 0.0):
+        now = time.perf_counter()
+        record = CallRecord(
+            stage=step_stage(llm_request[1]), started_ms=(now - self._started) * 1000, step=step, candidate=candidate,
+            queue_ms=queued_seconds * 1000, _started=now,
+        )
+        token = _current_call.set(record)
+        try:
+            yield record
+        finally:
+            record.wall_ms = (time.perf_counter() - now) * 1000
+            _current_call.reset(token)
+            with self._lock:
+                self._records.append(record)
+
+    def summary(self) -> dict:
+        """返回 {"total": {...}, "stages": {阶段: {...}}, "calls": [每次调用的记录]}。"""
+        with self._lock:
+            records = sorted(self._records, key=lambda r: r.started_ms)
+        stages = {}
+        for stage in STAGES:
+            stage_records = [r for r in records if r.stage == stage]
+            intervals = [(r.started_ms, r.started_ms + r.wall_ms) for r in stage_records]
+            stages[stage] = _aggregate(stage_records, _union_ms(intervals))
+        return {
+            "total": _aggregate(records, (time.perf_counter() - self._started) * 1000),
+            "stages": stages,
+            "calls": [r.to_dict() for r in records],
+        }
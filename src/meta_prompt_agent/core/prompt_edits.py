@@ -0,0 +1,78 @@
+# src/meta_prompt_agent/core/prompt_edits.py
+import json
+import logging
+
+from meta_prompt_agent.core.structured_output import strip_code_fence
+
+logger = logging.getLogger(__name__)
+
+
+class PromptEditError(ValueError):
+    """编辑列表无法解析，或无法无歧义地应用到先前的提示词上。"""
+
+
+def parse_edit_list(text: str) -> list[dict]:
+    """
+    解析模型返回的编辑列表：{"edits": [...]} 或直接为列表。每个编辑为以下之一：
+    {"op": "replace", "find": 原文片段, "text": 新文本}、{"op": "delete", "find": 原文片段}、
+    {"op": "insert", "after": 原文片段 | "before": 原文片段 | "position": "start" | "end", "text": 新文本}。
+    格式不符时抛出 PromptEditError。
+    """
+    try:
+        data = json.loads(strip_code_fence(text))
+    except json.JSONDecodeError as e:
+        raise PromptEditError(f"编辑列表不是有效的JSON: {e}") from e
+    edits = data.get("edits") if isinstance(data, dict) else data
+    if not isinstance(edits, list):
+        raise PromptEditError("编辑列表缺少 edits 数组。")
+    for index, edit in enumerate(edits):
+        if not isinstance(edit, dict):
+            raise PromptEditError(f"第 {index + 1} 个编辑不是JSON对象。")
+        op = edit.get("op")
+        if op in ("replace", "delete"):
+            if not isinstance(edit.get("find"), str) or not edit["find"]:
+                raise PromptEditError(f"第 {index + 1} 个编辑 ({op}) 缺少 find。")
+        elif op == "insert":
+            if not any(isinstance(edit.get(key), str) for key in ("after", "before", "position")):
+                raise PromptEditError(f"第 {index + 1} 个编辑 (insert) 缺少插入位置。")
+        else:
+            raise PromptEditError(f"第 {index + 1} 个编辑的操作 '{op}' 不受支持。")
+        if op in ("replace", "insert") and not isinstance(edit.get("text"), str):
+            raise PromptEditError(f"第 {index + 1} 个编辑 ({op}) 缺少 text。")
+    return edits
+
+
+def _locate(prompt: str, anchor: str, index: int) -> int:
+    count = prompt.count(anchor)
+    if count != 1:
+        reason = "找不到" if count == 0 else f"出现了 {count} 次"
+        raise PromptEditError(f"第 {index + 1} 个编辑的定位文本{reason}: '{anchor[:30]}'")
+    return prompt.index(anchor)
+
+
+def apply_edits(prompt: str, edits: list[dict]) -> str:
+    """
+    依次把编辑应用到提示词上。每个定位文本必须在 (已应用之前编辑的) 提示词中恰好出现一次，
+    否则抛出 PromptEditError；结果为空时同样视为失败。
+    """
+    result = prompt
+    for index, edit in enumerate(edits):
+        op = edit["op"]
+        if op in ("replace", "delete"):
+            start = _locate(result, edit["find"], index)
+            result = result[:start] + (edit["text"] if op == "replace" else "") + result[start + len(edit["find"]):]
+        elif edit.get("after") is not None:
+            position = _locate(result, edit["after"], index) + len(edit["after"])
+            result = result[:position] + edit["text"] + result[position:]
+        elif edit.get("before") is not None:
+            position = _locate(result, edit["before"], index)
+            result = result[:position] + edit["text"] + result[position:]
+        elif edit["position"] == "start":
+            result = edit["text"] + result
+        elif edit["position"] == "end":
+            result = result + edit["text"]
+        else:
+            raise PromptEditError(f"第 {index + 1} 个编辑的插入位置 '{edit['position']}' 不受支持。")
+    if not result.strip():
+        raise PromptEditError("应用编辑后的提示词为空。")
+    return result
@@ -0,0 +1,97 @@
+# src/meta_prompt_agent/core/prompt_layout.py
+import logging
+import string
+
+from meta_prompt_agent.config import settings
+from meta_prompt_agent.core import template_registry
+from meta_prompt_agent.prompts.templates import (
+    CORE_META_PROMPT_TEMPLATE,
+    EVALUATION_META_PROMPT_TEMPLATE,
+    REFINEMENT_FEEDBACK_TEMPLATE,
+    REFINEMENT_EDITS_TEMPLATE,
+    EXPLAIN_TERM_TEMPLATE,
+    NEAR_DUPLICATE_SEED_TEMPLATE,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def static_prefix(template: str) -> str:
+    """返回模板中第一个占位符之前的固定文本 (转义的花括号已还原)，即格式化结果中与请求无关的前缀。"""
+    literals = []
+    for literal, field_name, _, _ in string.Formatter().parse(template):
+        literals.append(literal) # 转义的 {{ / }} 会把固定文本分成多段
+        if field_name is not None:
+            return "".join(literals)
+    return ""
+
+
+_BUILTIN_PREFIXES = tuple(static_prefix(template) for template in (
+    CORE_META_PROMPT_TEMPLATE, EVALUATION_META_PROMPT_TEMPLATE, REFINEMENT_FEEDBACK_TEMPLATE,
+    REFINEMENT_EDITS_TEMPLATE, EXPLAIN_TERM_TEMPLATE, NEAR_DUPLICATE_SEED_TEMPLATE,
+))
+_prefixes_by_version: tuple[str, tuple[str, ...]] | None = None
+
+
+def _known_prefixes() -> tuple[str, ...]:
+    # 内置模板加上当前注册表中的结构化模板，按长度降序 (优先匹配最长的前缀)；注册表版本变化时重新计算
+    global _prefixes_by_version
+    registry = template_registry.get_registry()
+    cached = _prefixes_by_version
+    if cached is not None and cached[0] == registry.version:
+        return cached[1]
+    prefixes = set(_BUILTIN_PREFIXES)
+    for name in registry.names():
+        segments = registry.get(name).segments
+        if segments and segments[0][1] is not None:
+            prefixes.add(segments[0][0])
+    result = tuple(sorted((p for p in prefixes if p), key=len, reverse=True))
+    _prefixes_by_version = (registry.version, result)
+    return result
+
+
+def split_prompt(prompt_content: str) -> tuple[str | None, str]:
+    """
+    把按模板格式化出的提示拆分为 (固定前缀, 可变部分)。不以已知模板的前缀开头、前缀短于
+    LLM_PROMPT_PREFIX_MIN_CHARS 或未启用拆分时返回 (None, prompt_content)。
+    """
+    if not settings.LLM_PROMPT_PREFIX_SPLIT_ENABLED:
+        return None, prompt_content
+    for prefix in _known_prefixes():
+        if len(prefix) < settings.LLM_PROMPT_PREFIX_MIN_CHARS:
+            break
+        if len(prompt_content) > len(prefix) and prompt_content.startswith(prefix):
+            return prefix, prompt_content[len(prefix):]
+    return None, prompt_content
+
+
+def layout_messages(prompt_content: str, messages_history: list | None) -> list[dict]:
+    """
+    组织发送给提供者的消息列表：固定前缀作为第一条 system 消息 (在各请求之间逐字节相同，
+    提供者可以复用这段前缀的缓存)，随后是对话历史，最后是可变部分。无法拆分时与原来一样只追加一条 user 消息。
+    """
+    prefix, suffix = split_prompt(prompt_content)
+    messages = [{"role": "system", "content": prefix}] if prefix is not None else []
+    messages.extend(messages_history or [])
+    messages.append({"role": "user", "content": suffix})
+    return messages
+
+
+def split_system_messages(messages: list[dict]) -> tuple[str | None, list[dict]]:
+    """为只支持单独 system 指令的接口 (Gemini) 取出开头的 system 消息，返回 (system 文本, 其余消息)。"""
+    if messages and messages[0].get("role") == "system":
+        return messages[0].get("content", ""), messages[1:]
+    return None, messages
+
+
+def qwen_cache_marked(messages: list[dict]) -> list[dict]:
+    """
+    QWEN_EXPLICIT_PREFIX_CACHE 启用时，为开头的 system 消息加上 DashScope 显式缓存标记 (cache_control)，
+    要求服务端缓存到该消息为止的前缀；未启用或没有 system 消息时原样返回。
+    """
+    if not settings.QWEN_EXPLICIT_PREFIX_CACHE or not messages or messages[0].get("role") != "system":
+        return messages
+    first = {**messages[0], "content": [
+        {"type": "text", "text": messages[0].get("content", ""), "cache_control": {"type": "ephemeral"}},
+    ]}
+    return [first, *messages[1:]]
@@ -0,0 +1,190 @@
+# src/meta_prompt_agent/core/provider_router.py
+import logging
+import math
+import threading
+import time
+from collections import deque
+
+from meta_prompt_agent.config import settings
+from meta_prompt_agent.core import resilience
+
+logger = logging.getLogger(__name__)
+
+KNOWN_PROVIDERS = ("qwen", "gemini", "ollama")
+
+
+def is_provider_configured(provider: str) -> bool:
+    """提供者是否具备调用所需的配置 (API 密钥)。ollama 为本地服务，无需密钥。"""
+    if provider == "gemini":
+        return bool(settings.GEMINI_API_KEY)
+    if provider == "qwen":
+        return bool(settings.QWEN_API_KEY_FROM_ENV)
+    return provider == "ollama"
+
+
+def _percentile(sorted_values: list[float], pct: float) -> float:
+    # 最近秩 (nearest-rank) 百分位
+    index = max(0, math.ceil(pct / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+class ProviderHealth:
+    """
+    单个提供者的滚动窗口统计：最近 window_size 次调用中、且不早于 window_seconds 的样本。
+    """
+
+    def __init__(self, window_size: int, window_seconds: float):
+        self.window_seconds = window_seconds
+        self._samples: deque[tuple[float, float, bool]] = deque(maxlen=window_size)
+
+    def record(self, latency_seconds: float, ok: bool, now: float) -> None:
+        self._samples.append((now, latency_seconds, ok))
+
+    def _prune(self, now: float) -> None:
+        while self._samples and now - self._samples[0][0] > self.window_seconds:
+            self._samples.popleft()
+
+    def snapshot(self, now: float) -> dict:
+        self._prune(now)
+        latencies = sorted(latency for _, latency, _ in self._samples)
+        errors = sum(1 for _, _, ok in self._samples if not ok)
+        samples = len(self._samples)
+        return {
+            "samples": samples,
+            "p50_ms": round(_percentile(latencies, 50) * 1000, 1) if latencies else None,
+            "p95_ms": round(_percentile(latencies, 95) * 1000, 1) if latencies else None,
+            "p99_ms": round(_percentile(latencies, 99) * 1000, 1) if latencies else None,
+            "error_rate": errors / samples if samples else 0.0,
+        }
+
+
+class ProviderRouter:
+    """
+    按提供者的滚动延迟百分位和错误率决定调用顺序。
+
+    排序规则：健康的提供者按 "p95 延迟 / (1 - 错误率)" 从低到高排列，样本不足的提供者视为最优以便探测；
+    错误率超过 max_error_rate 或熔断器处于打开状态的提供者标记为降级并排在最后 (仍作为最后的兜底)。
+    降级样本随时间窗口过期后，该提供者会重新被探测。
+
+    Args:
+        providers (list[str]): 参与路由的提供者，顺序即样本不足时的优先级。
+        window_size (int): 每个提供者保留的最大样本数。
+        window_seconds (float): 样本有效期 (秒)。
+        min_samples (int): 计算健康状态所需的最少样本数。
+        max_error_rate (float): 超过该错误率即视为降级。
+    """
+
+    def __init__(self, providers: list[str], window_size: int = 200, window_seconds: float = 300,
+                 min_samples: int = 5, max_error_rate: float = 0.5):
+        self.providers = list(providers)
+        self.min_samples = min_samples
+        self.max_error_rate = max_error_rate
+        self._health = {p: ProviderHealth(window_size, window_seconds) for p in self.providers}
+        self._lock = threading.Lock()
+
+    def record(self, provider: str, latency_seconds: float, ok: bool) -> None:
+        health = self._health.get(provider)
+        if health is None:
+            return
+        with self._lock:
+            health.record(latency_seconds, ok, time.monotonic())
+
+    def _evaluate(self) -> dict[str, dict]:
+        now = time.monotonic()
+        with self._lock:
+            stats = {p: self._health[p].snapshot(now) for p in self.providers}
+        for provider, entry in stats.items():
+            entry["configured"] = is_provider_configured(provider)
+            entry["circuit_open"] = resilience.is_circuit_open(provider)
+            enough = entry["samples"] >= self.min_samples
+            entry["healthy"] = entry["configured"] and not entry["circuit_open"] and not (
+                enough and entry["error_rate"] > self.max_error_rate
+            )
+            if not enough:
+                entry["score"] = 0.0
+            else:
+                entry["score"] = (entry["p95_ms"] or 0.0) / max(1.0 - entry["error_rate"], 0.05)
+        return stats
+
+    def _order(self, stats: dict[str, dict]) -> list[str]:
+        candidates = [p for p in self.providers if stats[p]["configured"]]
+        return sorted(candidates, key=lambda p: (not stats[p]["healthy"], stats[p]["score"]))
+
+    def route(self) -> list[str]:
+        """返回本次调用应依次尝试的提供者列表 (首个为主选，其余用于故障转移)。未配置密钥的提供者被排除。"""
+        return self._order(self._evaluate())
+
+    def snapshot(self) -> dict:
+        """
+        返回可在运行时查看的路由状态：每个提供者的样本数、p50/p95/p99 延迟、错误率、健康状态和路由权重，
+        以及当前的调用顺序。权重与 1/score 成正比 (降级或未配置的提供者为 0)，样本不足者按当前最优者计算。
+        """
+        stats = self._evaluate()
+        order = self._order(stats)
+        known_scores = [s["score"] for s in stats.values() if s["healthy"] and s["score"] > 0]
+        best_score = min(known_scores) if known_scores else 1.0
+        inverse = {
+            p: (1.0 / (s["score"] or best_score)) if s["healthy"] else 0.0
+            for p, s in stats.items()
+        }
+        total = sum(inverse.values())
+        for provider, entry in stats.items():
+            entry["weight"] = round(inverse[provider] / total, 3) if total else 0.0
+            entry["score"] = round(entry["score"], 1)
+        return {"enabled": True, "order": order, "providers": stats}
+
+
+_default_router: ProviderRouter | None = None
+_default_router_lock = threading.Lock()
+
+
+def get_router() -> ProviderRouter | None:
+    """
+    返回按 settings 配置的全局路由器；LLM_ROUTER_PROVIDERS 为空时返回 None (沿用 ACTIVE_LLM_PROVIDER)。
+    """
+    global _default_router
+    if not settings.LLM_ROUTER_PROVIDERS:
+        return None
+    if _default_router is None:
+        with _default_router_lock:
+            if _default_router is None:
+                unknown = [p for p in settings.LLM_ROUTER_PROVIDERS if p not in KNOWN_PROVIDERS]
+                if unknown:
+                    logger.warning(f"LLM_ROUTER_PROVIDERS 中包含未知的提供者 {unknown}，已忽略。")
+                _default_router = ProviderRouter(
+                    [p for p in settings.LLM_ROUTER_PROVIDERS if p in KNOWN_PROVIDERS],
+                    window_size=settings.LLM_ROUTER_WINDOW_SIZE,
+                    window_seconds=settings.LLM_ROUTER_WINDOW_SECONDS,
+                    min_samples=settings.LLM_ROUTER_MIN_SAMPLES,
+                    max_error_rate=settings.LLM_ROUTER_MAX_ERROR_RATE,
+                )
+                logger.info(f"已启用多提供者路由: {_default_router.providers}")
+    return _default_router
+
+
+def route_providers() -> list[str]:
+    """返回本次LLM调用依次尝试的提供者；未启用路由或没有可用提供者时只返回 ACTIVE_LLM_PROVIDER。"""
+    router = get_router()
+    if router is None:
+        return [settings.ACTIVE_LLM_PROVIDER]
+    return router.route() or [settings.ACTIVE_LLM_PROVIDER]
+
+
+def record_call(provider: str, latency_seconds: float, ok: bool) -> None:
+    router = get_router()
+    if router is not None:
+        router.record(provider, latency_seconds, ok)
+
+
+def get_routing_snapshot() -> dict:
+    router = get_router()
+    if router is None:
+        return {"enabled": False, "order": [settings.ACTIVE_LLM_PROVIDER], "providers": {}}
+    return router.snapshot()
+
+
+def reset_router() -> None:
+    """丢弃全局路由器及其统计 (配置变更后或测试中使用)。"""
+    global _default_router
+    with _default_router_lock:
+        _default_router = None
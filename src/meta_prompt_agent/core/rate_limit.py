@@ -0,0 +1,315 @@
+# src/meta_prompt_agent/core/rate_limit.py
+import asyncio
+import contextlib
+import logging
+import re
+import threading
+import time
+import weakref
+
+from meta_prompt_agent.config import settings
+
+logger = logging.getLogger(__name__)
+
+_CJK_RE = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估计文本的 token 数：中日韩字符按 1 个 token 计，其余字符按 4 个字符 1 个 token 计。
+    仅用于客户端限流的预留，不要求精确。
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def estimate_message_tokens(prompt_content: str, messages_history: list | None) -> int:
+    return estimate_tokens(prompt_content) + sum(estimate_tokens(str(m.get("content", ""))) for m in messages_history or [])
+
+
+class RateLimitQueueTimeout(Exception):
+    """在 max_queue_seconds 内无法获得调用额度。"""
+
+    def __init__(self, key: str, needed_wait: float):
+        super().__init__(f"{key} 的限流排队时间超过上限 (需要等待 {needed_wait:.1f}s)")
+        self.key = key
+        self.needed_wait = needed_wait
+
+
+class TokenBucket:
+    """
+    每分钟补充 rate_per_minute 个令牌的令牌桶，容量等于每分钟的额度。
+
+    采用预留方式：reserve 立即扣除令牌 (余额可以为负)，并返回调用方需要等待的秒数，
+    因此排队的调用按到达顺序获得额度，不需要轮询。
+    """
+
+    def __init__(self, rate_per_minute: float):
+        self.capacity = float(rate_per_minute)
+        self.rate_per_second = rate_per_minute / 60.0
+        self.tokens = self.capacity
+        self._updated_at = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated_at) * self.rate_per_second)
+        self._updated_at = now
+
+    def reserve(self, amount: float, now: float) -> float:
+        self._refill(now)
+        self.tokens -= min(amount, self.capacity) # 超过容量的单次请求按容量计，避免永远无法满足
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate_per_second
+
+    def refund(self, amount: float, now: float) -> None:
+        self._refill(now)
+        self.tokens = min(self.capacity, self.tokens + min(amount, self.capacity))
+
+
+class ProviderLimiter:
+    """
+    单个 (提供者, 模型) 的客户端限流：RPM 与 TPM 两个令牌桶，加上最大并发数。各项为 0 时不限制。
+
+    额度不足时调用会排队等待，最长 max_queue_seconds；超过则抛出 RateLimitQueueTimeout，而不是把请求发给上游被限流。
+    同步调用使用 threading.Semaphore；异步调用在每个事件循环中使用独立的 asyncio.Semaphore。
+    """
+
+    def __init__(self, key: str, rpm: int = 0, tpm: int = 0, max_concurrency: int = 0, max_queue_seconds: float = 10):
+        self.key = key
+        self.max_concurrency = max_concurrency
+        self.max_queue_seconds = max_queue_seconds
+        self._requests = TokenBucket(rpm) if rpm > 0 else None
+        self._tokens = TokenBucket(tpm) if tpm > 0 else None
+        self._semaphore = threading.BoundedSemaphore(max_concurrency) if max_concurrency > 0 else None
+        self._async_semaphores: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "queued": 0, "rejected": 0, "total_queue_wait_ms": 0.0, "max_queue_wait_ms": 0.0}
+        self._in_flight = 0
+
+    def _reserve(self, tokens: int) -> float:
+        with self._lock:
+            now = time.monotonic()
+            wait = 0.0
+            if self._requests is not None:
+                wait = max(wait, self._requests.reserve(1, now))
+            if self._tokens is not None:
+                wait = max(wait, self._tokens.reserve(tokens, now))
+            if wait > self.max_queue_seconds:
+                self._refund_locked(tokens, now)
+                self._stats["rejected"] += 1
+                raise RateLimitQueueTimeout(self.key, wait)
+            return wait
+
+    def _refund_locked(self, tokens: int, now: float) -> None:
+        if self._requests is not None:
+            self._requests.refund(1, now)
+        if self._tokens is not None:
+            self._tokens.refund(tokens, now)
+
+    def _refund(self, tokens: int) -> None:
+        """退还已预留但最终没有发出的调用额度 (排队超时或被取消)。"""
+        with self._lock:
+            self._refund_locked(tokens, time.monotonic())
+
+    def adjust_tokens(self, delta: int) -> None:
+        """用实际消耗修正预留的 token 数 (delta > 0 追加扣除，< 0 退还)。"""
+        if self._tokens is None or delta == 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if delta > 0:
+                self._tokens.reserve(delta, now)
+            else:
+                self._tokens.refund(-delta, now)
+
+    def _record_admitted(self, queue_wait: float) -> None:
+        with self._lock:
+            self._stats["calls"] += 1
+            self._in_flight += 1
+            if queue_wait > 0.001:
+                self._stats["queued"] += 1
+            wait_ms = queue_wait * 1000
+            self._stats["total_queue_wait_ms"] += wait_ms
+            self._stats["max_queue_wait_ms"] = max(self._stats["max_queue_wait_ms"], wait_ms)
+
+    def _record_rejected(self) -> None:
+        with self._lock:
+            self._stats["rejected"] += 1
+
+    def _record_released(self) -> None:
+        with self._lock:
+            self._in_flight -= 1
+
+    @contextlib.contextmanager
+    def slot(self, tokens: int):
+        """同步获取一次调用额度；产出本次调用的排队等待秒数。"""
+        started = time.monotonic()
+        wait = self._reserve(tokens)
+        try:
+            if wait > 0:
+                time.sleep(wait)
+            if self._semaphore is not None:
+                remaining = self.max_queue_seconds - (time.monotonic() - started)
+                if not self._semaphore.acquire(timeout=max(remaining, 0)):
+                    self._record_rejected()
+                    raise RateLimitQueueTimeout(self.key, time.monotonic() - started)
+        except BaseException: # 调用没有发出，预留的 RPM / TPM 额度需要退还
+            self._refund(tokens)
+            raise
+        queue_wait = time.monotonic() - started
+        self._record_admitted(queue_wait)
+        try:
+            yield queue_wait
+        finally:
+            self._record_released()
+            if self._semaphore is not None:
+                self._semaphore.release()
+
+    def _get_async_semaphore(self) -> asyncio.Semaphore | None:
+        if self.max_concurrency <= 0:
+            return None
+        loop = asyncio.get_running_loop()
+        semaphore = self._async_semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._async_semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return semaphore
+
+    @contextlib.asynccontextmanager
+    async def slot_async(self, tokens: int):
+        """slot 的异步版本。"""
+        started = time.monotonic()
+        wait = self._reserve(tokens)
+        try:
+            if wait > 0:
+                await asyncio.sleep(wait)
+            semaphore = self._get_async_semaphore()
+            if semaphore is not None:
+                remaining = self.max_queue_seconds - (time.monotonic() - started)
+                try:
+                    await asyncio.wait_for(semaphore.acquire(), timeout=max(remaining, 0))
+                except asyncio.TimeoutError:
+                    self._record_rejected()
+                    raise RateLimitQueueTimeout(self.key, time.monotonic() - started) from None
+        except BaseException: # 包括排队期间被取消 (CancelledError)
+            self._refund(tokens)
+            raise
+        queue_wait = time.monotonic() - started
+        self._record_admitted(queue_wait)
+        try:
+            yield queue_wait
+        finally:
+            self._record_released()
+            if semaphore is not None:
+                semaphore.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot["in_flight"] = self._in_flight
+        snapshot["total_queue_wait_ms"] = round(snapshot["total_queue_wait_ms"], 1)
+        snapshot["max_queue_wait_ms"] = round(snapshot["max_queue_wait_ms"], 1)
+        return snapshot
+
+
+_limiters: dict[tuple[str, str], ProviderLimiter | None] = {}
+_limiters_lock = threading.Lock()
+
+
+def _limits_for(provider: str, model: str) -> dict:
+    limits = dict(settings.LLM_RATE_LIMITS_BY_PROVIDER.get(provider, {}))
+    limits.update(settings.LLM_RATE_LIMITS_BY_MODEL.get(f"{provider}/{model}", {}))
+    return limits
+
+
+def get_limiter(provider: str, model: str) -> ProviderLimiter | None:
+    """返回 (提供者, 模型) 的限流器；该组合未配置任何限制时返回 None。"""
+    key = (provider, model)
+    if key in _limiters:
+        return _limiters[key]
+    with _limiters_lock:
+        if key not in _limiters:
+            limits = _limits_for(provider, model)
+            if any(limits.get(name, 0) > 0 for name in ("rpm", "tpm", "max_concurrency")):
+                _limiters[key] = ProviderLimiter(
+                    f"{provider}/{model}",
+                    rpm=limits.get("rpm", 0), tpm=limits.get("tpm", 0),
+                    max_concurrency=limits.get("max_concurrency", 0),
+                    max_queue_seconds=settings.LLM_RATE_LIMIT_MAX_QUEUE_SECONDS,
+                )
+                logger.info(f"已为 {provider}/{model} 启用客户端限流: {limits}")
+            else:
+                _limiters[key] = None
+    return _limiters[key]
+
+
+def slot_for_async(provider: str, model: str, prompt_tokens: int):
+    """
+    返回 (提供者, 模型) 的异步限流上下文 (供流式调用在整个流期间占用额度)；未配置限制时返回空上下文。
+    """
+    limiter = get_limiter(provider, model)
+    if limiter is None:
+        return contextlib.nullcontext(0.0)
+    return limiter.slot_async(prompt_tokens + settings.LLM_RATE_LIMIT_OUTPUT_TOKENS_ESTIMATE)
+
+
+def queue_timeout_error(e: RateLimitQueueTimeout) -> tuple[str, dict]:
+    logger.warning(f"客户端限流：{e}")
+    return (
+        f"错误：{e.key} 当前请求过多，排队超时，请稍后再试。",
+        {"type": "RateLimitQueueTimeout", "limiter": e.key, "needed_wait": round(e.needed_wait, 2)},
+    )
+
+
+def _settle_tokens(limiter: ProviderLimiter, reserved_output: int, result: str, error: dict | None) -> None:
+    # 预留时按估计的输出长度扣除；调用结束后按实际输出修正 (失败时退还输出部分)
+    actual_output = estimate_tokens(result) if error is None else 0
+    limiter.adjust_tokens(actual_output - reserved_output)
+
+
+def limited_call(provider: str, model: str, prompt_tokens: int, fn) -> tuple[str, dict | None]:
+    """
+    在 (提供者, 模型) 的限流额度内执行 fn() -> (text, error)。排队超时时不调用 fn，返回 RateLimitQueueTimeout 错误。
+    """
+    limiter = get_limiter(provider, model)
+    if limiter is None:
+        return fn()
+    reserved_output = settings.LLM_RATE_LIMIT_OUTPUT_TOKENS_ESTIMATE
+    try:
+        with limiter.slot(prompt_tokens + reserved_output) as queue_wait:
+            if queue_wait > 0.001:
+                logger.info(f"调用 {limiter.key} 前排队等待 {queue_wait * 1000:.0f}ms。")
+            result, error = fn()
+    except RateLimitQueueTimeout as e:
+        return queue_timeout_error(e)
+    _settle_tokens(limiter, reserved_output, result, error)
+    return result, error
+
+
+async def limited_call_async(provider: str, model: str, prompt_tokens: int, fn) -> tuple[str, dict | None]:
+    """limited_call 的异步版本，fn 为返回 (text, error) 的协程函数。"""
+    limiter = get_limiter(provider, model)
+    if limiter is None:
+        return await fn()
+    reserved_output = settings.LLM_RATE_LIMIT_OUTPUT_TOKENS_ESTIMATE
+    try:
+        async with limiter.slot_async(prompt_tokens + reserved_output) as queue_wait:
+            if queue_wait > 0.001:
+                logger.info(f"(async) 调用 {limiter.key} 前排队等待 {queue_wait * 1000:.0f}ms。")
+            result, error = await fn()
+    except RateLimitQueueTimeout as e:
+        return queue_timeout_error(e)
+    _settle_tokens(limiter, reserved_output, result, error)
+    return result, error
+
+
+def get_rate_limit_stats() -> dict[str, dict]:
+    """返回每个已启用限流的 (提供者/模型) 的调用数、排队数、拒绝数、排队等待时间 (总计/最大) 与在途数。"""
+    with _limiters_lock:
+        limiters = [limiter for limiter in _limiters.values() if limiter is not None]
+    return {limiter.key: limiter.stats() for limiter in limiters}
+
+
+def reset_limiters() -> None:
+    """丢弃所有限流器 (配置变更后或测试中使用)。"""
+    with _limiters_lock:
+        _limiters.clear()
@@ -0,0 +1,110 @@
+# src/meta_prompt_agent/core/refinement_context.py
+import json
+import logging
+
+from meta_prompt_agent.core.rate_limit import estimate_message_tokens, estimate_tokens
+from meta_prompt_agent.prompts.templates import REFINEMENT_FEEDBACK_TEMPLATE
+
+logger = logging.getLogger(__name__)
+
+_DIMENSION_LABELS = {
+    "clarity": "清晰度",
+    "completeness": "完整性",
+    "specificity_actionability": "具体性/可操作性",
+    "faithfulness_consistency": "忠实度/一致性",
+}
+
+
+def actionable_feedback(report: dict | str, include_details: bool = True) -> str:
+    """
+    从评估报告中提取精炼所需的要点：主要弱点、各维度评分 (及未满分维度的理由)、非低级别风险和改进建议。
+    include_details=False 时省略理由与优点，只保留评分、风险和建议。无法解析为JSON的报告原样返回。
+    """
+    if not isinstance(report, dict):
+        return str(report).strip()
+    lines = []
+    summary = report.get("evaluation_summary") or {}
+    if isinstance(summary, dict):
+        if summary.get("overall_score") is not None:
+            lines.append(f"总体评分：{summary['overall_score']}/5")
+        if summary.get("main_weaknesses"):
+            lines.append(f"主要弱点：{summary['main_weaknesses']}")
+        if include_details and summary.get("main_strengths"):
+            lines.append(f"需保留的优点：{summary['main_strengths']}")
+    dimensions = report.get("dimension_scores") or {}
+    if isinstance(dimensions, dict):
+        for name, entry in dimensions.items():
+            if not isinstance(entry, dict) or entry.get("score") is None:
+                continue
+            line = f"- {_DIMENSION_LABELS.get(name, name)}：{entry['score']}/5"
+            if include_details and entry.get("justification") and entry["score"] != 5:
+                line += f"（{entry['justification']}）"
+            lines.append(line)
+    risks = report.get("potential_risks") or {}
+    if isinstance(risks, dict) and risks.get("level") and str(risks["level"]).lower() != "low":
+        lines.append(f"潜在风险 ({risks['level']})：{risks.get('description', '')}")
+    suggestions = report.get("suggestions_for_improvement") or []
+    if isinstance(suggestions, list) and suggestions:
+        lines.append("改进建议：")
+        lines.extend(f"{i}. {suggestion}" for i, suggestion in enumerate(suggestions, 1))
+    if not lines: # 报告结构与预期不符时退回为紧凑的JSON文本
+        return json.dumps(report, ensure_ascii=False, separators=(",", ":"))
+    return "\n".join(lines)
+
+
+def _truncate_to_tokens(text: str, max_tokens: int) -> str:
+    if max_tokens <= 0:
+        return ""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    low, high = 0, len(text)
+    while low < high: # 二分查找加上省略号后不超过预算的最长前缀
+        mid = (low + high + 1) // 2
+        if estimate_tokens(text[:mid] + "…") <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low] + "…"
+
+
+def build_refinement_request(
+    user_raw_request: str, initial_core_prompt: str, current_prompt: str,
+    evaluation_report: dict | str, token_budget: int = 0, template: str = REFINEMENT_FEEDBACK_TEMPLATE,
+) -> tuple[str, list[dict], dict]:
+    """
+    构建一次精炼调用的 (prompt_content, messages_history, stats)。
+
+    每项内容只发送一次：对话历史只包含核心元提示与当前提示词 (不再累积先前各轮的评估与精炼)，
+    新消息中只附加评估报告的要点，而不是原始报告及重复的提示词。
+    token_budget > 0 时依次采取以下措施直到估计的输入 token 数不超过预算：省略评估理由与优点、
+    以原始用户请求代替核心元提示、截断评估要点。当前提示词本身不会被截断。
+    stats 包含 tokens (估计的输入 token 数) 和 trimmed (采取的措施)。
+    template 为新消息的模板 (含 {feedback} 占位符)，例如要求返回编辑列表的 REFINEMENT_EDITS_TEMPLATE。
+    """
+    trimmed = []
+    history = [
+        {"role": "user", "content": str(initial_core_prompt)},
+        {"role": "assistant", "content": str(current_prompt)},
+    ]
+    feedback = actionable_feedback(evaluation_report)
+
+    def total_tokens() -> int:
+        return estimate_message_tokens(template.format(feedback=feedback), history)
+
+    if token_budget > 0 and total_tokens() > token_budget:
+        feedback = actionable_feedback(evaluation_report, include_details=False)
+        trimmed.append("feedback_details")
+    if token_budget > 0 and total_tokens() > token_budget:
+        history[0] = {"role": "user", "content": f"原始用户请求：\n{user_raw_request}"}
+        trimmed.append("core_prompt")
+    if token_budget > 0 and total_tokens() > token_budget:
+        full_feedback = feedback
+        feedback_budget = token_budget - (total_tokens() - estimate_tokens(feedback))
+        feedback = _truncate_to_tokens(full_feedback, feedback_budget)
+        while feedback and total_tokens() > token_budget: # 非中日韩字符按 4 个一组取整，拼入模板后的估计值可能多出 1
+            feedback_budget -= 1
+            feedback = _truncate_to_tokens(full_feedback, feedback_budget)
+        trimmed.append("feedback_truncated")
+        if total_tokens() > token_budget:
+            logger.warning(f"精炼调用的输入 (约 {total_tokens()} tokens) 仍超过预算 {token_budget}：当前提示词本身已超出预算。")
+    return template.format(feedback=feedback), history, {"tokens": total_tokens(), "trimmed": trimmed}
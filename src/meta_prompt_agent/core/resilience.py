@@ -0,0 +1,285 @@
+# src/meta_prompt_agent/core/resilience.py
+import asyncio
+import contextlib
+import contextvars
+import logging
+import random
+import threading
+import time
+
+from meta_prompt_agent.config import settings
+
+logger = logging.getLogger(__name__)
+
+# --- 错误分类 ---
+TRANSIENT = "transient"   # 网络抖动、超时、限流、服务端 5xx：可重试，计入熔断
+FATAL = "fatal"           # 配置错误、密钥无效：不重试，立即熔断 (已知的错误配置快速失败)
+REQUEST = "request"       # 与本次请求相关 (例如被安全过滤、本地限流排队超时)：不重试，不计入熔断
+PERMANENT = "permanent"   # 其他失败：不重试，计入熔断
+
+# QwenSDKError 是通义千问适配器的兜底错误 (任意异常，包括程序错误)，不按类型视为暂时性错误：
+# 有状态码时按状态码分类，否则只有 exception_type 为下面的网络类异常时才重试
+_TRANSIENT_TYPES = {"ConnectionError", "TimeoutError"}
+_TRANSIENT_STATUS = {408, 429, 500, 502, 503, 504}
+_FATAL_STATUS = {401, 403}
+_TRANSIENT_EXCEPTIONS = {
+    "ServiceUnavailable", "DeadlineExceeded", "ResourceExhausted", "InternalServerError",
+    "TooManyRequests", "GatewayTimeout", "ConnectError", "ReadTimeout",
+    # DashScope SDK 基于 requests，网络异常以这些类型抛出
+    "ConnectionError", "Timeout", "ConnectTimeout", "ChunkedEncodingError",
+}
+_FATAL_ERROR_CODES = {"InvalidApiKey", "AccessDenied", "Unauthorized", "PermissionDenied"}
+
+
+def classify_error(error: dict | None) -> str | None:
+    """
+    将LLM调用返回的错误详情归类为 TRANSIENT / FATAL / REQUEST / PERMANENT；成功 (error 为 None) 时返回 None。
+    """
+    if error is None:
+        return None
+    error_type = error.get("type")
+    status_code = error.get("status_code")
+    if error_type == "ConfigurationError" or status_code in _FATAL_STATUS:
+        return FATAL
+    if error.get("error_code") in _FATAL_ERROR_CODES or error.get("exception_type") in ("PermissionDenied", "Unauthenticated"):
+        return FATAL
+    # 客户端限流排队超时不是提供者的故障：不重试 (已排过队)，也不计入熔断
+    if error_type in ("GeminiContentError", "InputValidationError", "RateLimitQueueTimeout"):
+        return REQUEST
+    if error_type in _TRANSIENT_TYPES or status_code in _TRANSIENT_STATUS:
+        return TRANSIENT
+    if isinstance(status_code, int) and status_code >= 500:
+        return TRANSIENT
+    if error.get("exception_type") in _TRANSIENT_EXCEPTIONS:
+        return TRANSIENT
+    return PERMANENT
+
+
+# --- 熔断器 ---
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class CircuitBreaker:
+    """
+    单个提供者的熔断器 (closed / open / half_open)。
+
+    连续 failure_threshold 次失败 (TRANSIENT 或 PERMANENT) 后打开，recovery_seconds 后进入半开状态，
+    只放行一个探测调用：成功则关闭，失败则重新打开。FATAL 错误立即打开，并使用更长的 fatal_recovery_seconds。
+    """
+
+    def __init__(self, provider: str, failure_threshold: int = 5, recovery_seconds: float = 30,
+                 fatal_recovery_seconds: float = 300):
+        self.provider = provider
+        self.failure_threshold = failure_threshold
+        self.recovery_seconds = recovery_seconds
+        self.fatal_recovery_seconds = fatal_recovery_seconds
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.last_error_type: str | None = None
+        self._opened_at = 0.0
+        self._open_for = 0.0
+        self._probe_in_flight = False
+        self._probe_started = 0.0
+        self._lock = threading.Lock()
+
+    def _open(self, duration: float) -> None:
+        if self.state != OPEN:
+            logger.warning(f"提供者 '{self.provider}' 的熔断器打开 {duration:.0f}s (最近错误: {self.last_error_type})。")
+        self.state = OPEN
+        self._opened_at = time.monotonic()
+        self._open_for = duration
+        self._probe_in_flight = False
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self._open_for:
+                self.state = HALF_OPEN
+                self._probe_in_flight = False
+            # 探测调用若被取消而未回报结果，超过 recovery_seconds 后允许新的探测，避免永久卡在半开状态
+            if self.state == HALF_OPEN and (
+                not self._probe_in_flight or time.monotonic() - self._probe_started >= self.recovery_seconds
+            ):
+                self._probe_in_flight = True
+                self._probe_started = time.monotonic()
+                return True
+            return False
+
+    def record(self, error_kind: str | None, error_type: str | None = None) -> None:
+        with self._lock:
+            if error_kind is None:
+                if self.state != CLOSED:
+                    logger.info(f"提供者 '{self.provider}' 的熔断器已恢复为关闭状态。")
+                self.state = CLOSED
+                self.consecutive_failures = 0
+                self._probe_in_flight = False
+                return
+            if error_kind == REQUEST:
+                if self.state == HALF_OPEN:
+                    self._probe_in_flight = False
+                return
+            self.last_error_type = error_type
+            self.consecutive_failures += 1
+            if error_kind == FATAL:
+                self._open(self.fatal_recovery_seconds)
+            elif self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                self._open(self.recovery_seconds)
+
+    def retry_after(self) -> float:
+        with self._lock:
+            if self.state != OPEN:
+                return 0.0
+            return max(0.0, self._open_for - (time.monotonic() - self._opened_at))
+
+    def open_error(self) -> tuple[str, dict]:
+        retry_after = round(self.retry_after(), 1)
+        return (
+            f"错误：LLM服务提供者 '{self.provider}' 暂时不可用 (熔断器已打开，约 {retry_after}s 后重试)。",
+            {"type": "CircuitOpenError", "provider": self.provider, "retry_after": retry_after,
+             "last_error_type": self.last_error_type},
+        )
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.state, "consecutive_failures": self.consecutive_failures,
+            "last_error_type": self.last_error_type, "retry_after": round(self.retry_after(), 1),
+        }
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(provider: str) -> CircuitBreaker:
+    breaker = _breakers.get(provider)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(provider)
+            if breaker is None:
+                breaker = _breakers[provider] = CircuitBreaker(
+                    provider,
+                    failure_threshold=settings.LLM_BREAKER_FAILURE_THRESHOLD,
+                    recovery_seconds=settings.LLM_BREAKER_RECOVERY_SECONDS,
+                    fatal_recovery_seconds=settings.LLM_BREAKER_FATAL_RECOVERY_SECONDS,
+                )
+    return breaker
+
+
+def is_circuit_open(provider: str) -> bool:
+    breaker = _breakers.get(provider)
+    return breaker is not None and breaker.state == OPEN and breaker.retry_after() > 0
+
+
+def get_breaker_states() -> dict[str, dict]:
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {b.provider: b.snapshot() for b in breakers}
+
+
+def reset_breakers() -> None:
+    """清空所有熔断器状态 (配置变更后或测试中使用)。"""
+    with _breakers_lock:
+        _breakers.clear()
+
+
+# --- 每请求的重试预算 ---
+class RetryBudget:
+    """一次用户请求 (包括其中所有的LLM调用与故障转移) 允许的重试总次数。"""
+
+    def __init__(self, max_retries: int):
+        self.remaining = max_retries
+        self._lock = threading.Lock()
+
+    def try_consume(self) -> bool:
+        with self._lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+
+_current_budget: contextvars.ContextVar[RetryBudget | None] = contextvars.ContextVar("llm_retry_budget", default=None)
+
+
+@contextlib.contextmanager
+def retry_budget(max_retries: int | None = None):
+    """
+    在该上下文中的所有LLM调用共享一个重试预算；已处于某个预算中时沿用外层预算。
+    """
+    if _current_budget.get() is not None:
+        yield _current_budget.get()
+        return
+    budget = RetryBudget(settings.LLM_RETRY_BUDGET_PER_REQUEST if max_retries is None else max_retries)
+    token = _current_budget.set(budget)
+    try:
+        yield budget
+    finally:
+        _current_budget.reset(token)
+
+
+@contextlib.contextmanager
+def bind_retry_budget(budget: RetryBudget):
+    """
+    在该上下文中使用一个已有的重试预算。用于同一请求的LLM调用分散在不同线程中执行的场景 (例如命令行批处理)。
+    """
+    token = _current_budget.set(budget)
+    try:
+        yield budget
+    finally:
+        _current_budget.reset(token)
+
+
+def backoff_delay(retry_index: int) -> float:
+    """带完全抖动 (full jitter) 的指数退避：在 [0, min(上限, 基数 * 2^n)] 内均匀取值。"""
+    return random.uniform(0, min(settings.LLM_RETRY_MAX_DELAY, settings.LLM_RETRY_BASE_DELAY * (2 ** retry_index)))
+
+
+def _next_retry_delay(provider: str, error: dict, error_kind: str, attempt: int, budget: RetryBudget) -> float | None:
+    if error_kind != TRANSIENT or attempt >= settings.LLM_RETRY_MAX_ATTEMPTS:
+        return None
+    if not budget.try_consume():
+        logger.warning(f"提供者 '{provider}' 调用失败 ({error.get('type')})，本次请求的重试预算已用尽。")
+        return None
+    delay = backoff_delay(attempt - 1)
+    logger.warning(f"提供者 '{provider}' 调用失败 ({error.get('type')})，{delay:.2f}s 后进行第 {attempt} 次重试。")
+    return delay
+
+
+def call_with_retries(provider: str, fn) -> tuple[str, dict | None]:
+    """
+    通过熔断器调用 fn() -> (text, error)，对 TRANSIENT 错误在重试预算内按指数退避重试。
+    熔断器打开时不调用 fn，直接返回 CircuitOpenError。
+    """
+    breaker = get_breaker(provider)
+    budget = _current_budget.get() or RetryBudget(settings.LLM_RETRY_BUDGET_PER_REQUEST)
+    attempt = 0
+    while True:
+        if not breaker.allow():
+            return breaker.open_error()
+        attempt += 1
+        result, error = fn()
+        error_kind = classify_error(error)
+        breaker.record(error_kind, error.get("type") if error else None)
+        delay = _next_retry_delay(provider, error, error_kind, attempt, budget) if error else None
+        if delay is None:
+            return result, error
+        time.sleep(delay)
+
+
+async def call_with_retries_async(provider: str, fn) -> tuple[str, dict | None]:
+    """call_with_retries 的异步版本，fn 为返回 (text, error) 的协程函数。"""
+    breaker = get_breaker(provider)
+    budget = _current_budget.get() or RetryBudget(settings.LLM_RETRY_BUDGET_PER_REQUEST)
+    attempt = 0
+    while True:
+        if not breaker.allow():
+            return breaker.open_error()
+        attempt += 1
+        result, error = await fn()
+        error_kind = classify_error(error)
+        breaker.record(error_kind, error.get("type") if error else None)
+        delay = _next_retry_delay(provider, error, error_kind, attempt, budget) if error else None
+        if delay is None:
+            return result, error
+        await asyncio.sleep(delay)
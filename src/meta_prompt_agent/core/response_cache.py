@@ -0,0 +1,214 @@
+# src/meta_prompt_agent/core/response_cache.py
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from meta_prompt_agent.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(provider: str, model: str, messages: list[dict], options: dict | None = None) -> str:
+    """
+    根据 (提供者, 模型, 完整消息列表, 生成参数) 计算内容寻址的缓存键 (SHA-256)。
+    使用规范化的 JSON (键排序、无多余空白)，保证相同内容得到相同的键。
+    """
+    canonical = json.dumps(
+        {"provider": provider, "model": model, "messages": messages, "options": options or {}},
+        ensure_ascii=False, sort_keys=True, separators=(",", ":"),
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    两级 LLM 响应缓存：内存 LRU + 可选的磁盘目录。两级都有容量上限和 TTL。线程安全。
+
+    Args:
+        max_entries (int): 内存中最多保留的条目数，超出时淘汰最久未使用的条目。
+        ttl_seconds (float): 条目有效期 (秒)，<= 0 表示永不过期。
+        disk_dir (str, optional): 磁盘缓存目录，为 None 时不启用磁盘层。
+        disk_max_entries (int): 磁盘上最多保留的条目数。
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 3600,
+                 disk_dir: str | None = None, disk_max_entries: int = 10000):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.disk_dir = disk_dir
+        self.disk_max_entries = disk_max_entries
+        self._memory: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._disk_index: OrderedDict[str, float] | None = None # 惰性加载
+        self._lock = threading.Lock()
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    # --- 内部工具 ---
+    def _is_expired(self, created_at: float, now: float) -> bool:
+        return self.ttl_seconds > 0 and now - created_at > self.ttl_seconds
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], f"{key}.json")
+
+    def _load_disk_index(self) -> OrderedDict:
+        if self._disk_index is None:
+            entries = []
+            if os.path.isdir(self.disk_dir):
+                for root, _, files in os.walk(self.disk_dir):
+                    for name in files:
+                        if name.endswith(".json"):
+                            path = os.path.join(root, name)
+                            entries.append((os.path.getmtime(path), name[:-5]))
+            entries.sort()
+            self._disk_index = OrderedDict((key, mtime) for mtime, key in entries)
+        return self._disk_index
+
+    def _remove_disk_entry(self, key: str) -> None:
+        self._load_disk_index().pop(key, None)
+        try:
+            os.remove(self._disk_path(key))
+        except FileNotFoundError:
+            pass
+
+    def _read_disk(self, key: str, now: float) -> str | None:
+        index = self._load_disk_index()
+        path = self._disk_path(key)
+        if key not in index:
+            # 索引只在首次使用时扫描目录；其他进程 (例如另一个 uvicorn worker) 之后写入的条目直接按路径查找并纳入索引
+            try:
+                index[key] = os.path.getmtime(path)
+            except OSError:
+                return None
+            self._trim_disk_index()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            created_at, value = entry["created_at"], entry["value"]
+            expired = self._is_expired(created_at, now)
+            if not isinstance(value, str):
+                raise TypeError(f"value 的类型为 {type(value).__name__}")
+        except FileNotFoundError: # 已被其他进程淘汰或清空
+            index.pop(key, None)
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e: # 损坏或格式不符的文件
+            logger.warning(f"读取磁盘缓存条目 {key[:12]} 失败: {e!r}")
+            self._remove_disk_entry(key)
+            return None
+        if expired:
+            self._stats["expirations"] += 1
+            self._remove_disk_entry(key)
+            return None
+        index.move_to_end(key)
+        return value
+
+    def _trim_disk_index(self) -> None:
+        index = self._load_disk_index()
+        while len(index) > self.disk_max_entries:
+            oldest_key = next(iter(index))
+            self._remove_disk_entry(oldest_key)
+            self._stats["evictions"] += 1
+
+    def _write_disk(self, key: str, value: str, now: float) -> None:
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp" # 多个进程共享目录，临时文件名需同时区分进程与线程
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"created_at": now, "value": value}, f, ensure_ascii=False)
+            os.replace(tmp_path, path) # 原子替换，避免读到半写入的文件
+        except OSError as e:
+            logger.warning(f"写入磁盘缓存条目 {key[:12]} 失败: {e}")
+            return
+        index = self._load_disk_index()
+        index[key] = now
+        index.move_to_end(key)
+        self._trim_disk_index()
+
+    # --- 公共接口 ---
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created_at, value = entry
+                if not self._is_expired(created_at, now):
+                    self._memory.move_to_end(key)
+                    self._stats["memory_hits"] += 1
+                    return value
+                del self._memory[key]
+                self._stats["expirations"] += 1
+            if self.disk_dir:
+                value = self._read_disk(key, now)
+                if value is not None:
+                    self._stats["disk_hits"] += 1
+                    self._put_memory(key, value, now) # 提升到内存层
+                    return value
+            self._stats["misses"] += 1
+            return None
+
+    def _put_memory(self, key: str, value: str, now: float) -> None:
+        self._memory[key] = (now, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def put(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._put_memory(key, value, now)
+            if self.disk_dir:
+                self._write_disk(key, value, now)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            if self.disk_dir:
+                for key in list(self._load_disk_index()):
+                    self._remove_disk_entry(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot["memory_entries"] = len(self._memory)
+            snapshot["disk_entries"] = len(self._disk_index) if self._disk_index is not None else None
+        lookups = snapshot["memory_hits"] + snapshot["disk_hits"] + snapshot["misses"]
+        snapshot["hit_rate"] = (snapshot["memory_hits"] + snapshot["disk_hits"]) / lookups if lookups else 0.0
+        return snapshot
+
+
+_default_cache: ResponseCache | None = None
+_default_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache | None:
+    """
+    返回按 settings 配置的全局响应缓存；LLM_CACHE_ENABLED 为 False 时返回 None。
+    """
+    global _default_cache
+    if not settings.LLM_CACHE_ENABLED:
+        return None
+    if _default_cache is None:
+        with _default_cache_lock:
+            if _default_cache is None:
+                _default_cache = ResponseCache(
+                    max_entries=settings.LLM_CACHE_MAX_ENTRIES,
+                    ttl_seconds=settings.LLM_CACHE_TTL_SECONDS,
+                    disk_dir=settings.LLM_CACHE_DIR,
+                    disk_max_entries=settings.LLM_CACHE_DISK_MAX_ENTRIES,
+                )
+                logger.info(
+                    f"已启用LLM响应缓存 (内存上限 {settings.LLM_CACHE_MAX_ENTRIES} 条, TTL {settings.LLM_CACHE_TTL_SECONDS}s, "
+                    f"磁盘目录: {settings.LLM_CACHE_DIR or '未启用'})。"
+                )
+    return _default_cache
+
+
+def reset_response_cache() -> None:
+    """丢弃全局缓存实例 (配置变更后或测试中使用)，下次访问时按当前配置重建。"""
+    global _default_cache
+    with _default_cache_lock:
+        _default_cache = None
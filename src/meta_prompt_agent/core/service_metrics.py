@@ -0,0 +1,364 @@
+# src/meta_prompt_agent/core/service_metrics.py
+import bisect
+import contextlib
+import json
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+
+from meta_prompt_agent.config import settings
+from meta_prompt_agent.core import rate_limit, response_cache, single_flight
+
+logger = logging.getLogger(__name__)
+
+# --- 进程内指标 ---
+# 每个指标一把锁，更新只是字典中的一次加法；Prometheus 文本格式只在抓取时生成。
+# 多个 uvicorn worker 时，各进程定期把快照写入 METRICS_MULTIPROC_DIR 下自己的文件 (文件名带进程号、启动时间与随机后缀，
+# 进程号被复用时不会覆盖已退出 worker 的文件)，任一 worker 处理 /metrics 时合并全部文件：
+# 计数器与直方图求和 (包括已退出的 worker)，仪表盘只合并仍存活的进程。
+
+_DEFAULT_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+_TOKENS_PER_SECOND_BUCKETS = (1, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: dict[tuple, object] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            samples = [[list(key), _copy_value(value)] for key, value in self._values.items()]
+        return {"type": self.type_name, "help": self.documentation, "labels": list(self.labelnames), "samples": samples}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+
+def _copy_value(value):
+    return {"buckets": list(value["buckets"]), "sum": value["sum"], "count": value["count"]} if isinstance(value, dict) else value
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    @contextlib.contextmanager
+    def track_in_progress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), buckets=_DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value) # 落入的第一个上界 (le) 桶；超过所有上界时记入 +Inf
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = {"buckets": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            entry["buckets"][index] += 1
+            entry["sum"] += value
+            entry["count"] += 1
+
+    def snapshot(self) -> dict:
+        data = super().snapshot()
+        data["bounds"] = list(self.buckets)
+        return data
+
+
+# --- 指标定义 ---
+HTTP_REQUESTS = Counter("mpa_http_requests_total", "API 请求数", ("method", "endpoint", "status"))
+HTTP_LATENCY = Histogram("mpa_http_request_duration_seconds", "API 请求耗时 (流式响应只计到响应开始)", ("method", "endpoint"))
+HTTP_IN_FLIGHT = Gauge("mpa_http_requests_in_flight", "正在处理的 API 请求数")
+LLM_LATENCY = Histogram("mpa_llm_call_duration_seconds", "单次上游LLM调用的耗时 (不含限流排队)", ("provider", "model"))
+LLM_IN_FLIGHT = Gauge("mpa_llm_calls_in_flight", "正在进行的上游LLM调用数", ("provider",))
+LLM_ERRORS = Counter("mpa_llm_errors_total", "上游LLM调用失败次数，按错误类型", ("provider", "type"))
+LLM_TOKENS = Counter(
+    "mpa_llm_tokens_total", "成功调用的 token 数 (提供者未返回用量时为本地估算；cached_input 为输入中命中前缀缓存的部分)",
+    ("provider", "model", "direction"),
+)
+LLM_TOKENS_PER_SECOND = Histogram(
+    "mpa_llm_output_tokens_per_second", "单次调用的输出 token 速率", ("provider", "model"), buckets=_TOKENS_PER_SECOND_BUCKETS
+)
+_METRICS = (HTTP_REQUESTS, HTTP_LATENCY, HTTP_IN_FLIGHT, LLM_LATENCY, LLM_IN_FLIGHT, LLM_ERRORS, LLM_TOKENS, LLM_TOKENS_PER_SECOND)
+
+
+def observe_http_request(method: str, endpoint: str, status: int, seconds: float) -> None:
+    HTTP_REQUESTS.inc(method=method, endpoint=endpoint, status=status)
+    HTTP_LATENCY.observe(seconds, method=method, endpoint=endpoint)
+
+
+def observe_llm_call(provider: str, model: str | None, seconds: float, error: dict | None, usage: tuple | None) -> None:
+    """记录一次上游LLM调用；usage 为 pipeline_metrics.record_attempt 返回的 (输入, 输出, 是否估算, 命中缓存的输入)。"""
+    if not settings.METRICS_ENABLED:
+        return
+    model = model or ""
+    LLM_LATENCY.observe(seconds, provider=provider, model=model)
+    if error is not None:
+        LLM_ERRORS.inc(provider=provider, type=error.get("type", "UnknownError"))
+        return
+    if usage:
+        LLM_TOKENS.inc(usage[0], provider=provider, model=model, direction="input")
+        LLM_TOKENS.inc(usage[1], provider=provider, model=model, direction="output")
+        if len(usage) > 3 and usage[3]:
+            LLM_TOKENS.inc(usage[3], provider=provider, model=model, direction="cached_input")
+        if seconds > 0:
+            LLM_TOKENS_PER_SECOND.observe(usage[1] / seconds, provider=provider, model=model)
+
+
+def llm_call_in_flight(provider: str):
+    if not settings.METRICS_ENABLED:
+        return contextlib.nullcontext()
+    return LLM_IN_FLIGHT.track_in_progress(provider=provider)
+
+
+def _runtime_samples():
+    # 各模块已有的统计 (响应缓存、限流排队、请求合并)，在抓取或写快照时读取，不增加调用路径上的开销
+    cache = response_cache.get_response_cache()
+    if cache is not None:
+        stats = cache.stats()
+        for kind in ("memory_hits", "disk_hits", "misses", "evictions", "expirations"):
+            yield "mpa_response_cache_events_total", "counter", "响应缓存事件数", {"event": kind}, stats[kind]
+        yield "mpa_response_cache_entries", "gauge", "响应缓存条目数", {"tier": "memory"}, stats["memory_entries"]
+        if stats["disk_entries"] is not None:
+            yield "mpa_response_cache_entries", "gauge", "响应缓存条目数", {"tier": "disk"}, stats["disk_entries"]
+    for limiter, stats in rate_limit.get_rate_limit_stats().items():
+        labels = {"limiter": limiter}
+        yield "mpa_rate_limit_calls_total", "counter", "通过客户端限流的调用数", labels, stats["calls"]
+        yield "mpa_rate_limit_queued_total", "counter", "需要排队的调用数", labels, stats["queued"]
+        yield "mpa_rate_limit_rejected_total", "counter", "排队超时被拒绝的调用数", labels, stats["rejected"]
+        yield "mpa_rate_limit_queue_wait_seconds_total", "counter", "累计排队等待时间", labels, stats["total_queue_wait_ms"] / 1000
+        yield "mpa_rate_limit_in_flight", "gauge", "限流器内正在进行的调用数", labels, stats["in_flight"]
+    for path, stats in single_flight.get_coalescing_stats().items():
+        labels = {"path": path}
+        yield "mpa_single_flight_leaders_total", "counter", "实际发起的上游调用数", labels, stats["leaders"]
+        yield "mpa_single_flight_coalesced_total", "counter", "被合并的调用数", labels, stats["coalesced"]
+        yield "mpa_single_flight_in_flight", "gauge", "正在进行的合并组数", labels, stats["in_flight"]
+
+
+def _collected_snapshot() -> dict:
+    metrics = {}
+    try:
+        samples = list(_runtime_samples())
+    except Exception:
+        logger.exception("收集运行时统计指标失败。")
+        return metrics
+    for name, type_name, documentation, labels, value in samples:
+        # 这些统计随进程退出而消失，只合并仍存活的进程
+        entry = metrics.setdefault(name, {"type": type_name, "help": documentation, "labels": list(labels), "samples": [], "live_only": True})
+        entry["samples"].append([[str(v) for v in labels.values()], value])
+    return metrics
+
+
+def process_snapshot() -> dict:
+    """当前进程的全部指标快照 (可序列化为 JSON)。"""
+    metrics = {}
+    for metric in _METRICS:
+        metrics[metric.name] = metric.snapshot()
+        if isinstance(metric, Gauge):
+            metrics[metric.name]["live_only"] = True # 在途数等仪表盘只对仍存活的进程有意义
+    metrics.update(_collected_snapshot())
+    return {"pid": os.getpid(), "instance": _instance_id(), "written_at": time.time(), "metrics": metrics}
+
+
+# --- 多进程 ---
+_instance: tuple[int, str] | None = None
+
+
+def _instance_id() -> str:
+    # 按进程号缓存：fork 出的子进程继承了父进程的模块状态，进程号变化时重新生成
+    global _instance
+    pid = os.getpid()
+    if _instance is None or _instance[0] != pid:
+        _instance = (pid, f"{pid}-{int(time.time())}-{uuid.uuid4().hex[:8]}")
+    return _instance[1]
+
+
+def _multiproc_dir() -> str | None:
+    return settings.METRICS_MULTIPROC_DIR
+
+
+def flush() -> None:
+    """把当前进程的快照原子地写入 METRICS_MULTIPROC_DIR (未配置时不做任何事)。"""
+    directory = _multiproc_dir()
+    if not directory:
+        return
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"worker-{_instance_id()}.json")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(process_snapshot(), f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+_flusher: threading.Thread | None = None
+_flusher_stop = threading.Event()
+
+
+def start_flusher() -> None:
+    """配置了 METRICS_MULTIPROC_DIR 时启动后台线程，每 METRICS_FLUSH_INTERVAL_SECONDS 写一次快照。"""
+    global _flusher
+    if not _multiproc_dir() or not settings.METRICS_ENABLED or (_flusher is not None and _flusher.is_alive()):
+        return
+    _flusher_stop.clear()
+
+    def run():
+        while not _flusher_stop.wait(settings.METRICS_FLUSH_INTERVAL_SECONDS):
+            try:
+                flush()
+            except OSError:
+                logger.exception("写入指标快照失败。")
+
+    _flusher = threading.Thread(target=run, name="metrics-flusher", daemon=True)
+    _flusher.start()
+
+
+def stop_flusher() -> None:
+    global _flusher
+    _flusher_stop.set()
+    if _flusher is not None:
+        _flusher.join(timeout=5)
+        _flusher = None
+    if _multiproc_dir():
+        flush()
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _load_snapshots() -> list[dict]:
+    directory = _multiproc_dir()
+    if not directory:
+        return [process_snapshot()]
+    flush() # 处理抓取的进程总是提供最新数据
+    snapshots = []
+    for filename in sorted(os.listdir(directory)):
+        if not (filename.startswith("worker-") and filename.endswith(".json")):
+            continue
+        try:
+            with open(os.path.join(directory, filename), "r", encoding="utf-8") as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            logger.warning(f"无法读取指标快照文件 '{filename}'，已跳过。")
+    return snapshots
+
+
+def _snapshot_alive(snapshot: dict) -> bool:
+    if snapshot.get("instance") == _instance_id():
+        return True
+    # 进程号可能已被其他进程复用：存活的 worker 每 METRICS_FLUSH_INTERVAL_SECONDS 刷新一次快照，长时间未刷新视为已退出
+    stale_after = max(3 * settings.METRICS_FLUSH_INTERVAL_SECONDS, 10)
+    return _pid_alive(snapshot.get("pid", -1)) and time.time() - snapshot.get("written_at", 0) <= stale_after
+
+
+def _merge(snapshots: list[dict]) -> dict:
+    merged: dict[str, dict] = {}
+    for snapshot in snapshots:
+        alive = _snapshot_alive(snapshot)
+        for name, metric in snapshot["metrics"].items():
+            if metric.get("live_only") and not alive:
+                continue # 已退出进程的仪表盘 (在途数等) 不再有意义；计数器保留
+            target = merged.setdefault(name, {**metric, "samples": {}})
+            for labels, value in metric["samples"]:
+                key = tuple(labels)
+                current = target["samples"].get(key)
+                if isinstance(value, dict):
+                    if current is None:
+                        target["samples"][key] = _copy_value(value)
+                    else:
+                        current["buckets"] = [a + b for a, b in zip(current["buckets"], value["buckets"])]
+                        current["sum"] += value["sum"]
+                        current["count"] += value["count"]
+                else:
+                    target["samples"][key] = (current or 0) + value
+    return merged
+
+
+def _escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra: tuple = ()) -> str:
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label_value(value)}"' for name, value in pairs) + "}"
+
+
+def _format_number(value: float) -> str:
+    if isinstance(value, float) and math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render_latest() -> str:
+    """以 Prometheus 文本格式 (0.0.4) 返回所有 worker 合并后的指标。"""
+    lines = []
+    for name, metric in sorted(_merge(_load_snapshots()).items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for labels, value in sorted(metric["samples"].items()):
+            if metric["type"] != "histogram":
+                lines.append(f"{name}{_format_labels(metric['labels'], labels)} {_format_number(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(list(metric["bounds"]) + [math.inf], value["buckets"]):
+                cumulative += count
+                le = _format_number(float(bound))
+                lines.append(f"{name}_bucket{_format_labels(metric['labels'], labels, (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(metric['labels'], labels)} {_format_number(value['sum'])}")
+            lines.append(f"{name}_count{_format_labels(metric['labels'], labels)} {value['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def reset() -> None:
+    """清空本进程的指标 (测试中使用)。"""
+    for metric in _METRICS:
+        metric.clear()
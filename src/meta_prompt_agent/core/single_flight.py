@@ -0,0 +1,168 @@
+# src/meta_prompt_agent/core/single_flight.py
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class _Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {"leaders": 0, "coalesced": 0, "shared_failures": 0}
+
+    def incr(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self._counts[name] += amount
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._counts)
+
+    def reset(self) -> None:
+        with self._lock:
+            for name in self._counts:
+                self._counts[name] = 0
+
+
+def _is_failure(result) -> bool:
+    # LLM 调用的返回值约定为 (text, error)；error 非 None 即为失败
+    return isinstance(result, tuple) and len(result) == 2 and result[1] is not None
+
+
+class _InFlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception: BaseException | None = None
+        self.followers = 0
+
+
+class SingleFlight:
+    """
+    同步版本的请求合并 (single-flight)：同一 key 的并发调用只执行一次 fn，所有调用方共享其结果。
+
+    领头调用一结束 (无论成功或失败) 就从在途表中移除并唤醒所有等待者，等待者之间互不阻塞；
+    之后到达的调用会重新发起新的请求，因此失败结果不会被缓存。
+    """
+
+    def __init__(self):
+        self._calls: dict[str, _InFlightCall] = {}
+        self._lock = threading.Lock()
+        self._stats = _Stats()
+
+    def do(self, key: str, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.followers += 1
+                leader = False
+            else:
+                call = self._calls[key] = _InFlightCall()
+                leader = True
+        if not leader:
+            self._stats.incr("coalesced")
+            call.done.wait()
+            if call.exception is not None:
+                raise call.exception
+            return call.result
+
+        self._stats.incr("leaders")
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.exception = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            if call.followers and (call.exception is not None or _is_failure(call.result)):
+                self._stats.incr("shared_failures", call.followers)
+            call.done.set()
+        return call.result
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+    def stats(self) -> dict:
+        snapshot = self._stats.snapshot()
+        snapshot["in_flight"] = self.in_flight()
+        return snapshot
+
+    def reset_stats(self) -> None:
+        self._stats.reset()
+
+
+class AsyncSingleFlight:
+    """
+    异步版本的请求合并。领头调用在独立的 Task 中执行，所有调用方 (包括领头者) 通过 asyncio.shield 等待它，
+    因此某个调用方被取消 (例如客户端断开) 不会取消其他调用方共享的上游请求。
+    不同事件循环中的调用不会互相合并。
+    """
+
+    def __init__(self):
+        self._calls: dict[tuple[int, str], tuple[asyncio.Task, list[int]]] = {}
+        self._stats = _Stats()
+
+    async def do(self, key: str, coro_fn):
+        loop = asyncio.get_running_loop()
+        call_key = (id(loop), key)
+        entry = self._calls.get(call_key)
+        if entry is not None:
+            task, followers = entry
+            followers[0] += 1
+            self._stats.incr("coalesced")
+            return await asyncio.shield(task)
+
+        followers = [0]
+        task = loop.create_task(coro_fn())
+        self._calls[call_key] = (task, followers)
+        self._stats.incr("leaders")
+
+        def _on_done(finished: asyncio.Task) -> None:
+            self._calls.pop(call_key, None)
+            # 总是取出异常，避免领头者被取消时出现 "Task exception was never retrieved"
+            failed = finished.cancelled() or finished.exception() is not None or _is_failure(finished.result())
+            if followers[0] and failed:
+                self._stats.incr("shared_failures", followers[0])
+
+        task.add_done_callback(_on_done)
+        return await asyncio.shield(task)
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    def stats(self) -> dict:
+        snapshot = self._stats.snapshot()
+        snapshot["in_flight"] = self.in_flight()
+        return snapshot
+
+    def reset_stats(self) -> None:
+        self._stats.reset()
+
+
+_sync_group = SingleFlight()
+_async_group = AsyncSingleFlight()
+
+
+def get_sync_group() -> SingleFlight:
+    return _sync_group
+
+
+def get_async_group() -> AsyncSingleFlight:
+    return _async_group
+
+
+def get_coalescing_stats() -> dict:
+    """
+    返回同步与异步两条调用路径的合并统计：
+    leaders (实际发起的上游调用数)、coalesced (被合并而未发起上游调用的次数)、
+    shared_failures (共享到失败结果的跟随者数) 以及当前在途的 key 数量 in_flight。
+    """
+    return {"sync": _sync_group.stats(), "async": _async_group.stats()}
+
+
+def reset_coalescing_stats() -> None:
+    _sync_group.reset_stats()
+    _async_group.reset_stats()
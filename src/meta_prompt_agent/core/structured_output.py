@@ -0,0 +1,205 @@
+# src/meta_prompt_agent/core/structured_output.py
+import contextlib
+import contextvars
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# --- 请求所需的响应格式 ---
+class StructuredRequest(tuple):
+    """
+    流水线产出的一次LLM调用 (prompt_content, messages_history)，并要求响应符合 schema。
+    解包方式与普通的二元组相同，因此驱动函数仍可以 invoke_llm(*request) 调用。
+    """
+
+    def __new__(cls, prompt_content: str, messages_history: list | None, schema: dict):
+        request = super().__new__(cls, (prompt_content, messages_history))
+        request.schema = schema
+        return request
+
+
+def request_schema(llm_request) -> dict | None:
+    return getattr(llm_request, "schema", None)
+
+
+_current_schema: contextvars.ContextVar[dict | None] = contextvars.ContextVar("llm_response_schema", default=None)
+
+
+@contextlib.contextmanager
+def response_schema(schema: dict | None):
+    """在该上下文中的LLM调用要求提供者以 JSON / Schema 模式输出 (schema 为 None 时不要求)。"""
+    token = _current_schema.set(schema)
+    try:
+        yield schema
+    finally:
+        _current_schema.reset(token)
+
+
+def current_response_schema() -> dict | None:
+    return _current_schema.get()
+
+
+_GEMINI_SCHEMA_KEYS = {"type", "properties", "required", "items", "enum", "description", "nullable", "format"}
+
+
+def to_gemini_schema(schema: dict) -> dict:
+    """转换为 Gemini responseSchema 支持的 OpenAPI 子集：类型名大写，去掉不支持的关键字。"""
+    converted = {}
+    for key, value in schema.items():
+        if key not in _GEMINI_SCHEMA_KEYS:
+            continue
+        if key == "type":
+            converted[key] = str(value).upper()
+        elif key == "properties":
+            converted[key] = {name: to_gemini_schema(sub) for name, sub in value.items()}
+        elif key == "items":
+            converted[key] = to_gemini_schema(value)
+        else:
+            converted[key] = value
+    return converted
+
+
+# --- 容错的 JSON 解析 ---
+_CLOSERS = {"{": "}", "[": "]"}
+_PY_LITERALS = (("True", "true"), ("False", "false"), ("None", "null"))
+_MAX_OBJECT_STARTS = 8 # 说明文字中的花括号最多跳过的次数，避免对大量花括号的输出反复扫描
+
+
+def strip_code_fence(text: str) -> str:
+    cleaned = text.strip()
+    if cleaned.startswith("```"):
+        cleaned = cleaned.split("\n", 1)[1] if "\n" in cleaned else ""
+    if cleaned.endswith("```"):
+        cleaned = cleaned[:-3]
+    return cleaned.strip()
+
+
+def _drop_trailing_comma(out: list[str]) -> None:
+    while out and out[-1].isspace():
+        out.pop()
+    if out and out[-1] == ",":
+        out.pop()
+
+
+def repair_json(text: str, start: int | None = None) -> str | None:
+    """
+    对模型输出做一次增量扫描，修复常见问题后返回 JSON 文本；找不到 JSON 起始位置时返回 None。
+    start 为扫描的起始位置 (应指向 { 或 [)，默认为第一个 { 或 [。
+
+    可修复：JSON 前后的说明文字与代码块标记、注释 (/* */ 与 //)、末尾多余的逗号、
+    字符串中未转义的换行与制表符、Python 风格的 True / False / None、括号不匹配，
+    以及输出被截断 (未闭合的字符串、悬空的键、未闭合的对象与数组)。
+    """
+    return _repair_from(text, start)[0]
+
+
+def _repair_from(text: str, start: int | None) -> tuple[str | None, int]:
+    # 返回 (修复后的 JSON 文本, 扫描结束的位置)
+    if start is None:
+        starts = [i for i in (text.find("{"), text.find("[")) if i >= 0]
+        if not starts:
+            return None, len(text)
+        start = min(starts)
+    i, n = start, len(text)
+    out: list[str] = []
+    stack: list[str] = []
+    in_string = escape = False
+    while i < n:
+        ch = text[i]
+        if in_string:
+            if escape:
+                escape = False
+                out.append(ch)
+            elif ch == "\\":
+                escape = True
+                out.append(ch)
+            elif ch == '"':
+                in_string = False
+                out.append(ch)
+            elif ch == "\n":
+                out.append("\\n")
+            elif ch == "\t":
+                out.append("\\t")
+            elif ch != "\r":
+                out.append(ch)
+            i += 1
+            continue
+        if ch == '"':
+            in_string = True
+            out.append(ch)
+        elif ch in _CLOSERS:
+            stack.append(ch)
+            out.append(ch)
+        elif ch in "}]":
+            _drop_trailing_comma(out)
+            if stack:
+                out.append(_CLOSERS[stack.pop()]) # 括号不匹配时按实际打开的括号闭合
+                if not stack:
+                    i += 1
+                    break # 顶层值已完整，忽略其后的说明文字
+        elif text.startswith("/*", i):
+            end = text.find("*/", i + 2)
+            i = n if end < 0 else end + 2
+            continue
+        elif text.startswith("//", i):
+            end = text.find("\n", i)
+            i = n if end < 0 else end
+            continue
+        else:
+            literal = next(((py, js) for py, js in _PY_LITERALS if text.startswith(py, i)), None)
+            if literal:
+                out.append(literal[1])
+                i += len(literal[0])
+                continue
+            out.append(ch)
+        i += 1
+    if in_string: # 输出在字符串中被截断
+        if escape:
+            out.pop()
+        out.append('"')
+    repaired = "".join(out).rstrip()
+    if not stack:
+        return repaired, i
+    tail = "".join(_CLOSERS[opener] for opener in reversed(stack))
+    body = repaired.rstrip(",").rstrip()
+    if body.endswith(":"):
+        body += " null"
+    # 截断处可能是悬空的键 ({"a": 1, "b")：补上 null 值后再尝试
+    for candidate in (body + tail, body + ": null" + tail):
+        try:
+            json.loads(candidate)
+            return candidate, i
+        except json.JSONDecodeError:
+            continue
+    return body + tail, i
+
+
+def parse_json_object(text: str) -> tuple[dict | None, bool]:
+    """
+    把模型输出解析为 JSON 对象。返回 (对象, 是否经过修复)；无法得到 JSON 对象时返回 (None, False)。
+
+    修复时从第一个 { 开始，而不是第一个 { 或 [，前面的说明文字中的方括号 (例如 "[1-5] 分") 不影响解析；
+    说明文字中的花括号扫描完仍不是对象时，从其后的下一个 { 继续尝试。
+    """
+    cleaned = strip_code_fence(text)
+    try:
+        data = json.loads(cleaned)
+        if isinstance(data, dict):
+            return data, False
+    except json.JSONDecodeError:
+        pass
+    start = cleaned.find("{")
+    for _ in range(_MAX_OBJECT_STARTS):
+        if start < 0:
+            break
+        repaired, end = _repair_from(cleaned, start)
+        try:
+            data = json.loads(repaired)
+            if isinstance(data, dict):
+                return data, True
+        except json.JSONDecodeError:
+            pass
+        start = cleaned.find("{", end) # 跳过已扫描的部分，不会落入该对象内部的嵌套对象
+    return None, False
@@ -0,0 +1,434 @@
+# src/meta_prompt_agent/core/template_registry.py
+import asyncio
+import contextlib
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import string
+import threading
+import time
+import tomllib
+from dataclasses import dataclass, replace
+
+try:
+    import yaml
+except ImportError: # PyYAML 未安装时不支持 .yaml / .yml 模板文件 (可选依赖: pip install "meta_prompt[yaml]")
+    yaml = None
+
+from meta_prompt_agent.config import settings
+from meta_prompt_agent.prompts.templates import STRUCTURED_PROMPT_TEMPLATES
+
+logger = logging.getLogger(__name__)
+
+USER_REQUEST_FIELD = "user_raw_request" # 由调用方自动填入，模板不需要在 variables 中声明
+
+
+class TemplateError(ValueError):
+    """结构化模板定义不合法 (缺少字段、占位符与声明的变量不一致等)。"""
+
+
+@dataclass(frozen=True)
+class CompiledTemplate:
+    """
+    预先解析过的结构化模板。segments 是 (字面文本, 占位符名或 None) 的序列，
+    渲染时按顺序拼接一次即可，不再重复解析模板字符串。
+    """
+    name: str
+    task_types: tuple[str, ...]
+    description: str
+    variables: tuple[str, ...]
+    placeholders: frozenset[str]
+    source: str
+    segments: tuple[tuple[str, str | None], ...]
+    version: str # 模板正文与变量的内容摘要，模板内容变化时随之变化
+
+    def missing_variables(self, values: dict | None) -> list[str]:
+        """返回未提供或值为空白的已声明变量，保持声明顺序。"""
+        values = values or {}
+        return [var for var in self.variables if var not in values or not str(values[var]).strip()]
+
+    def render(self, values: dict) -> str:
+        """用 values 填充全部占位符；缺少占位符对应的值时抛出 KeyError。"""
+        parts = []
+        for literal, field_name in self.segments:
+            parts.append(literal)
+            if field_name is not None:
+                value = values[field_name]
+                parts.append(value if isinstance(value, str) else str(value))
+        return "".join(parts)
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name, "task_types": list(self.task_types), "description": self.description,
+            "variables": list(self.variables), "placeholders": sorted(self.placeholders), "version": self.version,
+        }
+
+
+def compile_template(name: str, data: dict) -> CompiledTemplate:
+    """
+    校验并编译一个模板定义。只允许简单的具名占位符 ({name})，不支持位置参数、属性/下标访问、
+    转换 (!r) 与格式说明 (:>10)；占位符必须在 variables 中声明 (user_raw_request 除外)，
+    声明的变量也必须在模板中出现。不合法时抛出 TemplateError。
+    """
+    if not isinstance(data, dict):
+        raise TemplateError(f"模板 '{name}' 的定义应为字典，实际是 {type(data).__name__}。")
+    source = data.get("core_template_override")
+    if not isinstance(source, str) or not source.strip():
+        raise TemplateError(f"模板 '{name}' 缺少 'core_template_override' 字符串。")
+    task_types = data.get("task_type", [])
+    if not isinstance(task_types, list) or not all(isinstance(t, str) and t for t in task_types):
+        raise TemplateError(f"模板 '{name}' 的 'task_type' 应为非空字符串列表。")
+    variables = data.get("variables", [])
+    if not isinstance(variables, list) or not all(isinstance(v, str) and v.isidentifier() for v in variables):
+        raise TemplateError(f"模板 '{name}' 的 'variables' 应为合法标识符组成的列表。")
+    if len(set(variables)) != len(variables):
+        raise TemplateError(f"模板 '{name}' 的 'variables' 中存在重复项。")
+    description = data.get("description", "")
+    if not isinstance(description, str):
+        raise TemplateError(f"模板 '{name}' 的 'description' 应为字符串。")
+
+    try:
+        parsed = list(string.Formatter().parse(source))
+    except ValueError as e:
+        raise TemplateError(f"模板 '{name}' 的花括号不匹配: {e}") from e
+    segments = []
+    pending_literal = ""
+    for literal, field_name, format_spec, conversion in parsed:
+        pending_literal += literal
+        if field_name is None:
+            continue
+        if not field_name.isidentifier():
+            raise TemplateError(f"模板 '{name}' 中的占位符 '{{{field_name}}}' 不是简单的具名占位符。")
+        if format_spec or conversion:
+            raise TemplateError(f"模板 '{name}' 中的占位符 '{field_name}' 不支持转换或格式说明。")
+        segments.append((pending_literal, field_name))
+        pending_literal = ""
+    if pending_literal:
+        segments.append((pending_literal, None))
+
+    placeholders = frozenset(field_name for _, field_name in segments if field_name is not None)
+    undeclared = sorted(placeholders - set(variables) - {USER_REQUEST_FIELD})
+    if undeclared:
+        raise TemplateError(f"模板 '{name}' 使用了未在 'variables' 中声明的占位符: {', '.join(undeclared)}。")
+    unused = [var for var in variables if var not in placeholders]
+    if unused:
+        raise TemplateError(f"模板 '{name}' 声明的变量未在模板中使用: {', '.join(unused)}。")
+    version = _digest({"source": source, "variables": variables})
+    return CompiledTemplate(
+        name=name, task_types=tuple(task_types), description=description, variables=tuple(variables),
+        placeholders=placeholders, source=source, segments=tuple(segments), version=version,
+    )
+
+
+def _digest(data) -> str:
+    canonical = json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:12]
+
+
+class TemplateRegistry:
+    """
+    一组编译好的结构化模板，以及 任务类型 -> 模板名 的索引。构造时编译全部模板，
+    有任何模板不合法时一次性报告所有错误并抛出 TemplateError。构造后只读，可在线程间共享。
+    """
+
+    def __init__(self, templates: dict):
+        if not isinstance(templates, dict):
+            raise TemplateError(f"模板集合应为字典，实际是 {type(templates).__name__}。")
+        compiled, errors = {}, []
+        for name, data in templates.items():
+            try:
+                compiled[name] = compile_template(name, data)
+            except TemplateError as e:
+                errors.append(str(e))
+        if errors:
+            raise TemplateError("结构化模板校验失败:\n" + "\n".join(errors))
+        self._templates: dict[str, CompiledTemplate] = compiled
+        index: dict[str, list[str]] = {}
+        for template in compiled.values():
+            for task_type in template.task_types:
+                index.setdefault(task_type, []).append(template.name)
+        self._index = {task_type: tuple(names) for task_type, names in index.items()}
+        self.version = _digest([[t.name, t.version, list(t.task_types), t.description] for t in compiled.values()])
+        self._snapshots: dict[str | None, tuple[bytes, str]] = {}
+        self._snapshot_lock = threading.Lock()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._templates
+
+    def __len__(self) -> int:
+        return len(self._templates)
+
+    def names(self) -> list[str]:
+        return list(self._templates)
+
+    def get(self, name: str) -> CompiledTemplate | None:
+        return self._templates.get(name)
+
+    def task_types(self) -> list[str]:
+        return list(self._index)
+
+    def for_task_type(self, task_type: str) -> list[CompiledTemplate]:
+        """返回适用于该任务类型的模板，保持模板的定义顺序。"""
+        return [self._templates[name] for name in self._index.get(task_type, ())]
+
+    def to_dict(self, task_type: str | None = None) -> dict:
+        templates = self.for_task_type(task_type) if task_type is not None else list(self._templates.values())
+        index = {task_type: list(self._index.get(task_type, ()))} if task_type is not None else {
+            key: list(names) for key, names in self._index.items()
+        }
+        return {"version": self.version, "templates": [template.to_dict() for template in templates], "task_types": index}
+
+    def snapshot(self, task_type: str | None = None) -> tuple[bytes, str]:
+        """
+        返回 (JSON 响应体, ETag)。ETag 是响应体的 SHA-256 摘要 (带引号的强校验值)，
+        内容不变时保持不变。已知任务类型的结果会被缓存，同一注册表只序列化一次 (未知类型不缓存，避免任意查询参数占用内存)。
+        """
+        cached = self._snapshots.get(task_type)
+        if cached is None:
+            body = json.dumps(self.to_dict(task_type), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            cached = (body, f'"{hashlib.sha256(body).hexdigest()[:32]}"')
+            if task_type is None or task_type in self._index:
+                with self._snapshot_lock:
+                    self._snapshots[task_type] = cached
+        return cached
+
+
+# --- 外部模板目录 ---
+_TEMPLATE_SUFFIXES = (".json", ".toml", ".yaml", ".yml")
+
+
+@dataclass(frozen=True)
+class _TemplateFile:
+    mtime_ns: int
+    size: int
+    digest: str
+    templates: dict | None # 解析失败时为 None
+    error: str | None = None
+
+
+def _parse_template_file(path: str, data: bytes) -> dict:
+    """按扩展名解析模板文件，内容应为 {模板名: 模板定义} 的映射。"""
+    suffix = os.path.splitext(path)[1].lower()
+    try:
+        if suffix == ".json":
+            parsed = json.loads(data.decode("utf-8"))
+        elif suffix == ".toml":
+            parsed = tomllib.loads(data.decode("utf-8"))
+        elif yaml is None:
+            raise TemplateError(f"读取 YAML 模板文件 '{path}' 需要安装 PyYAML (pip install \"meta_prompt[yaml]\")。")
+        else:
+            parsed = yaml.safe_load(data)
+    except TemplateError:
+        raise
+    except Exception as e: # JSON / TOML / YAML 语法错误、编码错误
+        raise TemplateError(f"无法解析模板文件 '{path}': {type(e).__name__} - {e}") from e
+    if not isinstance(parsed, dict):
+        raise TemplateError(f"模板文件 '{path}' 的顶层应为 {{模板名: 模板定义}} 的映射。")
+    return parsed
+
+
+def _in_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+class TemplateStore:
+    """
+    内置模板与外部模板目录 (*.json / *.toml / *.yaml / *.yml) 合并而成的注册表，支持热更新。
+    current() 至多每 check_interval_seconds 秒检查一次目录：修改时间与大小都未变的文件不再读取，
+    内容哈希未变的文件不再解析。有变化时构建新的注册表并整体替换引用，正在处理的请求继续使用各自取到的旧注册表；
+    在事件循环线程上调用时，目录检查交给后台线程执行，本次直接返回当前注册表，不阻塞事件循环；
+    新模板不合法时记录错误并保留当前注册表。启动 (构造) 时模板不合法则直接抛出 TemplateError。
+
+    Args:
+        directory (str | None): 外部模板目录，为 None 时只使用内置模板。
+        base_templates (dict): 内置模板，外部文件中的同名模板会覆盖它们。
+        check_interval_seconds (float): 两次检查之间的最短间隔 (秒)，<= 0 表示每次获取都检查。
+    """
+
+    def __init__(self, directory: str | None, base_templates: dict | None = None, check_interval_seconds: float = 2.0):
+        self.directory = directory
+        self.base_templates = base_templates or {}
+        self.check_interval_seconds = check_interval_seconds
+        self.reloads = 0
+        self.reload_errors = 0
+        self.last_error: str | None = None
+        self._lock = threading.Lock()
+        self._files: dict[str, _TemplateFile] = {}
+        self._unsupported_files: list[str] = []
+        self._last_check = time.monotonic()
+        try:
+            self._files = self._scan()
+        except OSError as e:
+            raise TemplateError(f"无法读取模板目录 '{directory}': {e}") from e
+        self._registry = self._build(self._files)
+
+    def current(self) -> TemplateRegistry:
+        """返回当前的注册表 (到期时先检查文件变化；其他线程正在检查时直接返回当前注册表，不等待)。"""
+        if self.directory is not None and time.monotonic() - self._last_check >= self.check_interval_seconds:
+            if self._lock.acquire(blocking=False):
+                if _in_event_loop():
+                    self._last_check = time.monotonic()
+                    try:
+                        threading.Thread(target=self._refresh_and_release, name="template-reload", daemon=True).start()
+                    except BaseException:
+                        self._lock.release()
+                        raise
+                else:
+                    self._refresh_and_release()
+        return self._registry
+
+    def _refresh_and_release(self) -> None:
+        try:
+            self._refresh_locked()
+        finally:
+            self._lock.release()
+
+    def refresh(self) -> bool:
+        """立即检查模板目录，注册表被替换时返回 True。"""
+        with self._lock:
+            return self._refresh_locked()
+
+    def _refresh_locked(self) -> bool:
+        self._last_check = time.monotonic()
+        if self.directory is None:
+            return False
+        previous = self._files
+        try:
+            self._files = self._scan()
+        except OSError as e:
+            self._record_error(f"无法读取模板目录 '{self.directory}': {e}")
+            return False
+        if {path: f.digest for path, f in self._files.items()} == {path: f.digest for path, f in previous.items()}:
+            return False
+        try:
+            registry = self._build(self._files)
+        except TemplateError as e:
+            self._record_error(str(e))
+            return False
+        old_version, self._registry = self._registry.version, registry
+        self.reloads += 1
+        self.last_error = None
+        logger.info(f"已重新加载结构化模板: 版本 {old_version} -> {registry.version}，共 {len(registry)} 个模板。")
+        return True
+
+    def _record_error(self, message: str) -> None:
+        self.reload_errors += 1
+        self.last_error = message
+        logger.error(f"重新加载结构化模板失败，继续使用版本 {self._registry.version}: {message}")
+
+    def _scan(self) -> dict[str, _TemplateFile]:
+        if self.directory is None:
+            return {}
+        files = {}
+        unsupported = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                # 跳过隐藏文件 (编辑器的临时文件等) 与子目录
+                if entry.name.startswith(".") or not entry.is_file():
+                    continue
+                if os.path.splitext(entry.name)[1].lower() not in _TEMPLATE_SUFFIXES:
+                    unsupported.append(entry.name)
+                    continue
+                stat = entry.stat()
+                old = self._files.get(entry.path)
+                if old is not None and (old.mtime_ns, old.size) == (stat.st_mtime_ns, stat.st_size):
+                    files[entry.path] = old
+                    continue
+                with open(entry.path, "rb") as f:
+                    data = f.read()
+                digest = hashlib.sha256(data).hexdigest()
+                if old is not None and old.digest == digest: # 只是被 touch，内容未变
+                    files[entry.path] = replace(old, mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+                    continue
+                try:
+                    files[entry.path] = _TemplateFile(stat.st_mtime_ns, stat.st_size, digest, _parse_template_file(entry.path, data))
+                except TemplateError as e:
+                    files[entry.path] = _TemplateFile(stat.st_mtime_ns, stat.st_size, digest, None, str(e))
+        unsupported.sort()
+        if unsupported != self._unsupported_files:
+            if unsupported:
+                logger.warning(f"模板目录 '{self.directory}' 中有不支持的文件，已忽略 (支持 {', '.join(_TEMPLATE_SUFFIXES)}): {unsupported}")
+            self._unsupported_files = unsupported
+        return files
+
+    def _build(self, files: dict[str, _TemplateFile]) -> TemplateRegistry:
+        merged = dict(self.base_templates)
+        defined_in: dict[str, str] = {}
+        errors = []
+        for path in sorted(files):
+            template_file = files[path]
+            if template_file.error is not None:
+                errors.append(template_file.error)
+                continue
+            for name, data in template_file.templates.items():
+                if name in defined_in:
+                    errors.append(f"模板 '{name}' 同时定义在 '{defined_in[name]}' 与 '{path}' 中。")
+                defined_in[name] = path
+                merged[name] = data
+        if errors:
+            raise TemplateError("结构化模板校验失败:\n" + "\n".join(errors))
+        return TemplateRegistry(merged)
+
+    def stats(self) -> dict:
+        registry = self._registry
+        return {
+            "directory": self.directory, "version": registry.version, "templates": len(registry),
+            "files": len(self._files), "unsupported_files": list(self._unsupported_files),
+            "reloads": self.reloads, "reload_errors": self.reload_errors, "last_error": self.last_error,
+        }
+
+
+_store: TemplateStore | None = None
+_store_lock = threading.Lock()
+_pinned_registry: contextvars.ContextVar[TemplateRegistry | None] = contextvars.ContextVar("template_registry", default=None)
+
+
+def get_template_store() -> TemplateStore:
+    """返回按 settings (TEMPLATES_DIR) 构建的全局模板仓库，首次调用时加载并编译全部模板；TEMPLATES_DIR 变化时重建。"""
+    global _store
+    store = _store
+    if store is None or store.directory != settings.TEMPLATES_DIR:
+        with _store_lock:
+            if _store is None or _store.directory != settings.TEMPLATES_DIR:
+                _store = TemplateStore(settings.TEMPLATES_DIR, STRUCTURED_PROMPT_TEMPLATES, settings.TEMPLATES_RELOAD_INTERVAL_SECONDS)
+                logger.info(
+                    f"已编译 {len(_store.current())} 个结构化模板 (版本 {_store.current().version})"
+                    + (f"，外部模板目录: {_store.directory}" if _store.directory else "") + "。"
+                )
+            store = _store
+    return store
+
+
+def get_registry() -> TemplateRegistry:
+    """返回当前的模板注册表 (在 pinned 上下文中返回固定的注册表)。API 与界面在启动时调用一次，使不合法的模板尽早暴露。"""
+    pinned = _pinned_registry.get()
+    if pinned is not None:
+        return pinned
+    return get_template_store().current()
+
+
+@contextlib.contextmanager
+def pinned(registry: TemplateRegistry):
+    """在上下文中固定 get_registry() 的返回值，保证一次处理中的多次查找使用同一版本的模板。"""
+    token = _pinned_registry.set(registry)
+    try:
+        yield registry
+    finally:
+        _pinned_registry.reset(token)
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """判断 If-None-Match 请求头是否与 etag 匹配 (支持多个值、弱校验前缀 W/ 与 *)。"""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
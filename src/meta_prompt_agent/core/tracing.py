@@ -0,0 +1,323 @@
+# src/meta_prompt_agent/core/tracing.py
+import atexit
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import queue
+import re
+import secrets
+import threading
+import time
+
+import requests
+
+from meta_prompt_agent.config import settings
+
+logger = logging.getLogger(__name__)
+
+KIND_INTERNAL, KIND_SERVER, KIND_CLIENT = "internal", "server", "client"
+STATUS_UNSET, STATUS_OK, STATUS_ERROR = "unset", "ok", "error"
+_OTLP_KINDS = {KIND_INTERNAL: 1, KIND_SERVER: 2, KIND_CLIENT: 3}
+_OTLP_STATUS = {STATUS_UNSET: 0, STATUS_OK: 1, STATUS_ERROR: 2}
+_TRACEPARENT_RE = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+
+class Span:
+    """一段被追踪的操作。trace_id / span_id 采用 W3C Trace Context 的十六进制格式。"""
+
+    def __init__(self, name: str, trace_id: str, parent_id: str | None, kind: str = KIND_INTERNAL, attributes: dict | None = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = {key: value for key, value in (attributes or {}).items() if value is not None}
+        self.status = STATUS_UNSET
+        self.status_message = None
+        self.start_ns = time.time_ns()
+        self.end_ns: int | None = None
+
+    def set_attribute(self, key: str, value) -> None:
+        if value is not None:
+            self.attributes[key] = value
+
+    def set_attributes(self, attributes: dict) -> None:
+        for key, value in attributes.items():
+            self.set_attribute(key, value)
+
+    def set_status(self, status: str, message: str | None = None) -> None:
+        self.status, self.status_message = status, message
+
+    def record_error(self, error: dict | None) -> None:
+        """按适配器返回的错误字典设置状态 (error 为 None 时标记为成功)。"""
+        if error is None:
+            self.set_status(STATUS_OK)
+        else:
+            self.set_attribute("error.type", error.get("type"))
+            self.set_status(STATUS_ERROR, str(error.get("type")))
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id, "span_id": self.span_id, "parent_id": self.parent_id,
+            "name": self.name, "kind": self.kind, "start_ns": self.start_ns, "end_ns": self.end_ns,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3) if self.end_ns else None,
+            "attributes": self.attributes, "status": self.status, "status_message": self.status_message,
+        }
+
+
+_current_span: contextvars.ContextVar[Span | None] = contextvars.ContextVar("trace_span", default=None)
+
+
+def current_span() -> Span | None:
+    return _current_span.get()
+
+
+def current_trace_id() -> str | None:
+    span = _current_span.get()
+    return span.trace_id if span is not None else None
+
+
+def parse_traceparent(header: str | None) -> tuple[str, str] | None:
+    """解析 W3C traceparent 请求头，返回 (trace_id, 父 span_id)；格式无效时返回 None。"""
+    match = _TRACEPARENT_RE.match((header or "").strip().lower())
+    if match is None or set(match.group(1)) == {"0"} or set(match.group(2)) == {"0"}:
+        return None
+    return match.group(1), match.group(2)
+
+
+def format_traceparent(span: Span) -> str:
+    return f"00-{span.trace_id}-{span.span_id}-01"
+
+
+def begin_span(
+    name: str, kind: str = KIND_INTERNAL, attributes: dict | None = None,
+    parent: Span | None = None, traceparent: str | None = None,
+) -> Span | None:
+    """
+    开始一个 span 但不设为当前 span (用于跨越多个线程或调度步骤的操作，例如批处理中的一个条目)，需要调用 end_span 结束。
+    父 span 依次取 parent、当前 span、traceparent 请求头；都没有时开始新的 trace。TRACING_ENABLED 为 False 时返回 None。
+    """
+    if not settings.TRACING_ENABLED:
+        return None
+    parent = parent or _current_span.get()
+    remote = parse_traceparent(traceparent) if parent is None else None
+    if parent is not None:
+        trace_id, parent_id = parent.trace_id, parent.span_id
+    elif remote is not None:
+        trace_id, parent_id = remote
+    else:
+        trace_id, parent_id = secrets.token_hex(16), None
+    return Span(name, trace_id, parent_id, kind, attributes)
+
+
+def end_span(span: Span | None) -> None:
+    if span is not None and span.end_ns is None:
+        span.end_ns = time.time_ns()
+        _export(span)
+
+
+@contextlib.contextmanager
+def start_span(
+    name: str, kind: str = KIND_INTERNAL, attributes: dict | None = None,
+    parent: Span | None = None, traceparent: str | None = None,
+):
+    """开始一个 span 并在上下文中设为当前 span，退出时结束并交给导出器。TRACING_ENABLED 为 False 时产出 None。"""
+    span = begin_span(name, kind, attributes, parent, traceparent)
+    if span is None:
+        yield None
+        return
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.set_status(STATUS_ERROR, f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        _current_span.reset(token)
+        end_span(span)
+
+
+@contextlib.contextmanager
+def use_span(span: Span | None):
+    """把由 begin_span 开始的 span 设为当前 span，退出时不结束它 (用于结束时间晚于当前代码块的操作，例如流式响应)。"""
+    if span is None:
+        yield None
+        return
+    token = _current_span.set(span)
+    try:
+        yield span
+    finally:
+        _current_span.reset(token)
+
+
+# --- 日志 ---
+# 由入口 (API / 界面 / 命令行) 传给 config.logging_config.setup_logging，配置层不依赖 core
+class TraceContextFilter(logging.Filter):
+    """为日志记录加上 trace_id 与 span_id 字段 (不在 span 中时为 "-")。"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        span = _current_span.get()
+        record.trace_id = span.trace_id if span is not None else "-"
+        record.span_id = span.span_id if span is not None else "-"
+        return True
+
+
+# --- 导出 ---
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp_json(spans: list[Span]) -> dict:
+    """按 OTLP/HTTP 的 JSON 编码组织一批 span。"""
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": settings.TRACING_SERVICE_NAME}}]},
+        "scopeSpans": [{"scope": {"name": "meta_prompt_agent"}, "spans": [{
+            "traceId": span.trace_id, "spanId": span.span_id, "parentSpanId": span.parent_id or "",
+            "name": span.name, "kind": _OTLP_KINDS.get(span.kind, 1),
+            "startTimeUnixNano": str(span.start_ns), "endTimeUnixNano": str(span.end_ns),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in span.attributes.items()],
+            "status": {"code": _OTLP_STATUS[span.status], **({"message": span.status_message} if span.status_message else {})},
+        } for span in spans]}],
+    }]}
+
+
+class FileSpanExporter:
+    """把 span 以 JSON Lines 追加写入文件，每行一个 span。"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def export(self, spans: list[Span]) -> None:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            for span in spans:
+                f.write(json.dumps(span.to_dict(), ensure_ascii=False) + "\n")
+
+
+class OtlpHttpSpanExporter:
+    """以 OTLP/HTTP (JSON 编码) 发送到收集器，例如本地的 OpenTelemetry Collector (默认 4318 端口)。"""
+
+    def __init__(self, endpoint: str, timeout: float = 5):
+        self.endpoint = endpoint
+        self.timeout = timeout
+
+    def export(self, spans: list[Span]) -> None:
+        response = requests.post(self.endpoint, json=to_otlp_json(spans), timeout=self.timeout)
+        response.raise_for_status()
+
+
+class BatchSpanProcessor:
+    """
+    在后台线程中批量导出结束的 span，调用路径上只有一次入队。队列满时丢弃新的 span，
+    导出失败只记录日志，不影响请求处理。
+    """
+
+    def __init__(self, exporter, max_queue_size: int = 2048, max_batch_size: int = 256, interval_seconds: float = 2.0):
+        self.exporter = exporter
+        self.max_batch_size = max_batch_size
+        self.interval_seconds = interval_seconds
+        self.dropped = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._flush_requested = threading.Event()
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+        self._thread.start()
+
+    def on_end(self, span: Span) -> None:
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self._queue.qsize() >= self.max_batch_size:
+            self._flush_requested.set()
+
+    def _drain(self) -> None:
+        with self._lock:
+            while True:
+                batch = []
+                while len(batch) < self.max_batch_size:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if not batch:
+                    return
+                try:
+                    self.exporter.export(batch)
+                except Exception as e:
+                    logger.warning(f"导出 {len(batch)} 个 trace span 失败: {type(e).__name__} - {e}")
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            self._flush_requested.wait(self.interval_seconds)
+            self._flush_requested.clear()
+            self._drain()
+
+    def force_flush(self) -> None:
+        self._drain()
+
+    def shutdown(self) -> None:
+        self._stopped.set()
+        self._flush_requested.set()
+        self._thread.join(timeout=5)
+        self._drain()
+
+
+_processor: BatchSpanProcessor | None = None
+_processor_lock = threading.Lock()
+_processor_configured = False
+
+
+def _build_exporter():
+    exporter = (settings.TRACING_EXPORTER or "none").lower()
+    if exporter == "file":
+        return FileSpanExporter(settings.TRACING_FILE_PATH)
+    if exporter == "otlp":
+        return OtlpHttpSpanExporter(settings.TRACING_OTLP_ENDPOINT)
+    if exporter != "none":
+        logger.warning(f"未知的 TRACING_EXPORTER '{exporter}'，不导出 trace。")
+    return None
+
+
+def get_span_processor() -> BatchSpanProcessor | None:
+    """返回按 settings 配置的全局导出处理器；TRACING_EXPORTER 为 none 时返回 None。"""
+    global _processor, _processor_configured
+    if not _processor_configured:
+        with _processor_lock:
+            if not _processor_configured:
+                exporter = _build_exporter()
+                if exporter is not None:
+                    _processor = BatchSpanProcessor(exporter, interval_seconds=settings.TRACING_EXPORT_INTERVAL_SECONDS)
+                    logger.info(f"已启用 trace 导出: {type(exporter).__name__}")
+                _processor_configured = True
+    return _processor
+
+
+def _export(span: Span) -> None:
+    processor = get_span_processor()
+    if processor is not None:
+        processor.on_end(span)
+
+
+def shutdown() -> None:
+    """导出剩余的 span 并停止导出线程 (配置变更后或测试中也可用于重置)。"""
+    global _processor, _processor_configured
+    with _processor_lock:
+        processor, _processor, _processor_configured = _processor, None, False
+    if processor is not None:
+        processor.shutdown()
+
+
+atexit.register(shutdown)
@@ -0,0 +1,181 @@
+# src/meta_prompt_agent/core/transport.py
+import asyncio
+import logging
+import threading
+import weakref
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from meta_prompt_agent.config import settings
+
+logger = logging.getLogger(__name__)
+
+# 每个 LLM 提供者一个共享的 keep-alive 会话，避免每次调用都重新建立 TCP/TLS 连接
+_sessions: dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+# 异步客户端按事件循环隔离：httpx 的连接绑定在创建它的事件循环上
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[str, httpx.AsyncClient]]" = weakref.WeakKeyDictionary()
+
+# 连接池命中/未命中计数 (同步会话与异步客户端按提供者合并统计)：命中 = 复用了池中的空闲连接，未命中 = 新建了连接
+_pool_stats: dict[str, dict[str, int]] = {}
+_pool_stats_lock = threading.Lock()
+
+
+def _record_pool_event(provider: str, event: str) -> None:
+    with _pool_stats_lock:
+        stats = _pool_stats.setdefault(provider, {"requests": 0, "hits": 0, "misses": 0})
+        stats[event] += 1
+
+
+def _counting_pool_class(base_cls: type, provider: str) -> type:
+    """
+    基于 urllib3 连接池类派生一个带计数的子类。
+    每次取连接计为一次请求，每次新建连接计为一次未命中。
+    """
+    class _CountingConnectionPool(base_cls):
+        def _get_conn(self, timeout=None):
+            _record_pool_event(provider, "requests")
+            return super()._get_conn(timeout=timeout)
+
+        def _new_conn(self):
+            _record_pool_event(provider, "misses")
+            return super()._new_conn()
+
+    _CountingConnectionPool.__name__ = f"Counting{base_cls.__name__}"
+    return _CountingConnectionPool
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """按提供者统计连接复用情况的 HTTPAdapter。"""
+
+    def __init__(self, provider: str, **kwargs):
+        self.provider = provider
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        super().init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _counting_pool_class(HTTPConnectionPool, self.provider),
+            "https": _counting_pool_class(HTTPSConnectionPool, self.provider),
+        }
+
+
+def _counting_request_hook(provider: str):
+    """
+    httpx 的请求钩子：每个请求计为一次取连接，并通过 httpcore 的 trace 扩展把新建的连接计为一次未命中。
+    """
+    async def on_request(request: httpx.Request) -> None:
+        _record_pool_event(provider, "requests")
+        outer_trace = request.extensions.get("trace")
+        async def trace(event_name: str, info: dict) -> None:
+            if event_name in ("connection.connect_tcp.complete", "connection.connect_unix_socket.complete"):
+                _record_pool_event(provider, "misses")
+            if outer_trace is not None:
+                await outer_trace(event_name, info)
+        request.extensions["trace"] = trace
+    return on_request
+
+
+def _create_session(provider: str) -> requests.Session:
+    maxsize = settings.HTTP_POOL_MAXSIZE_BY_PROVIDER.get(provider, settings.HTTP_POOL_MAXSIZE)
+    adapter = PooledHTTPAdapter(
+        provider,
+        pool_connections=settings.HTTP_POOL_CONNECTIONS,
+        pool_maxsize=maxsize,
+        pool_block=settings.HTTP_POOL_BLOCK,
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    logger.info(
+        f"为提供者 '{provider}' 创建 keep-alive 会话 "
+        f"(pool_connections={settings.HTTP_POOL_CONNECTIONS}, pool_maxsize={maxsize}, block={settings.HTTP_POOL_BLOCK})。"
+    )
+    return session
+
+
+def get_session(provider: str) -> requests.Session:
+    """获取 (必要时创建) 指定提供者的共享会话。线程安全。"""
+    session = _sessions.get(provider)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(provider)
+            if session is None:
+                session = _create_session(provider)
+                _sessions[provider] = session
+    return session
+
+
+def post(url: str, provider: str = "default", **kwargs) -> requests.Response:
+    """
+    通过提供者的共享连接池发送 POST 请求。参数与 requests.post 相同。
+    """
+    return get_session(provider).post(url, **kwargs)
+
+
+def get_async_client(provider: str) -> httpx.AsyncClient:
+    """
+    获取 (必要时创建) 当前事件循环中指定提供者的共享 httpx.AsyncClient。
+    只能在协程中调用；同一事件循环内不会并发创建，因此无需加锁。
+    """
+    loop = asyncio.get_running_loop()
+    clients = _async_clients.setdefault(loop, {})
+    client = clients.get(provider)
+    if client is None or client.is_closed:
+        keepalive = settings.HTTP_POOL_MAXSIZE_BY_PROVIDER.get(provider, settings.HTTP_POOL_MAXSIZE)
+        limits = httpx.Limits(
+            max_connections=settings.ASYNC_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=min(keepalive, settings.ASYNC_HTTP_MAX_CONNECTIONS),
+        )
+        client = httpx.AsyncClient(
+            limits=limits, timeout=settings.LLM_REQUEST_TIMEOUT,
+            event_hooks={"request": [_counting_request_hook(provider)]},
+        )
+        clients[provider] = client
+        logger.info(
+            f"为提供者 '{provider}' 创建异步 HTTP 客户端 "
+            f"(max_connections={limits.max_connections}, max_keepalive={limits.max_keepalive_connections})。"
+        )
+    return client
+
+
+async def aclose_async_clients() -> None:
+    """关闭当前事件循环中的所有异步客户端 (例如在 FastAPI 关闭时调用)。"""
+    loop = asyncio.get_running_loop()
+    clients = _async_clients.pop(loop, {})
+    for client in clients.values():
+        await client.aclose()
+
+
+def get_pool_stats() -> dict[str, dict[str, int]]:
+    """
+    返回每个提供者的连接池计数快照 (同步会话与异步客户端合并统计)。
+
+    Returns:
+        dict: 形如 {"ollama": {"requests": 10, "hits": 9, "misses": 1}}。
+    """
+    with _pool_stats_lock:
+        snapshot = {}
+        for provider, stats in _pool_stats.items():
+            entry = dict(stats)
+            entry["hits"] = max(entry["requests"] - entry["misses"], 0)
+            snapshot[provider] = entry
+        return snapshot
+
+
+def reset_pool_stats() -> None:
+    with _pool_stats_lock:
+        _pool_stats.clear()
+
+
+def close_all_sessions() -> None:
+    """关闭所有共享会话，释放池中的连接。下次调用时会重新创建。"""
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+    for session in sessions:
+        session.close()
@@ -126,6 +126,45 @@ EVALUATION_META_PROMPT_TEMPLATE = """
 ```
 """
 
+# 与 EVALUATION_META_PROMPT_TEMPLATE 中的输出格式对应的 JSON Schema，用于各提供者的 JSON / Schema 输出模式
+_EVALUATION_DIMENSIONS = ["clarity", "completeness", "specificity_actionability", "faithfulness_consistency"]
+EVALUATION_REPORT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "evaluation_summary": {
+            "type": "object",
+            "properties": {
+                "overall_score": {"type": "integer"},
+                "main_strengths": {"type": "string"},
+                "main_weaknesses": {"type": "string"},
+            },
+            "required": ["main_strengths", "main_weaknesses"],
+        },
+        "dimension_scores": {
+            "type": "object",
+            "properties": {
+                name: {
+                    "type": "object",
+                    "properties": {"score": {"type": "integer"}, "justification": {"type": "string"}},
+                    "required": ["score", "justification"],
+                }
+                for name in _EVALUATION_DIMENSIONS
+            },
+            "required": _EVALUATION_DIMENSIONS,
+        },
+        "potential_risks": {
+            "type": "object",
+            "properties": {
+                "level": {"type": "string", "enum": ["Low", "Medium", "High"]},
+                "description": {"type": "string"},
+            },
+            "required": ["level", "description"],
+        },
+        "suggestions_for_improvement": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": ["evaluation_summary", "dimension_scores", "potential_risks", "suggestions_for_improvement"],
+}
+
 REFINEMENT_META_PROMPT_TEMPLATE = """
 您现在是一个“元提示优化AI”。基于用户的原始请求、先前生成的目标提示词以及对其的评估报告（可能包含结构化的评分和建议），请生成一个经过改进的、更优质的目标提示词。
 请重点解决评估报告中指出的不足之处，并保留优点。确保新的提示词更加清晰、完整和有效，并且更适合预期的任务类型。
@@ -149,6 +188,45 @@ REFINEMENT_META_PROMPT_TEMPLATE = """
 请生成改进后的目标提示词 (P2)，严格按照结构输出：
 """
 
+# 精炼轮使用的紧凑模板：核心元提示与当前提示词已作为对话历史发送，这里只附加从评估报告中提取的要点，
+# 避免同一内容在一次调用中重复出现
+REFINEMENT_FEEDBACK_TEMPLATE = """
+您现在是一个“元提示优化AI”。上一条回复是先前生成的目标提示词，它针对上面的用户请求生成。
+下面是对它的评估要点（从评估报告中提取）。请生成一个经过改进的、更优质的目标提示词：
+重点解决指出的不足之处，并保留优点；新的提示词必须严格遵循原始“核心元提示”或特定任务类型模板中要求的结构。
+
+评估要点：
+\"\"\"
+{feedback}
+\"\"\"
+
+请生成改进后的目标提示词，严格按照结构输出：
+"""
+
+# 编辑列表形式的精炼：只返回对上一版提示词的修改，由代理在本地应用，减少输出 token
+REFINEMENT_EDITS_TEMPLATE = """
+您现在是一个“元提示优化AI”。上一条回复是先前生成的目标提示词，它针对上面的用户请求生成。
+下面是对它的评估要点（从评估报告中提取）。请只针对指出的不足之处修改该提示词，保留其余内容和原有结构。
+
+评估要点：
+\"\"\"
+{feedback}
+\"\"\"
+
+请不要输出完整的提示词，而是输出一个JSON编辑列表，按顺序应用到上一版提示词上：
+```json
+{{
+  "edits": [
+    {{"op": "replace", "find": "<上一版中需要替换的原文片段>", "text": "<新文本>"}},
+    {{"op": "insert", "after": "<上一版中的原文片段>", "text": "<插入的新文本>"}},
+    {{"op": "delete", "find": "<上一版中需要删除的原文片段>"}}
+  ]
+}}
+```
+要求：find / after 必须逐字复制上一版中恰好出现一次的原文片段，尽量简短；insert 也可以使用 "before" 或 "position": "start" / "end"。
+不需要修改时输出 {{"edits": []}}。不要在JSON之外输出任何内容。
+"""
+
 # 新增的解释模板 (已修正花括号)
 EXPLAIN_TERM_TEMPLATE = """
 您是一位知识渊博且善于清晰表达的AI导师。您的任务是向一位正在学习如何优化AI提示词的用户解释一个特定的术语或短语。
@@ -181,6 +259,36 @@ EXPLAIN_TERM_TEMPLATE = """
 ```
 """
 
+# 近似重复请求的种子模板：基于相似请求已生成的P1做最小必要修改，而不是从头生成
+NEAR_DUPLICATE_SEED_TEMPLATE = """
+您现在是一个“元提示优化AI”。下面是一个与当前请求高度相似的先前请求，以及为它生成的优化提示词。
+请以该提示词为基础，只做必要的修改，使其准确对应当前的用户请求；保留原有的结构和格式。
+
+先前的用户请求：
+\"\"\"
+{previous_request}
+\"\"\"
+
+为先前请求生成的优化提示词：
+\"\"\"
+{previous_prompt}
+\"\"\"
+
+当前的用户请求：
+\"\"\"
+{user_raw_request}
+\"\"\"
+
+请直接输出修改后的优化提示词：
+"""
+
+
+# best_of_n 模式的候选变体：第一个候选使用原始核心提示，其余候选附加该说明以得到不同的写法
+# (相同的提示会被响应缓存与请求合并折叠为同一个结果)
+BEST_OF_N_VARIANT_TEMPLATE = """{core_prompt}
+
+（这是第 {index}/{total} 个候选方案：请在满足以上全部要求的前提下，尝试与常规写法不同的组织方式或侧重点。）
+"""
 
 # --- 结构化元提示模板 (按任务类型区分) ---
 STRUCTURED_PROMPT_TEMPLATES = {
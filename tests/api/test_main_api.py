@@ -1,4 +1,5 @@
 # tests/api/test_main_api.py
+import json
 import pytest
 from fastapi.testclient import TestClient
 from unittest.mock import patch 
@@ -27,13 +28,13 @@ def test_explain_term_endpoint_success(monkeypatch):
     )
 
     mock_explain_calls = []
-    def mock_successful_explain_term(term_to_explain: str, context_prompt: str):
+    async def mock_successful_explain_term(term_to_explain: str, context_prompt: str):
         mock_explain_calls.append({"term_to_explain": term_to_explain, "context_prompt": context_prompt})
         assert term_to_explain == term_to_explain_input 
         assert context_prompt == context_prompt_input
         return expected_explanation_text, None 
     
-    monkeypatch.setattr('meta_prompt_agent.api.main.explain_term_in_prompt', mock_successful_explain_term)
+    monkeypatch.setattr('meta_prompt_agent.api.main.explain_term_in_prompt_async', mock_successful_explain_term)
 
     # 2. 执行 (Act)
     response = client.post("/explain-term", json=request_payload.model_dump()) 
@@ -127,13 +128,13 @@ def test_explain_term_endpoint_agent_call_fails(monkeypatch):
     simulated_agent_error_message = "错误：模拟的Ollama API在解释时连接失败"
     simulated_agent_error_details = {"type": "ConnectionError", "details": "模拟连接失败"}
 
-    # 模拟 core.agent.explain_term_in_prompt 函数，使其返回一个错误
-    def mock_failing_explain_term(term_to_explain: str, context_prompt: str):
+    # 模拟 core.agent.explain_term_in_prompt_async 函数，使其返回一个错误
+    async def mock_failing_explain_term(term_to_explain: str, context_prompt: str):
         assert term_to_explain == term_to_explain_input
         assert context_prompt == context_prompt_input
         return simulated_agent_error_message, simulated_agent_error_details
     
-    monkeypatch.setattr('meta_prompt_agent.api.main.explain_term_in_prompt', mock_failing_explain_term)
+    monkeypatch.setattr('meta_prompt_agent.api.main.explain_term_in_prompt_async', mock_failing_explain_term)
 
     # 2. 执行 (Act)
     response = client.post("/explain-term", json=request_payload.model_dump())
@@ -146,4 +147,194 @@ def test_explain_term_endpoint_agent_call_fails(monkeypatch):
     assert "detail" in response_data, "错误响应中应包含 'detail' 字段"
     # API 端点会将 agent 返回的错误消息作为 detail 返回
     assert response_data["detail"] == simulated_agent_error_message, \
-        f"500错误的详情与agent返回的错误消息不符。预期: '{simulated_agent_error_message}', 实际: '{response_data['detail']}'"
\ No newline at end of file
+        f"500错误的详情与agent返回的错误消息不符。预期: '{simulated_agent_error_message}', 实际: '{response_data['detail']}'"
+
+def test_generate_simple_p1_endpoint_awaits_async_pipeline(monkeypatch):
+    """
+    测试 /generate-simple-p1 端点调用异步版本的 generate_and_refine_prompt_async。
+    """
+    calls = []
+    async def mock_generate_async(**kwargs):
+        calls.append(kwargs)
+        return {"p1_initial_optimized_prompt": "优化后的P1", "error_message": None}
+    monkeypatch.setattr('meta_prompt_agent.api.main.generate_and_refine_prompt_async', mock_generate_async)
+
+    response = client.post("/generate-simple-p1", json={"raw_request": "写一首诗", "task_type": "通用/问答"})
+
+    assert response.status_code == 200, response.text
+    assert response.json()["p1_prompt"] == "优化后的P1"
+    assert len(calls) == 1 and calls[0]["enable_self_correction"] is False
+
+
+def test_generate_simple_p1_endpoint_returns_metrics_only_when_requested(monkeypatch):
+    metrics = {"total": {"calls": 1}, "stages": {}, "calls": []}
+    async def mock_generate_async(**kwargs):
+        return {"p1_initial_optimized_prompt": "优化后的P1", "error_message": None, "metrics": metrics}
+    monkeypatch.setattr('meta_prompt_agent.api.main.generate_and_refine_prompt_async', mock_generate_async)
+
+    default_response = client.post("/generate-simple-p1", json={"raw_request": "写一首诗"})
+    metrics_response = client.post("/generate-simple-p1", json={"raw_request": "写一首诗", "include_metrics": True})
+
+    assert default_response.json()["metrics"] is None
+    assert metrics_response.json()["metrics"] == metrics
+
+
+def test_generate_simple_p1_stream_endpoint_emits_sse_events(monkeypatch):
+    """
+    测试 /generate-simple-p1/stream 以 SSE 格式推送 token 与 done 事件。
+    """
+    async def mock_stream_p1(user_raw_request: str, task_type: str):
+        yield "token", "优化"
+        yield "token", "后的P1"
+        yield "done", "优化后的P1"
+    monkeypatch.setattr('meta_prompt_agent.api.main.stream_p1_prompt_async', mock_stream_p1)
+
+    response = client.post("/generate-simple-p1/stream", json={"raw_request": "写一首诗"})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = [block for block in response.text.split("\n\n") if block]
+    assert events[0] == 'event: token\ndata: {"text": "优化"}'
+    assert events[-1].startswith("event: done\n")
+    assert '"p1_prompt": "优化后的P1"' in events[-1]
+
+def test_generate_simple_p1_stream_endpoint_emits_error_event(monkeypatch):
+    async def mock_stream_p1(user_raw_request: str, task_type: str):
+        yield "error", ("生成初始优化提示失败: 错误：超时", {"type": "TimeoutError"})
+    monkeypatch.setattr('meta_prompt_agent.api.main.stream_p1_prompt_async', mock_stream_p1)
+
+    response = client.post("/generate-simple-p1/stream", json={"raw_request": "写一首诗"})
+
+    assert response.status_code == 200
+    assert response.text.startswith("event: error\n")
+    assert "生成初始优化提示失败" in response.text
+
+def test_error_responses_carry_trace_id(monkeypatch):
+    monkeypatch.setattr(settings, 'TRACING_ENABLED', True)
+    async def mock_generate_async(**kwargs):
+        return {"p1_initial_optimized_prompt": "", "error_message": "错误：超时"}
+    monkeypatch.setattr('meta_prompt_agent.api.main.generate_and_refine_prompt_async', mock_generate_async)
+    traceparent = "00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01"
+
+    response = client.post("/generate-simple-p1", json={"raw_request": "写一首诗"}, headers={"traceparent": traceparent})
+
+    assert response.status_code == 500
+    assert response.json() == {"detail": "错误：超时", "trace_id": "4bf92f3577b34da6a3ce929d0e0e4736"}
+    assert response.headers["X-Trace-Id"] == "4bf92f3577b34da6a3ce929d0e0e4736"
+    assert client.post("/generate-simple-p1", json={"raw_request": ""}).json()["trace_id"]
+
+def test_server_span_ends_after_streaming_body_is_sent(monkeypatch):
+    from meta_prompt_agent.core import tracing
+    spans = []
+    processor = tracing.BatchSpanProcessor(type("ListExporter", (), {"export": lambda self, batch: spans.extend(batch)})(), interval_seconds=60)
+    monkeypatch.setattr(settings, 'TRACING_ENABLED', True)
+    monkeypatch.setattr(tracing, '_processor', processor)
+    monkeypatch.setattr(tracing, '_processor_configured', True)
+    async def mock_stream_p1(user_raw_request: str, task_type: str):
+        yield "token", "优化"
+        with tracing.start_span("llm.stream"): # 在发送响应体的过程中产生的子 span
+            pass
+        yield "done", "优化后的P1"
+    monkeypatch.setattr('meta_prompt_agent.api.main.stream_p1_prompt_async', mock_stream_p1)
+
+    response = client.post("/generate-simple-p1/stream", json={"raw_request": "写一首诗"})
+    processor.force_flush()
+    processor.shutdown()
+
+    assert response.status_code == 200 and "event: done" in response.text
+    [server] = [span for span in spans if span.kind == tracing.KIND_SERVER]
+    [inner] = [span for span in spans if span.name == "llm.stream"]
+    assert inner.parent_id == server.span_id
+    assert server.end_ns >= inner.end_ns, "流式响应的 span 应在响应体发送完毕后结束"
+
+def test_metrics_endpoint_exposes_request_counts_by_route_template(monkeypatch):
+    monkeypatch.setattr(settings, 'METRICS_MULTIPROC_DIR', None)
+    client.get("/")
+
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert 'mpa_http_requests_total{method="GET",endpoint="/",status="200"}' in response.text
+    assert "# TYPE mpa_llm_call_duration_seconds histogram" in response.text
+    assert 'endpoint="/metrics"' not in response.text
+
+def test_templates_endpoint_supports_conditional_requests():
+    response = client.get("/templates")
+
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    assert response.headers["cache-control"].startswith("public, max-age=")
+    data = response.json()
+    assert "DetailedCodeFunction" in data["task_types"]["代码生成"]
+    assert {t["name"] for t in data["templates"]} >= {"DefaultQnA", "BasicImageGen"}
+
+    not_modified = client.get("/templates", headers={"If-None-Match": etag})
+    assert not_modified.status_code == 304
+    assert not_modified.headers["etag"] == etag
+
+    filtered = client.get("/templates", params={"task_type": "图像生成"})
+    assert [t["name"] for t in filtered.json()["templates"]] == ["BasicImageGen", "DetailedImageGen"]
+    assert filtered.headers["etag"] != etag
+
+def test_stats_endpoint_reports_coalescing_and_pool_stats():
+    response = client.get("/stats")
+
+    assert response.status_code == 200
+    data = response.json()
+    assert set(data["single_flight"]) == {"sync", "async"}
+    assert {"leaders", "coalesced", "shared_failures", "in_flight"} <= set(data["single_flight"]["async"])
+    assert isinstance(data["connection_pool"], dict)
+    assert data["response_cache"] is None or "hit_rate" in data["response_cache"]
+    assert data["routing"]["order"]
+    assert data["templates"]["version"] and data["templates"]["reload_errors"] == 0
+
+
+def test_generate_batch_endpoint_returns_per_item_results(monkeypatch):
+    """
+    测试 /generate-batch 对每个条目分别返回结果或错误，并传递每个条目的设置。
+    """
+    calls = []
+    async def mock_generate_async(**kwargs):
+        calls.append(kwargs)
+        if kwargs["user_raw_request"] == "失败的请求":
+            return {"error_message": "生成初始优化提示失败: 错误：超时", "error_details": {"type": "TimeoutError"}}
+        return {"final_prompt": f"P-{kwargs['user_raw_request']}", "p1_initial_optimized_prompt": "P1", "error_message": None}
+    monkeypatch.setattr('meta_prompt_agent.api.main.generate_and_refine_prompt_async', mock_generate_async)
+
+    payload = {"items": [
+        {"raw_request": "写一首诗", "id": "a"},
+        {"raw_request": "失败的请求", "id": "b"},
+        {"raw_request": "画一只猫", "task_type": "图像生成", "enable_self_correction": True, "max_recursion_depth": 2,
+         "structured_template_name": "BasicImageGen", "structured_template_vars": {"style": "水彩"}},
+    ], "max_concurrency": 2}
+    response = client.post("/generate-batch", json=payload)
+
+    assert response.status_code == 200, response.text
+    data = response.json()
+    assert data["succeeded"] == 2 and data["failed"] == 1
+    assert [r["index"] for r in data["results"]] == [0, 1, 2]
+    assert data["results"][0]["final_prompt"] == "P-写一首诗" and data["results"][0]["id"] == "a"
+    assert data["results"][1]["status"] == "error" and data["results"][1]["error_details"]["type"] == "TimeoutError"
+    image_call = next(c for c in calls if c["user_raw_request"] == "画一只猫")
+    assert image_call["enable_self_correction"] is True and image_call["max_recursion_depth"] == 2
+    assert image_call["use_structured_template_name"] == "BasicImageGen"
+
+
+def test_generate_batch_endpoint_streams_ndjson(monkeypatch):
+    async def mock_generate_async(**kwargs):
+        return {"final_prompt": kwargs["user_raw_request"], "p1_initial_optimized_prompt": "P1", "error_message": None}
+    monkeypatch.setattr('meta_prompt_agent.api.main.generate_and_refine_prompt_async', mock_generate_async)
+
+    response = client.post("/generate-batch", json={"items": [{"raw_request": "一"}, {"raw_request": "二"}], "stream": True})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(line["final_prompt"] for line in lines[:-1]) == ["一", "二"]
+    assert lines[-1] == {"done": True, "succeeded": 2, "failed": 0}
+
+
+def test_generate_batch_endpoint_rejects_empty_batch():
+    response = client.post("/generate-batch", json={"items": []})
+    assert response.status_code == 422
@@ -0,0 +1,16 @@
+# tests/conftest.py
+import pytest
+
+from meta_prompt_agent.config import settings
+from meta_prompt_agent.core import rate_limit, resilience
+
+
+@pytest.fixture(autouse=True)
+def isolate_resilience_state(monkeypatch):
+    # 熔断器和限流器是进程级状态，测试之间必须隔离；同时取消重试的退避等待以加快测试
+    monkeypatch.setattr(settings, 'LLM_RETRY_BASE_DELAY', 0.0)
+    resilience.reset_breakers()
+    rate_limit.reset_limiters()
+    yield
+    resilience.reset_breakers()
+    rate_limit.reset_limiters()
@@ -4,7 +4,9 @@ import os
 import json
 import io 
 import builtins
+import asyncio
 import requests 
+import httpx
 import google.generativeai as genai 
 import dashscope # 确保导入 dashscope 以便 mock
 from dashscope.api_entities.dashscope_response import Role, GenerationResponse, GenerationOutput, Choice, Message
@@ -21,9 +23,20 @@ from meta_prompt_agent.core.agent import (
     load_feedback, 
     save_feedback,
     generate_and_refine_prompt,
-    explain_term_in_prompt 
+    explain_term_in_prompt,
+    call_ollama_api_async,
+    call_qwen_api_async,
+    call_gemini_api_async,
+    generate_and_refine_prompt_async,
+    explain_term_in_prompt_async,
+    stream_ollama_api_async,
+    stream_qwen_api_async,
+    stream_gemini_api_async,
+    stream_p1_prompt_async,
 )
 from meta_prompt_agent.config import settings 
+from meta_prompt_agent.core import transport
+from meta_prompt_agent.core import client_registry
 from meta_prompt_agent.prompts.templates import ( 
     CORE_META_PROMPT_TEMPLATE,
     STRUCTURED_PROMPT_TEMPLATES,
@@ -33,6 +46,13 @@ from meta_prompt_agent.prompts.templates import (
 )
 
 
+@pytest.fixture(autouse=True)
+def reset_client_registry():
+    # 客户端注册表会缓存 SDK 客户端；每个测试都需要重新构建以使用各自的 mock
+    client_registry.clear()
+    yield
+    client_registry.clear()
+
 # --- 模块级别的辅助类定义 (MockResponse 已存在) ---
 class MockResponse: # 用于模拟 requests.Response
     def __init__(self, json_data, status_code, text_data=None, request_obj=None):
@@ -230,7 +250,7 @@ def test_call_ollama_api_success(monkeypatch):
         assert payload['messages'][-1]['content'] == prompt_content
         mock_api_response = {"message": {"content": expected_response_content}}
         return MockResponse(json_data=mock_api_response, status_code=200)
-    monkeypatch.setattr(requests, 'post', mock_post_success)
+    monkeypatch.setattr(transport, 'post', mock_post_success)
     result_content, error_details = call_ollama_api(prompt_content)
     assert error_details is None
     assert result_content == expected_response_content
@@ -240,7 +260,7 @@ def test_call_ollama_api_connection_error(monkeypatch):
     prompt_content = "这是一个会遇到连接错误的提示。"
     def mock_post_raises_connection_error(*args, **kwargs):
         raise requests.exceptions.ConnectionError("Simulated Connection Error")
-    monkeypatch.setattr(requests, 'post', mock_post_raises_connection_error)
+    monkeypatch.setattr(transport, 'post', mock_post_raises_connection_error)
     result_content, error_details = call_ollama_api(prompt_content)
     assert result_content.startswith("错误：无法连接到Ollama服务")
     assert error_details is not None and error_details.get("type") == "ConnectionError"
@@ -252,7 +272,7 @@ def test_call_ollama_api_http_error(monkeypatch):
     def mock_post_raises_http_error(*args, **kwargs):
         prepared_request = requests.Request('POST', args[0] if args else kwargs.get('url', settings.OLLAMA_API_URL)).prepare()
         return MockResponse(json_data=error_response_json, status_code=http_status_code, request_obj=prepared_request)
-    monkeypatch.setattr(requests, 'post', mock_post_raises_http_error)
+    monkeypatch.setattr(transport, 'post', mock_post_raises_http_error)
     result_content, error_details = call_ollama_api(prompt_content)
     assert result_content.startswith(f"错误：Ollama API交互失败 (HTTP {http_status_code})")
     assert error_details is not None and error_details.get("type") == "HTTPError"
@@ -261,7 +281,7 @@ def test_call_ollama_api_timeout(monkeypatch):
     prompt_content = "这是一个会遇到超时的提示。"
     def mock_post_raises_timeout(*args, **kwargs):
         raise requests.exceptions.Timeout("Simulated Request Timeout")
-    monkeypatch.setattr(requests, 'post', mock_post_raises_timeout)
+    monkeypatch.setattr(transport, 'post', mock_post_raises_timeout)
     result_content, error_details = call_ollama_api(prompt_content)
     assert result_content.startswith("错误：请求Ollama API超时")
     assert error_details is not None and error_details.get("type") == "TimeoutError"
@@ -271,7 +291,7 @@ def test_call_ollama_api_unexpected_response_format(monkeypatch):
     mock_api_response = {"model": "test_model", "wrong_key": "some_content"} # 缺少 message.content
     def mock_post_unexpected_format(*args, **kwargs):
         return MockResponse(json_data=mock_api_response, status_code=200)
-    monkeypatch.setattr(requests, 'post', mock_post_unexpected_format)
+    monkeypatch.setattr(transport, 'post', mock_post_unexpected_format)
     result_content, error_details = call_ollama_api(prompt_content)
     assert result_content == "错误：Ollama API响应格式不符合预期"
     assert error_details is not None and error_details.get("type") == "FormatError"
@@ -280,7 +300,7 @@ def test_call_ollama_api_unknown_error(monkeypatch):
     prompt_content = "这是一个会遇到未知错误的提示。"
     def mock_post_raises_generic_exception(*args, **kwargs):
         raise RuntimeError("Simulated generic error") 
-    monkeypatch.setattr(requests, 'post', mock_post_raises_generic_exception)
+    monkeypatch.setattr(transport, 'post', mock_post_raises_generic_exception)
     result_content, error_details = call_ollama_api(prompt_content)
     assert result_content == "错误：调用Ollama API时发生未知内部错误"
     assert error_details is not None and error_details.get("type") == "UnknownError"
@@ -801,3 +821,198 @@ def test_call_qwen_api_unexpected_response_format(monkeypatch):
     assert error is not None
     assert error.get("type") == "QwenFormatError"
 
+
+
+# --- 异步版本的测试用例 (invoke_llm_async / call_*_api_async / generate_and_refine_prompt_async) ---
+
+def _mock_async_client(monkeypatch, handler):
+    """让 transport.get_async_client 返回一个由 handler 处理请求的 httpx.AsyncClient。"""
+    monkeypatch.setattr(transport, 'get_async_client', lambda provider: httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+
+def test_call_ollama_api_async_success(monkeypatch):
+    prompt_content = "异步测试提示"
+    def handler(request):
+        payload = json.loads(request.content)
+        assert payload["model"] == settings.OLLAMA_MODEL
+        assert payload["messages"][-1]["content"] == prompt_content
+        return httpx.Response(200, json={"message": {"content": "<<think>>思考<</think>>异步结果"}})
+    _mock_async_client(monkeypatch, handler)
+    result, error = asyncio.run(call_ollama_api_async(prompt_content))
+    assert error is None and result == "异步结果"
+
+def test_call_ollama_api_async_connection_error(monkeypatch):
+    def handler(request):
+        raise httpx.ConnectError("Simulated Connection Error", request=request)
+    _mock_async_client(monkeypatch, handler)
+    result, error = asyncio.run(call_ollama_api_async("提示"))
+    assert result.startswith("错误：无法连接到Ollama服务")
+    assert error.get("type") == "ConnectionError"
+
+def test_call_ollama_api_async_http_error(monkeypatch):
+    _mock_async_client(monkeypatch, lambda request: httpx.Response(400, json={"error": "Invalid model"}))
+    result, error = asyncio.run(call_ollama_api_async("提示"))
+    assert result.startswith("错误：Ollama API交互失败 (HTTP 400)")
+    assert error.get("type") == "HTTPError" and error.get("ollama_error") == "Invalid model"
+
+def test_call_qwen_api_async_success(monkeypatch):
+    monkeypatch.setattr(settings, 'QWEN_API_KEY_FROM_ENV', 'test_qwen_api_key')
+    def handler(request):
+        assert request.headers["Authorization"] == "Bearer test_qwen_api_key"
+        payload = json.loads(request.content)
+        assert payload["model"] == settings.QWEN_MODEL_NAME
+        assert payload["input"]["messages"][-1] == {"role": "user", "content": "你好"}
+        return httpx.Response(200, json={"output": {"choices": [{"message": {"role": "assistant", "content": "通义千问异步回复"}}]}})
+    _mock_async_client(monkeypatch, handler)
+    result, error = asyncio.run(call_qwen_api_async("你好"))
+    assert error is None and result == "通义千问异步回复"
+
+def test_call_qwen_api_async_api_error(monkeypatch):
+    monkeypatch.setattr(settings, 'QWEN_API_KEY_FROM_ENV', 'test_qwen_api_key')
+    _mock_async_client(monkeypatch, lambda request: httpx.Response(
+        400, json={"code": "InvalidParameter", "message": "Invalid parameter", "request_id": "rid"}))
+    result, error = asyncio.run(call_qwen_api_async("你好"))
+    assert result.startswith("错误：通义千问 API 调用失败。状态码: 400。")
+    assert error.get("type") == "QwenAPIError" and error.get("error_code") == "InvalidParameter"
+
+def test_call_qwen_api_async_non_json_error_keeps_status(monkeypatch):
+    from meta_prompt_agent.core.resilience import TRANSIENT, classify_error
+    monkeypatch.setattr(settings, 'QWEN_API_KEY_FROM_ENV', 'test_qwen_api_key')
+    _mock_async_client(monkeypatch, lambda request: httpx.Response(502, text="<html>Bad Gateway</html>"))
+    result, error = asyncio.run(call_qwen_api_async("你好"))
+    assert result.startswith("错误：通义千问 API 调用失败。状态码: 502。")
+    assert error.get("type") == "QwenAPIError" and error.get("status_code") == 502
+    assert classify_error(error) == TRANSIENT
+
+def test_call_qwen_api_async_non_json_ok_body_is_format_error(monkeypatch):
+    monkeypatch.setattr(settings, 'QWEN_API_KEY_FROM_ENV', 'test_qwen_api_key')
+    _mock_async_client(monkeypatch, lambda request: httpx.Response(200, text="not json"))
+    result, error = asyncio.run(call_qwen_api_async("你好"))
+    assert error.get("type") == "QwenFormatError" and "not json" in error.get("details")
+
+def test_call_qwen_api_async_no_api_key(monkeypatch):
+    monkeypatch.setattr(settings, 'QWEN_API_KEY_FROM_ENV', None)
+    result, error = asyncio.run(call_qwen_api_async("你好"))
+    assert error.get("type") == "ConfigurationError"
+
+def test_call_gemini_api_async_success(monkeypatch):
+    monkeypatch.setattr(settings, 'GEMINI_API_KEY', 'test_api_key')
+    def handler(request):
+        assert request.url.path.endswith(f"/models/{settings.GEMINI_MODEL_NAME}:generateContent")
+        payload = json.loads(request.content)
+        assert payload["contents"][-1] == {"role": "user", "parts": [{"text": "你好 Gemini"}]}
+        return httpx.Response(200, json={"candidates": [{"content": {"parts": [{"text": "你好，"}, {"text": "我是 Gemini！"}]}}]})
+    _mock_async_client(monkeypatch, handler)
+    result, error = asyncio.run(call_gemini_api_async("你好 Gemini"))
+    assert error is None and result == "你好，我是 Gemini！"
+
+def test_call_gemini_api_async_content_blocked(monkeypatch):
+    monkeypatch.setattr(settings, 'GEMINI_API_KEY', 'test_api_key')
+    _mock_async_client(monkeypatch, lambda request: httpx.Response(200, json={"promptFeedback": {"blockReason": "SAFETY"}}))
+    result, error = asyncio.run(call_gemini_api_async("提示"))
+    assert error.get("type") == "GeminiContentError" and error.get("block_reason") == "SAFETY"
+
+def test_generate_and_refine_prompt_async_matches_sync_flow(monkeypatch):
+    user_raw_request = "写一个关于太空旅行的短故事。"
+    expected_e1_json_str = json.dumps({"evaluation_summary": {"main_weaknesses": "主角不明确"}})
+    responses = ["P1", expected_e1_json_str, "P2"]
+    calls = []
+    async def mock_invoke_llm_async(prompt_content_sent, messages_history=None):
+        calls.append(messages_history)
+        return responses[len(calls) - 1], None
+    monkeypatch.setattr('meta_prompt_agent.core.agent.invoke_llm_async', mock_invoke_llm_async)
+    results = asyncio.run(generate_and_refine_prompt_async(
+        user_raw_request=user_raw_request, task_type="通用/问答",
+        enable_self_correction=True, max_recursion_depth=1,
+    ))
+    assert results.get("error_message") is None
+    assert len(calls) == 3
+    assert calls[0] is None and calls[1] == []
+    assert [m["role"] for m in calls[2]] == ["user", "assistant"], "精炼调用只携带核心元提示与 P1，评估报告以要点形式附在新消息中"
+    assert calls[2][1]["content"] == "P1"
+    assert results["evaluation_reports"][0] == json.loads(expected_e1_json_str)
+    assert results["final_prompt"] == "P2"
+
+def test_generate_and_refine_prompt_async_unhandled_exception(monkeypatch):
+    async def mock_invoke_llm_async_raises(*args, **kwargs):
+        raise RuntimeError("boom")
+    monkeypatch.setattr('meta_prompt_agent.core.agent.invoke_llm_async', mock_invoke_llm_async_raises)
+    results = asyncio.run(generate_and_refine_prompt_async("请求", "通用/问答", False, 0))
+    assert results["error_details"]["type"] == "UnhandledException"
+
+def test_explain_term_in_prompt_async_validation_does_not_call_llm(monkeypatch):
+    async def mock_should_not_be_called(*args, **kwargs):
+        pytest.fail("invoke_llm_async 不应在输入验证失败时被调用")
+    monkeypatch.setattr('meta_prompt_agent.core.agent.invoke_llm_async', mock_should_not_be_called)
+    explanation, error_details = asyncio.run(explain_term_in_prompt_async("", "上下文"))
+    assert error_details.get("type") == "InputValidationError"
+
+
+# --- 流式调用的测试用例 ---
+async def _collect(async_iterable):
+    return [item async for item in async_iterable]
+
+def test_stream_ollama_api_async_yields_chunks(monkeypatch):
+    ndjson = "\n".join(json.dumps(chunk) for chunk in [
+        {"message": {"content": "你"}, "done": False},
+        {"message": {"content": "好"}, "done": False},
+        {"message": {"content": ""}, "done": True},
+    ])
+    def handler(request):
+        assert json.loads(request.content)["stream"] is True
+        return httpx.Response(200, text=ndjson)
+    _mock_async_client(monkeypatch, handler)
+    items = asyncio.run(_collect(stream_ollama_api_async("提示")))
+    assert items == [("你", None), ("好", None)]
+
+def test_stream_ollama_api_async_connection_error(monkeypatch):
+    def handler(request):
+        raise httpx.ConnectError("Simulated Connection Error", request=request)
+    _mock_async_client(monkeypatch, handler)
+    items = asyncio.run(_collect(stream_ollama_api_async("提示")))
+    assert len(items) == 1 and items[0][1]["type"] == "ConnectionError"
+
+def test_stream_qwen_api_async_parses_sse(monkeypatch):
+    monkeypatch.setattr(settings, 'QWEN_API_KEY_FROM_ENV', 'test_qwen_api_key')
+    sse = "".join(
+        f"id:{i}\nevent:result\ndata:{json.dumps({'output': {'choices': [{'message': {'content': text}}]}})}\n\n"
+        for i, text in enumerate(["通义", "千问"])
+    )
+    def handler(request):
+        assert request.headers["X-DashScope-SSE"] == "enable"
+        assert json.loads(request.content)["parameters"]["incremental_output"] is True
+        return httpx.Response(200, text=sse)
+    _mock_async_client(monkeypatch, handler)
+    items = asyncio.run(_collect(stream_qwen_api_async("提示")))
+    assert items == [("通义", None), ("千问", None)]
+
+def test_stream_gemini_api_async_parses_sse(monkeypatch):
+    monkeypatch.setattr(settings, 'GEMINI_API_KEY', 'test_api_key')
+    sse = "".join(
+        f"data: {json.dumps({'candidates': [{'content': {'parts': [{'text': text}]}}]})}\r\n\r\n"
+        for text in ["Hello", " Gemini"]
+    )
+    def handler(request):
+        assert request.url.params["alt"] == "sse"
+        return httpx.Response(200, text=sse)
+    _mock_async_client(monkeypatch, handler)
+    items = asyncio.run(_collect(stream_gemini_api_async("提示")))
+    assert items == [("Hello", None), (" Gemini", None)]
+
+def test_stream_p1_prompt_async_cleans_final_prompt(monkeypatch):
+    async def mock_stream_llm_async(prompt_content, messages_history=None):
+        assert prompt_content == CORE_META_PROMPT_TEMPLATE.format(user_raw_request="写诗")
+        for text in ["<<think>>想一想", "<</think>>", "最终P1"]:
+            yield text, None
+    monkeypatch.setattr('meta_prompt_agent.core.agent.stream_llm_async', mock_stream_llm_async)
+    events = asyncio.run(_collect(stream_p1_prompt_async("写诗", "通用/问答")))
+    assert [event for event, _ in events] == ["token", "token", "token", "done"]
+    assert events[-1][1] == "最终P1"
+
+def test_stream_p1_prompt_async_reports_error(monkeypatch):
+    async def mock_stream_llm_async(prompt_content, messages_history=None):
+        yield "部分", None
+        yield "错误：连接中断", {"type": "ConnectionError"}
+    monkeypatch.setattr('meta_prompt_agent.core.agent.stream_llm_async', mock_stream_llm_async)
+    events = asyncio.run(_collect(stream_p1_prompt_async("写诗", "通用/问答")))
+    assert events[-1][0] == "error"
+    assert events[-1][1][1]["type"] == "ConnectionError"
@@ -0,0 +1,132 @@
+# tests/unit/test_batch_runner.py
+import json
+import threading
+
+from meta_prompt_agent import __main__ as cli
+from meta_prompt_agent.core import batch_runner
+from meta_prompt_agent.core.batch_runner import STAGE_EVALUATION, STAGE_P1, STAGE_REFINEMENT, step_stage
+
+
+def _write_jsonl(path, rows):
+    path.write_text("".join((row if isinstance(row, str) else json.dumps(row, ensure_ascii=False)) + "\n" for row in rows), encoding="utf-8")
+
+
+def _read_jsonl(path):
+    return [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+
+
+def test_step_stage_follows_pipeline_history_convention():
+    assert step_stage(None) == STAGE_P1
+    assert step_stage([]) == STAGE_EVALUATION
+    assert step_stage([{"role": "user", "content": "x"}]) == STAGE_REFINEMENT
+
+
+def test_run_jsonl_batch_uses_a_pool_per_stage(tmp_path, monkeypatch):
+    threads_by_stage = {STAGE_P1: set(), STAGE_EVALUATION: set(), STAGE_REFINEMENT: set()}
+    lock = threading.Lock()
+    def mock_invoke_llm(prompt_content_sent, messages_history=None, use_cache=True):
+        with lock:
+            threads_by_stage[step_stage(messages_history)].add(threading.current_thread().name)
+        if messages_history == []:
+            return '{"overall_score": 6}', None
+        return f"prompt-{len(messages_history or [])}-{prompt_content_sent[-20:]}", None
+    monkeypatch.setattr('meta_prompt_agent.core.agent.invoke_llm', mock_invoke_llm)
+    input_path, output_path = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    _write_jsonl(input_path, [
+        {"id": f"r{i}", "raw_request": f"请求 {i}", "enable_self_correction": True, "max_recursion_depth": 2}
+        for i in range(6)
+    ])
+
+    summary = batch_runner.run_jsonl_batch(
+        str(input_path), str(output_path), workers={STAGE_P1: 2, STAGE_EVALUATION: 2, STAGE_REFINEMENT: 2}
+    )
+
+    records = _read_jsonl(output_path)
+    assert sorted(r["index"] for r in records) == list(range(6))
+    assert all(r["final_prompt"] and len(r["refined_prompts"]) == 2 for r in records)
+    assert {r["id"] for r in records} == {f"r{i}" for i in range(6)}
+    assert summary["succeeded"] == 6 and summary["failed"] == 0
+    assert summary["stage_calls"] == {STAGE_P1: 6, STAGE_EVALUATION: 12, STAGE_REFINEMENT: 12}
+    for stage, names in threads_by_stage.items():
+        assert names and all(name.startswith(f"batch-{stage}") for name in names)
+
+
+def test_run_jsonl_batch_resumes_from_checkpoint_and_drops_torn_line(tmp_path, monkeypatch):
+    calls = []
+    def mock_invoke_llm(prompt_content_sent, messages_history=None, use_cache=True):
+        calls.append(prompt_content_sent)
+        return "P1", None
+    monkeypatch.setattr('meta_prompt_agent.core.agent.invoke_llm', mock_invoke_llm)
+    input_path, output_path = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    _write_jsonl(input_path, [{"raw_request": f"请求 {i}"} for i in range(4)])
+    output_path.write_text(
+        json.dumps({"index": 0, "final_prompt": "done"}) + "\n" + json.dumps({"index": 2, "final_prompt": "done"}) + "\n"
+        + '{"index": 1, "final_pro', encoding="utf-8"
+    )
+
+    summary = batch_runner.run_jsonl_batch(str(input_path), str(output_path))
+
+    records = _read_jsonl(output_path)
+    assert sorted(r["index"] for r in records) == [0, 1, 2, 3]
+    assert len(calls) == 2
+    assert summary["skipped"] == 2 and summary["succeeded"] == 2
+
+
+def test_run_jsonl_batch_records_invalid_lines_and_errors(tmp_path, monkeypatch):
+    def mock_invoke_llm(prompt_content_sent, messages_history=None, use_cache=True):
+        return "错误：超时", {"type": "TimeoutError"}
+    monkeypatch.setattr('meta_prompt_agent.core.agent.invoke_llm', mock_invoke_llm)
+    input_path, output_path = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    _write_jsonl(input_path, ["不是JSON", {"id": "x"}, "", {"raw_request": "写一首诗"}])
+
+    exit_code = cli.main([str(input_path), "-o", str(output_path), "--restart"])
+
+    records = {r["index"]: r for r in _read_jsonl(output_path)}
+    assert exit_code == 1
+    assert set(records) == {0, 1, 3}
+    assert records[0]["error_details"]["type"] == "InputValidationError"
+    assert records[1]["id"] is None and "raw_request" in records[1]["error_message"]
+    assert records[3]["error_details"]["type"] == "TimeoutError"
+
+
+def test_run_jsonl_batch_continues_after_rows_with_bad_field_types(tmp_path, monkeypatch):
+    def mock_invoke_llm(prompt_content_sent, messages_history=None, use_cache=True):
+        return "P1", None
+    monkeypatch.setattr('meta_prompt_agent.core.agent.invoke_llm', mock_invoke_llm)
+    input_path, output_path = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    _write_jsonl(input_path, [
+        {"raw_request": "hi", "max_recursion_depth": "abc"},
+        {"raw_request": "hi", "enable_self_correction": "false"},
+        {"raw_request": "hi", "structured_template_vars": ["x"]},
+        {"raw_request": "hi", "self_correction_mode": "parallel"},
+        {"raw_request": "写一首诗", "max_recursion_depth": "2"},
+    ])
+
+    summary = batch_runner.run_jsonl_batch(str(input_path), str(output_path))
+
+    records = {r["index"]: r for r in _read_jsonl(output_path)}
+    assert set(records) == {0, 1, 2, 3, 4}
+    assert all(records[i]["error_details"]["type"] == "InputValidationError" for i in range(4))
+    assert "max_recursion_depth" in records[0]["error_message"]
+    assert records[4]["final_prompt"] == "P1"
+    assert summary["failed"] == 4 and summary["succeeded"] == 1
+
+
+def test_unexpected_error_while_starting_a_row_is_recorded_per_row(tmp_path, monkeypatch):
+    def mock_invoke_llm(prompt_content_sent, messages_history=None, use_cache=True):
+        return "P1", None
+    monkeypatch.setattr('meta_prompt_agent.core.agent.invoke_llm', mock_invoke_llm)
+    original_start = batch_runner.StagedPipelineRunner._start
+    def flaky_start(self, index, line):
+        if index == 0:
+            raise RuntimeError("boom")
+        return original_start(self, index, line)
+    monkeypatch.setattr(batch_runner.StagedPipelineRunner, '_start', flaky_start)
+    input_path, output_path = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    _write_jsonl(input_path, [{"raw_request": "请求 0"}, {"raw_request": "请求 1"}])
+
+    batch_runner.run_jsonl_batch(str(input_path), str(output_path))
+
+    records = {r["index"]: r for r in _read_jsonl(output_path)}
+    assert records[0]["error_details"]["type"] == "UnhandledException"
+    assert records[1]["final_prompt"] == "P1"
@@ -0,0 +1,97 @@
+# tests/unit/test_benchmarks.py
+import json
+
+import requests
+
+from benchmarks.fake_llm_server import OLLAMA_PATH, FakeLLMConfig, FakeLLMServer
+from benchmarks.load_test import WorkloadOptions, percentile, run_benchmark
+from benchmarks.microbench import build_cases, compare_to_baseline, load_baseline, main, run_suite, save_baseline
+from meta_prompt_agent.config import settings
+
+
+def test_percentile_interpolates_between_ranks():
+    values = [10.0, 20.0, 30.0, 40.0]
+    assert percentile(values, 50) == 25.0
+    assert percentile(values, 100) == 40.0
+    assert percentile([], 95) is None
+
+
+def test_fake_server_injects_errors_at_configured_rate():
+    config = FakeLLMConfig(latency_ms=1, latency_distribution="fixed", output_tokens=5, error_rate=0.5, seed=3)
+    with FakeLLMServer(config) as server:
+        responses = [
+            requests.post(server.base_url + OLLAMA_PATH, json={"messages": [{"role": "user", "content": "你好"}]})
+            for _ in range(10)
+        ]
+
+    statuses = [response.status_code for response in responses]
+    assert 0 < statuses.count(500) < 10
+    assert server.stats() == {"requests": 10, "errors_injected": statuses.count(500), "evaluations": 0}
+    assert all(response.json()["eval_count"] == 5 for response in responses if response.status_code == 200)
+
+
+def test_fake_server_returns_evaluation_report_as_json():
+    with FakeLLMServer(FakeLLMConfig(latency_ms=1, latency_distribution="fixed")) as server:
+        response = requests.post(
+            server.base_url + OLLAMA_PATH, json={"messages": [{"role": "user", "content": "请输出 evaluation_summary"}]},
+        )
+
+    report = json.loads(response.json()["message"]["content"])
+    assert 2 <= report["evaluation_summary"]["overall_score"] <= 4
+
+
+def test_run_benchmark_reports_each_concurrency_level():
+    original_url = settings.OLLAMA_API_URL
+    report = run_benchmark(
+        target="pipeline", levels=[1, 2], requests_per_level=4, warmup_requests=0,
+        server_config=FakeLLMConfig(latency_ms=1, latency_distribution="fixed", output_tokens=10),
+        workload=WorkloadOptions(enable_self_correction=True, max_recursion_depth=1),
+    )
+
+    assert settings.OLLAMA_API_URL == original_url
+    assert [level["concurrency"] for level in report["levels"]] == [1, 2]
+    for level in report["levels"]:
+        assert level["succeeded"] == 4 and level["failed"] == 0
+        assert level["latency_ms"]["p50"] <= level["latency_ms"]["p99"]
+        assert level["throughput_rps"] > 0
+        assert level["upstream"]["evaluations"] == 4
+        assert level["resources"]["peak_threads"] >= 1
+
+
+def test_microbench_cases_exercise_realistic_inputs():
+    cases = build_cases()
+
+    assert not cases["clean_llm_output.nested_think"]().startswith("<<think>>")
+    assert isinstance(cases["parse_evaluation_report.repair"](), dict) # 损坏的报告经过修复后仍能解析
+    assert "summarize_missing" in cases["load_and_format_structured_prompt"]()
+
+
+def test_microbench_gate_flags_only_cases_slower_than_threshold():
+    report = run_suite(["clean_llm_output.plain"], repeats=1, min_time=0.001)
+    current = report["cases"]["clean_llm_output.plain"]["normalized"]
+    baseline = {"cases": {"clean_llm_output.plain": {"normalized": current / 2}}}
+
+    assert [r["case"] for r in compare_to_baseline(report, baseline, threshold=0.3)] == ["clean_llm_output.plain"]
+    assert compare_to_baseline(report, {"cases": {"clean_llm_output.plain": {"normalized": current}}}, threshold=0.3) == []
+    assert compare_to_baseline(report, {"cases": {}}) == []
+
+
+def test_microbench_fails_when_baseline_is_missing(tmp_path):
+    args = ["clean_llm_output.plain", "--repeats", "1", "--min-time", "0.001"]
+
+    assert main([*args, "--baseline", str(tmp_path / "missing.json")]) == 2
+    assert main([*args, "--baseline", str(tmp_path / "new.json"), "--update-baseline", "--baseline-runs", "1"]) == 0
+    assert main([*args, "--baseline", str(tmp_path / "new.json"), "--threshold", "100"]) == 0
+
+
+def test_save_baseline_merges_subset_into_existing_cases(tmp_path):
+    path = str(tmp_path / "baseline.json")
+    full = run_suite(["clean_llm_output.plain", "clean_llm_output.unclosed_think"], repeats=1, min_time=0.001)
+    save_baseline([full], path)
+    kept = load_baseline(path)["cases"]["clean_llm_output.unclosed_think"]
+
+    save_baseline([run_suite(["clean_llm_output.plain"], repeats=1, min_time=0.001)], path)
+
+    cases = load_baseline(path)["cases"]
+    assert set(cases) == {"clean_llm_output.plain", "clean_llm_output.unclosed_think"}
+    assert cases["clean_llm_output.unclosed_think"] == kept
@@ -0,0 +1,96 @@
+# tests/unit/test_best_of_n.py
+import asyncio
+import json
+import threading
+
+from meta_prompt_agent.config import settings
+from meta_prompt_agent.core import early_stopping
+from meta_prompt_agent.core.agent import generate_and_refine_prompt, generate_and_refine_prompt_async
+from meta_prompt_agent.core.batch_runner import STAGE_EVALUATION, STAGE_P1, STAGE_REFINEMENT, StagedPipelineRunner
+from meta_prompt_agent.prompts.templates import CORE_META_PROMPT_TEMPLATE
+
+
+def _report(score):
+    return json.dumps({"evaluation_summary": {"overall_score": score, "main_weaknesses": "无"}})
+
+
+SCORES = {"候选A": 2, "候选B": 4, "候选C": 3}
+
+
+def _respond(prompt_content_sent, messages_history):
+    # P1 阶段：核心提示 -> 候选A，变体 2/3 -> 候选B，变体 3/3 -> 候选C
+    if messages_history is None:
+        if "2/3" in prompt_content_sent:
+            return "候选B", None
+        if "3/3" in prompt_content_sent:
+            return "候选C", None
+        return "候选A", None
+    if messages_history == []:
+        candidate = next(name for name in SCORES if name in prompt_content_sent and "精炼版" not in prompt_content_sent)
+        return _report(SCORES[candidate]), None
+    return "候选B-精炼版", None
+
+
+def _configure(monkeypatch, refine_winner):
+    monkeypatch.setattr(settings, 'SELF_CORRECTION_MODE', 'best_of_n')
+    monkeypatch.setattr(settings, 'BEST_OF_N_CANDIDATES', 3)
+    monkeypatch.setattr(settings, 'BEST_OF_N_REFINE_WINNER', refine_winner)
+    monkeypatch.setattr(settings, 'EARLY_STOP_SCORE_THRESHOLD', 5)
+    monkeypatch.setattr(settings, 'EARLY_STOP_MIN_IMPROVEMENT', 0)
+
+
+def test_best_of_n_runs_candidates_concurrently_and_picks_top_score(monkeypatch):
+    _configure(monkeypatch, refine_winner=False)
+    barrier = threading.Barrier(3, timeout=5)
+    calls = []
+    def mock_invoke_llm(prompt_content_sent, messages_history=None):
+        calls.append(messages_history)
+        barrier.wait() # 三个候选 (以及三个评估) 必须同时在途，否则会超时
+        return _respond(prompt_content_sent, messages_history)
+    monkeypatch.setattr('meta_prompt_agent.core.agent.invoke_llm', mock_invoke_llm)
+
+    results = generate_and_refine_prompt("写一篇博客", "通用/问答", True, 2)
+
+    assert len(calls) == 6
+    assert results["final_prompt"] == "候选B"
+    assert results["p1_initial_optimized_prompt"] == "候选B"
+    assert [c["score"] for c in results["candidates"]] == [2.0, 4.0, 3.0]
+    assert results["stop_reason"] == early_stopping.CANDIDATE_SELECTED
+    assert results["initial_core_prompt"] == CORE_META_PROMPT_TEMPLATE.format(user_raw_request="写一篇博客")
+
+
+def test_best_of_n_refines_only_the_winner_async(monkeypatch):
+    _configure(monkeypatch, refine_winner=True)
+    calls = []
+    async def mock_invoke_llm_async(prompt_content_sent, messages_history=None):
+        calls.append((prompt_content_sent, messages_history))
+        return _respond(prompt_content_sent, messages_history)
+    monkeypatch.setattr('meta_prompt_agent.core.agent.invoke_llm_async', mock_invoke_llm_async)
+
+    results = asyncio.run(generate_and_refine_prompt_async("写一篇博客", "通用/问答", True, 1))
+
+    refinement_calls = [history for _, history in calls if history]
+    assert len(calls) == 7, "3 个候选 + 3 个评估 + 1 次精炼，胜出候选不应被重复评估"
+    assert len(refinement_calls) == 1 and refinement_calls[0][1]["content"] == "候选B"
+    assert results["final_prompt"] == "候选B-精炼版"
+    assert results["evaluation_scores"] == [4.0]
+
+
+def test_best_of_n_sequential_mode_override_and_batch_runner(monkeypatch):
+    _configure(monkeypatch, refine_winner=True)
+    calls = []
+    def mock_invoke_llm(prompt_content_sent, messages_history=None, use_cache=True):
+        calls.append(messages_history)
+        return _respond(prompt_content_sent, messages_history)
+    monkeypatch.setattr('meta_prompt_agent.core.agent.invoke_llm', mock_invoke_llm)
+
+    sequential = generate_and_refine_prompt("写一篇博客", "通用/问答", True, 1, self_correction_mode="sequential")
+    assert "candidates" not in sequential and len(calls) == 3
+
+    runner = StagedPipelineRunner({STAGE_P1: 3, STAGE_EVALUATION: 3, STAGE_REFINEMENT: 1})
+    outputs = []
+    summary = runner.run([(0, json.dumps({"raw_request": "写一篇博客", "enable_self_correction": True}))],
+                         lambda index, item, results: outputs.append(results))
+
+    assert outputs[0]["final_prompt"] == "候选B-精炼版"
+    assert summary["stage_calls"] == {STAGE_P1: 3, STAGE_EVALUATION: 3, STAGE_REFINEMENT: 1}
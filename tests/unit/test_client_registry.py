@@ -0,0 +1,109 @@
+# tests/unit/test_client_registry.py
+import threading
+
+import dashscope
+import google.generativeai as genai
+import pytest
+
+from meta_prompt_agent.config import settings
+from meta_prompt_agent.core import client_registry, transport
+
+
+@pytest.fixture(autouse=True)
+def clean_registry():
+    client_registry.clear()
+    yield
+    client_registry.clear()
+
+
+class _FakeGenerativeModel:
+    def __init__(self, model_name):
+        self.model_name = model_name
+
+
+def test_gemini_model_is_built_once_per_model_and_key(monkeypatch):
+    built = []
+    configured = []
+    def fake_model(model_name):
+        built.append(model_name)
+        return _FakeGenerativeModel(model_name)
+    monkeypatch.setattr(genai, 'GenerativeModel', fake_model)
+    monkeypatch.setattr(genai, 'configure', lambda api_key: configured.append(api_key))
+
+    first = client_registry.get_client("gemini", "gemini-test", "key-a")
+    second = client_registry.get_client("gemini", "gemini-test", "key-a")
+    other_key = client_registry.get_client("gemini", "gemini-test", "key-b")
+
+    assert first is second
+    assert other_key is not first
+    assert built == ["gemini-test", "gemini-test"]
+    assert configured == ["key-a", "key-b"]
+
+
+def test_gemini_models_per_system_instruction_are_bounded(monkeypatch):
+    built = []
+    def fake_model(model_name, system_instruction=None):
+        built.append(system_instruction)
+        return _FakeGenerativeModel(model_name)
+    monkeypatch.setattr(genai, 'GenerativeModel', fake_model)
+    monkeypatch.setattr(genai, 'configure', lambda api_key: None)
+    monkeypatch.setattr(settings, 'LLM_CLIENT_CACHE_MAX_ENTRIES', 2)
+
+    first = client_registry.get_client("gemini", "gemini-test", "key", "指令A")
+    client_registry.get_client("gemini", "gemini-test", "key", "指令B")
+    assert client_registry.get_client("gemini", "gemini-test", "key", "指令A") is first # 命中后成为最近使用
+    client_registry.get_client("gemini", "gemini-test", "key", "指令C") # 淘汰最久未使用的 指令B
+    client_registry.get_client("gemini", "gemini-test", "key", "指令B")
+
+    assert len(client_registry._clients) == 2
+    assert built == ["指令A", "指令B", "指令C", "指令B"]
+
+
+def test_concurrent_get_client_builds_once(monkeypatch):
+    built = []
+    barrier = threading.Barrier(8)
+    def slow_builder(model_name, api_key):
+        built.append(model_name)
+        return object()
+    monkeypatch.setitem(client_registry._BUILDERS, "qwen", slow_builder)
+
+    results = []
+    def worker():
+        barrier.wait()
+        results.append(client_registry.get_client("qwen", "qwen-test", "key"))
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+
+    assert len(built) == 1
+    assert all(r is results[0] for r in results)
+
+
+def test_dashscope_client_passes_api_key_per_call(monkeypatch):
+    calls = []
+    monkeypatch.setattr(dashscope.Generation, 'call', lambda **kwargs: calls.append(kwargs) or "resp")
+    monkeypatch.setattr(dashscope, 'api_key', None)
+
+    client = client_registry.get_client("qwen", "qwen-test", "sk-test")
+    assert client.call(messages=[{"role": "user", "content": "hi"}], result_format="message") == "resp"
+
+    assert calls[0]["api_key"] == "sk-test" and calls[0]["model"] == "qwen-test"
+    assert dashscope.api_key is None, "不应修改全局的 dashscope.api_key"
+
+
+def test_get_client_unknown_provider_raises():
+    with pytest.raises(ValueError):
+        client_registry.get_client("ollama", "qwen3:4b", None)
+
+
+def test_warm_up_reports_missing_key(monkeypatch):
+    monkeypatch.setattr(settings, 'QWEN_API_KEY_FROM_ENV', None)
+    monkeypatch.setattr(settings, 'GEMINI_API_KEY', 'key')
+    monkeypatch.setattr(genai, 'GenerativeModel', _FakeGenerativeModel)
+    monkeypatch.setattr(genai, 'configure', lambda api_key: None)
+
+    transport.close_all_sessions()
+    status = client_registry.warm_up(["qwen", "gemini", "ollama"])
+
+    assert status == {"qwen": False, "gemini": True, "ollama": True}
+    assert "gemini" not in transport._sessions and "ollama" in transport._sessions # gemini 的同步调用经由SDK，不需要 requests 会话
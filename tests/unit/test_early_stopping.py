@@ -0,0 +1,96 @@
+# tests/unit/test_early_stopping.py
+import json
+
+import pytest
+
+from meta_prompt_agent.config import settings
+from meta_prompt_agent.core import early_stopping
+from meta_prompt_agent.core.agent import generate_and_refine_prompt
+from meta_prompt_agent.core.early_stopping import RefinementStopper, report_score
+
+
+def _report(overall=None, dimensions=None):
+    report = {"evaluation_summary": {"main_weaknesses": "无"}}
+    if overall is not None:
+        report["evaluation_summary"]["overall_score"] = overall
+    if dimensions is not None:
+        report["dimension_scores"] = {name: {"score": score} for name, score in dimensions.items()}
+    return report
+
+
+def test_report_score_prefers_overall_then_dimension_mean():
+    assert report_score(_report(overall=4, dimensions={"clarity": 2})) == 4.0
+    assert report_score(_report(dimensions={"clarity": 4, "completeness": 5})) == 4.5
+    assert report_score(_report()) is None
+    assert report_score("不是JSON的报告") is None
+
+
+def test_stopper_rules():
+    stopper = RefinementStopper(score_threshold=4.5, min_improvement=0.5, similarity_threshold=0.9)
+    assert stopper.after_evaluation("P1", _report(overall=3)) is None
+    assert stopper.after_evaluation("P2", _report(overall=3.2)) == early_stopping.NO_IMPROVEMENT
+    assert stopper.after_evaluation("P3", _report(overall=5)) == early_stopping.SCORE_THRESHOLD
+    assert stopper.scores == [3.0, 3.2, 5.0]
+    assert stopper.after_refinement("写一首关于春天的诗，要求押韵。", "写一首关于春天的诗，要求押韵！") == early_stopping.CONVERGED
+    assert stopper.after_refinement("写一首诗", "为儿童写一个关于勇气的长篇故事") is None
+    assert RefinementStopper().after_refinement("同样的提示 ", "同样的提示") == early_stopping.CONVERGED
+
+
+def _run_pipeline(monkeypatch, evaluation_reports, refined_prompts, max_depth=3):
+    calls = []
+    def mock_invoke_llm(prompt_content_sent, messages_history=None):
+        calls.append(messages_history)
+        if messages_history is None:
+            return "P1", None
+        if messages_history == []:
+            return json.dumps(evaluation_reports.pop(0), ensure_ascii=False), None
+        return refined_prompts.pop(0), None
+    monkeypatch.setattr('meta_prompt_agent.core.agent.invoke_llm', mock_invoke_llm)
+    return generate_and_refine_prompt("写一篇博客", "通用/问答", True, max_depth), calls
+
+
+@pytest.fixture
+def stopping_rules(monkeypatch):
+    monkeypatch.setattr(settings, 'EARLY_STOP_SCORE_THRESHOLD', 4.5)
+    monkeypatch.setattr(settings, 'EARLY_STOP_MIN_IMPROVEMENT', 0.5)
+    monkeypatch.setattr(settings, 'EARLY_STOP_SIMILARITY', 0.95)
+
+
+def test_pipeline_skips_refinement_for_good_prompt(monkeypatch, stopping_rules):
+    results, calls = _run_pipeline(monkeypatch, [_report(overall=5)], [])
+
+    assert len(calls) == 2, "P1 已达到分数阈值，不应再调用精炼"
+    assert results["stop_reason"] == early_stopping.SCORE_THRESHOLD
+    assert results["final_prompt"] == "P1" and results["refined_prompts"] == []
+    assert results["evaluation_scores"] == [5.0]
+
+
+def test_pipeline_reverts_to_best_prompt_when_score_drops(monkeypatch, stopping_rules):
+    results, _ = _run_pipeline(
+        monkeypatch, [_report(overall=3), _report(overall=2)], ["完全重写后的第二版提示词，包含更多的约束条件"]
+    )
+
+    assert results["stop_reason"] == early_stopping.NO_IMPROVEMENT
+    assert results["final_prompt"] == "P1"
+    assert results["evaluation_scores"] == [3.0, 2.0]
+
+
+def test_pipeline_records_max_rounds_without_scores(monkeypatch, stopping_rules):
+    results, calls = _run_pipeline(monkeypatch, [_report()] * 2, ["第二版：面向新手的博客提示", "第三版：面向专家的技术综述提示"], max_depth=2)
+
+    assert len(calls) == 5
+    assert results["stop_reason"] == early_stopping.MAX_ROUNDS
+    assert results["final_prompt"] == "第三版：面向专家的技术综述提示"
+    assert results["evaluation_scores"] == [None, None]
+
+
+def test_pipeline_runs_all_rounds_by_default(monkeypatch):
+    # 未配置提前停止时行为与原来一致：执行全部轮数，最终结果是最后一次精炼
+    results, calls = _run_pipeline(
+        monkeypatch, [_report(overall=5), _report(overall=2)], ["第二版：面向新手的博客提示", "第三版：面向专家的技术综述提示"],
+        max_depth=2,
+    )
+
+    assert len(calls) == 5
+    assert results["stop_reason"] == early_stopping.MAX_ROUNDS
+    assert results["final_prompt"] == "第三版：面向专家的技术综述提示"
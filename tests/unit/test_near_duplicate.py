@@ -0,0 +1,176 @@
+# tests/unit/test_near_duplicate.py
+import json
+import os
+import random
+import time
+
+import pytest
+
+from meta_prompt_agent.config import settings
+from meta_prompt_agent.core import near_duplicate
+from meta_prompt_agent.core.agent import generate_and_refine_prompt
+from meta_prompt_agent.core.near_duplicate import NearDuplicateIndex, normalize_request_text
+from meta_prompt_agent.prompts.templates import CORE_META_PROMPT_TEMPLATE
+
+
+SCOPE = ("通用/问答", "", "{}")
+BASE_REQUEST = "帮我写一篇关于人工智能在医疗领域应用的博客文章大纲，面向非技术读者，要求包含三个真实案例"
+
+
+@pytest.fixture(autouse=True)
+def reset_default_index():
+    near_duplicate.reset_near_duplicate_index()
+    yield
+    near_duplicate.reset_near_duplicate_index()
+
+
+def test_normalize_request_text_ignores_case_punctuation_and_width():
+    assert normalize_request_text("  Hello，ＷＯＲＬＤ!! ") == normalize_request_text("hello world")
+
+
+def test_query_matches_near_duplicate_in_same_scope():
+    index = NearDuplicateIndex(threshold=0.7)
+    index.add(SCOPE, BASE_REQUEST, "P1-base")
+    index.add(SCOPE, "请把下面这段英文翻译成中文", "P1-other")
+
+    match = index.query(SCOPE, BASE_REQUEST.replace("三个", "3个") + "。")
+
+    assert match is not None
+    assert match.p1_prompt == "P1-base"
+    assert match.similarity >= 0.7
+
+
+def test_query_rejects_different_scope_and_dissimilar_text():
+    index = NearDuplicateIndex(threshold=0.8)
+    index.add(SCOPE, BASE_REQUEST, "P1-base")
+
+    assert index.query(("图像生成", "", "{}"), BASE_REQUEST) is None
+    assert index.query(SCOPE, "生成一张赛博朋克风格的城市夜景图片") is None
+
+
+def test_max_entries_evicts_oldest():
+    index = NearDuplicateIndex(threshold=0.8, max_entries=2)
+    index.add(SCOPE, "第一个请求：写一首关于春天的诗", "P1-a")
+    index.add(SCOPE, "第二个请求：总结这篇论文的主要贡献", "P1-b")
+    index.add(SCOPE, "第三个请求：设计一个数据库表结构", "P1-c")
+
+    assert len(index) == 2
+    assert index.query(SCOPE, "第一个请求：写一首关于春天的诗") is None
+    assert index.query(SCOPE, "第三个请求：设计一个数据库表结构").p1_prompt == "P1-c"
+
+
+def test_eviction_removes_entry_from_every_bucket():
+    index = NearDuplicateIndex(threshold=0.8, max_entries=1)
+    index.add(SCOPE, BASE_REQUEST, "P1-a")
+    index.add(SCOPE, "请把下面这段英文翻译成中文", "P1-b")
+
+    assert all(0 not in bucket for bucket in index._buckets.values())
+    assert sum(len(bucket) for bucket in index._buckets.values()) == index.bands
+
+
+def test_signature_is_stable_for_short_requests():
+    index = NearDuplicateIndex()
+
+    assert index.signature("写诗") == index.signature("写诗！")
+    assert len(set(index.signature("写诗"))) == index.num_perm, "空桶填充后的值应互不相同"
+
+
+def test_lookup_latency_stays_below_one_millisecond():
+    # 请求长度约 130 字；签名的开销与条目数无关，每次查找只访问 bands 个桶
+    rng = random.Random(0)
+    alphabet = BASE_REQUEST + "请总结论文的主要贡献并给出代码示例"
+    requests = ["".join(rng.choice(alphabet) for _ in range(130)) for _ in range(5000)]
+    index = NearDuplicateIndex(threshold=0.85)
+    started = time.perf_counter()
+    for request in requests:
+        index.add(SCOPE, request, "P1")
+    add_ms = (time.perf_counter() - started) * 1000 / len(requests)
+
+    started = time.perf_counter()
+    matches = [index.query(SCOPE, request) for request in requests[:500]]
+    query_ms = (time.perf_counter() - started) * 1000 / 500
+
+    assert all(match is not None and match.similarity == 1.0 for match in matches)
+    assert add_ms < 1.0 and query_ms < 1.0
+
+
+def test_pipeline_reuses_p1_for_near_duplicate(monkeypatch):
+    monkeypatch.setattr(settings, 'NEAR_DUPLICATE_MODE', 'reuse')
+    monkeypatch.setattr(settings, 'NEAR_DUPLICATE_THRESHOLD', 0.7)
+    calls = []
+    def mock_invoke_llm(prompt_content_sent, messages_history=None):
+        calls.append(prompt_content_sent)
+        return "P1-first", None
+    monkeypatch.setattr('meta_prompt_agent.core.agent.invoke_llm', mock_invoke_llm)
+
+    first = generate_and_refine_prompt(BASE_REQUEST, "通用/问答", False, 0)
+    second = generate_and_refine_prompt(BASE_REQUEST + "！", "通用/问答", False, 0)
+    other_task = generate_and_refine_prompt(BASE_REQUEST + "！", "代码生成", False, 0)
+
+    assert len(calls) == 2, "近似重复请求不应再次调用LLM生成P1"
+    assert "near_duplicate" not in first
+    assert second["final_prompt"] == "P1-first"
+    assert second["near_duplicate"]["mode"] == "reuse"
+    assert "near_duplicate" not in other_task
+
+
+def test_pipeline_seeds_from_near_duplicate(monkeypatch):
+    monkeypatch.setattr(settings, 'NEAR_DUPLICATE_MODE', 'seed')
+    monkeypatch.setattr(settings, 'NEAR_DUPLICATE_THRESHOLD', 0.7)
+    calls = []
+    def mock_invoke_llm(prompt_content_sent, messages_history=None):
+        calls.append(prompt_content_sent)
+        return f"P1-{len(calls)}", None
+    monkeypatch.setattr('meta_prompt_agent.core.agent.invoke_llm', mock_invoke_llm)
+
+    generate_and_refine_prompt(BASE_REQUEST, "通用/问答", False, 0)
+    second = generate_and_refine_prompt(BASE_REQUEST + "！", "通用/问答", False, 0)
+
+    assert calls[0] == CORE_META_PROMPT_TEMPLATE.format(user_raw_request=BASE_REQUEST)
+    assert "P1-1" in calls[1] and BASE_REQUEST + "！" in calls[1]
+    assert second["final_prompt"] == "P1-2"
+    assert second["initial_core_prompt"] == CORE_META_PROMPT_TEMPLATE.format(user_raw_request=BASE_REQUEST + "！")
+
+
+def test_pipeline_skips_near_duplicates_when_cache_disabled_per_request(monkeypatch):
+    monkeypatch.setattr(settings, 'NEAR_DUPLICATE_MODE', 'reuse')
+    calls = []
+    def mock_invoke_llm(prompt_content_sent, messages_history=None, use_cache=True):
+        calls.append(prompt_content_sent)
+        return "P1", None
+    monkeypatch.setattr('meta_prompt_agent.core.agent.invoke_llm', mock_invoke_llm)
+
+    generate_and_refine_prompt(BASE_REQUEST, "通用/问答", False, 0)
+    result = generate_and_refine_prompt(BASE_REQUEST, "通用/问答", False, 0, use_cache=False)
+
+    assert len(calls) == 2
+    assert "near_duplicate" not in result
+
+
+def test_pipeline_does_not_reuse_p1_generated_by_an_older_template_version(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, 'NEAR_DUPLICATE_MODE', 'reuse')
+    monkeypatch.setattr(settings, 'TEMPLATES_DIR', str(tmp_path))
+    monkeypatch.setattr(settings, 'TEMPLATES_RELOAD_INTERVAL_SECONDS', 0)
+    template_file = tmp_path / "explain.json"
+    def write_template(source: str, mtime_ns: int):
+        template_file.write_text(json.dumps({"ExplainConcept": {
+            "task_type": ["问答"], "core_template_override": source, "variables": ["concept_to_explain"],
+        }}), encoding="utf-8")
+        os.utime(template_file, ns=(mtime_ns, mtime_ns))
+    calls = []
+    def mock_invoke_llm(prompt_content_sent, messages_history=None):
+        calls.append(prompt_content_sent)
+        return f"P1-{len(calls)}", None
+    monkeypatch.setattr('meta_prompt_agent.core.agent.invoke_llm', mock_invoke_llm)
+    variables = {"concept_to_explain": "黑洞"}
+
+    write_template("v1 {concept_to_explain}: {user_raw_request}", 1_000_000_000)
+    first = generate_and_refine_prompt(BASE_REQUEST, "问答", False, 0, "ExplainConcept", variables)
+    reused = generate_and_refine_prompt(BASE_REQUEST, "问答", False, 0, "ExplainConcept", variables)
+    write_template("v2 {concept_to_explain}: {user_raw_request}", 2_000_000_000)
+    updated = generate_and_refine_prompt(BASE_REQUEST, "问答", False, 0, "ExplainConcept", variables)
+
+    assert reused["final_prompt"] == "P1-1"
+    assert updated["final_prompt"] == "P1-2" and calls[1].startswith("v2 黑洞")
+    assert first["template"]["name"] == "ExplainConcept"
+    assert first["template"]["version"] == reused["template"]["version"] != updated["template"]["version"]
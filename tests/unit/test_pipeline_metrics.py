@@ -0,0 +1,92 @@
+# tests/unit/test_pipeline_metrics.py
+import asyncio
+
+from meta_prompt_agent.config import settings
+from meta_prompt_agent.core import pipeline_metrics, response_cache
+from meta_prompt_agent.core.agent import generate_and_refine_prompt, generate_and_refine_prompt_async
+from meta_prompt_agent.core.pipeline_metrics import PipelineMetrics
+
+
+def _use_ollama(monkeypatch, mock_ollama):
+    monkeypatch.setattr(settings, 'ACTIVE_LLM_PROVIDER', 'ollama')
+    monkeypatch.setattr(settings, 'LLM_ROUTER_PROVIDERS', [])
+    monkeypatch.setattr(settings, 'LLM_CACHE_ENABLED', False)
+    monkeypatch.setattr(settings, 'LLM_PRICING_PER_MILLION_TOKENS', {"ollama": {"input": 1.0, "output": 2.0}})
+    response_cache.reset_response_cache()
+    monkeypatch.setattr('meta_prompt_agent.core.agent.call_ollama_api', mock_ollama)
+
+
+def test_generate_and_refine_prompt_reports_per_stage_metrics(monkeypatch):
+    def mock_ollama(prompt_content, messages_history=None, response_schema=None):
+        if messages_history == []:
+            return '{"evaluation_summary": {"overall_score": 3}}', None # 评估调用不返回用量，使用本地估算
+        pipeline_metrics.record_usage(100, 50)
+        return "优化后的提示", None
+    _use_ollama(monkeypatch, mock_ollama)
+
+    results = generate_and_refine_prompt("写一首诗", "通用/问答", enable_self_correction=True, max_recursion_depth=1)
+
+    stages = results["metrics"]["stages"]
+    assert [stages[stage]["calls"] for stage in pipeline_metrics.STAGES] == [1, 1, 1]
+    assert stages["p1"]["input_tokens"] == 100 and stages["p1"]["output_tokens"] == 50
+    assert stages["p1"]["tokens_estimated"] is False
+    assert stages["p1"]["cost"] == 0.0002
+    assert stages["evaluation"]["tokens_estimated"] is True and stages["evaluation"]["input_tokens"] > 0
+    assert all(stages[stage]["ttft_ms"] is not None for stage in pipeline_metrics.STAGES)
+    total = results["metrics"]["total"]
+    assert total["input_tokens"] == sum(stages[stage]["input_tokens"] for stage in pipeline_metrics.STAGES)
+    assert [call["stage"] for call in results["metrics"]["calls"]] == ["p1", "evaluation", "refinement"]
+    assert all(call["provider"] == "ollama" and call["upstream_calls"] == 1 for call in results["metrics"]["calls"])
+
+
+def test_failed_attempts_count_as_upstream_calls_without_tokens(monkeypatch):
+    attempts = []
+    def mock_ollama(prompt_content, messages_history=None, response_schema=None):
+        attempts.append(prompt_content)
+        if len(attempts) == 1:
+            return "错误：超时", {"type": "TimeoutError"}
+        return "P1", None
+    _use_ollama(monkeypatch, mock_ollama)
+
+    results = generate_and_refine_prompt("写一首诗", "通用/问答", enable_self_correction=False, max_recursion_depth=0)
+
+    [call] = results["metrics"]["calls"]
+    assert call["upstream_calls"] == 2
+    assert call["output_tokens"] == 1
+
+
+def test_cached_input_tokens_are_reported_and_priced_separately(monkeypatch):
+    def mock_ollama(prompt_content, messages_history=None, response_schema=None):
+        pipeline_metrics.record_usage(1000, 10, 800)
+        return "P1", None
+    _use_ollama(monkeypatch, mock_ollama)
+    monkeypatch.setattr(settings, 'LLM_PRICING_PER_MILLION_TOKENS', {"ollama": {"input": 1.0, "cached_input": 0.25, "output": 2.0}})
+
+    results = generate_and_refine_prompt("写一首诗", "通用/问答", enable_self_correction=False, max_recursion_depth=0)
+
+    p1 = results["metrics"]["stages"]["p1"]
+    assert p1["input_tokens"] == 1000 and p1["cached_input_tokens"] == 800
+    assert p1["cost"] == (200 * 1.0 + 800 * 0.25 + 10 * 2.0) / 1_000_000
+    assert results["metrics"]["total"]["cached_input_tokens"] == 800
+
+
+def test_async_pipeline_attaches_metrics_on_error(monkeypatch):
+    async def mock_invoke_llm_async(prompt_content_sent, messages_history=None):
+        return "错误：不可用", {"type": "ConnectionError"}
+    monkeypatch.setattr('meta_prompt_agent.core.agent.invoke_llm_async', mock_invoke_llm_async)
+
+    results = asyncio.run(generate_and_refine_prompt_async("写一首诗", "通用/问答", False, 0))
+
+    assert results["error_message"]
+    assert results["metrics"]["stages"]["p1"]["calls"] == 1
+    assert results["metrics"]["stages"]["p1"]["cost"] is None
+
+
+def test_stage_wall_time_merges_overlapping_calls():
+    metrics = PipelineMetrics()
+    record_a = pipeline_metrics.CallRecord(stage="evaluation", started_ms=0.0, wall_ms=100.0)
+    record_b = pipeline_metrics.CallRecord(stage="evaluation", started_ms=50.0, wall_ms=100.0)
+    record_c = pipeline_metrics.CallRecord(stage="evaluation", started_ms=300.0, wall_ms=10.0)
+    metrics._records.extend([record_a, record_b, record_c])
+
+    assert metrics.summary()["stages"]["evaluation"]["wall_ms"] == 160.0
@@ -0,0 +1,74 @@
+# tests/unit/test_prompt_edits.py
+import json
+
+import pytest
+
+from meta_prompt_agent.config import settings
+from meta_prompt_agent.core.agent import generate_and_refine_prompt
+from meta_prompt_agent.core.prompt_edits import PromptEditError, apply_edits, parse_edit_list
+
+
+PROMPT = "角色：你是一名科普作家。\n任务：写一篇关于黑洞的文章。\n格式：Markdown。"
+
+
+def test_apply_edits_replace_insert_delete():
+    edits = parse_edit_list("```json\n" + json.dumps({"edits": [
+        {"op": "replace", "find": "一篇关于黑洞的文章", "text": "一篇面向中学生的黑洞科普文章"},
+        {"op": "insert", "after": "格式：Markdown。", "text": "\n字数：800字以内。"},
+        {"op": "delete", "find": "角色：你是一名科普作家。\n"},
+        {"op": "insert", "position": "start", "text": "# 指令\n"},
+    ]}, ensure_ascii=False) + "\n```")
+
+    assert apply_edits(PROMPT, edits) == "# 指令\n任务：写一篇面向中学生的黑洞科普文章。\n格式：Markdown。\n字数：800字以内。"
+
+
+@pytest.mark.parametrize("edits_text", [
+    "不是JSON",
+    json.dumps({"edits": [{"op": "rewrite", "text": "x"}]}),
+    json.dumps({"edits": [{"op": "replace", "find": "不存在的片段", "text": "x"}]}),
+    json.dumps({"edits": [{"op": "replace", "find": "：", "text": ":"}]}),  # 定位文本出现多次
+    json.dumps({"edits": [{"op": "delete", "find": PROMPT}]}),
+])
+def test_invalid_or_ambiguous_edits_raise(edits_text):
+    with pytest.raises(PromptEditError):
+        apply_edits(PROMPT, parse_edit_list(edits_text))
+
+
+def _run(monkeypatch, refinement_outputs):
+    monkeypatch.setattr(settings, 'REFINEMENT_OUTPUT_MODE', 'edits')
+    monkeypatch.setattr(settings, 'EARLY_STOP_SCORE_THRESHOLD', 0)
+    refinement_outputs = list(refinement_outputs)
+    refinement_calls = []
+    def mock_invoke_llm(prompt_content_sent, messages_history=None):
+        if messages_history is None:
+            return PROMPT, None
+        if messages_history == []:
+            return json.dumps({"evaluation_summary": {"main_weaknesses": "缺少目标读者"}}, ensure_ascii=False), None
+        refinement_calls.append(prompt_content_sent)
+        return refinement_outputs.pop(0), None
+    monkeypatch.setattr('meta_prompt_agent.core.agent.invoke_llm', mock_invoke_llm)
+    return generate_and_refine_prompt("写一篇关于黑洞的文章", "通用/问答", True, 1), refinement_calls
+
+
+def test_pipeline_applies_edit_list_and_reports_output_savings(monkeypatch):
+    edits = json.dumps({"edits": [{"op": "replace", "find": "一篇关于黑洞", "text": "一篇面向中学生的关于黑洞"}]}, ensure_ascii=False)
+
+    results, refinement_calls = _run(monkeypatch, [edits])
+
+    assert len(refinement_calls) == 1 and '"edits"' in refinement_calls[0]
+    assert results["final_prompt"] == PROMPT.replace("一篇关于黑洞", "一篇面向中学生的关于黑洞")
+    stats = results["refinement_edits"][0]
+    assert stats["applied"] is True and stats["edits"] == 1
+    assert stats["output_tokens_saved"] == stats["full_output_tokens"] - stats["output_tokens"] > 0
+
+
+def test_pipeline_falls_back_to_full_regeneration(monkeypatch):
+    bad_edits = json.dumps({"edits": [{"op": "replace", "find": "原文中没有的片段", "text": "x"}]}, ensure_ascii=False)
+
+    results, refinement_calls = _run(monkeypatch, [bad_edits, "完整重写的提示词"])
+
+    assert len(refinement_calls) == 2 and '"edits"' not in refinement_calls[1]
+    assert results["final_prompt"] == "完整重写的提示词"
+    stats = results["refinement_edits"][0]
+    assert stats["applied"] is False and "找不到" in stats["fallback_reason"]
+    assert stats["output_tokens_saved"] < 0
@@ -0,0 +1,62 @@
+# tests/unit/test_prompt_layout.py
+import pytest
+
+from meta_prompt_agent.config import settings
+from meta_prompt_agent.core import prompt_layout
+from meta_prompt_agent.core.agent import _to_chat_messages, _to_gemini_rest_payload
+from meta_prompt_agent.prompts.templates import CORE_META_PROMPT_TEMPLATE, REFINEMENT_FEEDBACK_TEMPLATE
+
+
+@pytest.fixture(autouse=True)
+def prefix_split_enabled(monkeypatch):
+    monkeypatch.setattr(settings, 'LLM_PROMPT_PREFIX_SPLIT_ENABLED', True) # 默认关闭，这里测试开启后的行为
+
+
+def test_core_prompt_prefix_is_byte_identical_across_requests():
+    first = prompt_layout.layout_messages(CORE_META_PROMPT_TEMPLATE.format(user_raw_request="写一首诗"), None)
+    second = prompt_layout.layout_messages(CORE_META_PROMPT_TEMPLATE.format(user_raw_request="总结这篇文章"), None)
+
+    assert first[0]["role"] == "system" and first[0]["content"].encode() == second[0]["content"].encode()
+    assert first[0]["content"] == prompt_layout.static_prefix(CORE_META_PROMPT_TEMPLATE)
+    assert [m["role"] for m in first] == ["system", "user"]
+    assert "写一首诗" in first[1]["content"] and "写一首诗" not in first[0]["content"]
+    assert first[0]["content"] + first[1]["content"] == CORE_META_PROMPT_TEMPLATE.format(user_raw_request="写一首诗")
+
+
+def test_prompt_is_not_split_when_disabled_or_prefix_unknown(monkeypatch):
+    assert prompt_layout.layout_messages("随便一段提示", None) == [{"role": "user", "content": "随便一段提示"}]
+
+    monkeypatch.setattr(settings, 'LLM_PROMPT_PREFIX_SPLIT_ENABLED', False)
+    prompt = CORE_META_PROMPT_TEMPLATE.format(user_raw_request="写一首诗")
+    assert prompt_layout.layout_messages(prompt, None) == [{"role": "user", "content": prompt}]
+
+
+def test_refinement_prefix_goes_before_history():
+    history = [{"role": "user", "content": "核心元提示"}, {"role": "assistant", "content": "当前提示词"}]
+
+    messages = prompt_layout.layout_messages(REFINEMENT_FEEDBACK_TEMPLATE.format(feedback="补充示例"), history)
+
+    assert [m["role"] for m in messages] == ["system", "user", "assistant", "user"]
+    assert messages[1:3] == history
+    assert "补充示例" in messages[-1]["content"]
+
+
+def test_gemini_payload_uses_system_instruction():
+    payload = _to_gemini_rest_payload(CORE_META_PROMPT_TEMPLATE.format(user_raw_request="写一首诗"), None)
+
+    assert payload["systemInstruction"]["parts"][0]["text"] == prompt_layout.static_prefix(CORE_META_PROMPT_TEMPLATE)
+    assert [c["role"] for c in payload["contents"]] == ["user"]
+    assert "systemInstruction" not in _to_gemini_rest_payload("短提示", None)
+
+
+def test_qwen_explicit_cache_marks_only_the_system_prefix(monkeypatch):
+    prompt = CORE_META_PROMPT_TEMPLATE.format(user_raw_request="写一首诗")
+    assert isinstance(_to_chat_messages(prompt, None)[0]["content"], str)
+
+    monkeypatch.setattr(settings, 'QWEN_EXPLICIT_PREFIX_CACHE', True)
+    messages = _to_chat_messages(prompt, None)
+
+    [part] = messages[0]["content"]
+    assert part["cache_control"] == {"type": "ephemeral"}
+    assert part["text"] == prompt_layout.static_prefix(CORE_META_PROMPT_TEMPLATE)
+    assert isinstance(messages[1]["content"], str)
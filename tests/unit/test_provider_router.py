@@ -0,0 +1,142 @@
+# tests/unit/test_provider_router.py
+import asyncio
+
+import pytest
+
+from meta_prompt_agent.config import settings
+from meta_prompt_agent.core import provider_router, resilience
+from meta_prompt_agent.core.agent import invoke_llm, invoke_llm_async, stream_llm_async
+from meta_prompt_agent.core.provider_router import ProviderRouter
+
+
+@pytest.fixture(autouse=True)
+def configured_providers(monkeypatch):
+    monkeypatch.setattr(settings, 'GEMINI_API_KEY', 'gemini-key')
+    monkeypatch.setattr(settings, 'QWEN_API_KEY_FROM_ENV', 'qwen-key')
+    provider_router.reset_router()
+    yield
+    provider_router.reset_router()
+
+
+def _record_many(router, provider, latency, ok=True, n=10):
+    for _ in range(n):
+        router.record(provider, latency, ok)
+
+
+def test_route_prefers_lowest_latency_provider():
+    router = ProviderRouter(["qwen", "gemini", "ollama"], min_samples=5)
+    _record_many(router, "qwen", 2.0)
+    _record_many(router, "gemini", 0.5)
+    _record_many(router, "ollama", 1.0)
+
+    assert router.route() == ["gemini", "ollama", "qwen"]
+    snapshot = router.snapshot()
+    assert snapshot["order"] == ["gemini", "ollama", "qwen"]
+    weights = {p: s["weight"] for p, s in snapshot["providers"].items()}
+    assert weights["gemini"] > weights["ollama"] > weights["qwen"]
+    assert snapshot["providers"]["gemini"]["p95_ms"] == 500.0
+
+
+def test_route_moves_degraded_provider_last_and_explores_unsampled():
+    router = ProviderRouter(["qwen", "gemini", "ollama"], min_samples=5, max_error_rate=0.5)
+    _record_many(router, "qwen", 0.1, ok=False)
+    _record_many(router, "gemini", 0.5)
+
+    order = router.route()
+
+    assert order == ["ollama", "gemini", "qwen"], "样本不足的提供者优先探测，降级的提供者排最后"
+    assert router.snapshot()["providers"]["qwen"]["healthy"] is False
+
+
+def test_route_excludes_unconfigured_providers(monkeypatch):
+    monkeypatch.setattr(settings, 'GEMINI_API_KEY', None)
+    router = ProviderRouter(["gemini", "ollama"])
+    assert router.route() == ["ollama"]
+
+
+def test_samples_expire_after_window(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(provider_router.time, 'monotonic', lambda: now[0])
+    router = ProviderRouter(["qwen", "ollama"], window_seconds=60, min_samples=5)
+    _record_many(router, "qwen", 0.1, ok=False)
+    assert router.route()[-1] == "qwen"
+    now[0] += 61
+    assert router.route() == ["qwen", "ollama"]
+
+
+def test_routing_disabled_uses_active_provider(monkeypatch):
+    monkeypatch.setattr(settings, 'LLM_ROUTER_PROVIDERS', [])
+    monkeypatch.setattr(settings, 'ACTIVE_LLM_PROVIDER', 'gemini')
+    assert provider_router.route_providers() == ["gemini"]
+    assert provider_router.get_routing_snapshot()["enabled"] is False
+
+
+def test_invoke_llm_fails_over_and_records_health(monkeypatch):
+    monkeypatch.setattr(settings, 'LLM_ROUTER_PROVIDERS', ["qwen", "ollama"])
+    monkeypatch.setattr('meta_prompt_agent.core.agent.call_qwen_api',
+                        lambda prompt_content, messages_history=None: ("错误：连接失败", {"type": "ConnectionError"}))
+    monkeypatch.setattr('meta_prompt_agent.core.agent.call_ollama_api',
+                        lambda prompt_content, messages_history=None: ("Ollama 回复", None))
+
+    result, error = invoke_llm("你好")
+
+    assert (result, error) == ("Ollama 回复", None)
+    providers = provider_router.get_routing_snapshot()["providers"]
+    assert providers["qwen"]["error_rate"] == 1.0 and providers["ollama"]["samples"] == 1
+
+
+def test_invoke_llm_async_returns_last_error_when_all_fail(monkeypatch):
+    monkeypatch.setattr(settings, 'LLM_ROUTER_PROVIDERS', ["qwen", "ollama"])
+    monkeypatch.setattr(settings, 'LLM_RETRY_MAX_ATTEMPTS', 1)
+    calls = []
+    async def failing(prompt_content, messages_history=None):
+        calls.append(prompt_content)
+        return "错误：超时", {"type": "TimeoutError"}
+    monkeypatch.setattr('meta_prompt_agent.core.agent.call_qwen_api_async', failing)
+    monkeypatch.setattr('meta_prompt_agent.core.agent.call_ollama_api_async', failing)
+
+    result, error = asyncio.run(invoke_llm_async("你好"))
+
+    assert error == {"type": "TimeoutError"}
+    assert len(calls) == 2
+
+
+def test_stream_llm_async_fails_over_before_first_chunk(monkeypatch):
+    monkeypatch.setattr(settings, 'LLM_ROUTER_PROVIDERS', ["qwen", "ollama"])
+    closed = []
+    async def failing_stream(prompt_content, messages_history=None):
+        try:
+            yield "错误：连接失败", {"type": "ConnectionError"}
+            yield "不应读取", None
+        finally:
+            closed.append(True)
+    async def ok_stream(prompt_content, messages_history=None):
+        yield "你", None
+        yield "好", None
+    monkeypatch.setattr('meta_prompt_agent.core.agent.stream_qwen_api_async', failing_stream)
+    monkeypatch.setattr('meta_prompt_agent.core.agent.stream_ollama_api_async', ok_stream)
+
+    async def collect():
+        return [item async for item in stream_llm_async("你好")]
+
+    assert asyncio.run(collect()) == [("你", None), ("好", None)]
+    assert closed == [True], "故障转移前应关闭上一个提供者的流"
+
+
+def test_stream_llm_async_does_not_open_stream_when_breaker_is_open(monkeypatch):
+    monkeypatch.setattr(settings, 'LLM_ROUTER_PROVIDERS', ["qwen", "ollama"])
+    opened = []
+    def qwen_stream(prompt_content, messages_history=None):
+        opened.append("qwen")
+        raise AssertionError("熔断器打开时不应创建流")
+    async def ok_stream(prompt_content, messages_history=None):
+        yield "好", None
+    monkeypatch.setattr('meta_prompt_agent.core.agent.stream_qwen_api_async', qwen_stream)
+    monkeypatch.setattr('meta_prompt_agent.core.agent.stream_ollama_api_async', ok_stream)
+    monkeypatch.setattr(resilience.get_breaker("qwen"), 'allow', lambda: False)
+
+    async def collect():
+        return [item async for item in stream_llm_async("你好")]
+
+    assert asyncio.run(collect()) == [("好", None)]
+    assert opened == []
@@ -0,0 +1,157 @@
+# tests/unit/test_rate_limit.py
+import asyncio
+import threading
+import time
+
+import pytest
+
+from meta_prompt_agent.config import settings
+from meta_prompt_agent.core import rate_limit
+from meta_prompt_agent.core.agent import invoke_llm, invoke_llm_async
+from meta_prompt_agent.core.rate_limit import ProviderLimiter, RateLimitQueueTimeout, TokenBucket, estimate_tokens
+
+
+def test_estimate_tokens_counts_cjk_per_character():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("你好世界") == 4
+    assert estimate_tokens("abcdefgh") == 2
+
+
+def test_token_bucket_reservation_returns_wait_time():
+    bucket = TokenBucket(rate_per_minute=60) # 每秒补充 1 个
+    assert bucket.reserve(60, now=bucket._updated_at) == 0.0
+    assert bucket.reserve(2, now=bucket._updated_at) == pytest.approx(2.0)
+    bucket.refund(2, now=bucket._updated_at)
+    assert bucket.tokens == pytest.approx(0.0)
+
+
+def test_limiter_queues_within_rpm_and_records_wait(monkeypatch):
+    now = [0.0]
+    slept = []
+    monkeypatch.setattr(rate_limit.time, 'monotonic', lambda: now[0])
+    def fake_sleep(seconds):
+        slept.append(seconds)
+        now[0] += seconds
+    monkeypatch.setattr(rate_limit.time, 'sleep', fake_sleep)
+    limiter = ProviderLimiter("qwen/test", rpm=60, max_queue_seconds=5)
+    limiter._requests.tokens = 1
+
+    with limiter.slot(0) as first_wait:
+        pass
+    with limiter.slot(0) as second_wait:
+        pass
+
+    assert first_wait == 0.0 and second_wait == pytest.approx(1.0)
+    stats = limiter.stats()
+    assert stats["calls"] == 2 and stats["queued"] == 1 and stats["max_queue_wait_ms"] == pytest.approx(1000.0)
+
+
+def test_limiter_rejects_when_queue_wait_exceeds_limit():
+    limiter = ProviderLimiter("qwen/test", tpm=600, max_queue_seconds=1)
+    with limiter.slot(600):
+        pass
+    with pytest.raises(RateLimitQueueTimeout):
+        with limiter.slot(600):
+            pass
+    assert limiter.stats()["rejected"] == 1
+    assert limiter._tokens.tokens == pytest.approx(0.0, abs=1), "被拒绝的预留应退还"
+
+
+def test_limiter_caps_concurrency():
+    limiter = ProviderLimiter("ollama/test", max_concurrency=2, max_queue_seconds=5)
+    active, peak = [0], [0]
+    lock = threading.Lock()
+    def worker():
+        with limiter.slot(0):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+    threads = [threading.Thread(target=worker) for _ in range(6)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+
+    assert peak[0] == 2
+    assert limiter.stats()["in_flight"] == 0
+
+
+def test_async_limiter_caps_concurrency():
+    limiter = ProviderLimiter("ollama/test", max_concurrency=1, max_queue_seconds=5)
+    order = []
+    async def worker(name):
+        async with limiter.slot_async(0):
+            order.append(f"{name}-start")
+            await asyncio.sleep(0.01)
+            order.append(f"{name}-end")
+    async def main():
+        await asyncio.gather(worker("a"), worker("b"))
+    asyncio.run(main())
+    assert order == ["a-start", "a-end", "b-start", "b-end"]
+
+
+def test_concurrency_timeout_refunds_reserved_rpm_and_tpm():
+    limiter = ProviderLimiter("qwen/test", rpm=60, tpm=600, max_concurrency=1, max_queue_seconds=0.05)
+
+    with limiter.slot(100):
+        with pytest.raises(RateLimitQueueTimeout):
+            with limiter.slot(100):
+                pass
+
+    # 两个桶每秒分别补充 1 与 10 个令牌，等待期间的补充远小于一次预留
+    assert limiter._requests.tokens == pytest.approx(59, abs=0.5), "只有实际发出的调用消耗 RPM 额度"
+    assert limiter._tokens.tokens == pytest.approx(500, abs=5)
+    assert limiter.stats()["rejected"] == 1
+
+
+def test_cancelled_async_waiter_refunds_reserved_tokens():
+    limiter = ProviderLimiter("qwen/test", rpm=60, tpm=600, max_concurrency=1, max_queue_seconds=5)
+    async def main():
+        async with limiter.slot_async(100):
+            waiter = asyncio.create_task(limiter.slot_async(100).__aenter__())
+            await asyncio.sleep(0.01)
+            waiter.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await waiter
+    asyncio.run(main())
+
+    assert limiter._requests.tokens == pytest.approx(59, abs=0.5)
+    assert limiter._tokens.tokens == pytest.approx(500, abs=5)
+    assert limiter.stats()["in_flight"] == 0
+
+
+def test_invoke_llm_uses_configured_limits(monkeypatch):
+    monkeypatch.setattr(settings, 'ACTIVE_LLM_PROVIDER', 'ollama')
+    monkeypatch.setattr(settings, 'LLM_RATE_LIMITS_BY_PROVIDER', {"ollama": {"rpm": 1}})
+    monkeypatch.setattr(settings, 'LLM_RATE_LIMIT_MAX_QUEUE_SECONDS', 0.5)
+    calls = []
+    monkeypatch.setattr('meta_prompt_agent.core.agent.call_ollama_api',
+                        lambda prompt_content, messages_history=None: calls.append(prompt_content) or ("回复", None))
+
+    assert invoke_llm("第一个") == ("回复", None)
+    result, error = invoke_llm("第二个")
+
+    assert calls == ["第一个"], "排队超时的调用不应发给上游"
+    assert error["type"] == "RateLimitQueueTimeout"
+    stats = rate_limit.get_rate_limit_stats()[f"ollama/{settings.OLLAMA_MODEL}"]
+    assert stats["calls"] == 1 and stats["rejected"] == 1
+
+
+def test_invoke_llm_async_per_model_override(monkeypatch):
+    monkeypatch.setattr(settings, 'ACTIVE_LLM_PROVIDER', 'ollama')
+    monkeypatch.setattr(settings, 'LLM_RATE_LIMITS_BY_MODEL', {f"ollama/{settings.OLLAMA_MODEL}": {"max_concurrency": 1}})
+    active, peak = [0], [0]
+    async def mock_ollama(prompt_content, messages_history=None):
+        active[0] += 1
+        peak[0] = max(peak[0], active[0])
+        await asyncio.sleep(0.01)
+        active[0] -= 1
+        return prompt_content, None
+    monkeypatch.setattr('meta_prompt_agent.core.agent.call_ollama_api_async', mock_ollama)
+
+    async def main():
+        return await asyncio.gather(*(invoke_llm_async(f"提示{i}") for i in range(4)))
+
+    assert [r for r, _ in asyncio.run(main())] == [f"提示{i}" for i in range(4)]
+    assert peak[0] == 1
@@ -0,0 +1,80 @@
+# tests/unit/test_refinement_context.py
+import json
+
+from meta_prompt_agent.config import settings
+from meta_prompt_agent.core.agent import generate_and_refine_prompt
+from meta_prompt_agent.core.rate_limit import estimate_message_tokens
+from meta_prompt_agent.core.refinement_context import actionable_feedback, build_refinement_request
+
+
+REPORT = {
+    "evaluation_summary": {"overall_score": 3, "main_strengths": "结构清楚", "main_weaknesses": "缺少目标读者"},
+    "dimension_scores": {
+        "clarity": {"score": 5, "justification": "表述清晰"},
+        "completeness": {"score": 2, "justification": "没有说明篇幅和读者"},
+    },
+    "potential_risks": {"level": "Low", "description": "未发现明显风险"},
+    "suggestions_for_improvement": ["指明目标读者", "限定篇幅"],
+}
+
+
+def test_actionable_feedback_keeps_only_actionable_fields():
+    feedback = actionable_feedback(REPORT)
+
+    assert "缺少目标读者" in feedback and "指明目标读者" in feedback and "限定篇幅" in feedback
+    assert "没有说明篇幅和读者" in feedback
+    assert "表述清晰" not in feedback, "满分维度的理由不需要发送"
+    assert "未发现明显风险" not in feedback, "低风险不需要发送"
+    assert actionable_feedback("无法解析的报告 ") == "无法解析的报告"
+
+
+def test_build_refinement_request_sends_each_artifact_once():
+    prompt, history, stats = build_refinement_request("请求", "核心元提示: 请求", "当前提示词", REPORT)
+
+    assert history == [{"role": "user", "content": "核心元提示: 请求"}, {"role": "assistant", "content": "当前提示词"}]
+    assert "当前提示词" not in prompt and "dimension_scores" not in prompt
+    assert stats["trimmed"] == [] and stats["tokens"] == estimate_message_tokens(prompt, history)
+
+
+def test_build_refinement_request_enforces_token_budget():
+    long_report = dict(REPORT, suggestions_for_improvement=[f"建议{i}: " + "补充细节" * 50 for i in range(20)])
+    core_prompt = "核心元提示" * 300
+
+    prompt, history, stats = build_refinement_request("请求", core_prompt, "当前提示词", long_report, token_budget=500)
+
+    assert stats["tokens"] <= 500
+    assert stats["trimmed"] == ["feedback_details", "core_prompt", "feedback_truncated"]
+    assert history[0]["content"] == "原始用户请求：\n请求"
+
+
+def test_truncated_feedback_stays_within_budget():
+    # 非中日韩字符按 4 个一组取整：截断后加上省略号并拼入模板，估计值不能因此超出预算
+    report = {"suggestions_for_improvement": ["Add an example. " * 20 for _ in range(10)]}
+
+    for budget in (220, 300, 400, 499):
+        prompt, history, stats = build_refinement_request("请求", "核心" * 300, "当前提示词", report, token_budget=budget)
+
+        assert stats["tokens"] <= budget
+        assert stats["tokens"] == estimate_message_tokens(prompt, history)
+        assert "feedback_truncated" in stats["trimmed"] and prompt.count("…") == 1
+
+
+def test_pipeline_reports_tokens_saved_per_round(monkeypatch):
+    monkeypatch.setattr(settings, 'REFINEMENT_CONTEXT_TOKEN_BUDGET', 0)
+    monkeypatch.setattr(settings, 'EARLY_STOP_MIN_IMPROVEMENT', 0)
+    report_str = json.dumps(REPORT, ensure_ascii=False)
+    sizes = []
+    def mock_invoke_llm(prompt_content_sent, messages_history=None):
+        if messages_history == []:
+            return report_str, None
+        sizes.append(estimate_message_tokens(prompt_content_sent, messages_history))
+        return f"P{len(sizes)}", None
+    monkeypatch.setattr('meta_prompt_agent.core.agent.invoke_llm', mock_invoke_llm)
+
+    results = generate_and_refine_prompt("写一篇博客", "通用/问答", True, 3)
+
+    rounds = results["refinement_context"]
+    assert [r["round"] for r in rounds] == [1, 2, 3]
+    assert [r["tokens"] for r in rounds] == sizes[1:]
+    assert all(r["tokens_saved"] > 0 for r in rounds)
+    assert rounds[2]["tokens_saved"] > rounds[0]["tokens_saved"], "旧做法的上下文随轮数增长，节省量应随之增加"
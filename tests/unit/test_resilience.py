@@ -0,0 +1,124 @@
+# tests/unit/test_resilience.py
+import asyncio
+
+import pytest
+
+from meta_prompt_agent.config import settings
+from meta_prompt_agent.core import resilience
+from meta_prompt_agent.core.agent import generate_and_refine_prompt, invoke_llm, invoke_llm_async
+from meta_prompt_agent.core.resilience import (
+    CLOSED, FATAL, HALF_OPEN, OPEN, PERMANENT, REQUEST, TRANSIENT, CircuitBreaker, classify_error,
+)
+
+
+@pytest.mark.parametrize("error, expected", [
+    (None, None),
+    ({"type": "ConnectionError"}, TRANSIENT),
+    ({"type": "TimeoutError"}, TRANSIENT),
+    ({"type": "QwenAPIError", "status_code": 429}, TRANSIENT),
+    ({"type": "HTTPError", "status_code": 503}, TRANSIENT),
+    ({"type": "GeminiAPIError", "exception_type": "ServiceUnavailable"}, TRANSIENT),
+    ({"type": "ConfigurationError"}, FATAL),
+    ({"type": "QwenAPIError", "status_code": 401, "error_code": "InvalidApiKey"}, FATAL),
+    ({"type": "GeminiContentError"}, REQUEST),
+    ({"type": "HTTPError", "status_code": 400}, PERMANENT),
+    ({"type": "QwenSDKError", "exception_type": "AttributeError"}, PERMANENT),
+    ({"type": "QwenSDKError", "exception_type": "ConnectionError"}, TRANSIENT),
+    ({"type": "QwenSDKError", "exception_type": "JSONDecodeError", "status_code": 502}, TRANSIENT),
+    ({"type": "QwenSDKError", "exception_type": "JSONDecodeError", "status_code": 400}, PERMANENT),
+])
+def test_classify_error(error, expected):
+    assert classify_error(error) == expected
+
+
+def test_breaker_opens_after_threshold_and_recovers_via_half_open(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(resilience.time, 'monotonic', lambda: now[0])
+    breaker = CircuitBreaker("qwen", failure_threshold=3, recovery_seconds=10)
+    for _ in range(3):
+        assert breaker.allow()
+        breaker.record(TRANSIENT, "TimeoutError")
+    assert breaker.state == OPEN and not breaker.allow()
+
+    now[0] = 10.0
+    assert breaker.allow(), "恢复时间到后应放行一个探测调用"
+    assert breaker.state == HALF_OPEN and not breaker.allow()
+    breaker.record(None)
+    assert breaker.state == CLOSED and breaker.allow()
+
+
+def test_breaker_reopens_when_half_open_probe_fails(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(resilience.time, 'monotonic', lambda: now[0])
+    breaker = CircuitBreaker("qwen", failure_threshold=1, recovery_seconds=10)
+    breaker.record(TRANSIENT, "ConnectionError")
+    now[0] = 10.0
+    assert breaker.allow()
+    breaker.record(TRANSIENT, "ConnectionError")
+    assert breaker.state == OPEN and breaker.retry_after() == 10.0
+
+
+def test_request_errors_do_not_trip_breaker():
+    breaker = CircuitBreaker("gemini", failure_threshold=1)
+    breaker.record(REQUEST, "GeminiContentError")
+    assert breaker.state == CLOSED
+
+
+def test_invoke_llm_retries_transient_errors(monkeypatch):
+    monkeypatch.setattr(settings, 'ACTIVE_LLM_PROVIDER', 'ollama')
+    responses = [("错误：超时", {"type": "TimeoutError"}), ("错误：连接失败", {"type": "ConnectionError"}), ("成功", None)]
+    monkeypatch.setattr('meta_prompt_agent.core.agent.call_ollama_api',
+                        lambda prompt_content, messages_history=None: responses.pop(0))
+
+    assert invoke_llm("提示") == ("成功", None)
+    assert responses == []
+
+
+def test_fatal_error_fails_fast_without_retry(monkeypatch):
+    monkeypatch.setattr(settings, 'ACTIVE_LLM_PROVIDER', 'gemini')
+    calls = []
+    def mock_gemini(prompt_content, messages_history=None):
+        calls.append(prompt_content)
+        return "错误：Gemini API 密钥未配置。", {"type": "ConfigurationError"}
+    monkeypatch.setattr('meta_prompt_agent.core.agent.call_gemini_api', mock_gemini)
+
+    first = invoke_llm("提示")
+    second = invoke_llm("提示")
+
+    assert first[1]["type"] == "ConfigurationError"
+    assert second[1]["type"] == "CircuitOpenError" and second[1]["last_error_type"] == "ConfigurationError"
+    assert len(calls) == 1, "已知的错误配置不应被重试，也不应被后续请求再次调用"
+
+
+def test_retry_budget_is_shared_across_a_request(monkeypatch):
+    monkeypatch.setattr(settings, 'ACTIVE_LLM_PROVIDER', 'ollama')
+    monkeypatch.setattr(settings, 'LLM_RETRY_BUDGET_PER_REQUEST', 1)
+    monkeypatch.setattr(settings, 'LLM_BREAKER_FAILURE_THRESHOLD', 100)
+    calls = []
+    def mock_ollama(prompt_content, messages_history=None):
+        calls.append(prompt_content)
+        return "错误：超时", {"type": "TimeoutError"}
+    monkeypatch.setattr('meta_prompt_agent.core.agent.call_ollama_api', mock_ollama)
+
+    results = generate_and_refine_prompt("写诗", "通用/问答", False, 0)
+
+    assert results["error_details"]["type"] == "TimeoutError"
+    assert len(calls) == 2, "整个请求只允许一次重试"
+
+
+def test_invoke_llm_async_retries_with_backoff(monkeypatch):
+    monkeypatch.setattr(settings, 'ACTIVE_LLM_PROVIDER', 'ollama')
+    monkeypatch.setattr(settings, 'LLM_RETRY_BASE_DELAY', 0.01)
+    delays = []
+    real_sleep = asyncio.sleep
+    async def recording_sleep(delay):
+        delays.append(delay)
+        await real_sleep(0)
+    monkeypatch.setattr(resilience.asyncio, 'sleep', recording_sleep)
+    responses = [("错误：超时", {"type": "TimeoutError"}), ("成功", None)]
+    async def mock_ollama(prompt_content, messages_history=None):
+        return responses.pop(0)
+    monkeypatch.setattr('meta_prompt_agent.core.agent.call_ollama_api_async', mock_ollama)
+
+    assert asyncio.run(invoke_llm_async("提示")) == ("成功", None)
+    assert len(delays) == 1 and 0 <= delays[0] <= 0.01
@@ -0,0 +1,141 @@
+# tests/unit/test_response_cache.py
+import asyncio
+import threading
+
+import pytest
+
+from meta_prompt_agent.config import settings
+from meta_prompt_agent.core import response_cache
+from meta_prompt_agent.core.agent import invoke_llm, invoke_llm_async
+from meta_prompt_agent.core.response_cache import ResponseCache, make_cache_key
+
+
+@pytest.fixture(autouse=True)
+def reset_default_cache():
+    response_cache.reset_response_cache()
+    yield
+    response_cache.reset_response_cache()
+
+
+def test_make_cache_key_is_stable_and_content_addressed():
+    messages = [{"role": "user", "content": "你好"}]
+    key = make_cache_key("qwen", "qwen-plus", messages, {"temperature": 0.2})
+    assert key == make_cache_key("qwen", "qwen-plus", [{"content": "你好", "role": "user"}], {"temperature": 0.2})
+    assert key != make_cache_key("qwen", "qwen-max", messages, {"temperature": 0.2})
+    assert key != make_cache_key("qwen", "qwen-plus", messages, {"temperature": 0.7})
+
+
+def test_memory_lru_eviction():
+    cache = ResponseCache(max_entries=2, ttl_seconds=0)
+    cache.put("a", "A")
+    cache.put("b", "B")
+    assert cache.get("a") == "A" # a 变为最近使用
+    cache.put("c", "C")          # 淘汰 b
+    assert cache.get("b") is None
+    assert cache.get("a") == "A" and cache.get("c") == "C"
+    stats = cache.stats()
+    assert stats["evictions"] == 1 and stats["memory_hits"] == 3 and stats["misses"] == 1
+
+
+def test_ttl_expiration(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(response_cache.time, 'time', lambda: now[0])
+    cache = ResponseCache(max_entries=10, ttl_seconds=60)
+    cache.put("k", "v")
+    now[0] += 61
+    assert cache.get("k") is None
+    assert cache.stats()["expirations"] == 1
+
+
+def test_disk_tier_survives_new_instance_and_is_bounded(tmp_path):
+    cache = ResponseCache(max_entries=1, ttl_seconds=0, disk_dir=str(tmp_path), disk_max_entries=2)
+    cache.put("aa11", "first")
+    cache.put("bb22", "second")
+    cache.put("cc33", "third") # 磁盘层超过上限，淘汰最旧的 aa11
+
+    fresh = ResponseCache(max_entries=10, ttl_seconds=0, disk_dir=str(tmp_path), disk_max_entries=2)
+    assert fresh.get("aa11") is None
+    assert fresh.get("bb22") == "second"
+    assert fresh.stats()["disk_hits"] == 1
+    assert fresh.get("bb22") == "second"
+    assert fresh.stats()["memory_hits"] == 1, "磁盘命中后应提升到内存层"
+
+
+def test_disk_entries_written_by_another_process_after_index_load_are_read(tmp_path):
+    worker_a = ResponseCache(max_entries=10, ttl_seconds=0, disk_dir=str(tmp_path))
+    worker_b = ResponseCache(max_entries=10, ttl_seconds=0, disk_dir=str(tmp_path))
+    assert worker_a.get("dd44") is None # 此时 worker_a 已加载磁盘索引
+
+    worker_b.put("dd44", "shared")
+
+    assert worker_a.get("dd44") == "shared"
+    assert worker_a.stats()["disk_hits"] == 1 and worker_a.stats()["disk_entries"] == 1
+
+
+def test_malformed_disk_entry_is_treated_as_miss_and_removed(tmp_path):
+    cache = ResponseCache(max_entries=10, ttl_seconds=60, disk_dir=str(tmp_path))
+    for key, content in (("ee55", '{"unexpected": 1}'), ("ff66", '["not", "an", "entry"]'), ("ab77", '{"created_at": "x", "value": "v"}')):
+        path = tmp_path / key[:2] / f"{key}.json"
+        path.parent.mkdir(exist_ok=True)
+        path.write_text(content, encoding="utf-8")
+
+        assert cache.get(key) is None
+        assert not path.exists()
+
+
+def test_invoke_llm_uses_cache_and_supports_opt_out(monkeypatch):
+    monkeypatch.setattr(settings, 'LLM_CACHE_ENABLED', True)
+    monkeypatch.setattr(settings, 'LLM_CACHE_DIR', None)
+    monkeypatch.setattr(settings, 'ACTIVE_LLM_PROVIDER', 'ollama')
+    calls = []
+    def mock_call_ollama(prompt_content, messages_history=None):
+        calls.append(prompt_content)
+        return f"response-{len(calls)}", None
+    monkeypatch.setattr('meta_prompt_agent.core.agent.call_ollama_api', mock_call_ollama)
+
+    assert invoke_llm("同一个提示") == ("response-1", None)
+    assert invoke_llm("同一个提示") == ("response-1", None)
+    assert len(calls) == 1
+    assert invoke_llm("同一个提示", use_cache=False) == ("response-2", None)
+    assert len(calls) == 2
+    assert invoke_llm("同一个提示") == ("response-2", None), "跳过缓存得到的新结果应写回缓存"
+
+
+def test_invoke_llm_does_not_cache_errors(monkeypatch):
+    monkeypatch.setattr(settings, 'LLM_CACHE_ENABLED', True)
+    monkeypatch.setattr(settings, 'LLM_CACHE_DIR', None)
+    monkeypatch.setattr(settings, 'ACTIVE_LLM_PROVIDER', 'ollama')
+    monkeypatch.setattr(settings, 'LLM_RETRY_MAX_ATTEMPTS', 1)
+    calls = []
+    def mock_failing_ollama(prompt_content, messages_history=None):
+        calls.append(True)
+        return "错误：超时", {"type": "TimeoutError"}
+    monkeypatch.setattr('meta_prompt_agent.core.agent.call_ollama_api', mock_failing_ollama)
+    invoke_llm("提示")
+    invoke_llm("提示")
+    assert len(calls) == 2
+
+
+def test_invoke_llm_async_runs_disk_cache_io_off_the_event_loop(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, 'LLM_CACHE_ENABLED', True)
+    monkeypatch.setattr(settings, 'LLM_CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(settings, 'ACTIVE_LLM_PROVIDER', 'ollama')
+    io_threads = []
+    for name in ("get", "put"):
+        original = getattr(ResponseCache, name)
+        def recording(self, *args, _original=original, **kwargs):
+            io_threads.append(threading.get_ident())
+            return _original(self, *args, **kwargs)
+        monkeypatch.setattr(ResponseCache, name, recording)
+    async def mock_call_ollama_async(prompt_content, messages_history=None):
+        return "异步响应", None
+    monkeypatch.setattr('meta_prompt_agent.core.agent.call_ollama_api_async', mock_call_ollama_async)
+
+    async def run():
+        first = await invoke_llm_async("同一个提示")
+        second = await invoke_llm_async("同一个提示")
+        return first, second, threading.get_ident()
+    first, second, loop_thread = asyncio.run(run())
+
+    assert first == second == ("异步响应", None)
+    assert len(io_threads) == 3 and loop_thread not in io_threads # 未命中读取、写入、命中读取
@@ -0,0 +1,93 @@
+# tests/unit/test_service_metrics.py
+import json
+import os
+
+from meta_prompt_agent.config import settings
+from meta_prompt_agent.core import service_metrics
+from meta_prompt_agent.core.agent import invoke_llm
+from meta_prompt_agent.core.service_metrics import Counter, Gauge, Histogram
+
+_DEAD_PID = 4194304 + 1 # 超过 Linux pid_max 的进程号，一定不存在
+
+
+def test_render_latest_formats_counters_and_cumulative_histograms(monkeypatch):
+    monkeypatch.setattr(settings, 'METRICS_MULTIPROC_DIR', None)
+    counter = Counter("test_events_total", "测试计数", ("kind",))
+    histogram = Histogram("test_duration_seconds", "测试耗时", buckets=(0.1, 1))
+    counter.inc(kind='a"b')
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+    monkeypatch.setattr(service_metrics, '_METRICS', (counter, histogram))
+
+    text = service_metrics.render_latest()
+
+    assert 'test_events_total{kind="a\\"b"} 1' in text
+    assert 'test_duration_seconds_bucket{le="0.1"} 1' in text
+    assert 'test_duration_seconds_bucket{le="1"} 2' in text
+    assert 'test_duration_seconds_bucket{le="+Inf"} 3' in text
+    assert "test_duration_seconds_count 3" in text
+    assert "# TYPE test_duration_seconds histogram" in text
+
+
+def test_multiprocess_snapshots_sum_counters_and_drop_gauges_of_exited_workers(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, 'METRICS_MULTIPROC_DIR', str(tmp_path))
+    counter = Counter("test_requests_total", "测试计数")
+    gauge = Gauge("test_in_flight", "测试仪表盘")
+    counter.inc(2)
+    gauge.inc()
+    monkeypatch.setattr(service_metrics, '_METRICS', (counter, gauge))
+    monkeypatch.setattr(service_metrics, '_runtime_samples', lambda: iter(()))
+    (tmp_path / f"worker-{_DEAD_PID}.json").write_text(json.dumps({"pid": _DEAD_PID, "metrics": {
+        "test_requests_total": {"type": "counter", "help": "测试计数", "labels": [], "samples": [[[], 3]]},
+        "test_in_flight": {"type": "gauge", "help": "测试仪表盘", "labels": [], "samples": [[[], 7]], "live_only": True},
+    }}), encoding="utf-8")
+
+    text = service_metrics.render_latest()
+
+    assert "test_requests_total 5" in text
+    assert "test_in_flight 1" in text
+
+
+def test_reused_pid_does_not_overwrite_or_revive_an_exited_worker(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, 'METRICS_MULTIPROC_DIR', str(tmp_path))
+    counter = Counter("test_requests_total", "测试计数")
+    gauge = Gauge("test_in_flight", "测试仪表盘")
+    counter.inc(2)
+    monkeypatch.setattr(service_metrics, '_METRICS', (counter, gauge))
+    monkeypatch.setattr(service_metrics, '_runtime_samples', lambda: iter(()))
+    # 一个已退出的 worker 使用过与当前进程相同的进程号，文件名中的实例标识不同
+    old_instance = f"{os.getpid()}-1-deadbeef"
+    (tmp_path / f"worker-{old_instance}.json").write_text(json.dumps({
+        "pid": os.getpid(), "instance": old_instance, "written_at": 1.0, "metrics": {
+            "test_requests_total": {"type": "counter", "help": "测试计数", "labels": [], "samples": [[[], 3]]},
+            "test_in_flight": {"type": "gauge", "help": "测试仪表盘", "labels": [], "samples": [[[], 7]], "live_only": True},
+        }}), encoding="utf-8")
+
+    text = service_metrics.render_latest()
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted([f"worker-{old_instance}.json", f"worker-{service_metrics._instance_id()}.json"])
+    assert "test_requests_total 5" in text
+    assert "test_in_flight 7" not in text # 快照长期未刷新，仪表盘不再计入
+
+
+def test_invoke_llm_records_latency_tokens_and_error_types(monkeypatch):
+    service_metrics.reset()
+    monkeypatch.setattr(settings, 'ACTIVE_LLM_PROVIDER', 'ollama')
+    monkeypatch.setattr(settings, 'LLM_ROUTER_PROVIDERS', [])
+    monkeypatch.setattr(settings, 'LLM_CACHE_ENABLED', False)
+    monkeypatch.setattr(settings, 'LLM_RETRY_MAX_ATTEMPTS', 1)
+    responses = iter([("好的", None), ("错误：超时", {"type": "TimeoutError"})])
+    monkeypatch.setattr('meta_prompt_agent.core.agent.call_ollama_api', lambda prompt_content, messages_history=None: next(responses))
+
+    invoke_llm("第一次")
+    invoke_llm("第二次")
+
+    labels = {"provider": "ollama", "model": settings.OLLAMA_MODEL}
+    latency = service_metrics.LLM_LATENCY.snapshot()["samples"]
+    assert latency == [[[labels["provider"], labels["model"]], latency[0][1]]] and latency[0][1]["count"] == 2
+    errors = dict((tuple(k), v) for k, v in service_metrics.LLM_ERRORS.snapshot()["samples"])
+    assert errors == {("ollama", "TimeoutError"): 1}
+    tokens = dict((tuple(k), v) for k, v in service_metrics.LLM_TOKENS.snapshot()["samples"])
+    assert tokens[("ollama", settings.OLLAMA_MODEL, "output")] == 2 # 未返回用量时按本地估算
+    assert dict((tuple(k), v) for k, v in service_metrics.LLM_IN_FLIGHT.snapshot()["samples"]) == {("ollama",): 0}
@@ -0,0 +1,136 @@
+# tests/unit/test_single_flight.py
+import asyncio
+import threading
+import time
+
+import pytest
+
+from meta_prompt_agent.config import settings
+from meta_prompt_agent.core import single_flight
+from meta_prompt_agent.core.agent import invoke_llm, invoke_llm_async
+from meta_prompt_agent.core.single_flight import AsyncSingleFlight, SingleFlight
+
+
+@pytest.fixture(autouse=True)
+def reset_stats():
+    single_flight.reset_coalescing_stats()
+    yield
+    single_flight.reset_coalescing_stats()
+
+
+def _run_concurrently(n, target):
+    barrier = threading.Barrier(n)
+    results = [None] * n
+    def worker(i):
+        barrier.wait()
+        results[i] = target()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return results
+
+
+def test_sync_single_flight_shares_one_call():
+    group = SingleFlight()
+    calls = []
+    def slow_call():
+        calls.append(1)
+        time.sleep(0.1)
+        return "结果", None
+
+    results = _run_concurrently(8, lambda: group.do("key", slow_call))
+
+    assert len(calls) == 1
+    assert results == [("结果", None)] * 8
+    stats = group.stats()
+    assert stats["leaders"] == 1 and stats["coalesced"] == 7 and stats["in_flight"] == 0
+
+
+def test_sync_single_flight_failure_is_shared_once_and_not_retained():
+    group = SingleFlight()
+    calls = []
+    def failing_call():
+        calls.append(1)
+        time.sleep(0.1)
+        return "错误：超时", {"type": "TimeoutError"}
+
+    results = _run_concurrently(4, lambda: group.do("key", failing_call))
+
+    assert len(calls) == 1
+    assert all(error == {"type": "TimeoutError"} for _, error in results)
+    assert group.stats()["shared_failures"] == 3
+    # 失败结果不会被保留：之后的调用重新发起请求
+    group.do("key", failing_call)
+    assert len(calls) == 2
+
+
+def test_sync_single_flight_propagates_exception_to_followers():
+    group = SingleFlight()
+    def broken_call():
+        time.sleep(0.1)
+        raise RuntimeError("boom")
+    def call():
+        try:
+            return group.do("key", broken_call)
+        except RuntimeError as e:
+            return str(e)
+
+    assert _run_concurrently(3, call) == ["boom"] * 3
+    assert group.in_flight() == 0
+
+
+def test_async_single_flight_shares_one_call_and_survives_leader_cancel():
+    group = AsyncSingleFlight()
+    calls = []
+    async def slow_call():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "结果", None
+
+    async def main():
+        leader = asyncio.create_task(group.do("key", slow_call))
+        await asyncio.sleep(0)
+        followers = [asyncio.create_task(group.do("key", slow_call)) for _ in range(5)]
+        await asyncio.sleep(0)
+        leader.cancel()
+        return await asyncio.gather(*followers)
+
+    results = asyncio.run(main())
+
+    assert len(calls) == 1
+    assert results == [("结果", None)] * 5
+    assert group.stats()["coalesced"] == 5 and group.in_flight() == 0
+
+
+def test_invoke_llm_coalesces_identical_concurrent_calls(monkeypatch):
+    monkeypatch.setattr(settings, 'ACTIVE_LLM_PROVIDER', 'ollama')
+    calls = []
+    def mock_call_ollama_api(prompt_content, messages_history=None):
+        calls.append(prompt_content)
+        time.sleep(0.1)
+        return f"回复: {prompt_content}", None
+    monkeypatch.setattr('meta_prompt_agent.core.agent.call_ollama_api', mock_call_ollama_api)
+
+    results = _run_concurrently(6, lambda: invoke_llm("相同的提示"))
+    fresh = invoke_llm("相同的提示", use_cache=False)
+
+    assert calls == ["相同的提示", "相同的提示"]
+    assert results == [("回复: 相同的提示", None)] * 6 and fresh == results[0]
+    assert single_flight.get_coalescing_stats()["sync"]["coalesced"] == 5
+
+
+def test_invoke_llm_async_coalescing_can_be_disabled(monkeypatch):
+    monkeypatch.setattr(settings, 'ACTIVE_LLM_PROVIDER', 'ollama')
+    monkeypatch.setattr(settings, 'LLM_SINGLE_FLIGHT_ENABLED', False)
+    calls = []
+    async def mock_call_ollama_api_async(prompt_content, messages_history=None):
+        calls.append(prompt_content)
+        await asyncio.sleep(0.01)
+        return "回复", None
+    monkeypatch.setattr('meta_prompt_agent.core.agent.call_ollama_api_async', mock_call_ollama_api_async)
+
+    async def main():
+        return await asyncio.gather(*(invoke_llm_async("相同的提示") for _ in range(3)))
+
+    assert asyncio.run(main()) == [("回复", None)] * 3
+    assert len(calls) == 3
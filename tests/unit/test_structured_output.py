@@ -0,0 +1,94 @@
+# tests/unit/test_structured_output.py
+import json
+
+from meta_prompt_agent.config import settings
+from meta_prompt_agent.core import structured_output, transport
+from meta_prompt_agent.core.agent import call_ollama_api, generate_and_refine_prompt
+from meta_prompt_agent.core.structured_output import parse_json_object, repair_json
+from meta_prompt_agent.prompts.templates import EVALUATION_REPORT_SCHEMA
+
+
+class MockResponse:
+    def __init__(self, json_data):
+        self._json = json_data
+        self.status_code = 200
+
+    def json(self):
+        return self._json
+
+    def raise_for_status(self):
+        pass
+
+
+def test_parse_json_object_strict_json_is_not_repaired():
+    assert parse_json_object('```json\n{"a": 1}\n```') == ({"a": 1}, False)
+
+
+def test_parse_json_object_repairs_prose_comments_and_trailing_commas():
+    text = '好的，这是评估报告：\n{\n  // 总结\n  "a": [1, 2,], /* 备注 */\n  "b": True,\n  "c": None,\n}\n希望对您有帮助。'
+    assert parse_json_object(text) == ({"a": [1, 2], "b": True, "c": None}, True)
+
+
+def test_parse_json_object_repairs_raw_newlines_in_strings():
+    data, repaired = parse_json_object('{"text": "第一行\n第二行"}')
+    assert repaired and data == {"text": "第一行\n第二行"}
+
+
+def test_repair_json_closes_truncated_output():
+    assert json.loads(repair_json('{"summary": {"score": 4, "notes": "未完')) == {"summary": {"score": 4, "notes": "未完"}}
+    assert json.loads(repair_json('{"a": [1, 2, ')) == {"a": [1, 2]}
+    assert json.loads(repair_json('{"a": 1, "b":')) == {"a": 1, "b": None}
+    assert json.loads(repair_json('{"a": 1, "b"')) == {"a": 1, "b": None}
+
+
+def test_parse_json_object_ignores_brackets_and_braces_in_leading_prose():
+    text = 'Scores use a [1-5] scale. Report: {"evaluation_summary": {"overall_score": 4}}'
+    assert parse_json_object(text) == ({"evaluation_summary": {"overall_score": 4}}, True)
+
+    text = '占位符写作 {name}，评分范围 [1-5]。报告：{"evaluation_summary": {"overall_score": 3}, "notes": "未完'
+    assert parse_json_object(text) == ({"evaluation_summary": {"overall_score": 3}, "notes": "未完"}, True)
+
+
+def test_parse_json_object_without_json_returns_none():
+    assert parse_json_object("这不是JSON") == (None, False)
+    assert parse_json_object("[1, 2]") == (None, False)
+
+
+def test_to_gemini_schema_uppercases_types_and_drops_unsupported_keys():
+    converted = structured_output.to_gemini_schema(
+        {"type": "object", "additionalProperties": False, "properties": {"s": {"type": "array", "items": {"type": "string"}}}}
+    )
+    assert converted == {"type": "OBJECT", "properties": {"s": {"type": "ARRAY", "items": {"type": "STRING"}}}}
+
+
+def test_call_ollama_api_sends_format_only_inside_schema_context(monkeypatch):
+    payloads = []
+    def mock_post(*args, **kwargs):
+        payloads.append(json.loads(kwargs["data"]))
+        return MockResponse({"message": {"content": "{}"}})
+    monkeypatch.setattr(transport, 'post', mock_post)
+
+    call_ollama_api("普通请求")
+    call_ollama_api("评估", [], response_schema=EVALUATION_REPORT_SCHEMA)
+
+    assert "format" not in payloads[0]
+    assert payloads[1]["format"] == EVALUATION_REPORT_SCHEMA
+
+
+def test_pipeline_requests_schema_for_evaluation_and_parses_repaired_report(monkeypatch):
+    monkeypatch.setattr(settings, "LLM_STRUCTURED_OUTPUT_ENABLED", True)
+    seen = []
+    def mock_invoke_llm(prompt_content_sent, messages_history=None):
+        seen.append((messages_history, structured_output.current_response_schema()))
+        if messages_history == []:
+            return '评估如下：{"evaluation_summary": {"overall_score": 3,}, "suggestions_for_improvement": ["更具体"', None
+        return "P1", None
+    monkeypatch.setattr('meta_prompt_agent.core.agent.invoke_llm', mock_invoke_llm)
+
+    results = generate_and_refine_prompt("写一首诗", "通用/问答", enable_self_correction=True, max_recursion_depth=1)
+
+    assert seen[0] == (None, None)
+    assert seen[1] == ([], EVALUATION_REPORT_SCHEMA)
+    assert all(schema is None for history, schema in seen[2:])
+    assert results["evaluation_reports"][0]["evaluation_summary"]["overall_score"] == 3
+    assert results["evaluation_reports"][0]["suggestions_for_improvement"] == ["更具体"]
@@ -0,0 +1,205 @@
+# tests/unit/test_template_registry.py
+import asyncio
+import json
+import os
+
+import pytest
+
+from meta_prompt_agent.config import settings
+from meta_prompt_agent.core import template_registry
+from meta_prompt_agent.core.template_registry import TemplateError, TemplateRegistry, TemplateStore, compile_template
+from meta_prompt_agent.prompts.templates import STRUCTURED_PROMPT_TEMPLATES
+
+
+def _template(source: str, variables: list | None = None, task_type: list | None = None) -> dict:
+    return {"task_type": task_type or ["通用"], "description": "测试模板", "core_template_override": source, "variables": variables or []}
+
+
+def test_render_matches_str_format_for_every_builtin_template():
+    registry = template_registry.get_registry()
+    for name, data in STRUCTURED_PROMPT_TEMPLATES.items():
+        values = {var: f"<{var}>" for var in data["variables"]}
+        values["user_raw_request"] = "用户请求 {不是占位符}"
+        assert registry.get(name).render(values) == data["core_template_override"].format(**values)
+
+
+def test_compile_keeps_escaped_braces_and_records_placeholders():
+    template = compile_template("Json", _template('输出 {{"topic": "{topic}"}}\n请求: {user_raw_request}', ["topic"]))
+
+    assert template.placeholders == {"topic", "user_raw_request"}
+    assert template.render({"topic": "黑洞", "user_raw_request": "解释"}) == '输出 {"topic": "黑洞"}\n请求: 解释'
+
+
+@pytest.mark.parametrize("source, variables, message", [
+    ("{0}", [], "具名占位符"),
+    ("{user.name}", [], "具名占位符"),
+    ("{topic!r}", ["topic"], "格式说明"),
+    ("{topic:>10}", ["topic"], "格式说明"),
+    ("{topic} {audience}", ["topic"], "未在 'variables' 中声明"),
+    ("{topic}", ["topic", "audience"], "未在模板中使用"),
+    ("{topic", ["topic"], "花括号不匹配"),
+])
+def test_compile_rejects_malformed_templates(source, variables, message):
+    with pytest.raises(TemplateError, match=message):
+        compile_template("Bad", _template(source, variables))
+
+
+def test_registry_reports_all_invalid_templates_at_once():
+    with pytest.raises(TemplateError) as excinfo:
+        TemplateRegistry({
+            "Good": _template("{user_raw_request}"),
+            "NoSource": {"task_type": ["通用"], "variables": []},
+            "Undeclared": _template("{topic}"),
+        })
+
+    assert "NoSource" in str(excinfo.value) and "Undeclared" in str(excinfo.value)
+    assert "Good" not in str(excinfo.value)
+
+
+def test_task_type_index_preserves_definition_order():
+    registry = TemplateRegistry({
+        "A": _template("{user_raw_request}", task_type=["问答", "通用"]),
+        "B": _template("{user_raw_request}", task_type=["研究"]),
+        "C": _template("{user_raw_request}", task_type=["问答"]),
+    })
+
+    assert [t.name for t in registry.for_task_type("问答")] == ["A", "C"]
+    assert registry.for_task_type("不存在") == []
+    assert registry.to_dict("研究")["task_types"] == {"研究": ["B"]}
+
+
+def test_missing_variables_treats_blank_values_as_missing():
+    template = compile_template("T", _template("{topic} {audience}", ["topic", "audience"]))
+
+    assert template.missing_variables({"topic": "  ", "extra": "x"}) == ["topic", "audience"]
+    assert template.missing_variables({"topic": "黑洞", "audience": "学生"}) == []
+
+
+def test_snapshot_etag_is_stable_and_content_addressed():
+    templates = {"A": _template("{user_raw_request}"), "B": _template("{user_raw_request}", task_type=["研究"])}
+    body, etag = TemplateRegistry(templates).snapshot()
+
+    assert TemplateRegistry(templates).snapshot() == (body, etag)
+    assert TemplateRegistry({**templates, "C": _template("{user_raw_request}")}).snapshot()[1] != etag
+    assert TemplateRegistry(templates).snapshot("研究")[1] != etag
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, False), ('"abc"', True), ('W/"abc"', True), ('"x", "abc"', True), ("*", True), ('"x"', False),
+])
+def test_etag_matches(header, expected):
+    assert template_registry.etag_matches(header, '"abc"') is expected
+
+
+# --- 外部模板目录 ---
+def _write(path, text: str, mtime_ns: int | None = None):
+    path.write_text(text, encoding="utf-8")
+    if mtime_ns is not None:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_store_merges_json_toml_and_yaml_files_over_builtin_templates(tmp_path):
+    _write(tmp_path / "qa.json", json.dumps({"DefaultQnA": _template("新版: {user_raw_request}", task_type=["问答"])}))
+    _write(tmp_path / "research.toml", '[Survey]\ntask_type = ["研究"]\ncore_template_override = "综述 {topic}"\nvariables = ["topic"]\n')
+    _write(tmp_path / "image.yaml", "Poster:\n  task_type: [图像生成]\n  core_template_override: '海报 {user_raw_request}'\n")
+    _write(tmp_path / "notes.txt", "不是模板文件")
+
+    registry = TemplateStore(str(tmp_path), STRUCTURED_PROMPT_TEMPLATES, check_interval_seconds=0).current()
+
+    assert registry.get("DefaultQnA").render({"user_raw_request": "问"}) == "新版: 问"
+    assert registry.get("Survey").render({"topic": "黑洞"}) == "综述 黑洞"
+    assert registry.get("Poster") is not None and "ExplainConcept" in registry
+
+
+def test_store_reports_unsupported_files_and_missing_pyyaml(tmp_path, monkeypatch):
+    _write(tmp_path / "qa.json", json.dumps({"A": _template("{user_raw_request}")}))
+    _write(tmp_path / "notes.txt", "不是模板文件")
+    _write(tmp_path / ".qa.json.swp", "编辑器临时文件")
+
+    store = TemplateStore(str(tmp_path), check_interval_seconds=0)
+    assert store.stats()["unsupported_files"] == ["notes.txt"]
+
+    monkeypatch.setattr(template_registry, "yaml", None)
+    _write(tmp_path / "image.yaml", "Poster:\n  core_template_override: '海报 {user_raw_request}'\n")
+    assert store.refresh() is False
+    assert "meta_prompt[yaml]" in store.stats()["last_error"]
+
+
+def test_store_reparses_only_changed_files_and_swaps_registry(tmp_path, monkeypatch):
+    _write(tmp_path / "a.json", json.dumps({"A": _template("A1 {user_raw_request}")}), mtime_ns=1_000_000_000)
+    _write(tmp_path / "b.json", json.dumps({"B": _template("B {user_raw_request}")}), mtime_ns=1_000_000_000)
+    store = TemplateStore(str(tmp_path), check_interval_seconds=0)
+    old_registry = store.current()
+    parsed = []
+    original_parse = template_registry._parse_template_file
+    monkeypatch.setattr(template_registry, "_parse_template_file", lambda path, data: parsed.append(path) or original_parse(path, data))
+
+    os.utime(tmp_path / "b.json", ns=(2_000_000_000, 2_000_000_000)) # 只 touch：重新读取但内容哈希不变，不解析
+    assert store.refresh() is False
+    _write(tmp_path / "a.json", json.dumps({"A": _template("A2 {user_raw_request}")}), mtime_ns=3_000_000_000)
+    new_registry = store.current()
+
+    assert parsed == [str(tmp_path / "a.json")]
+    assert new_registry is not old_registry and store.reloads == 1
+    assert old_registry.get("A").render({"user_raw_request": "x"}) == "A1 x" # 进行中的请求继续使用旧注册表
+    assert new_registry.get("A").render({"user_raw_request": "x"}) == "A2 x"
+    assert new_registry.get("A").version != old_registry.get("A").version
+    assert new_registry.get("B").version == old_registry.get("B").version
+
+
+def test_store_keeps_current_registry_when_update_is_invalid(tmp_path):
+    _write(tmp_path / "a.json", json.dumps({"A": _template("{user_raw_request}")}), mtime_ns=1_000_000_000)
+    store = TemplateStore(str(tmp_path), check_interval_seconds=0)
+    registry = store.current()
+
+    _write(tmp_path / "a.json", '{"A": {', mtime_ns=2_000_000_000)
+    assert store.current() is registry
+    _write(tmp_path / "a.json", json.dumps({"A": _template("{topic}")}), mtime_ns=3_000_000_000)
+    assert store.current() is registry
+
+    assert store.reload_errors == 2 and "topic" in store.stats()["last_error"]
+
+
+def test_store_rejects_invalid_templates_at_startup(tmp_path):
+    _write(tmp_path / "a.json", json.dumps({"A": _template("{user_raw_request}")}))
+    _write(tmp_path / "b.toml", '[A]\ncore_template_override = "{user_raw_request}"\n')
+
+    with pytest.raises(TemplateError, match="同时定义在"):
+        TemplateStore(str(tmp_path))
+    with pytest.raises(TemplateError, match="无法读取模板目录"):
+        TemplateStore(str(tmp_path / "missing"))
+
+
+def test_store_checks_files_at_most_once_per_interval(tmp_path):
+    _write(tmp_path / "a.json", json.dumps({"A": _template("A1 {user_raw_request}")}), mtime_ns=1_000_000_000)
+    store = TemplateStore(str(tmp_path), check_interval_seconds=3600)
+
+    _write(tmp_path / "a.json", json.dumps({"A": _template("A2 {user_raw_request}")}), mtime_ns=2_000_000_000)
+
+    assert store.current().get("A").source.startswith("A1")
+    assert store.refresh() is True and store.current().get("A").source.startswith("A2")
+
+
+def test_get_registry_follows_templates_dir_and_honours_pinning(tmp_path, monkeypatch):
+    _write(tmp_path / "extra.json", json.dumps({"Extra": _template("{user_raw_request}")}))
+    builtin = template_registry.get_registry()
+    monkeypatch.setattr(settings, "TEMPLATES_DIR", str(tmp_path))
+
+    assert "Extra" in template_registry.get_registry()
+    with template_registry.pinned(builtin):
+        assert template_registry.get_registry() is builtin
+    monkeypatch.setattr(settings, "TEMPLATES_DIR", None)
+    assert "Extra" not in template_registry.get_registry()
+
+
+def test_store_reloads_in_background_when_called_on_the_event_loop(tmp_path):
+    _write(tmp_path / "a.json", json.dumps({"A": _template("A1 {user_raw_request}")}), mtime_ns=1_000_000_000)
+    store = TemplateStore(str(tmp_path), check_interval_seconds=0)
+    _write(tmp_path / "a.json", json.dumps({"A": _template("A2 {user_raw_request}")}), mtime_ns=2_000_000_000)
+
+    async def current_on_loop():
+        return store.current()
+    assert asyncio.run(current_on_loop()).get("A").source.startswith("A1") # 不在事件循环上扫描目录
+    with store._lock: # 等待后台线程完成检查
+        pass
+    assert store.reloads == 1 and store.current().get("A").source.startswith("A2")
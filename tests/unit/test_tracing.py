@@ -0,0 +1,120 @@
+# tests/unit/test_tracing.py
+import json
+import logging
+
+import pytest
+
+from meta_prompt_agent.config import settings
+from meta_prompt_agent.core import response_cache, tracing
+from meta_prompt_agent.core.agent import generate_and_refine_prompt
+
+
+class _ListExporter:
+    def __init__(self):
+        self.spans = []
+
+    def export(self, spans):
+        self.spans.extend(spans)
+
+
+@pytest.fixture
+def exported(monkeypatch):
+    # 用内存导出器替换全局处理器，span 结束后立即刷新以便断言
+    exporter = _ListExporter()
+    processor = tracing.BatchSpanProcessor(exporter, interval_seconds=60)
+    monkeypatch.setattr(settings, 'TRACING_ENABLED', True)
+    monkeypatch.setattr(tracing, '_processor', processor)
+    monkeypatch.setattr(tracing, '_processor_configured', True)
+    yield lambda: (processor.force_flush(), exporter.spans)[1]
+    processor.shutdown()
+
+
+def test_child_spans_share_trace_and_link_to_parent(exported):
+    with tracing.start_span("parent") as parent:
+        with tracing.start_span("child", attributes={"skipped": None}) as child:
+            assert tracing.current_trace_id() == parent.trace_id
+    assert tracing.current_span() is None
+
+    spans = {span.name: span for span in exported()}
+    assert spans["child"].trace_id == spans["parent"].trace_id
+    assert spans["child"].parent_id == parent.span_id
+    assert "skipped" not in child.attributes
+
+
+def test_traceparent_header_continues_remote_trace(exported):
+    header = "00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01"
+
+    with tracing.start_span("server", tracing.KIND_SERVER, traceparent=header) as span:
+        pass
+
+    assert (span.trace_id, span.parent_id) == ("4bf92f3577b34da6a3ce929d0e0e4736", "00f067aa0ba902b7")
+    assert tracing.parse_traceparent("00-" + "0" * 32 + "-00f067aa0ba902b7-01") is None
+    assert tracing.parse_traceparent("不是有效的请求头") is None
+
+
+def test_disabled_tracing_yields_no_span(monkeypatch):
+    monkeypatch.setattr(settings, 'TRACING_ENABLED', False)
+    with tracing.start_span("noop") as span:
+        assert span is None
+
+
+def test_file_exporter_writes_json_lines(tmp_path):
+    path = tmp_path / "traces" / "spans.jsonl"
+    span = tracing.Span("op", "a" * 32, None, attributes={"llm.model": "qwen"})
+    span.end_ns = span.start_ns + 1_000_000
+
+    tracing.FileSpanExporter(str(path)).export([span])
+
+    [record] = [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+    assert record["name"] == "op" and record["duration_ms"] == 1.0
+    assert record["attributes"] == {"llm.model": "qwen"}
+    otlp_span = tracing.to_otlp_json([span])["resourceSpans"][0]["scopeSpans"][0]["spans"][0]
+    assert otlp_span["attributes"] == [{"key": "llm.model", "value": {"stringValue": "qwen"}}]
+
+
+def test_log_records_carry_trace_id(exported, caplog):
+    logger = logging.getLogger("test_tracing")
+    logger.addFilter(tracing.TraceContextFilter())
+    try:
+        with caplog.at_level(logging.INFO, logger="test_tracing"):
+            with tracing.start_span("op") as span:
+                logger.info("在 span 中")
+            logger.info("在 span 外")
+    finally:
+        logger.filters.clear()
+
+    assert [record.trace_id for record in caplog.records] == [span.trace_id, "-"]
+
+
+def test_pipeline_records_stage_and_provider_spans(monkeypatch, exported):
+    attempts = []
+    def mock_ollama(prompt_content, messages_history=None, response_schema=None):
+        attempts.append(prompt_content)
+        if len(attempts) == 1:
+            return "错误：超时", {"type": "TimeoutError"}
+        if messages_history == []:
+            return '{"evaluation_summary": {"overall_score": 3}}', None
+        return "优化后的提示", None
+    monkeypatch.setattr(settings, 'ACTIVE_LLM_PROVIDER', 'ollama')
+    monkeypatch.setattr(settings, 'LLM_ROUTER_PROVIDERS', [])
+    monkeypatch.setattr(settings, 'LLM_CACHE_ENABLED', False)
+    response_cache.reset_response_cache()
+    monkeypatch.setattr('meta_prompt_agent.core.agent.call_ollama_api', mock_ollama)
+
+    results = generate_and_refine_prompt("写一首诗", "通用/问答", enable_self_correction=True, max_recursion_depth=1)
+
+    spans = exported()
+    [root] = [span for span in spans if span.name == "generate_and_refine_prompt"]
+    assert results["trace_id"] == root.trace_id
+    assert all(span.trace_id == root.trace_id for span in spans)
+    stage_spans = [span for span in spans if span.name.startswith("pipeline.")]
+    assert sorted(span.name for span in stage_spans) == ["pipeline.evaluation", "pipeline.p1", "pipeline.refinement"]
+    assert all(span.parent_id == root.span_id for span in stage_spans)
+    [p1_span] = [span for span in stage_spans if span.name == "pipeline.p1"]
+    assert p1_span.attributes["llm.upstream_calls"] == 2 and p1_span.status == tracing.STATUS_OK
+    provider_spans = [span for span in spans if span.parent_id == p1_span.span_id]
+    assert [span.status for span in provider_spans] == [tracing.STATUS_ERROR, tracing.STATUS_OK]
+    assert provider_spans[0].attributes["error.type"] == "TimeoutError"
+    assert provider_spans[1].attributes["llm.model"] == settings.OLLAMA_MODEL
+    assert provider_spans[1].attributes["llm.output_tokens"] > 0
+    assert root.attributes["pipeline.stop_reason"] == results["stop_reason"]
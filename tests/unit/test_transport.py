@@ -0,0 +1,79 @@
+# tests/unit/test_transport.py
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from meta_prompt_agent.config import settings
+from meta_prompt_agent.core import transport
+
+
+class _KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # 支持 keep-alive
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        body = b'{"ok": true}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def local_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _KeepAliveHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/api/chat"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def clean_transport():
+    transport.close_all_sessions()
+    transport.reset_pool_stats()
+    yield
+    transport.close_all_sessions()
+    transport.reset_pool_stats()
+
+
+def test_post_reuses_keep_alive_connection(local_server):
+    for _ in range(3):
+        response = transport.post(local_server, provider="ollama", data="{}", timeout=5)
+        assert response.status_code == 200
+    stats = transport.get_pool_stats()["ollama"]
+    assert stats["requests"] == 3
+    assert stats["misses"] == 1, "只应新建一次连接，其余请求复用连接池"
+    assert stats["hits"] == 2
+
+
+def test_get_session_is_shared_per_provider():
+    assert transport.get_session("ollama") is transport.get_session("ollama")
+    assert transport.get_session("ollama") is not transport.get_session("qwen")
+
+
+def test_session_uses_provider_pool_size(monkeypatch):
+    monkeypatch.setitem(settings.HTTP_POOL_MAXSIZE_BY_PROVIDER, "ollama", 3)
+    adapter = transport.get_session("ollama").get_adapter("http://localhost:11434")
+    assert isinstance(adapter, transport.PooledHTTPAdapter)
+    assert adapter._pool_maxsize == 3
+
+
+def test_async_client_counts_pool_hits_and_misses(local_server):
+    async def run():
+        client = transport.get_async_client("qwen")
+        for _ in range(3):
+            response = await client.post(local_server, content=b"{}")
+            assert response.status_code == 200
+        await transport.aclose_async_clients()
+    asyncio.run(run())
+
+    assert transport.get_pool_stats()["qwen"] == {"requests": 3, "hits": 2, "misses": 1}